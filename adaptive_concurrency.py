@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+自适应并发限制（AIMD + 延迟梯度），包在 LLM 与图片 provider 的 HTTP 调用外层。
+
+- 每次调用占用一个名额（slot），并发数达到当前上限时排队等待；
+- 加性增：调用成功、延迟平稳且名额基本用满时，上限每轮 +1（每次成功 +1/limit）；
+- 乘性减：遇到 429 / 5xx / 超时时上限乘以 backoff（同一波错误在冷却期内只退让一次）；
+- 延迟梯度：短期平均延迟明显高于长期平均（超过 latency_tolerance 倍）时温和下调，
+  在上游真正开始报错之前就先减压（与乘性减一样，每个冷却期内最多下调一次）；
+- 同步调用用 slot()，asyncio 调用用 async_slot()，两者共用同一个上限与统计；
+- 当前上限、在途数、排队数、延迟等指标通过 get_concurrency_stats() 导出。
+"""
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict
+
+import requests
+
+try:
+    import httpx  # 可选：异步生成管线
+except ImportError:
+    httpx = None
+
+from cancellation import OperationCancelled, check_cancelled
+
+# ------------------------------
+# 自适应并发配置（可通过环境变量调节）
+# ------------------------------
+ADAPTIVE_CONCURRENCY_CONFIG = {
+    "llm_initial": int(os.getenv("LLM_CONCURRENCY_INITIAL", "4")),
+    "llm_min": int(os.getenv("LLM_CONCURRENCY_MIN", "1")),
+    "llm_max": int(os.getenv("LLM_CONCURRENCY_MAX", "16")),
+    # yunwu 图片接口限流严格，初始只放 1 个并发（与原 IMAGE_PARALLEL_MAX_WORKERS 默认一致），由控制器按表现上调
+    "image_initial": int(os.getenv("IMAGE_CONCURRENCY_INITIAL",
+                                   "1" if os.getenv("IMAGE_GENERATION_PROVIDER", "yunwu") == "yunwu" else "2")),
+    "image_min": int(os.getenv("IMAGE_CONCURRENCY_MIN", "1")),
+    "image_max": int(os.getenv("IMAGE_CONCURRENCY_MAX", "6")),
+    # 短期平均延迟超过长期平均的多少倍视为"延迟在上升"
+    "latency_tolerance": float(os.getenv("CONCURRENCY_LATENCY_TOLERANCE", "2.0")),
+    # 过载时上限乘以该系数
+    "backoff": float(os.getenv("CONCURRENCY_BACKOFF", "0.7")),
+}
+
+# 调用结果分类
+OUTCOME_SUCCESS = "success"
+OUTCOME_OVERLOAD = "overload"  # 429 / 5xx / 超时：需要退让
+OUTCOME_IGNORE = "ignore"  # 与上游负载无关（参数错误、认证失败、被取消等）
+
+
+def classify_exception(e: BaseException) -> str:
+    """把调用异常归类为过载信号或无关错误"""
+    if isinstance(e, OperationCancelled):
+        return OUTCOME_IGNORE
+    if isinstance(e, requests.exceptions.Timeout):
+        return OUTCOME_OVERLOAD
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return classify_status(e.response.status_code)
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return OUTCOME_OVERLOAD
+    if httpx is not None and isinstance(e, (httpx.TimeoutException, httpx.NetworkError)):
+        return OUTCOME_OVERLOAD
+    return OUTCOME_IGNORE
+
+
+def classify_status(status_code: int) -> str:
+    if status_code == 429 or status_code >= 500:
+        return OUTCOME_OVERLOAD
+    if 200 <= status_code < 300:
+        return OUTCOME_SUCCESS
+    return OUTCOME_IGNORE
+
+
+class _Slot:
+    """一次调用占用的名额；调用方可通过 observe_response 按 HTTP 状态码上报结果"""
+
+    __slots__ = ("outcome",)
+
+    def __init__(self):
+        self.outcome = None
+
+    def observe_response(self, response) -> None:
+        status_code = getattr(response, "status_code", None)
+        if status_code is not None:
+            self.outcome = classify_status(status_code)
+
+    def mark(self, outcome: str) -> None:
+        self.outcome = outcome
+
+
+class AdaptiveConcurrencyLimiter:
+    """单个上游的自适应并发上限"""
+
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int,
+                 latency_tolerance: float = 2.0, backoff: float = 0.7):
+        self.name = name
+        self.min_limit = max(1, minimum)
+        self.max_limit = max(self.min_limit, maximum)
+        self._limit = float(min(self.max_limit, max(self.min_limit, initial)))
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._waiting = 0
+        self._async_waiters = []  # [(事件循环, Future)]：名额释放时唤醒排队中的协程
+        self._short_latency = None  # 短期 EWMA（秒）
+        self._long_latency = None  # 长期 EWMA（秒）
+        self._last_backoff = 0.0
+        self._last_gradient_decrease = 0.0
+        self._stats = {"calls": 0, "successes": 0, "overloads": 0, "ignored": 0,
+                       "increases": 0, "decreases": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _acquire(self) -> float:
+        start = time.time()
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._inflight >= int(self._limit):
+                    # 分段等待，期间可响应取消令牌
+                    self._cond.wait(0.5)
+                    check_cancelled()
+            finally:
+                self._waiting -= 1
+            self._inflight += 1
+        return time.time() - start
+
+    async def _acquire_async(self) -> float:
+        start = time.time()
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._inflight < int(self._limit):
+                    self._inflight += 1
+                    return time.time() - start
+                wake = loop.create_future()
+                waiter = (loop, wake)
+                self._async_waiters.append(waiter)
+                self._waiting += 1
+            try:
+                # 名额释放时被唤醒；上限被调高时没有释放事件，因此仍分段重查
+                await asyncio.wait([wake], timeout=0.5)
+            finally:
+                with self._cond:
+                    self._waiting -= 1
+                    try:
+                        self._async_waiters.remove(waiter)
+                    except ValueError:
+                        pass
+
+    def _wake_async_waiters(self) -> None:
+        # 调用方需持有 self._cond
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, wake in waiters:
+            try:
+                loop.call_soon_threadsafe(_set_pending, wake)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _release(self, outcome: str, latency: float) -> None:
+        with self._cond:
+            self._inflight -= 1
+            self._stats["calls"] += 1
+            if outcome == OUTCOME_SUCCESS:
+                self._stats["successes"] += 1
+                self._on_success(latency)
+            elif outcome == OUTCOME_OVERLOAD:
+                self._stats["overloads"] += 1
+                self._on_overload()
+            else:
+                self._stats["ignored"] += 1
+            self._cond.notify_all()
+            self._wake_async_waiters()
+
+    def _on_success(self, latency: float) -> None:
+        # 调用方需持有 self._cond
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+        else:
+            self._short_latency += 0.3 * (latency - self._short_latency)
+            self._long_latency += 0.05 * (latency - self._long_latency)
+        if self._short_latency > self._long_latency * self.latency_tolerance:
+            # 延迟明显上升：温和下调，避免把上游推到报错；
+            # 短期均值回落前的每次成功都会命中这里，冷却期（约一次调用的耗时）内只下调一次，且刚退让过也不再下调
+            now = time.time()
+            if now - max(self._last_backoff, self._last_gradient_decrease) < self._cooldown():
+                return
+            self._last_gradient_decrease = now
+            new_limit = max(self.min_limit, self._limit * 0.9)
+            if int(new_limit) < int(self._limit):
+                self._stats["decreases"] += 1
+                print(f"📉 [{self.name}] 延迟上升（{self._short_latency:.1f}s / 基线 {self._long_latency:.1f}s），并发上限降至 {int(new_limit)}")
+            self._limit = new_limit
+        elif self._inflight + 1 >= int(self._limit) and time.time() - self._last_backoff >= self._cooldown():
+            # 名额基本用满且延迟平稳：加性增（约每轮 +1）；刚退让过的冷却期内不加
+            new_limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+            if int(new_limit) > int(self._limit):
+                self._stats["increases"] += 1
+                print(f"📈 [{self.name}] 延迟平稳，并发上限升至 {int(new_limit)}")
+            self._limit = new_limit
+
+    def _cooldown(self) -> float:
+        return max(1.0, self._short_latency or 0.0)
+
+    def _on_overload(self) -> None:
+        # 调用方需持有 self._cond；冷却期（约一次调用的耗时）内的连续错误只退让一次
+        now = time.time()
+        if now - self._last_backoff < self._cooldown():
+            return
+        self._last_backoff = now
+        new_limit = max(self.min_limit, self._limit * self.backoff)
+        if int(new_limit) < int(self._limit):
+            self._stats["decreases"] += 1
+        self._limit = new_limit
+        print(f"🚦 [{self.name}] 上游过载（429/5xx/超时），并发上限降至 {int(self._limit)}")
+
+    def _record_wait(self, wait: float) -> None:
+        with self._cond:
+            wait_ms = wait * 1000
+            self._stats["total_wait_ms"] += wait_ms
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+
+    @contextmanager
+    def slot(self):
+        """占用一个并发名额；with 块内抛出的异常按 classify_exception 归类，正常结束默认视为成功"""
+        self._record_wait(self._acquire())
+        slot = _Slot()
+        start = time.time()
+        outcome = OUTCOME_IGNORE
+        try:
+            yield slot
+            outcome = slot.outcome or OUTCOME_SUCCESS
+        except BaseException as e:
+            outcome = slot.outcome if slot.outcome == OUTCOME_OVERLOAD else classify_exception(e)
+            raise
+        finally:
+            self._release(outcome, time.time() - start)
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """slot() 的 asyncio 版本：排队时不占用线程，任务被取消时放弃排队"""
+        self._record_wait(await self._acquire_async())
+        slot = _Slot()
+        start = time.time()
+        outcome = OUTCOME_IGNORE
+        try:
+            yield slot
+            outcome = slot.outcome or OUTCOME_SUCCESS
+        except BaseException as e:
+            outcome = slot.outcome if slot.outcome == OUTCOME_OVERLOAD else classify_exception(e)
+            raise
+        finally:
+            self._release(outcome, time.time() - start)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                limit=int(self._limit),
+                min_limit=self.min_limit,
+                max_limit=self.max_limit,
+                inflight=self._inflight,
+                waiting=self._waiting,
+                short_latency_ms=round((self._short_latency or 0.0) * 1000, 1),
+                long_latency_ms=round((self._long_latency or 0.0) * 1000, 1),
+            )
+        stats["total_wait_ms"] = round(stats["total_wait_ms"], 1)
+        stats["max_wait_ms"] = round(stats["max_wait_ms"], 1)
+        return stats
+
+
+def _set_pending(future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+_cfg = ADAPTIVE_CONCURRENCY_CONFIG
+llm_concurrency = AdaptiveConcurrencyLimiter(
+    "llm", _cfg["llm_initial"], _cfg["llm_min"], _cfg["llm_max"], _cfg["latency_tolerance"], _cfg["backoff"]
+)
+image_concurrency = AdaptiveConcurrencyLimiter(
+    "image", _cfg["image_initial"], _cfg["image_min"], _cfg["image_max"], _cfg["latency_tolerance"], _cfg["backoff"]
+)
+
+
+def get_concurrency_stats() -> Dict:
+    return {"llm": llm_concurrency.stats(), "image": image_concurrency.stats()}
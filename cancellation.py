@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+协作式取消令牌：让被放弃的生成任务尽快停止，不再消耗 token、图片额度和线程。
+
+- CancelToken：一次性的取消信号，可派生子令牌（父令牌取消时子令牌一并取消），
+  取消时依次调用已注册的回调（例如关闭正在读取的 HTTP 响应）；
+  回调与子令牌在用完后应注销（add_callback 返回的注销函数 / child.detach()），
+  否则长期存在的场景级、游戏级令牌上的回调会不断累积；
+- cancel_scope(token)：把令牌绑定为当前线程的"当前令牌"，http_transport 发出的请求、
+  cancellable_sleep 等都会自动感知，无需把令牌逐层传给每个图片/LLM provider 函数；
+- 被取消时统一抛出 OperationCancelled，调用方不应把它当作普通失败去重试或兜底；
+- run_cancellable(awaitable, token)：asyncio 代码没有"当前线程令牌"，由它把令牌的取消转成任务取消。
+"""
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+
+class OperationCancelled(Exception):
+    """任务已被取消（调用方放弃了结果）"""
+
+
+class CancelToken:
+    """可在任意线程取消的一次性令牌"""
+
+    def __init__(self, parent: Optional["CancelToken"] = None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = ""
+        self._detach = None
+        if parent is not None:
+            # 父令牌取消时子令牌一并取消；子令牌不会反向影响父令牌
+            self._detach = parent.add_callback(lambda: self.cancel(parent.reason))
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "") -> bool:
+        """取消令牌并执行回调；已取消时返回 False"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason or "cancelled"
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ 取消回调执行失败：{str(e)[:100]}")
+        self.detach()
+        return True
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """注册取消回调（已取消则立即执行），返回注销函数"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                registered = True
+            else:
+                registered = False
+        if not registered:
+            callback()
+            return lambda: None
+
+        def remove():
+            with self._lock:
+                try:
+                    self._callbacks.remove(callback)
+                except ValueError:
+                    pass
+        return remove
+
+    def child(self) -> "CancelToken":
+        return CancelToken(parent=self)
+
+    def detach(self) -> None:
+        """从父令牌注销（子令牌的工作结束后调用；取消时自动注销）"""
+        detach, self._detach = self._detach, None
+        if detach is not None:
+            detach()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待取消，返回是否已取消（可用作可中断的 sleep）"""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise OperationCancelled(self.reason)
+
+
+_local = threading.local()
+
+
+def current_token() -> Optional[CancelToken]:
+    """当前线程绑定的取消令牌（没有则为 None）"""
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def cancel_scope(token: Optional[CancelToken]):
+    """在 with 块内把 token 设为当前线程的取消令牌；token 为 None 时沿用外层令牌"""
+    if token is None:
+        yield current_token()
+        return
+    previous = current_token()
+    _local.token = token
+    try:
+        token.raise_if_cancelled()
+        yield token
+    finally:
+        _local.token = previous
+
+
+def check_cancelled() -> None:
+    """当前令牌已取消时抛出 OperationCancelled"""
+    token = current_token()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def cancellable_sleep(seconds: float) -> None:
+    """可被当前令牌打断的 sleep（被取消时抛出 OperationCancelled）"""
+    token = current_token()
+    if token is None:
+        time.sleep(max(0.0, seconds))
+        return
+    if token.wait(max(0.0, seconds)):
+        raise OperationCancelled(token.reason)
+
+
+async def run_cancellable(awaitable, token: Optional[CancelToken]):
+    """
+    在当前事件循环中等待 awaitable；token 被取消（可在任意线程）时取消该任务并抛出 OperationCancelled。
+    token 为 None 时直接等待。
+    """
+    task = asyncio.ensure_future(awaitable)
+    if token is None:
+        return await task
+    loop = asyncio.get_running_loop()
+    remove = token.add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if token.cancelled:
+            raise OperationCancelled(token.reason)
+        raise
+    finally:
+        remove()
@@ -2,15 +2,16 @@
 import os
 import sys
 import json
+import queue
 import requests
 import threading
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+import hmac
 from pathlib import Path
 from datetime import datetime
 from typing import Dict, Optional
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, request, jsonify, send_file, send_from_directory, Response, stream_with_context
 
 # 设置环境变量以使用 UTF-8 编码（解决 Windows GBK 编码问题）
 if sys.platform == 'win32':
@@ -30,7 +31,33 @@ from main2 import (
     get_video_task_status,  # 保留占位函数，避免导入错误
     # ==================== 主角形象生成功能 ====================
     generate_game_id,
-    generate_main_character_image
+    generate_main_character_image,
+    _generate_single_option_text_stream,
+    _merge_template_with_input,
+    _scene_image_request_key
+)
+from http_transport import http_get, get_pool_stats
+from scene_cache import SceneCache
+from cancellation import CancelToken, OperationCancelled
+from rate_limiter import get_rate_limit_stats
+from adaptive_concurrency import get_concurrency_stats
+from provider_router import image_provider_router, get_provider_router_stats
+from hedging import get_hedging_stats
+from llm_cache import get_llm_cache_stats
+from single_flight import get_single_flight_stats
+from worldview_store import get_worldview_cache_stats
+from worldview_pool import worldview_pool, get_worldview_pool_stats
+from wiki_cache import get_wiki_cache_stats
+from image_store import image_store, extension_for, get_image_store_stats
+from storage_manager import storage_manager, get_storage_stats
+from image_variants import image_variants, get_image_variant_stats
+from reference_cache import get_reference_cache_stats
+from generation_scheduler import (
+    generation_scheduler,
+    PRIORITY_USER_BLOCKING,
+    PRIORITY_LAYER1_TEXT,
+    PRIORITY_LAYER1_IMAGE,
+    PRIORITY_LAYER2_SPECULATIVE
 )
 
 # 初始化Flask应用
@@ -50,6 +77,9 @@ if not os.path.exists(SAVE_DIR):
 IMAGE_CACHE_DIR = "image_cache"
 VIDEO_CACHE_DIR = "video_cache"
 
+# 内容寻址图片的浏览器缓存时长（秒）：文件名即内容哈希，内容永不变化
+IMMUTABLE_MAX_AGE = 31536000
+
 # 确保缓存目录存在
 if not os.path.exists(IMAGE_CACHE_DIR):
     os.makedirs(IMAGE_CACHE_DIR)
@@ -67,92 +97,136 @@ if not os.path.exists(VIDEO_CACHE_DIR):
 #   'layer2_generating': False,  # 第二层是否正在生成
 #   'layer2_cancel': False,  # 第二层生成取消标志
 #   'layer2_selected_option': None,  # 用户选择的选项索引（用于第二层生成控制）
-#   'layer2_thread': None  # 第二层生成线程对象
+#   'layer2_thread': None,  # 第二层生成线程对象
+#   'cancel_token': CancelToken(),  # 场景级取消令牌（场景被清理/淘汰时取消，中止全部在途请求）
+#   'option_cancel_tokens': {option_index: CancelToken},  # 选项级（场景令牌的子令牌），选项标记为 cancelled 时取消
+#   'layer2_cancel_token': None  # 第二层生成的令牌（场景令牌的子令牌），layer2_cancel 置位时取消
 # }}
-pregeneration_cache = {}
-# 线程锁，保证缓存操作的线程安全（带追踪：定位谁持有锁）
-_cache_lock_holder = None  # 🔧 调试：追踪当前持有锁的线程（threading.Thread）
-_cache_lock_acquire_time = None  # 🔧 调试：追踪锁的获取时间（time.time）
+# 并发结构：顶层索引锁只管插入/删除，条目读写持有各自场景的锁（见 scene_cache.py）
+pregeneration_cache = SceneCache()
+
+
+def scene_lock(scene_id):
+    """获取 scene_id 对应的条目锁（不同场景互不阻塞）"""
+    return pregeneration_cache.scene_lock(scene_id)
 
 
-class TrackedLock:
+
+
+class SceneProgressBus:
     """
-    为 threading.Lock 增加“谁持有锁/持有多久/当前堆栈”的追踪能力。
-    目的：定位 cache_lock 被长时间持有导致的“图片生成后无法写入缓存”问题。
+    按 scene_id 分发生成进度事件（generation_status 变化 + 对应数据），供 SSE 推送使用。
+    publish 只做非阻塞入队，可以在持有场景锁时调用；订阅者队列满时丢弃最旧的事件。
     """
 
-    def __init__(self, name: str = "cache_lock"):
+    def __init__(self, max_queue_size=256):
         self._lock = threading.Lock()
-        self.name = name
-        self.holder_ident = None
-        self.holder_name = None
-        self.holder_since = None
-        self._last_stack_dump_ts = 0.0
-
-    def acquire(self, blocking: bool = True, timeout: float = -1):
-        import time
-        # 兼容 threading.Lock.acquire(blocking=True, timeout=-1)
-        if timeout is None or timeout == -1:
-            got = self._lock.acquire(blocking)
-        else:
-            got = self._lock.acquire(blocking, timeout)
-
-        if got:
-            global _cache_lock_holder, _cache_lock_acquire_time
-            self.holder_ident = threading.get_ident()
-            self.holder_name = threading.current_thread().name
-            self.holder_since = time.time()
-            _cache_lock_holder = threading.current_thread()
-            _cache_lock_acquire_time = self.holder_since
-
-        return got
-
-    def release(self):
-        global _cache_lock_holder, _cache_lock_acquire_time
-        self.holder_ident = None
-        self.holder_name = None
-        self.holder_since = None
-        _cache_lock_holder = None
-        _cache_lock_acquire_time = None
-        return self._lock.release()
-
-    def __enter__(self):
-        self.acquire()
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.release()
-        return False
-
-    def dump_holder_stack(self, limit: int = 40, min_interval_seconds: float = 2.0):
-        """
-        返回当前持锁线程的“实时堆栈”（不是获取锁时的堆栈）。
-        为避免刷屏，默认 2 秒最多输出一次（由调用方 print）。
-        """
-        import sys
-        import time
-        import traceback
+        self._subscribers = {}  # scene_id -> set(queue.Queue)
+        self._max_queue_size = max_queue_size
+
+    def subscribe(self, scene_id):
+        q = queue.Queue(maxsize=self._max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(scene_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, scene_id, q):
+        with self._lock:
+            subs = self._subscribers.get(scene_id)
+            if subs:
+                subs.discard(q)
+                if not subs:
+                    del self._subscribers[scene_id]
+
+    def publish(self, scene_id, event):
+        with self._lock:
+            subs = list(self._subscribers.get(scene_id, ()))
+        for q in subs:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    q.put_nowait(event)
+                except (queue.Empty, queue.Full):
+                    pass
 
-        if not self.holder_ident:
-            return None
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(v) for v in self._subscribers.values())
 
-        now = time.time()
-        if now - self._last_stack_dump_ts < min_interval_seconds:
-            return None
 
-        frames = sys._current_frames()
-        frame = frames.get(self.holder_ident)
-        if frame is None:
-            self._last_stack_dump_ts = now
-            return f"[{self.name}] 无法获取持锁线程堆栈（holder_ident={self.holder_ident})"
+progress_bus = SceneProgressBus()
+# 终态：到达后该选项不会再有状态变化
+TERMINAL_GENERATION_STATUSES = ('completed', 'failed', 'cancelled')
 
-        stack = "".join(traceback.format_stack(frame, limit=limit))
-        self._last_stack_dump_ts = now
-        return stack
 
+def set_generation_status(scene_id, cache_entry, option_index, status):
+    """
+    更新选项的生成状态，唤醒该选项的等待者并推送进度事件（调用方需持有 scene_lock(scene_id)）
+    事件中附带当前 layer1 数据：text_completed/text_only 时前端即可先渲染文本，completed 时图片随之到达。
+    """
+    cache_entry.setdefault('generation_status', {})[option_index] = status
+    if status == 'cancelled':
+        # 中止该选项在途的 LLM/图片请求
+        option_token = cache_entry.get('option_cancel_tokens', {}).get(option_index)
+        if option_token is not None:
+            option_token.cancel("选项已取消")
+    pregeneration_cache.notify_option(scene_id, option_index)
+    pregeneration_cache.account(scene_id, cache_entry)
+    progress_bus.publish(scene_id, {
+        "sceneId": scene_id,
+        "optionIndex": option_index,
+        "status": status,
+        "optionData": cache_entry.get('layer1', {}).get(option_index)
+    })
 
-cache_lock = TrackedLock("cache_lock")
-MAX_CACHE_SIZE = 3  # 最大缓存场景数量，超过此数量将清理最旧的缓存（降低内存占用）
+def _option_cancel_token(cache_entry, option_index):
+    """返回选项级取消令牌（场景令牌的子令牌，按需创建），调用方需持有场景锁"""
+    scene_token = cache_entry.setdefault('cancel_token', CancelToken())
+    tokens = cache_entry.setdefault('option_cancel_tokens', {})
+    token = tokens.get(option_index)
+    if token is None or (token.cancelled and not scene_token.cancelled
+                         and cache_entry.get('generation_status', {}).get(option_index) != 'cancelled'):
+        # 选项被取消后又重新开始生成：换一个新令牌（旧令牌从场景令牌上注销）
+        if token is not None:
+            token.detach()
+        token = tokens[option_index] = scene_token.child()
+    return token
+
+def _cancel_layer2(cache_entry, reason):
+    """置第二层取消标志并中止其在途请求，调用方需持有场景锁"""
+    cache_entry['layer2_cancel'] = True
+    layer2_token = cache_entry.get('layer2_cancel_token')
+    if layer2_token is not None:
+        layer2_token.cancel(reason)
+
+# 条件等待的判定函数（在场景锁内调用，entry 可能为 None）
+def _completed_with_image(option_index):
+    """选项已 completed 且带图片时返回其 option_data"""
+    def predicate(cache_entry):
+        if not cache_entry:
+            return None
+        option_data = cache_entry.get('layer1', {}).get(option_index)
+        if not isinstance(option_data, dict):
+            return None
+        if cache_entry.get('generation_status', {}).get(option_index) != 'completed':
+            return None
+        scene_image = option_data.get('scene_image')
+        return option_data if scene_image and scene_image.get('url') else None
+    return predicate
+
+def _option_settled(option_index):
+    """选项已有数据时返回 option_data；失败/取消/场景被清理时返回对应状态字符串（结束等待）"""
+    def predicate(cache_entry):
+        if not cache_entry:
+            return 'missing'
+        option_data = cache_entry.get('layer1', {}).get(option_index)
+        if isinstance(option_data, dict):
+            return option_data
+        status = cache_entry.get('generation_status', {}).get(option_index, 'pending')
+        return status if status in ['failed', 'cancelled'] else None
+    return predicate
 
 # 辅助函数：清理错误消息中的特殊字符（避免编码问题）
 def clean_error_message(error_msg):
@@ -169,60 +243,84 @@ def clean_error_message(error_msg):
         # 如果清理失败，返回安全的默认消息
         return "发生错误，请稍后重试"
 
+# 参与场景ID计算的 global_state 字段（真正影响后续生成的内容）
+# 世界观身份单独处理（优先 game_id）；'_' 开头的临时字段（如 _visual_context）不参与
+SCENE_ID_STATE_FIELDS = ('flow_worldline', 'tone', 'hidden_ending_prediction', 'user_theme', 'image_style')
+
+def _canonical_json(value):
+    """规范化序列化：键排序、无空白，保证同一内容在任何进程中得到相同字节"""
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+
+def _worldview_identity(global_state):
+    """世界观身份：有 game_id 时直接使用（无需序列化整个世界观），否则对 core_worldview 取摘要"""
+    game_id = global_state.get('game_id')
+    if game_id:
+        return f"game:{game_id}".encode('utf-8')
+    return b"worldview:" + hashlib.sha256(_canonical_json(global_state.get('core_worldview'))).digest()
+
 # 生成场景ID的辅助函数
-def generate_scene_id(global_state_hash, current_options_hash):
-    """根据全局状态和当前选项生成唯一的场景ID"""
-    return f"{hash(str(global_state_hash))}_{hash(str(current_options_hash))}"
+def generate_scene_id(global_state, current_options):
+    """
+    根据全局状态和当前选项生成稳定的场景ID（内容寻址）
+    使用 sha256 而非进程加盐的 hash()，同一状态在不同 worker 进程 / 重启后得到相同的 scene_id。
+    """
+    state_hasher = hashlib.sha256()
+    if isinstance(global_state, dict):
+        state_hasher.update(_worldview_identity(global_state))
+        # 逐字段增量写入摘要，避免把整个 global_state 拼成一个大字符串
+        for field in SCENE_ID_STATE_FIELDS:
+            state_hasher.update(b"\x00" + field.encode('utf-8') + b"=")
+            state_hasher.update(_canonical_json(global_state.get(field)))
+    else:
+        state_hasher.update(_canonical_json(global_state))
+    options_digest = hashlib.sha256(_canonical_json(current_options)).hexdigest()
+    return f"{state_hasher.hexdigest()[:16]}_{options_digest[:16]}"
 
 # 缓存清理函数：清理旧的、无用的缓存
-def cleanup_old_cache(current_scene_id=None):
-    """清理旧的缓存，保留最近使用的场景"""
-    with cache_lock:
-        cache_size = len(pregeneration_cache)
-        if cache_size <= MAX_CACHE_SIZE:
-            return
-        
-        # 如果提供了当前场景ID，确保它不被清理
-        scenes_to_keep = set()
-        if current_scene_id:
-            scenes_to_keep.add(current_scene_id)
-        if 'initial' in pregeneration_cache:
-            scenes_to_keep.add('initial')
-        
-        # 计算需要清理的数量
-        to_remove = cache_size - MAX_CACHE_SIZE
-        
-        # 找出最旧的缓存（除了要保留的）
-        scenes_to_remove = []
-        for scene_id in pregeneration_cache:
-            if scene_id not in scenes_to_keep:
-                scenes_to_remove.append(scene_id)
-        
-        # 如果场景太多，清理最旧的（这里简化处理，清理除了当前和initial之外的所有）
-        if len(scenes_to_remove) > to_remove:
-            # 只清理超出限制的部分
-            scenes_to_remove = scenes_to_remove[:to_remove]
-        
-        # 清理选中的场景
-        for scene_id in scenes_to_remove:
-            cache_entry = pregeneration_cache.get(scene_id)
-            if cache_entry:
-                # 停止正在进行的生成
-                if cache_entry.get('layer2_generating', False):
-                    cache_entry['layer2_cancel'] = True
-                    layer2_thread = cache_entry.get('layer2_thread')
-                    if layer2_thread and layer2_thread.is_alive():
-                        layer2_thread.join(timeout=0.5)
-            
-            del pregeneration_cache[scene_id]
-            print(f"🗑️ 已清理旧缓存场景 {scene_id}（内存优化）")
-        
-        print(f"📊 当前缓存大小：{len(pregeneration_cache)}/{MAX_CACHE_SIZE}")
+def cleanup_old_cache(current_scene_id=None, game_id=None):
+    """
+    按 会话空闲 / TTL / 玩家配额 / 总字节预算淘汰缓存（LRU，容量见 scene_cache.SCENE_CACHE_CONFIG）
+    当前场景与当前玩家的 initial 不会被淘汰；不要在持有场景锁时调用。
+    """
+    # 当前场景与当前玩家的 initial 不淘汰
+    scenes_to_keep = {_initial_scene_key(game_id)}
+    if current_scene_id:
+        scenes_to_keep.add(current_scene_id)
+    
+    # 只在索引锁内摘除条目，取消后台任务在各自的场景锁内完成（不等待线程退出）
+    removed = pregeneration_cache.evict(keep=scenes_to_keep)
+    for scene_id, cache_entry, reason in removed:
+        _cancel_scene_generation(scene_id, cache_entry)
+        print(f"🗑️ 已淘汰缓存场景 {scene_id}（原因：{reason}）")
+    
+    if removed:
+        stats = pregeneration_cache.get_stats()
+        print(f"📊 当前缓存：{stats['scenes']} 个场景，约 {stats['bytes'] / 1024:.1f} KB")
+
+def _cancel_scene_generation(scene_id, cache_entry):
+    """
+    取消已移出缓存的场景上仍在进行的生成：置取消标志、未完成的选项标记为 cancelled 并唤醒等待者。
+    在途的 LLM/图片请求由场景取消令牌中止，第二层线程随之退出，这里不 join。
+    """
+    with scene_lock(scene_id):
+        cache_entry['should_cancel'] = True
+        cache_entry['layer2_cancel'] = True
+        scene_token = cache_entry.get('cancel_token')
+        if scene_token is not None:
+            # 级联取消选项级与第二层令牌，中止该场景全部在途请求
+            scene_token.cancel("场景已清理")
+        for idx, status in list(cache_entry.get('generation_status', {}).items()):
+            if status not in TERMINAL_GENERATION_STATUSES:
+                set_generation_status(scene_id, cache_entry, idx, 'cancelled')
+        for ev in cache_entry.get('generation_events', {}).values():
+            ev.set()
+    # 该场景排队中的第一层/第二层任务都不再需要
+    generation_scheduler.cancel_queued(scene_id, min_priority=PRIORITY_LAYER1_TEXT)
 
 # 清理已使用选项的缓存数据
 def cleanup_used_options(scene_id, used_option_index):
     """清理已使用的选项数据，释放内存"""
-    with cache_lock:
+    with scene_lock(scene_id):
         if scene_id not in pregeneration_cache:
             return
         
@@ -240,6 +338,72 @@ def cleanup_used_options(scene_id, used_option_index):
                     # 这里可以进一步优化，但为了安全，暂时保留
                     pass
 
+# 新建一个场景缓存条目（与预生成结构一致）
+def _new_scene_cache_entry(owner=None):
+    """owner 为玩家标识（game_id），用于按玩家配额淘汰"""
+    return {
+        'owner': owner,
+        'layer1': {},
+        'layer2': {},
+        'generation_status': {},
+        'generation_events': {},
+        'should_cancel': False,
+        'current_generating_index': None,
+        'layer2_generating': False,
+        'layer2_cancel': False,
+        'layer2_selected_option': None,
+        'layer2_thread': None,
+        'current_layer2_option': None,
+        'cancel_token': CancelToken(),
+        'option_cancel_tokens': {},
+        'layer2_cancel_token': None
+    }
+
+# 场景条目的归属玩家（game_id），用于按玩家配额淘汰与会话空闲清理
+def _scene_owner(global_state):
+    return global_state.get('game_id') if isinstance(global_state, dict) else None
+
+# 每个玩家独立的“初始场景”缓存槽（前端仍以 sceneId='initial' 访问）；没有 game_id 时退回共享槽
+def _initial_scene_key(game_id):
+    return f"initial:{game_id}" if game_id else 'initial'
+
+# 把 generate_scene_image 的返回值整理为 optionData['scene_image']（含 scene_text_hash，确保图片与文本匹配）
+def _build_scene_image_payload(img, scene_text):
+    return {
+        "url": img.get("url"),
+        "prompt": img.get("prompt", ""),
+        "style": img.get("style", "default"),
+        "width": img.get("width", 1024),
+        "height": img.get("height", 1024),
+        "cached": img.get("cached", True),
+        "scene_text_hash": hashlib.md5(scene_text.encode('utf-8')).hexdigest()
+    }
+
+# 从 initial 缓存组装“开始游戏”的 optionData
+def _initial_option_data(initial_cache):
+    return {
+        "scene": initial_cache.get('initial_scene', '') or "你开始了你的冒险之旅.",
+        "scene_image": initial_cache.get('initial_scene_image', None),
+        "next_options": initial_cache.get('initial_options', []),
+        "flow_update": {},
+        "deep_background_links": {}
+    }
+
+# 格式化一条 Server-Sent Events 消息
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(generator):
+    """把事件生成器包装为 text/event-stream 响应（禁用代理缓冲，保证逐条推送）"""
+    return Response(
+        stream_with_context(generator),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 # 允许前端跨域访问
 @app.after_request
 def after_request(response):
@@ -259,6 +423,7 @@ def generate_worldview():
         difficulty = data.get('difficulty', '中等')
         tone_key = data.get('toneKey', 'normal_ending')
         image_style = data.get('imageStyle', None)  # 图片风格选择
+        fresh = bool(data.get('fresh', False))  # 玩家想要全新的世界：跳过世界观缓存
         
         # 基础校验
         if not game_theme:
@@ -268,9 +433,14 @@ def generate_worldview():
         game_id = generate_game_id()
         print(f"🎮 生成游戏ID: {game_id}")
         
-        # 调用后端生成世界观的函数
+        # 调用后端生成世界观的函数（预热池按主题/基调/难度/主角属性完全匹配时直接取用）
         try:
-            global_state = llm_generate_global(game_theme, protagonist_attr, difficulty, tone_key)
+            pooled = None if fresh else worldview_pool.take(game_theme, tone_key, difficulty, protagonist_attr)
+            if pooled:
+                global_state = _merge_template_with_input(pooled['worldview'], protagonist_attr, difficulty, tone_key)
+            else:
+                global_state = llm_generate_global(game_theme, protagonist_attr, difficulty, tone_key, fresh=fresh)
+            pooled_initial = pooled.get('initial') if pooled else None
             
             # 保存游戏ID到global_state
             global_state['game_id'] = game_id
@@ -344,6 +514,9 @@ def generate_worldview():
             print(f"⚠️ 更新主角形象信息失败：{str(e)}")
         
         # 世界观生成成功后，立即启动第一次选项的生成（后台线程，不使用预生成机制）
+        # 按玩家隔离的初始场景槽：并发创建世界观的玩家互不覆盖
+        initial_key = _initial_scene_key(game_id)
+        
         def generate_initial_options():
             """生成第一次选项（根据世界观动态生成）"""
             try:
@@ -352,7 +525,16 @@ def generate_worldview():
                 # 根据世界观生成初始场景和选项
                 # 使用"开始游戏"作为初始选项，生成第一个场景和后续选项
                 initial_option = "开始游戏"
-                result = _generate_single_option(0, initial_option, global_state)
+                if pooled_initial:
+                    # 预热池已备好初始场景文本：只需生成场景图片
+                    print(f"🔥 使用预热池中的初始场景文本，仅生成场景图片")
+                    result = dict(pooled_initial['data'])
+                    scene_for_image = pooled_initial.get('scene_for_image') or result.get('scene', '')
+                    img = generate_scene_image(scene_for_image, global_state, "default", use_cache=True) if scene_for_image else None
+                    if img and isinstance(img, dict) and img.get('url'):
+                        result['scene_image'] = _build_scene_image_payload(img, scene_for_image)
+                else:
+                    result = _generate_single_option(0, initial_option, global_state)
                 
                 if isinstance(result, dict):
                     initial_option_data = result.get('data', result)
@@ -374,13 +556,14 @@ def generate_worldview():
                 # 后续预生成仍由前端触发 /pregenerate-next-layers（用户阅读时间后台生成），逻辑保持一致。
 
                 # 存储到特殊缓存位置（仅初始场景，不预生成选项剧情）
-                with cache_lock:
-                    if 'initial' not in pregeneration_cache:
-                        pregeneration_cache['initial'] = {
+                with scene_lock(initial_key):
+                    if initial_key not in pregeneration_cache:
+                        pregeneration_cache[initial_key] = {
+                            'owner': game_id,
                             'generation_events': {}
                         }
                     
-                    initial_cache = pregeneration_cache['initial']
+                    initial_cache = pregeneration_cache[initial_key]
                     # 不再填充 layer1（每个选项的剧情），交给后续预生成或按需生成
                     initial_cache['layer1'] = {}
                     # 确保initial_scene不为空，如果为空则使用默认场景
@@ -405,6 +588,13 @@ def generate_worldview():
                     events = initial_cache.get('generation_events', {})
                     if 'main' in events:
                         events['main'].set()
+                    pregeneration_cache.account(initial_key, initial_cache)
+                    progress_bus.publish(initial_key, {
+                        "sceneId": 'initial',
+                        "optionIndex": 0,
+                        "status": 'completed',
+                        "optionData": _initial_option_data(initial_cache)
+                    })
 
                 print(f"✅ 第一次选项生成完成（仅初始场景+选项，未预生成选项剧情/图片），选项数：{len(initial_options)}")
                 
@@ -413,12 +603,13 @@ def generate_worldview():
                 import traceback
                 traceback.print_exc()
                 # 即使失败，也设置一个标记，避免前端无限等待
-                with cache_lock:
-                    if 'initial' not in pregeneration_cache:
-                        pregeneration_cache['initial'] = {
+                with scene_lock(initial_key):
+                    if initial_key not in pregeneration_cache:
+                        pregeneration_cache[initial_key] = {
+                            'owner': game_id,
                             'generation_events': {}
                         }
-                    initial_cache = pregeneration_cache['initial']
+                    initial_cache = pregeneration_cache[initial_key]
                     initial_cache['completed'] = False
                     initial_cache['error'] = str(e)
                     
@@ -426,6 +617,12 @@ def generate_worldview():
                     events = initial_cache.get('generation_events', {})
                     if 'main' in events:
                         events['main'].set()
+                    progress_bus.publish(initial_key, {
+                        "sceneId": 'initial',
+                        "optionIndex": 0,
+                        "status": 'failed',
+                        "optionData": None
+                    })
         
         # 启动后台线程生成第一次选项（不阻塞响应）
         thread = threading.Thread(target=generate_initial_options, daemon=True)
@@ -471,6 +668,7 @@ def generate_option():
         option_index = data.get('optionIndex', 0)
         scene_id = data.get('sceneId', None)  # 前端传入的场景ID，用于缓存查找
         current_options = data.get('currentOptions', [])  # 当前选项列表，用于触发优先生成
+        initial_key = _initial_scene_key(_scene_owner(global_state))  # 该玩家的初始场景缓存槽
         
         # 🔍 调试日志：显示前端传入的参数
         print(f"🔍 [generate-option] 收到请求：")
@@ -492,7 +690,7 @@ def generate_option():
             }
             # 也写入缓存（便于后续在该 scene_id 下触发的优先生成/补生成复用）
             if scene_id:
-                with cache_lock:
+                with scene_lock(scene_id):
                     if scene_id in pregeneration_cache:
                         pregeneration_cache[scene_id]['visual_context'] = global_state['_visual_context']
         
@@ -510,16 +708,17 @@ def generate_option():
         # 处理第一次生成的情况（sceneId为null或'initial'）
         if not scene_id or scene_id == 'initial':
             # 第一次生成：从initial缓存读取
-            with cache_lock:
+            with scene_lock(initial_key):
                 # 如果initial缓存不存在，创建并等待
-                if 'initial' not in pregeneration_cache:
-                    pregeneration_cache['initial'] = {
+                if initial_key not in pregeneration_cache:
+                    pregeneration_cache[initial_key] = {
+                        'owner': _scene_owner(global_state),
                         'generation_events': {},
                         'completed': False
                     }
                     need_wait = True
                 else:
-                    initial_cache = pregeneration_cache['initial']
+                    initial_cache = pregeneration_cache[initial_key]
                     
                     # 检查是否生成完成
                     if initial_cache.get('completed', False):
@@ -561,22 +760,22 @@ def generate_option():
                 
                 # 如果需要等待，创建等待事件
                 if need_wait:
-                    initial_cache = pregeneration_cache['initial']
+                    initial_cache = pregeneration_cache[initial_key]
                     events = initial_cache.setdefault('generation_events', {})
                     if 'main' not in events:
                         events['main'] = threading.Event()
                     wait_event = events['main']
         
         if scene_id and scene_id != 'initial':
-            with cache_lock:
+            with scene_lock(scene_id):
                 # 🔍 调试日志：检查 scene_id 是否在缓存中
                 print(f"🔍 [generate-option] 检查 scene_id 是否在缓存中...")
                 print(f"   - 查找的 scene_id：{scene_id}")
                 print(f"   - 缓存中的 scene_id 列表：{list(pregeneration_cache.keys())}")
                 print(f"   - scene_id 是否在缓存中：{scene_id in pregeneration_cache}")
                 
-                if scene_id in pregeneration_cache:
-                    cache_entry = pregeneration_cache[scene_id]
+                cache_entry = pregeneration_cache.lookup(scene_id)
+                if cache_entry is not None:
                     print(f"✅ [generate-option] scene_id 匹配成功，找到缓存条目")
                     print(f"   - 缓存条目中的 layer1 选项索引：{list(cache_entry.get('layer1', {}).keys())}")
                     print(f"   - 缓存条目中的生成状态：{cache_entry.get('generation_status', {})}")
@@ -630,7 +829,9 @@ def generate_option():
                                 else:
                                     # 正在生成的不是用户选择的选项的第二层，停止生成
                                     print(f"⏹️ 停止生成选项 {current_layer2_option} 的第二层（用户选择了选项 {option_index}）")
-                                    cache_entry['layer2_cancel'] = True
+                                    _cancel_layer2(cache_entry, f"用户选择了选项 {option_index}")
+                                    # 抢占：排队中尚未开始的第二层推测任务直接取消，把 LLM 名额让给玩家选择的内容
+                                    generation_scheduler.cancel_queued(scene_id, min_priority=PRIORITY_LAYER2_SPECULATIVE)
                                     # 保存线程引用，在释放锁后等待（避免死锁）
                                     layer2_thread_to_wait = cache_entry.get('layer2_thread')
                             else:
@@ -666,7 +867,7 @@ def generate_option():
                             # 标记需要取消其他未开始的生成
                             cache_entry['should_cancel'] = True
                             # 如果用户选择的选项还未生成，标记为高优先级
-                            generation_status[option_index] = 'generating'
+                            set_generation_status(scene_id, cache_entry, option_index, 'generating')
                             # 创建事件对象
                             events = cache_entry.setdefault('generation_events', {})
                             if option_index not in events:
@@ -676,20 +877,20 @@ def generate_option():
                             # 启动单个选项的生成任务（优先生成）
                             def generate_selected_option():
                                 try:
-                                    result = _generate_single_option(option_index, option, global_state)
+                                    result = _generate_single_option(option_index, option, global_state, hedge=True)
                                     if isinstance(result, dict):
                                         opt_data = result.get('data', result)
                                     else:
                                         opt_data = result
                                     
-                                    with cache_lock:
+                                    with scene_lock(scene_id):
                                         if scene_id in pregeneration_cache:
                                             cache_entry = pregeneration_cache[scene_id]
                                             if 'layer1' not in cache_entry:
                                                 cache_entry['layer1'] = {}
                                             cache_entry['layer1'][option_index] = opt_data
                                             generation_status = cache_entry.setdefault('generation_status', {})
-                                            generation_status[option_index] = 'completed'
+                                            set_generation_status(scene_id, cache_entry, option_index, 'completed')
                                             
                                             # 触发等待事件
                                             events = cache_entry.get('generation_events', {})
@@ -698,14 +899,17 @@ def generate_option():
                                             print(f"✅ 选项 {option_index} 优先生成完成")
                                 except Exception as e:
                                     print(f"❌ 优先生成选项 {option_index} 失败：{str(e)}")
-                                    with cache_lock:
+                                    with scene_lock(scene_id):
                                         if scene_id in pregeneration_cache:
                                             events = pregeneration_cache[scene_id].get('generation_events', {})
                                             if option_index in events:
                                                 events[option_index].set()
                             
-                            thread = threading.Thread(target=generate_selected_option, daemon=True)
-                            thread.start()
+                            # 玩家正在等待该选项：以最高优先级交给调度器（排在所有预生成/推测任务之前）
+                            generation_scheduler.submit(
+                                generate_selected_option,
+                                priority=PRIORITY_USER_BLOCKING, upstream="llm", tag={"scene_id": scene_id, "option_index": option_index}
+                            )
                             need_wait = True
                     else:
                         # 情况3：scene_id不在缓存中，可能是第一次选择（前端传入了新生成的sceneId）
@@ -714,8 +918,8 @@ def generate_option():
                         print(f"   - 前端传入的 scene_id：{scene_id}")
                         print(f"   - 缓存中存在的 scene_id：{list(pregeneration_cache.keys())}")
                         print(f"   - 尝试从initial缓存查找...")
-                        if 'initial' in pregeneration_cache:
-                            initial_cache = pregeneration_cache['initial']
+                        if initial_key in pregeneration_cache:
+                            initial_cache = pregeneration_cache[initial_key]
                             if initial_cache.get('completed', False):
                                 layer1_data = initial_cache.get('layer1', {})
                                 if option_index in layer1_data:
@@ -731,22 +935,10 @@ def generate_option():
                     if not option_data:
                         print(f"🚀 [generate-option] 缓存未命中，按需生成选项 {option_index}（scene_id={scene_id}）...")
                         # 初始化该 scene_id 的缓存条目（与预生成结构一致）
-                        pregeneration_cache[scene_id] = {
-                            'layer1': {},
-                            'layer2': {},
-                            'generation_status': {},
-                            'generation_events': {},
-                            'should_cancel': False,
-                            'current_generating_index': None,
-                            'layer2_generating': False,
-                            'layer2_cancel': False,
-                            'layer2_selected_option': None,
-                            'layer2_thread': None,
-                            'current_layer2_option': None
-                        }
+                        pregeneration_cache[scene_id] = _new_scene_cache_entry(owner=_scene_owner(global_state))
                         cache_entry = pregeneration_cache[scene_id]
                         generation_status = cache_entry['generation_status']
-                        generation_status[option_index] = 'generating'
+                        set_generation_status(scene_id, cache_entry, option_index, 'generating')
                         events = cache_entry['generation_events']
                         if option_index not in events:
                             events[option_index] = threading.Event()
@@ -754,32 +946,34 @@ def generate_option():
 
                         def generate_selected_option_for_missing_scene():
                             try:
-                                result = _generate_single_option(option_index, option, global_state)
+                                result = _generate_single_option(option_index, option, global_state, hedge=True)
                                 if isinstance(result, dict):
                                     opt_data = result.get('data', result)
                                 else:
                                     opt_data = result
-                                with cache_lock:
+                                with scene_lock(scene_id):
                                     if scene_id in pregeneration_cache:
                                         entry = pregeneration_cache[scene_id]
                                         entry.setdefault('layer1', {})[option_index] = opt_data
-                                        entry.setdefault('generation_status', {})[option_index] = 'completed'
+                                        set_generation_status(scene_id, entry, option_index, 'completed')
                                         evs = entry.get('generation_events', {})
                                         if option_index in evs:
                                             evs[option_index].set()
                                 print(f"✅ [generate-option] 按需生成完成：scene_id={scene_id}, option_index={option_index}")
                             except Exception as e:
                                 print(f"❌ [generate-option] 按需生成失败：scene_id={scene_id}, option_index={option_index}, err={str(e)}")
-                                with cache_lock:
+                                with scene_lock(scene_id):
                                     if scene_id in pregeneration_cache:
                                         entry = pregeneration_cache[scene_id]
-                                        entry.setdefault('generation_status', {})[option_index] = 'failed'
+                                        set_generation_status(scene_id, entry, option_index, 'failed')
                                         evs = entry.get('generation_events', {})
                                         if option_index in evs:
                                             evs[option_index].set()
 
-                        thread = threading.Thread(target=generate_selected_option_for_missing_scene, daemon=True)
-                        thread.start()
+                        generation_scheduler.submit(
+                            generate_selected_option_for_missing_scene,
+                            priority=PRIORITY_USER_BLOCKING, upstream="llm", tag={"scene_id": scene_id, "option_index": option_index}
+                        )
                         need_wait = True
         
         # 在释放锁后等待第二层线程退出（避免死锁）
@@ -805,9 +999,9 @@ def generate_option():
                 
                 # 再次尝试从缓存读取（重要：不要在持锁状态下 sleep/wait，避免阻塞图片线程写回缓存）
                 if not scene_id or scene_id == 'initial':
-                    with cache_lock:
-                        if 'initial' in pregeneration_cache:
-                            initial_cache = pregeneration_cache['initial']
+                    with scene_lock(initial_key):
+                        if initial_key in pregeneration_cache:
+                            initial_cache = pregeneration_cache[initial_key]
                             if initial_cache.get('completed', False):
                                 if option_index == 0 and option == "开始游戏":
                                     initial_scene = initial_cache.get('initial_scene', '')
@@ -829,7 +1023,7 @@ def generate_option():
                     status = 'pending'
                     scene_image = None
 
-                    with cache_lock:
+                    with scene_lock(scene_id):
                         if scene_id in pregeneration_cache:
                             cache_entry = pregeneration_cache[scene_id]
                             option_data_temp = cache_entry.get('layer1', {}).get(option_index)
@@ -841,21 +1035,10 @@ def generate_option():
                         if status == 'completed' and scene_image and scene_image.get('url'):
                             option_data = option_data_temp
                         elif status == 'text_completed':
-                            # 图片还在生成中，继续等待（在锁外 sleep，在锁内短读）
-                            max_image_wait = 60
-                            start_time = time.time()
-                            while time.time() - start_time < max_image_wait:
-                                time.sleep(0.5)
-                                with cache_lock:
-                                    if scene_id in pregeneration_cache:
-                                        cache_entry = pregeneration_cache[scene_id]
-                                        option_data_temp2 = cache_entry.get('layer1', {}).get(option_index)
-                                        status2 = cache_entry.get('generation_status', {}).get(option_index, 'pending')
-                                        if isinstance(option_data_temp2, dict):
-                                            scene_image2 = option_data_temp2.get('scene_image')
-                                            if status2 == 'completed' and scene_image2 and scene_image2.get('url'):
-                                                option_data = option_data_temp2
-                                                break
+                            # 图片还在生成中：在该选项的条件变量上等待图片写回（不持锁 sleep 轮询）
+                            option_data = pregeneration_cache.wait_until(
+                                scene_id, _completed_with_image(option_index), 60, option_index=option_index
+                            )
                             if not option_data:
                                 # 等待超时：保持原逻辑，返回文本
                                 option_data = option_data_temp
@@ -864,22 +1047,14 @@ def generate_option():
 
                 # 🆕 关键修复：如果事件触发后仍未拿到 option_data，不要立即“同步再生成”，而是继续等待正在进行的预生成写回缓存
                 # - 常见场景：后台线程仍在进行 LLM/图片生成，事件触发/超时后短时间内数据尚未写入
-                # - 这里做一个“剩余时间内轮询”，确保优先等待预生成完成再返回
+                # - 这里在剩余时间内等待该选项的条件变量，确保优先等待预生成完成再返回
                 if not option_data and scene_id and scene_id != 'initial':
-                    poll_interval = float(os.getenv("OPTION_WAIT_POLL_SECONDS", "0.5"))
-                    while time.time() - start_wait_ts < wait_timeout:
-                        with cache_lock:
-                            cache_entry = pregeneration_cache.get(scene_id)
-                            if not cache_entry:
-                                break
-                            status = cache_entry.get('generation_status', {}).get(option_index, 'pending')
-                            option_data_temp = cache_entry.get('layer1', {}).get(option_index)
-                            if isinstance(option_data_temp, dict):
-                                option_data = option_data_temp
-                                break
-                            if status in ['failed', 'cancelled']:
-                                break
-                        time.sleep(poll_interval)
+                    remaining = wait_timeout - (time.time() - start_wait_ts)
+                    settled = pregeneration_cache.wait_until(
+                        scene_id, _option_settled(option_index), remaining, option_index=option_index
+                    )
+                    if isinstance(settled, dict):
+                        option_data = settled
                 
                 # 如果等待后仍然没有：
                 # 不要返回 error + message（前端会把 message 当作剧情展示，并触发 /generate-scene-image，导致“生成超时”被画进图里）
@@ -911,22 +1086,13 @@ def generate_option():
             if not scene_image or not scene_image.get('url'):
                 # 图片还没生成，等待图片生成完成
                 print(f"⏳ 文本数据已就绪，但图片还在生成中，等待图片生成完成...")
-                import time
                 max_image_wait = 60  # 最多等待60秒
-                start_time = time.time()
-                while time.time() - start_time < max_image_wait:
-                    time.sleep(0.5)
-                    with cache_lock:
-                        if scene_id in pregeneration_cache:
-                            cache_entry = pregeneration_cache[scene_id]
-                            if option_index in cache_entry.get('layer1', {}):
-                                option_data_temp = cache_entry['layer1'][option_index]
-                                status = cache_entry.get('generation_status', {}).get(option_index, 'pending')
-                                scene_image_temp = option_data_temp.get('scene_image')
-                                if status == 'completed' and scene_image_temp and scene_image_temp.get('url'):
-                                    option_data = option_data_temp
-                                    print(f"✅ 图片生成完成，数据已就绪（包含图片）")
-                                    break
+                ready = pregeneration_cache.wait_until(
+                    scene_id, _completed_with_image(option_index), max_image_wait, option_index=option_index
+                )
+                if ready:
+                    option_data = ready
+                    print(f"✅ 图片生成完成，数据已就绪（包含图片）")
                 if not option_data.get('scene_image') or not option_data.get('scene_image', {}).get('url'):
                     print(f"⚠️ 图片生成超时，但继续返回文本数据（图片可能稍后生成）")
         
@@ -948,24 +1114,15 @@ def generate_option():
         # 返回结果前，清理上一轮的缓存（如果提供了上一轮的scene_id）
         previous_scene_id = data.get('previousSceneId', None)
         if previous_scene_id and previous_scene_id != scene_id and previous_scene_id != 'initial':
-            with cache_lock:
-                if previous_scene_id in pregeneration_cache:
-                    # 停止该场景的第二层生成（如果正在生成）
-                    prev_cache_entry = pregeneration_cache[previous_scene_id]
-                    if prev_cache_entry.get('layer2_generating', False):
-                        prev_cache_entry['layer2_cancel'] = True
-                        layer2_thread = prev_cache_entry.get('layer2_thread')
-                        if layer2_thread and layer2_thread.is_alive():
-                            # 等待线程退出（最多等待1秒）
-                            layer2_thread.join(timeout=1.0)
-                    
-                    # 删除上一轮的缓存
-                    del pregeneration_cache[previous_scene_id]
-                    print(f"🗑️ 已清理上一轮场景 {previous_scene_id} 的缓存")
+            # 删除上一轮的缓存，并取消该场景仍在进行的生成（第二层线程检查取消标志后自行退出）
+            prev_cache_entry = pregeneration_cache.pop(previous_scene_id)
+            if prev_cache_entry is not None:
+                _cancel_scene_generation(previous_scene_id, prev_cache_entry)
+                print(f"🗑️ 已清理上一轮场景 {previous_scene_id} 的缓存")
         
         # 清理当前场景中未使用的选项数据（内存优化）
         if scene_id and scene_id != 'initial' and scene_id in pregeneration_cache:
-            with cache_lock:
+            with scene_lock(scene_id):
                 cache_entry = pregeneration_cache[scene_id]
                 # 🆕 先把“未选中的选项”标记为 cancelled，并触发其事件，避免后台线程继续回填导致状态卡死/刷警告
                 generation_status = cache_entry.get('generation_status', {})
@@ -975,7 +1132,7 @@ def generate_option():
                         if idx == option_index:
                             continue
                         if st in ['pending', 'generating', 'text_completed', 'text_only']:
-                            generation_status[idx] = 'cancelled'
+                            set_generation_status(scene_id, cache_entry, idx, 'cancelled')
                             ev = events.get(idx)
                             if ev:
                                 ev.set()
@@ -1012,7 +1169,7 @@ def generate_option():
                             print(f"🗑️ 已清理未使用的选项 {idx} 的第二层数据")
         
         # 定期清理旧缓存
-        cleanup_old_cache(scene_id)
+        cleanup_old_cache(scene_id, _scene_owner(global_state))
 
         # 如果返回的剧情数据缺少图片：默认不在 /generate-option 阻塞生成（避免长等待）。
         # 如需“选择后立即同步补图”，可设置环境变量：GENERATE_OPTION_ON_DEMAND_IMAGE=1
@@ -1087,6 +1244,242 @@ def generate_option():
         error_msg = clean_error_message(str(e))
         return jsonify({"status": "error", "message": f"选项剧情生成失败：{error_msg}"})
 
+# 流式接口：/generate-option 的 SSE 版本，场景正文边生成边推送
+@app.route('/generate-option-stream', methods=['POST'])
+def generate_option_stream():
+    """
+    生成单个选项对应的剧情（Server-Sent Events）
+    事件：
+      scene_delta            场景正文增量 {"text"}
+      options                选项段完成 {"options"}
+      worldline_update       世界线更新段完成 {"text"}
+      deep_background_links  深层背景关联段完成 {"text"}
+      reset                  流式中断已回退为普通请求，前端应清空已显示的增量
+      done                   完整 optionData（与 /generate-option 一致）{"optionData", "cached"}
+      scene_image            图片生成结束 {"sceneImage"}（失败时为 null）
+      error / end
+    缓存已有该选项数据时直接发出 done；结果会写回 pregeneration_cache，供 /generate-option 与第二层预生成复用。
+    """
+    data = request.json or {}
+    option = (data.get('option') or '').strip()
+    global_state = data.get('globalState', {})
+    option_index = data.get('optionIndex', 0)
+    scene_id = data.get('sceneId', None)
+    include_image = data.get('includeImage', True)
+    
+    if not option:
+        return jsonify({"status": "error", "message": "选项内容不能为空！"})
+    if not global_state:
+        return jsonify({"status": "error", "message": "全局状态不能为空！"})
+    
+    is_initial = not scene_id or scene_id == 'initial'
+    initial_key = _initial_scene_key(_scene_owner(global_state))
+    
+    def lookup_cached():
+        """返回 (option_data, wait_event)：已有数据 / 其他线程正在生成时的等待事件"""
+        with scene_lock(initial_key if is_initial else scene_id):
+            if is_initial:
+                initial_cache = pregeneration_cache.get(initial_key)
+                if not initial_cache:
+                    return None, None
+                if initial_cache.get('completed', False):
+                    if option_index == 0 and option == "开始游戏":
+                        return _initial_option_data(initial_cache), None
+                    return initial_cache.get('layer1', {}).get(option_index), None
+                events = initial_cache.setdefault('generation_events', {})
+                if 'main' not in events:
+                    events['main'] = threading.Event()
+                return None, events['main']
+            
+            cache_entry = pregeneration_cache.lookup(scene_id)
+            if not cache_entry:
+                return None, None
+            cached = cache_entry.get('layer1', {}).get(option_index)
+            if cached:
+                return cached, None
+            status = cache_entry.get('generation_status', {}).get(option_index, 'pending')
+            if status in ['generating', 'text_only']:
+                events = cache_entry.setdefault('generation_events', {})
+                if option_index not in events:
+                    events[option_index] = threading.Event()
+                return None, events[option_index]
+            return None, None
+    
+    def write_back(option_data, status):
+        if is_initial or not option_data:
+            return
+        with scene_lock(scene_id):
+            cache_entry = pregeneration_cache.get(scene_id)
+            if not cache_entry:
+                return
+            if cache_entry.get('generation_status', {}).get(option_index) == 'cancelled':
+                return
+            cache_entry.setdefault('layer1', {})[option_index] = dict(option_data)
+            set_generation_status(scene_id, cache_entry, option_index, status)
+            ev = cache_entry.get('generation_events', {}).get(option_index)
+            if ev:
+                ev.set()
+    
+    def release_claim(status):
+        """本请求置为 generating 后未写回结果就结束：更新为终态并唤醒等待者，避免其空等到超时"""
+        if is_initial:
+            return
+        with scene_lock(scene_id):
+            cache_entry = pregeneration_cache.get(scene_id)
+            if not cache_entry or cache_entry.get('generation_status', {}).get(option_index) != 'generating':
+                return
+            set_generation_status(scene_id, cache_entry, option_index, status)
+            ev = cache_entry.get('generation_events', {}).get(option_index)
+            if ev:
+                ev.set()
+    
+    def stream():
+        import time
+        try:
+            option_data, wait_event = lookup_cached()
+            if not option_data and wait_event:
+                # 已有后台任务在生成该选项：等待其完成，期间发送注释行保持连接
+                wait_timeout = int(os.getenv("OPTION_WAIT_TIMEOUT_SECONDS", "300"))
+                deadline = time.time() + wait_timeout
+                while not wait_event.wait(timeout=max(0.1, min(15, deadline - time.time()))):
+                    if time.time() >= deadline:
+                        break
+                    yield ": keep-alive\n\n"
+                option_data, _ = lookup_cached()
+            
+            if option_data:
+                print(f"✅ [generate-option-stream] 命中缓存：scene_id={scene_id}, option_index={option_index}")
+                yield _sse_event("done", {"optionData": option_data, "cached": True})
+            else:
+                if not is_initial:
+                    with scene_lock(scene_id):
+                        cache_entry = pregeneration_cache.setdefault(scene_id, _new_scene_cache_entry(owner=_scene_owner(global_state)))
+                        set_generation_status(scene_id, cache_entry, option_index, 'generating')
+                
+                unfinished_status = 'failed'
+                try:
+                    for event in _generate_single_option_text_stream(option_index, option, global_state):
+                        name = event.get('event')
+                        if name == 'done':
+                            option_data = (event.get('result') or {}).get('data')
+                        else:
+                            yield _sse_event(name, {k: v for k, v in event.items() if k != 'event'})
+                    if option_data:
+                        write_back(option_data, 'text_completed')
+                        unfinished_status = None
+                except OperationCancelled:
+                    unfinished_status = 'cancelled'
+                    raise
+                finally:
+                    # 异常、取消或客户端断开（GeneratorExit）时 unfinished_status 仍有值
+                    if unfinished_status:
+                        release_claim(unfinished_status)
+                if not option_data:
+                    raise RuntimeError("未生成有效的剧情数据")
+                yield _sse_event("done", {"optionData": option_data, "cached": False})
+            
+            # 文本已推送，图片随后补发
+            scene_text = (option_data or {}).get("scene") or ""
+            scene_image = (option_data or {}).get("scene_image")
+            has_image = isinstance(scene_image, dict) and scene_image.get("url")
+            if include_image and not has_image and scene_text.strip():
+                img = generate_scene_image(scene_text, global_state, "default", use_cache=True)
+                if img and isinstance(img, dict) and img.get("url"):
+                    option_data["scene_image"] = _build_scene_image_payload(img, scene_text)
+                    yield _sse_event("scene_image", {"sceneImage": option_data["scene_image"]})
+                else:
+                    print("⚠️ [generate-option-stream] 场景图片生成失败，仅返回文本")
+                    yield _sse_event("scene_image", {"sceneImage": None})
+                write_back(option_data, 'completed')
+            
+            yield _sse_event("end", {})
+        except OperationCancelled:
+            print(f"⏹️ [generate-option-stream] 选项 {option_index} 的生成已取消")
+            yield _sse_event("error", {"message": "选项剧情生成已取消"})
+        except Exception as e:
+            print(f"🔴 [generate-option-stream] 流式生成失败：{str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield _sse_event("error", {"message": f"选项剧情生成失败：{clean_error_message(str(e))}"})
+    
+    return _sse_response(stream())
+
+# 推送接口：按 scene_id 订阅预生成进度（SSE），替代阻塞等待与轮询
+@app.route('/scene-progress/<scene_id>', methods=['GET'])
+def scene_progress(scene_id):
+    """
+    订阅场景的生成进度（Server-Sent Events）
+    - 连接后先发送当前快照（每个选项一条 status 事件），之后推送每次 generation_status 变化
+    - status 事件：{"sceneId", "optionIndex", "status", "optionData"}，
+      状态流转 pending → generating → text_completed → completed（或 text_only / failed / cancelled）
+    - 可选参数 optionIndex：只关注某个选项，该选项到达终态后结束
+    - scene_id 为 initial 时需带 gameId 参数（初始场景按玩家隔离）
+    - 所有已知选项都到达终态（或超过 SCENE_PROGRESS_MAX_SECONDS）后发送 end 并关闭
+    """
+    option_filter = request.args.get('optionIndex', default=None, type=int)
+    max_seconds = float(os.getenv("SCENE_PROGRESS_MAX_SECONDS", "600"))
+    keepalive_seconds = float(os.getenv("SCENE_PROGRESS_KEEPALIVE_SECONDS", "15"))
+    
+    is_initial = scene_id == 'initial'
+    cache_key = _initial_scene_key(request.args.get('gameId')) if is_initial else scene_id
+    
+    # 先订阅再取快照，避免两者之间的状态变化丢失
+    subscription = progress_bus.subscribe(cache_key)
+    
+    def snapshot():
+        events = []
+        with scene_lock(cache_key):
+            cache_entry = pregeneration_cache.get(cache_key)
+            if not cache_entry:
+                return events
+            if is_initial:
+                if cache_entry.get('completed', False):
+                    events.append({"sceneId": scene_id, "optionIndex": 0, "status": 'completed',
+                                   "optionData": _initial_option_data(cache_entry)})
+                elif cache_entry.get('error'):
+                    events.append({"sceneId": scene_id, "optionIndex": 0, "status": 'failed', "optionData": None})
+                return events
+            layer1 = cache_entry.get('layer1', {})
+            for idx, status in cache_entry.get('generation_status', {}).items():
+                events.append({"sceneId": scene_id, "optionIndex": idx, "status": status,
+                               "optionData": layer1.get(idx)})
+        return events
+    
+    def stream():
+        import time
+        statuses = {}
+        deadline = time.time() + max_seconds
+        
+        def finished():
+            if option_filter is not None:
+                return statuses.get(option_filter) in TERMINAL_GENERATION_STATUSES
+            return bool(statuses) and all(st in TERMINAL_GENERATION_STATUSES for st in statuses.values())
+        
+        try:
+            for event in snapshot():
+                if option_filter is not None and event["optionIndex"] != option_filter:
+                    continue
+                statuses[event["optionIndex"]] = event["status"]
+                yield _sse_event("status", event)
+            
+            while not finished() and time.time() < deadline:
+                try:
+                    event = subscription.get(timeout=max(0.1, min(keepalive_seconds, deadline - time.time())))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if option_filter is not None and event["optionIndex"] != option_filter:
+                    continue
+                statuses[event["optionIndex"]] = event["status"]
+                yield _sse_event("status", event)
+            
+            yield _sse_event("end", {"sceneId": scene_id, "statuses": statuses})
+        finally:
+            # 客户端断开（GeneratorExit）或正常结束都要退订
+            progress_bus.unsubscribe(cache_key, subscription)
+    
+    return _sse_response(stream())
+
 # 预生成两层内容的核心逻辑（提取为独立函数，可被其他函数调用）
 def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
     """
@@ -1099,7 +1492,7 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
     
     # 如果没有提供scene_id，生成一个新的
     if not scene_id:
-        scene_id = generate_scene_id(str(global_state), str(current_options))
+        scene_id = generate_scene_id(global_state, current_options)
         print(f"   - 未提供 scene_id，已生成新的：{scene_id}")
     else:
         print(f"   - 使用传入的 scene_id：{scene_id}")
@@ -1110,21 +1503,9 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
     def async_pregenerate():
         try:
             # 初始化缓存条目（需要先加锁检查，避免重复初始化）
-            with cache_lock:
+            with scene_lock(scene_id):
                 if scene_id not in pregeneration_cache:
-                    pregeneration_cache[scene_id] = {
-                        'layer1': {},
-                        'layer2': {},
-                        'generation_status': {},
-                        'generation_events': {},
-                        'should_cancel': False,
-                        'current_generating_index': None,
-                        'layer2_generating': False,
-                        'layer2_cancel': False,
-                        'layer2_selected_option': None,
-                        'layer2_thread': None,
-                        'current_layer2_option': None
-                    }
+                    pregeneration_cache[scene_id] = _new_scene_cache_entry(owner=_scene_owner(global_state))
                 
                 cache_entry = pregeneration_cache[scene_id]
                 
@@ -1132,7 +1513,7 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                 generation_status = cache_entry['generation_status']
                 for i in range(len(current_options)):
                     if i not in generation_status:
-                        generation_status[i] = 'pending'
+                        set_generation_status(scene_id, cache_entry, i, 'pending')
                         # 创建事件对象
                         if 'generation_events' not in cache_entry:
                             cache_entry['generation_events'] = {}
@@ -1142,11 +1523,86 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
             # 第一层：并行生成所有选项（按优先级顺序提交任务），生成一个立即写入缓存
             print(f"📝 预生成第一层：并行生成 {len(current_options)} 个选项的下一轮剧情...")
             
+            def generate_option_image_task(opt_idx, option_data, scene_for_image, text_already_exists, option_token):
+                """第一层图片任务（image 上游）：生成图片并回填缓存，完成后状态置为 completed；选项取消时中止图片请求"""
+                try:
+                    print(f"🎨 [第一层预生成] 开始为选项 {opt_idx + 1} 生成图片...")
+                    img = generate_scene_image(scene_for_image, global_state, "default", use_cache=True, cancel_token=option_token)
+                    print(f"🎨 [第一层预生成] generate_scene_image 返回：img={img is not None}, type={type(img)}")
+
+                    if img and isinstance(img, dict) and img.get('url'):
+                        print(f"🎨 [第一层预生成] 图片生成成功，URL: {img.get('url', 'N/A')[:80]}...")
+                        scene_text_hash = hashlib.md5(scene_for_image.encode('utf-8')).hexdigest()
+                        option_data['scene_image'] = {
+                            "url": img.get("url"),
+                            "prompt": img.get("prompt", ""),
+                            "style": img.get("style", "default"),
+                            "width": img.get("width", 1024),
+                            "height": img.get("height", 1024),
+                            "cached": img.get("cached", True),
+                            "scene_text_hash": scene_text_hash,
+                        }
+
+                        print(f"🎨 [第一层预生成] 准备更新缓存中的图片数据...")
+                        # 场景锁只被同一场景的请求/后台线程短暂持有，直接阻塞获取（等待时间计入锁统计）
+                        with scene_lock(scene_id):
+                            if scene_id in pregeneration_cache:
+                                cache_entry = pregeneration_cache[scene_id]
+                                if opt_idx in cache_entry.get('layer1', {}):
+                                    cache_entry['layer1'][opt_idx]['scene_image'] = option_data['scene_image']
+                                    set_generation_status(scene_id, cache_entry, opt_idx, 'completed')  # 标记为完全完成
+                                    print(f"🎨 [第一层预生成] 缓存更新完成，状态已设置为 completed")
+                                else:
+                                    # ✅ 优化：即使 layer1 被清理，如果图片已生成，也应该写入缓存
+                                    # 原因：图片生成成本高，即使选项被取消，也应该保存以备后用
+                                    generation_status = cache_entry.get('generation_status', {})
+                                    current_status = generation_status.get(opt_idx, 'pending')
+
+                                    # 如果状态是 generating、text_completed 或 cancelled，但图片已生成，都应该写入缓存
+                                    # cancelled 状态可能是因为用户选择了其他选项，但图片可能仍然有用
+                                    if current_status in ['generating', 'text_completed'] or (current_status == 'cancelled' and option_data.get('scene_image')):
+                                        # 重新创建 layer1 数据并写入图片
+                                        if 'layer1' not in cache_entry:
+                                            cache_entry['layer1'] = {}
+                                        cache_entry['layer1'][opt_idx] = option_data
+                                        # 如果之前是 cancelled，现在图片生成了，可以标记为 completed（图片已就绪）
+                                        if current_status == 'cancelled':
+                                            set_generation_status(scene_id, cache_entry, opt_idx, 'completed')
+                                            print(f"✅ [第一层预生成] 选项 {opt_idx} 的 layer1 被清理且状态为 cancelled，但图片已生成，已重新写入缓存并标记为 completed")
+                                        else:
+                                            set_generation_status(scene_id, cache_entry, opt_idx, 'completed')
+                                            print(f"✅ [第一层预生成] 选项 {opt_idx} 的 layer1 被清理但正在生成中，已重新写入缓存并完成")
+                                        events = cache_entry.get('generation_events', {})
+                                        if opt_idx in events:
+                                            events[opt_idx].set()
+                                    else:
+                                        # 确实是被取消的选项且没有图片，标记为 cancelled
+                                        set_generation_status(scene_id, cache_entry, opt_idx, 'cancelled')
+                                        events = cache_entry.get('generation_events', {})
+                                        if opt_idx in events:
+                                            events[opt_idx].set()
+                                        print(f"⏭️ [第一层预生成] 选项 {opt_idx} 的 layer1 已被清理，标记为 cancelled（跳过图片回填）")
+                            else:
+                                print(f"⚠️ [第一层预生成] 缓存中找不到 scene_id: {scene_id}")
+
+                        if text_already_exists:
+                            print(f"✅ 选项 {opt_idx + 1} 图片已生成（复用文本）")
+                        else:
+                            print(f"✅ 选项 {opt_idx + 1} 场景图片已预生成并更新缓存")
+                    else:
+                        print(f"⚠️ 选项 {opt_idx + 1} 场景图片生成失败，将按需补图（img={img}, url={img.get('url') if img else 'N/A'}）")
+                except OperationCancelled:
+                    print(f"⏹️ [第一层预生成] 选项 {opt_idx + 1} 已取消，中止图片生成")
+                except Exception as img_err:
+                    print(f"⚠️ 选项 {opt_idx + 1} 场景图片生成异常：{img_err}，将按需补图")
+                    import traceback
+                    traceback.print_exc()
+            
             # 定义单个选项的生成任务函数
             def generate_single_option_task(opt_idx, option):
                 """生成单个选项的任务函数"""
                 # 在设置状态为 'generating' 之前就检查取消标志和状态
-                with cache_lock:
+                with scene_lock(scene_id):
                     if scene_id not in pregeneration_cache:
                         return
                     cache_entry = pregeneration_cache[scene_id]
@@ -1177,8 +1633,10 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                     
                     # 更新状态为 'generating'（只有在 pending 状态时才设置）
                     if current_status == 'pending':
-                        generation_status[opt_idx] = 'generating'
+                        set_generation_status(scene_id, cache_entry, opt_idx, 'generating')
                         cache_entry['current_generating_index'] = opt_idx
+                    # 选项被取消（或场景被清理）时，该令牌中止本任务在途的文本/图片请求
+                    option_token = _option_cancel_token(cache_entry, opt_idx)
                 
                 print(f"📝 开始并行生成选项 {opt_idx + 1}/{len(current_options)}: {option[:30]}...")
                 
@@ -1187,15 +1645,10 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                     option_data = None
                     scene_for_image = None
                     text_already_exists = False
-                    need_wait_for_text = False
-                    text_wait_event = None
                     
-                    with cache_lock:
+                    with scene_lock(scene_id):
                         if scene_id in pregeneration_cache:
                             cache_entry = pregeneration_cache[scene_id]
-                            generation_status = cache_entry.get('generation_status', {})
-                            status = generation_status.get(opt_idx, 'pending')
-                            
                             if 'layer1' in cache_entry and opt_idx in cache_entry['layer1']:
                                 existing_data = cache_entry['layer1'][opt_idx]
                                 # 检查是否只有文本（没有图片或图片无效）
@@ -1207,42 +1660,11 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                                         scene_for_image = (option_data.get('scene') or '').strip() or None
                                         text_already_exists = True
                                         print(f"🔄 选项 {opt_idx} 已有文本数据，将只生成图片")
-                            elif status == 'text_only':
-                                # 🆕 优化：文本正在生成中（来自上一层的第二层预生成），等待完成
-                                print(f"⏳ 选项 {opt_idx} 的文本正在生成中（来自上一层的第二层预生成），等待完成...")
-                                need_wait_for_text = True
-                                events = cache_entry.setdefault('generation_events', {})
-                                if opt_idx not in events:
-                                    events[opt_idx] = threading.Event()
-                                text_wait_event = events[opt_idx]
-                    
-                    # 🆕 优化：如果文本正在生成中，等待完成
-                    if need_wait_for_text and text_wait_event:
-                        wait_timeout = 180  # 最多等待180秒
-                        print(f"⏳ [第一层预生成] 等待选项 {opt_idx} 的文本生成完成（超时：{wait_timeout}秒）...")
-                        event_triggered = text_wait_event.wait(timeout=wait_timeout)
-                        
-                        if event_triggered:
-                            print(f"✅ [第一层预生成] 选项 {opt_idx} 的文本生成完成")
-                            # 再次检查缓存，获取文本数据
-                            with cache_lock:
-                                if scene_id in pregeneration_cache:
-                                    cache_entry = pregeneration_cache[scene_id]
-                                    if 'layer1' in cache_entry and opt_idx in cache_entry['layer1']:
-                                        existing_data = cache_entry['layer1'][opt_idx]
-                                        if existing_data and isinstance(existing_data, dict):
-                                            existing_image = existing_data.get('scene_image')
-                                            if not existing_image or not existing_image.get('url'):
-                                                option_data = existing_data.copy()
-                                                scene_for_image = (option_data.get('scene') or '').strip() or None
-                                                text_already_exists = True
-                                                print(f"🔄 选项 {opt_idx} 文本生成完成，将只生成图片")
-                        else:
-                            print(f"⚠️ [第一层预生成] 等待选项 {opt_idx} 的文本生成超时，将正常生成（文本+图片）")
                     
+                    # 第二层预生成若正在生成同一选项的文本，下面的文本请求会与之合并（single_flight），无需另行等待
                     # 如果没有文本数据，正常生成文本+图片
                     if not text_already_exists:
-                        result = _generate_single_option_text_only(opt_idx, option, global_state)
+                        result = _generate_single_option_text_only(opt_idx, option, global_state, cancel_token=option_token)
                         if result is None:
                             print(f"⚠️ [第一层预生成] 选项 {opt_idx} 的文本生成返回 None")
                             option_data = None
@@ -1265,8 +1687,8 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                     # 🔧 优化：文本生成完成后立即写入缓存（让第二层预生成可以立即开始）
                     # 然后再生成图片并更新缓存
                     if option_data:  # 确保有数据才写入
-                        # 🔧 使用带追踪的 cache_lock（可定位持锁线程）
-                        with cache_lock:
+                        # 🔧 只持有该场景的锁（不同场景互不阻塞）
+                        with scene_lock(scene_id):
                             # 🔍 再次检查 scene_id 是否在缓存中（在锁内）
                             if scene_id in pregeneration_cache:
                                 cache_entry = pregeneration_cache[scene_id]
@@ -1286,7 +1708,7 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                                 
                                 # 先写入文本数据（让第二层预生成可以立即开始）
                                 cache_entry['layer1'][opt_idx] = option_data.copy()  # 复制，避免后续修改影响
-                                cache_entry['generation_status'][opt_idx] = 'text_completed'  # 标记为文本已完成
+                                set_generation_status(scene_id, cache_entry, opt_idx, 'text_completed')  # 标记为文本已完成
                                 
                                 # 🔍 调试日志：显示写入缓存后的状态（简化日志，减少锁持有时间）
                                 print(f"✅ 选项 {opt_idx} 文本已写入缓存（等待图片生成），scene_id: {scene_id}")
@@ -1299,210 +1721,90 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                             else:
                                 print(f"⚠️ [第一层预生成] scene_id {scene_id} 不在缓存中，无法写入选项 {opt_idx} 的数据")
                     
-                    # 为当前场景生成图片（限速由 yunwu 全局限速锁 + IMAGE_SUBMIT_DELAY 控制）
-                    # 图片生成完成后更新缓存
+                    # 为当前场景生成图片：作为第一层图片任务交给调度器（image 上游，优先级低于文本任务）
+                    # 图片生成完成后更新缓存；返回图片任务的 Future，供调用方等待
                     if scene_for_image and option_data:
-                        try:
-                            print(f"🎨 [第一层预生成] 开始为选项 {opt_idx + 1} 生成图片...")
-                            img = generate_scene_image(scene_for_image, global_state, "default", use_cache=True)
-                            print(f"🎨 [第一层预生成] generate_scene_image 返回：img={img is not None}, type={type(img)}")
-                            
-                            if img and isinstance(img, dict) and img.get('url'):
-                                print(f"🎨 [第一层预生成] 图片生成成功，URL: {img.get('url', 'N/A')[:80]}...")
-                                scene_text_hash = hashlib.md5(scene_for_image.encode('utf-8')).hexdigest()
-                                option_data['scene_image'] = {
-                                    "url": img.get("url"),
-                                    "prompt": img.get("prompt", ""),
-                                    "style": img.get("style", "default"),
-                                    "width": img.get("width", 1024),
-                                    "height": img.get("height", 1024),
-                                    "cached": img.get("cached", True),
-                                    "scene_text_hash": scene_text_hash,
-                                }
-                                
-                                print(f"🎨 [第一层预生成] 准备更新缓存中的图片数据...")
-                                # 🔧 修复：添加超时机制，避免无限等待锁
-                                import time
-                                import threading as th
-                                lock_acquired = False
-                                lock_start_time = time.time()
-                                max_lock_wait = 10  # 最多等待10秒获取锁
-                                current_thread_name = th.current_thread().name
-                                
-                                print(f"🔍 [第一层预生成] 当前线程：{current_thread_name}，尝试获取缓存锁...")
-                                
-                                while not lock_acquired and (time.time() - lock_start_time) < max_lock_wait:
-                                    try:
-                                        # 尝试非阻塞获取锁
-                                        if cache_lock.acquire(blocking=False):
-                                            lock_acquired = True
-                                            elapsed_wait = time.time() - lock_start_time
-                                            print(f"🎨 [第一层预生成] 已获取缓存锁，开始更新...（等待时间：{elapsed_wait:.2f}秒，线程：{current_thread_name}）")
-                                            try:
-                                                if scene_id in pregeneration_cache:
-                                                    cache_entry = pregeneration_cache[scene_id]
-                                                    if opt_idx in cache_entry.get('layer1', {}):
-                                                        cache_entry['layer1'][opt_idx]['scene_image'] = option_data['scene_image']
-                                                        cache_entry['generation_status'][opt_idx] = 'completed'  # 标记为完全完成
-                                                        print(f"🎨 [第一层预生成] 缓存更新完成，状态已设置为 completed")
-                                                    else:
-                                                        # ✅ 优化：即使 layer1 被清理，如果图片已生成，也应该写入缓存
-                                                        # 原因：图片生成成本高，即使选项被取消，也应该保存以备后用
-                                                        generation_status = cache_entry.get('generation_status', {})
-                                                        current_status = generation_status.get(opt_idx, 'pending')
-                                                        
-                                                        # 如果状态是 generating、text_completed 或 cancelled，但图片已生成，都应该写入缓存
-                                                        # cancelled 状态可能是因为用户选择了其他选项，但图片可能仍然有用
-                                                        if current_status in ['generating', 'text_completed'] or (current_status == 'cancelled' and option_data.get('scene_image')):
-                                                            # 重新创建 layer1 数据并写入图片
-                                                            if 'layer1' not in cache_entry:
-                                                                cache_entry['layer1'] = {}
-                                                            cache_entry['layer1'][opt_idx] = option_data
-                                                            # 如果之前是 cancelled，现在图片生成了，可以标记为 completed（图片已就绪）
-                                                            if current_status == 'cancelled':
-                                                                cache_entry['generation_status'][opt_idx] = 'completed'
-                                                                print(f"✅ [第一层预生成] 选项 {opt_idx} 的 layer1 被清理且状态为 cancelled，但图片已生成，已重新写入缓存并标记为 completed")
-                                                            else:
-                                                                cache_entry['generation_status'][opt_idx] = 'completed'
-                                                                print(f"✅ [第一层预生成] 选项 {opt_idx} 的 layer1 被清理但正在生成中，已重新写入缓存并完成")
-                                                            events = cache_entry.get('generation_events', {})
-                                                            if opt_idx in events:
-                                                                events[opt_idx].set()
-                                                        else:
-                                                            # 确实是被取消的选项且没有图片，标记为 cancelled
-                                                            cache_entry['generation_status'][opt_idx] = 'cancelled'
-                                                            events = cache_entry.get('generation_events', {})
-                                                            if opt_idx in events:
-                                                                events[opt_idx].set()
-                                                            print(f"⏭️ [第一层预生成] 选项 {opt_idx} 的 layer1 已被清理，标记为 cancelled（跳过图片回填）")
-                                                else:
-                                                    print(f"⚠️ [第一层预生成] 缓存中找不到 scene_id: {scene_id}")
-                                            finally:
-                                                cache_lock.release()
-                                                print(f"🎨 [第一层预生成] 已释放缓存锁（线程：{current_thread_name}）")
-                                        else:
-                                            # 锁被其他线程持有，等待一小段时间后重试
-                                            elapsed = time.time() - lock_start_time
-                                            if elapsed < max_lock_wait:
-                                                if int(elapsed * 2) % 2 == 0:  # 每0.5秒打印一次
-                                                    # 🔧 调试：显示当前持有锁的线程信息
-                                                    import threading as th
-                                                    if _cache_lock_holder:
-                                                        holder_name = _cache_lock_holder.name if hasattr(_cache_lock_holder, 'name') else str(_cache_lock_holder)
-                                                        holder_time = time.time() - _cache_lock_acquire_time if _cache_lock_acquire_time else 0
-                                                        print(f"⏳ [第一层预生成] 等待获取缓存锁...（已等待 {elapsed:.1f}秒，最多等待 {max_lock_wait}秒，线程：{current_thread_name}）")
-                                                        print(f"   🔍 锁被线程持有：{holder_name}，已持有 {holder_time:.1f}秒")
-                                                        if holder_time > 5:
-                                                            print(f"   ⚠️ 警告：锁被持有超过5秒，可能存在死锁或耗时操作！")
-                                                    # 🔧 关键：打印持锁线程的“实时堆栈”，定位卡在哪一行
-                                                    stack = cache_lock.dump_holder_stack()
-                                                    if stack:
-                                                        print(f"   🧵 持锁线程实时堆栈（{holder_name}）:\n{stack}")
-                                                    else:
-                                                        print(f"⏳ [第一层预生成] 等待获取缓存锁...（已等待 {elapsed:.1f}秒，最多等待 {max_lock_wait}秒，线程：{current_thread_name}）")
-                                                time.sleep(0.5)  # 等待0.5秒后重试
-                                            else:
-                                                break
-                                    except Exception as lock_err:
-                                        print(f"⚠️ [第一层预生成] 获取缓存锁时发生错误：{lock_err}")
-                                        import traceback
-                                        traceback.print_exc()
-                                        break
-                                
-                                if not lock_acquired:
-                                    print(f"❌ [第一层预生成] 获取缓存锁超时（{max_lock_wait}秒），跳过缓存更新")
-                                    print(f"   💡 提示：图片数据已生成，但无法更新缓存，可能稍后会被其他线程更新")
-                                    print(f"   🔍 调试：scene_id={scene_id}, opt_idx={opt_idx}, 线程：{current_thread_name}")
-                                    # 🔧 修复：即使无法更新缓存，也尝试触发等待事件，避免其他线程无限等待
-                                    try:
-                                        if cache_lock.acquire(blocking=False):
-                                            try:
-                                                if scene_id in pregeneration_cache:
-                                                    cache_entry = pregeneration_cache[scene_id]
-                                                    events = cache_entry.get('generation_events', {})
-                                                    if opt_idx in events:
-                                                        events[opt_idx].set()
-                                                        print(f"   ✅ 已触发等待事件，通知其他线程图片数据已就绪")
-                                            finally:
-                                                cache_lock.release()
-                                    except:
-                                        pass
-                                
-                                if text_already_exists:
-                                    print(f"✅ 选项 {opt_idx + 1} 图片已生成（复用文本）")
-                                else:
-                                    print(f"✅ 选项 {opt_idx + 1} 场景图片已预生成并更新缓存")
-                            else:
-                                print(f"⚠️ 选项 {opt_idx + 1} 场景图片生成失败，将按需补图（img={img}, url={img.get('url') if img else 'N/A'}）")
-                        except Exception as img_err:
-                            print(f"⚠️ 选项 {opt_idx + 1} 场景图片生成异常：{img_err}，将按需补图")
-                            import traceback
-                            traceback.print_exc()
+                        return generation_scheduler.submit(
+                            generate_option_image_task, opt_idx, option_data, scene_for_image, text_already_exists, option_token,
+                            priority=PRIORITY_LAYER1_IMAGE, upstream="image", tag={"scene_id": scene_id, "option_index": opt_idx}
+                        )
                     elif not option_data:
                         print(f"⚠️ [第一层预生成] 选项 {opt_idx} 的 option_data 为空，无法写入缓存")
                         # 即使 option_data 为空，也要更新状态，避免一直处于 generating
-                        with cache_lock:
+                        with scene_lock(scene_id):
                             if scene_id in pregeneration_cache:
                                 cache_entry = pregeneration_cache[scene_id]
-                                cache_entry['generation_status'][opt_idx] = 'failed'
+                                set_generation_status(scene_id, cache_entry, opt_idx, 'failed')
                                 events = cache_entry.get('generation_events', {})
                                 if opt_idx in events:
                                     events[opt_idx].set()
                                     print(f"   - 已触发选项 {opt_idx} 的等待事件（失败状态）")
+                except OperationCancelled:
+                    # 取消方已把状态置为 cancelled 并唤醒等待者
+                    print(f"⏹️ [第一层预生成] 选项 {opt_idx} 已取消，中止生成")
                 except Exception as e:
                     print(f"❌ 生成选项 {opt_idx} 失败：{str(e)}")
                     print(f"   - scene_id: {scene_id}")
                     import traceback
                     traceback.print_exc()
-                    with cache_lock:
+                    with scene_lock(scene_id):
                         if scene_id in pregeneration_cache:
                             cache_entry = pregeneration_cache[scene_id]
-                            cache_entry['generation_status'][opt_idx] = 'failed'
+                            set_generation_status(scene_id, cache_entry, opt_idx, 'failed')
                             events = cache_entry.get('generation_events', {})
                             if opt_idx in events:
                                 events[opt_idx].set()
                         else:
                             print(f"⚠️ [异常处理] scene_id {scene_id} 不在缓存中，无法更新状态")
             
-            # 使用线程池并行生成所有选项（按优先级顺序提交任务）
-            # 限制并发，避免同时触发过多 LLM/下游调用导致排队或限流
-            max_workers = min(len(current_options), int(os.getenv("PREGEN_MAX_WORKERS", "2")))
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # 按优先级顺序（0→1→2→3）提交所有任务
-                futures = []
-                for opt_idx in range(len(current_options)):
-                    option = current_options[opt_idx]
-                    future = executor.submit(generate_single_option_task, opt_idx, option)
-                    futures.append((opt_idx, future))
-                
-                # 等待所有任务完成（可选，但保留以便跟踪完成状态）
-                print(f"🔍 [第一层预生成] 开始等待所有任务完成，共 {len(futures)} 个任务")
-                for opt_idx, future in futures:
-                    try:
-                        future.result()  # 等待任务完成，如果有异常会抛出
-                        print(f"✅ [第一层预生成] 选项 {opt_idx} 的任务已完成")
-                        # 🔍 立即检查缓存状态
-                        with cache_lock:
-                            if scene_id in pregeneration_cache:
-                                cache_entry = pregeneration_cache[scene_id]
-                                if opt_idx in cache_entry.get('layer1', {}):
-                                    print(f"   ✅ 选项 {opt_idx} 的数据已在缓存中")
-                                else:
-                                    print(f"   ⚠️ 选项 {opt_idx} 的数据不在缓存中！")
-                                status = cache_entry.get('generation_status', {}).get(opt_idx, 'unknown')
-                                print(f"   - 选项 {opt_idx} 的状态: {status}")
-                    except Exception as e:
-                        print(f"❌ 选项 {opt_idx} 的任务执行异常：{str(e)}")
-                        import traceback
-                        traceback.print_exc()
+            # 交给全局调度器并行生成所有选项（第一层文本优先级，按 0→1→2→3 顺序提交）
+            # 并发由调度器按上游统一限制（GEN_SCHED_LLM_CONCURRENCY / GEN_SCHED_IMAGE_CONCURRENCY），不再每次预生成单独开线程池
+            futures = []
+            for opt_idx in range(len(current_options)):
+                option = current_options[opt_idx]
+                future = generation_scheduler.submit(
+                    generate_single_option_task, opt_idx, option,
+                    priority=PRIORITY_LAYER1_TEXT, upstream="llm", tag={"scene_id": scene_id, "option_index": opt_idx}
+                )
+                futures.append((opt_idx, future))
+            
+            # 等待所有任务完成（文本任务返回其图片任务的 Future，一并等待）
+            print(f"🔍 [第一层预生成] 开始等待所有任务完成，共 {len(futures)} 个任务")
+            image_futures = []
+            for opt_idx, future in futures:
+                try:
+                    image_future = future.result()  # 等待文本任务完成，如果有异常会抛出
+                    if image_future is not None:
+                        image_futures.append((opt_idx, image_future))
+                    print(f"✅ [第一层预生成] 选项 {opt_idx} 的文本任务已完成")
+                except Exception as e:
+                    print(f"❌ 选项 {opt_idx} 的任务执行异常：{str(e)}")
+                    import traceback
+                    traceback.print_exc()
+            for opt_idx, image_future in image_futures:
+                try:
+                    image_future.result()
+                except Exception as e:
+                    print(f"❌ 选项 {opt_idx} 的图片任务执行异常：{str(e)}")
+            for opt_idx, _ in futures:
+                # 🔍 检查缓存状态
+                with scene_lock(scene_id):
+                    if scene_id in pregeneration_cache:
+                        cache_entry = pregeneration_cache[scene_id]
+                        if opt_idx in cache_entry.get('layer1', {}):
+                            print(f"   ✅ 选项 {opt_idx} 的数据已在缓存中")
+                        else:
+                            print(f"   ⚠️ 选项 {opt_idx} 的数据不在缓存中！")
+                        status = cache_entry.get('generation_status', {}).get(opt_idx, 'unknown')
+                        print(f"   - 选项 {opt_idx} 的状态: {status}")
             
             # 清理当前生成索引
-            with cache_lock:
+            with scene_lock(scene_id):
                 if scene_id in pregeneration_cache:
                     pregeneration_cache[scene_id]['current_generating_index'] = None
             
             # 🔍 调试日志：检查第一层预生成完成后的缓存状态
-            with cache_lock:
+            with scene_lock(scene_id):
                 if scene_id in pregeneration_cache:
                     cache_entry = pregeneration_cache[scene_id]
                     layer1_count = len(cache_entry.get('layer1', {}))
@@ -1528,55 +1830,84 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
             
             def generate_layer2():
                 try:
-                    # 🔧 优化：等待第一层文本数据写入缓存（文本生成完成后立即写入，所以等待时间很短）
-                    import time
-                    max_wait_attempts = 10  # 最多等待10次（文本生成很快）
-                    wait_interval = 0.3  # 每次等待0.3秒
+                    # 🔧 优化：在场景级条件变量上等待第一层文本数据写入缓存（任一选项状态变化即被唤醒，不再 sleep 轮询）
+                    layer1_wait_seconds = 3.0  # 文本生成完成后立即写入，所以等待时间很短
+                    expected_count = len(current_options)
                     layer1_data = {}
                     selected_option = None
                     
-                    for attempt in range(max_wait_attempts):
-                        # 🔧 修复：在锁外检查，避免长时间持有锁
-                        should_continue = False
-                        with cache_lock:
-                            if scene_id not in pregeneration_cache:
-                                if attempt < max_wait_attempts - 1:
-                                    should_continue = True
-                                else:
-                                    return
-                            
-                            if should_continue:
-                                # 释放锁后再 sleep
-                                pass
-                            else:
-                                cache_entry = pregeneration_cache[scene_id]
-                                layer1_data_temp = cache_entry.get('layer1', {})
-                                expected_count = len(current_options)
-                                
-                                # 检查是否所有选项的文本数据都已写入缓存（只需要文本数据，不需要图片）
-                                text_completed_count = 0
-                                for opt_idx in range(expected_count):
-                                    status = cache_entry.get('generation_status', {}).get(opt_idx, 'pending')
-                                    if status in ['text_completed', 'completed'] and opt_idx in layer1_data_temp:
-                                        text_completed_count += 1
+                    def count_text_completed(cache_entry):
+                        layer1_data_temp = cache_entry.get('layer1', {})
+                        generation_status = cache_entry.get('generation_status', {})
+                        return sum(
+                            1 for opt_idx in range(expected_count)
+                            if generation_status.get(opt_idx, 'pending') in ['text_completed', 'completed'] and opt_idx in layer1_data_temp
+                        )
+                    
+                    pregeneration_cache.wait_until(
+                        scene_id,
+                        lambda entry: entry is not None and count_text_completed(entry) >= expected_count,
+                        layer1_wait_seconds
+                    )
+                    with scene_lock(scene_id):
+                        cache_entry = pregeneration_cache.get(scene_id)
+                        if not cache_entry:
+                            return
+                        text_completed_count = count_text_completed(cache_entry)
+                        layer1_data = cache_entry.get('layer1', {}).copy()  # 复制数据，避免长时间持有锁
+                        selected_option = cache_entry.get('layer2_selected_option', None)
+                        layer2_token = cache_entry.get('layer2_cancel_token')
+                    if text_completed_count >= expected_count:
+                        print(f"✅ [第二层预生成] 第一层文本数据已就绪，共 {text_completed_count} 个选项")
+                    else:
+                        # 等待超时，即使数据不完整也继续
+                        print(f"⚠️ [第二层预生成] 等待超时，当前只有 {text_completed_count}/{expected_count} 个选项的文本数据，继续生成")
+                    
+                    # 第二层是推测生成：以最低优先级交给调度器，玩家正在等待的任务总能优先拿到 LLM 名额
+                    layer2_submit = generation_scheduler.submitter(
+                        PRIORITY_LAYER2_SPECULATIVE, upstream="llm", tag={"scene_id": scene_id}
+                    )
+                    
+                    def store_layer2(opt_idx, next_scene_id, layer2_data):
+                        """
+                        写回第二层数据，返回 False 表示已被取消。
+                        依次（不嵌套）持有当前场景锁与下一层场景锁，避免两个场景锁之间的死锁。
+                        """
+                        with scene_lock(scene_id):
+                            cache_entry = pregeneration_cache.get(scene_id)
+                            if cache_entry is None:
+                                # 当前场景已被淘汰/清理：其第二层数据不再需要
+                                print(f"⏹️ 场景 {scene_id} 已不在缓存中，丢弃选项 {opt_idx} 的第二层数据")
+                                return False
+                            if cache_entry.get('layer2_cancel', False):
+                                print(f"⏹️ 选项 {opt_idx} 的第二层生成在生成过程中被取消")
+                                return False
+                        
+                        # 🆕 优化：将第二层预生成的数据存储到下一层场景的 layer1（只有文本）
+                        with scene_lock(next_scene_id):
+                            # 初始化下一层场景的缓存结构（标记：只有文本，需要后续生成图片）
+                            next_cache_entry = pregeneration_cache.setdefault(
+                                next_scene_id, dict(_new_scene_cache_entry(owner=_scene_owner(global_state)), text_only_mode=True)
+                            )
+                            # layer2_data 格式：{option_index: option_data}
+                            for next_opt_idx, next_option_data in layer2_data.items():
+                                next_cache_entry.setdefault('layer1', {})[next_opt_idx] = next_option_data
+                                # 标记为只有文本，需要后续生成图片（同时唤醒等待该选项文本的第一层预生成）
+                                set_generation_status(next_scene_id, next_cache_entry, next_opt_idx, 'text_only')
                                 
-                                if text_completed_count >= expected_count:
-                                    layer1_data = layer1_data_temp.copy()  # 复制数据，避免长时间持有锁
-                                    selected_option = cache_entry.get('layer2_selected_option', None)
-                                    print(f"✅ [第二层预生成] 第一层文本数据已就绪，共 {text_completed_count} 个选项")
-                                    break
-                                elif attempt < max_wait_attempts - 1:
-                                    print(f"⏳ [第二层预生成] 等待第一层文本数据... ({text_completed_count}/{expected_count}，尝试 {attempt+1}/{max_wait_attempts})")
-                                    should_continue = True
-                                else:
-                                    # 最后一次尝试，即使数据不完整也继续
-                                    layer1_data = layer1_data_temp.copy()
-                                    selected_option = cache_entry.get('layer2_selected_option', None)
-                                    print(f"⚠️ [第二层预生成] 等待超时，当前只有 {text_completed_count}/{expected_count} 个选项的文本数据，继续生成")
+                                # 🆕 触发等待事件，通知第一层预生成可以开始生成图片了
+                                events = next_cache_entry.setdefault('generation_events', {})
+                                if next_opt_idx not in events:
+                                    events[next_opt_idx] = threading.Event()
+                                events[next_opt_idx].set()
                         
-                        # 🔧 修复：在锁外 sleep，避免阻塞其他线程
-                        if should_continue:
-                            time.sleep(wait_interval)
+                        # 保留原有的 layer2 存储（向后兼容）
+                        with scene_lock(scene_id):
+                            cache_entry = pregeneration_cache.get(scene_id)
+                            if cache_entry is not None:
+                                cache_entry.setdefault('layer2', {})[opt_idx] = layer2_data
+                                pregeneration_cache.account(scene_id, cache_entry)
+                        return True
                     
                     need_process_options = []
                     
@@ -1595,7 +1926,7 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                         
                         if next_options:
                             # 检查取消标志（在锁外快速检查）
-                            with cache_lock:
+                            with scene_lock(scene_id):
                                 if scene_id not in pregeneration_cache:
                                     return
                                 cache_entry = pregeneration_cache[scene_id]
@@ -1607,71 +1938,29 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                             
                             # 更新global_state（应用第一层的flow_update）
                             updated_global_state = global_state.copy()
-                            if 'flow_worldline' not in updated_global_state:
-                                updated_global_state['flow_worldline'] = {}
+                            # flow_worldline 单独复制：浅拷贝会让各选项的 flow_update 互相累积，导致预测的 next_scene_id 偏离
+                            updated_global_state['flow_worldline'] = dict(updated_global_state.get('flow_worldline') or {})
                             flow_update = layer1_option_data.get('flow_update', {})
                             if flow_update:
                                 updated_global_state['flow_worldline'].update(flow_update)
                             
                             # 计算下一层场景的 scene_id（用于存储第二层预生成的数据）
-                            next_scene_id = generate_scene_id(str(updated_global_state), str(next_options))
+                            next_scene_id = generate_scene_id(updated_global_state, next_options)
                             print(f"🔍 [第二层预生成] 计算下一层场景ID：{next_scene_id}")
                             
                             # 为下一轮的每个选项生成再下一层剧情（在锁外执行，避免长时间持有锁）
                             try:
-                                layer2_data = generate_all_options(updated_global_state, next_options, skip_images=True)
+                                layer2_data = generate_all_options(
+                                    updated_global_state, next_options, skip_images=True, submit=layer2_submit, cancel_token=layer2_token
+                                )
                                 
                                 # 再次检查取消标志并写入缓存（生成过程中可能被取消）
-                                with cache_lock:
-                                    if scene_id in pregeneration_cache:
-                                        cache_entry = pregeneration_cache[scene_id]
-                                        if cache_entry.get('layer2_cancel', False):
-                                            print(f"⏹️ 选项 {opt_idx} 的第二层生成在生成过程中被取消")
-                                            return
-                                    
-                                    # 🆕 优化：将第二层预生成的数据存储到下一层场景的 layer1（只有文本）
-                                    # 初始化下一层场景的缓存结构
-                                    if next_scene_id not in pregeneration_cache:
-                                        pregeneration_cache[next_scene_id] = {
-                                            'layer1': {},
-                                            'layer2': {},
-                                            'generation_status': {},
-                                            'generation_events': {},
-                                            'should_cancel': False,
-                                            'current_generating_index': None,
-                                            'layer2_generating': False,
-                                            'layer2_cancel': False,
-                                            'layer2_selected_option': None,
-                                            'layer2_thread': None,
-                                            'current_layer2_option': None,
-                                            'text_only_mode': True  # 标记：只有文本，需要后续生成图片
-                                        }
-                                    
-                                    next_cache_entry = pregeneration_cache[next_scene_id]
-                                    
-                                    # 将第二层预生成的数据存储到下一层场景的 layer1（只有文本）
-                                    # layer2_data 格式：{option_index: option_data}
-                                    for next_opt_idx, next_option_data in layer2_data.items():
-                                        if 'layer1' not in next_cache_entry:
-                                            next_cache_entry['layer1'] = {}
-                                        next_cache_entry['layer1'][next_opt_idx] = next_option_data
-                                        # 标记为只有文本，需要后续生成图片
-                                        next_cache_entry['generation_status'][next_opt_idx] = 'text_only'
-                                        
-                                        # 🆕 创建等待事件，用于通知第一层预生成文本已完成
-                                        events = next_cache_entry.setdefault('generation_events', {})
-                                        if next_opt_idx not in events:
-                                            events[next_opt_idx] = threading.Event()
-                                        
-                                        # 触发等待事件，通知第一层预生成可以开始生成图片了
-                                        events[next_opt_idx].set()
-                                        print(f"✅ 选项 {opt_idx} 的第二层数据已存储到下一层场景 {next_scene_id} 的 layer1[{next_opt_idx}]（只有文本），已触发等待事件")
-                                    
-                                    # 保留原有的 layer2 存储（向后兼容）
-                                    if 'layer2' not in cache_entry:
-                                        cache_entry['layer2'] = {}
-                                    cache_entry['layer2'][opt_idx] = layer2_data
-                                    print(f"✅ 选项 {opt_idx} 的第二层生成完成，共生成 {len(layer2_data)} 个选项的剧情（已存储到下一层场景 {next_scene_id}）")
+                                if not store_layer2(opt_idx, next_scene_id, layer2_data):
+                                    return
+                                print(f"✅ 选项 {opt_idx} 的第二层生成完成，共生成 {len(layer2_data)} 个选项的剧情（已存储到下一层场景 {next_scene_id}）")
+                            except OperationCancelled:
+                                print(f"⏹️ 选项 {opt_idx} 的第二层生成被取消，已中止在途请求")
+                                return
                             except Exception as e:
                                 print(f"❌ 生成选项 {opt_idx} 的第二层失败：{str(e)}")
                         
@@ -1682,7 +1971,7 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                         layer2_count = 0
                         for opt_idx, layer1_option_data in layer1_data.items():
                             # 检查取消标志（在锁外快速检查）
-                            with cache_lock:
+                            with scene_lock(scene_id):
                                 if scene_id not in pregeneration_cache:
                                     return
                                 cache_entry = pregeneration_cache[scene_id]
@@ -1696,69 +1985,28 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                             if next_options:
                                 # 更新global_state（应用第一层的flow_update）
                                 updated_global_state = global_state.copy()
-                                if 'flow_worldline' not in updated_global_state:
-                                    updated_global_state['flow_worldline'] = {}
+                                # flow_worldline 单独复制：浅拷贝会让各选项的 flow_update 互相累积，导致预测的 next_scene_id 偏离
+                                updated_global_state['flow_worldline'] = dict(updated_global_state.get('flow_worldline') or {})
                                 flow_update = layer1_option_data.get('flow_update', {})
                                 if flow_update:
                                     updated_global_state['flow_worldline'].update(flow_update)
                                 
                                 # 计算下一层场景的 scene_id（用于存储第二层预生成的数据）
-                                next_scene_id = generate_scene_id(str(updated_global_state), str(next_options))
+                                next_scene_id = generate_scene_id(updated_global_state, next_options)
                                 
                                 # 为下一轮的每个选项生成再下一层剧情（在锁外执行，避免长时间持有锁）
                                 try:
-                                    layer2_data = generate_all_options(updated_global_state, next_options, skip_images=True)
+                                    layer2_data = generate_all_options(
+                                        updated_global_state, next_options, skip_images=True, submit=layer2_submit, cancel_token=layer2_token
+                                    )
                                     
                                     # 再次检查取消标志并写入缓存（生成过程中可能被取消）
-                                    with cache_lock:
-                                        if scene_id in pregeneration_cache:
-                                            cache_entry = pregeneration_cache[scene_id]
-                                            if cache_entry.get('layer2_cancel', False):
-                                                print(f"⏹️ 选项 {opt_idx} 的第二层生成在生成过程中被取消")
-                                                return
-                                        
-                                        # 🆕 优化：将第二层预生成的数据存储到下一层场景的 layer1（只有文本）
-                                        # 初始化下一层场景的缓存结构
-                                        if next_scene_id not in pregeneration_cache:
-                                            pregeneration_cache[next_scene_id] = {
-                                                'layer1': {},
-                                                'layer2': {},
-                                                'generation_status': {},
-                                                'generation_events': {},
-                                                'should_cancel': False,
-                                                'current_generating_index': None,
-                                                'layer2_generating': False,
-                                                'layer2_cancel': False,
-                                                'layer2_selected_option': None,
-                                                'layer2_thread': None,
-                                                'current_layer2_option': None,
-                                                'text_only_mode': True  # 标记：只有文本，需要后续生成图片
-                                            }
-                                        
-                                        next_cache_entry = pregeneration_cache[next_scene_id]
-                                        
-                                        # 将第二层预生成的数据存储到下一层场景的 layer1（只有文本）
-                                        # layer2_data 格式：{option_index: option_data}
-                                        for next_opt_idx, next_option_data in layer2_data.items():
-                                            if 'layer1' not in next_cache_entry:
-                                                next_cache_entry['layer1'] = {}
-                                            next_cache_entry['layer1'][next_opt_idx] = next_option_data
-                                            # 标记为只有文本，需要后续生成图片
-                                            next_cache_entry['generation_status'][next_opt_idx] = 'text_only'
-                                            
-                                            # 🆕 创建等待事件，用于通知第一层预生成文本已完成
-                                            events = next_cache_entry.setdefault('generation_events', {})
-                                            if next_opt_idx not in events:
-                                                events[next_opt_idx] = threading.Event()
-                                            
-                                            # 触发等待事件，通知第一层预生成可以开始生成图片了
-                                            events[next_opt_idx].set()
-                                        
-                                        # 保留原有的 layer2 存储（向后兼容）
-                                        if 'layer2' not in cache_entry:
-                                            cache_entry['layer2'] = {}
-                                        cache_entry['layer2'][opt_idx] = layer2_data
-                                        layer2_count += len(layer2_data)
+                                    if not store_layer2(opt_idx, next_scene_id, layer2_data):
+                                        return
+                                    layer2_count += len(layer2_data)
+                                except OperationCancelled:
+                                    print(f"⏹️ 第二层生成被取消（用户选择了其他选项），已中止在途请求")
+                                    return
                                 except Exception as e:
                                     print(f"❌ 生成选项 {opt_idx} 的第二层失败：{str(e)}")
                         
@@ -1771,17 +2019,21 @@ def _pregenerate_next_layers_logic(global_state, current_options, scene_id):
                     traceback.print_exc()
                 finally:
                     # 标记第二层生成完成
-                    with cache_lock:
+                    with scene_lock(scene_id):
                         if scene_id in pregeneration_cache:
                             pregeneration_cache[scene_id]['layer2_generating'] = False
                             pregeneration_cache[scene_id]['current_layer2_option'] = None
             
             # 第二层在后台线程中继续生成（不阻塞）
-            with cache_lock:
+            with scene_lock(scene_id):
                 if scene_id in pregeneration_cache:
                     cache_entry = pregeneration_cache[scene_id]
                     cache_entry['layer2_generating'] = True
                     cache_entry['layer2_cancel'] = False
+                    previous_token = cache_entry.get('layer2_cancel_token')
+                    if previous_token is not None:
+                        previous_token.detach()  # 上一轮第二层的令牌不再使用，从场景令牌上注销
+                    cache_entry['layer2_cancel_token'] = cache_entry.setdefault('cancel_token', CancelToken()).child()
                     layer2_thread = threading.Thread(target=generate_layer2, daemon=True)
                     cache_entry['layer2_thread'] = layer2_thread
                     layer2_thread.start()
@@ -1823,7 +2075,7 @@ def pregenerate_next_layers():
             }
             # 尝试写入缓存条目（若已存在）
             if scene_id:
-                with cache_lock:
+                with scene_lock(scene_id):
                     if scene_id in pregeneration_cache:
                         pregeneration_cache[scene_id]['visual_context'] = global_state['_visual_context']
         
@@ -1840,6 +2092,8 @@ def pregenerate_next_layers():
         
         # 调用预生成核心逻辑
         scene_id = _pregenerate_next_layers_logic(global_state, current_options, scene_id)
+        pregeneration_cache.touch(scene_id)
+        cleanup_old_cache(scene_id, _scene_owner(global_state))
         
         # 🔍 调试日志：显示预生成返回的 scene_id
         print(f"🔍 [pregenerate-next-layers] 预生成返回的 sceneId：{scene_id}")
@@ -1872,9 +2126,9 @@ def get_pregenerated_layer2():
         if not scene_id or layer1_option_index is None or layer2_option_index is None:
             return jsonify({"status": "error", "message": "参数不完整！"})
         
-        with cache_lock:
-            if scene_id in pregeneration_cache:
-                cache_entry = pregeneration_cache[scene_id]
+        with scene_lock(scene_id):
+            cache_entry = pregeneration_cache.lookup(scene_id)
+            if cache_entry is not None:
                 if 'layer2' in cache_entry and layer1_option_index in cache_entry['layer2']:
                     layer2_data = cache_entry['layer2'][layer1_option_index]
                     if layer2_option_index in layer2_data:
@@ -2152,76 +2406,56 @@ def generate_ending():
         return jsonify({"status": "error", "message": f"生成游戏结局失败：{error_msg}"})
 
 # ------------------------------
-# 图片缓存管理函数
+# 图片缓存管理函数（统一走 image_store：按内容寻址存储 + 请求键索引）
 # ------------------------------
-import hashlib
-
-def get_cached_image(prompt_hash: str) -> str:
-    """从缓存获取图片路径"""
-    cache_path = Path(IMAGE_CACHE_DIR) / f"{prompt_hash}.png"
-    if cache_path.exists():
-        return str(cache_path)
+def get_cached_image(request_key: str) -> str:
+    """按请求键从图片存储获取图片路径"""
+    cached = image_store.lookup(request_key)
+    if cached:
+        cache_path = image_store.path_for_url(cached["url"])
+        return str(cache_path) if cache_path else None
     return None
 
-def cache_image(prompt_hash: str, image_url: str) -> str:
-    """缓存图片到本地"""
+def cache_image(request_key: str, image_url: str) -> str:
+    """缓存图片到本地，返回 /image_cache/ 下的 URL（本地图片只登记请求键，不再复制一份）"""
     try:
         # 检查是否是相对路径（本地缓存路径）
         if image_url.startswith('/image_cache/') or image_url.startswith('image_cache/'):
-            # 已经是本地缓存路径，不需要下载
-            cache_path = Path(IMAGE_CACHE_DIR) / f"{prompt_hash}.png"
-            if cache_path.exists():
-                print(f"✅ 图片已在本地缓存：{cache_path}")
-                return str(cache_path)
-            else:
-                # 如果文件不存在，尝试从相对路径提取hash
-                import re
-                hash_match = re.search(r'([a-f0-9]{32})\.png', image_url)
-                if hash_match:
-                    existing_hash = hash_match.group(1)
-                    existing_path = Path(IMAGE_CACHE_DIR) / f"{existing_hash}.png"
-                    if existing_path.exists():
-                        # 复制文件到新的hash名称
-                        import shutil
-                        shutil.copy2(existing_path, cache_path)
-                        print(f"✅ 从现有缓存复制图片：{cache_path}")
-                        return str(cache_path)
+            linked_url = image_store.link(request_key, image_url)
+            if not linked_url:
                 raise ValueError(f"本地缓存文件不存在：{image_url}")
+            print(f"✅ 图片已在本地缓存：{linked_url}")
+            return linked_url
         
         # 检查是否是完整的URL
         if not (image_url.startswith('http://') or image_url.startswith('https://')):
             raise ValueError(f"无效的图片URL格式：{image_url}（需要完整的HTTP/HTTPS URL或本地缓存路径）")
         
-        # 下载图片
-        response = requests.get(image_url, timeout=30)
+        # 下载图片（相同内容只存一份）
+        response = http_get(image_url, timeout=30)
         response.raise_for_status()
+        local_url = image_store.put_bytes(response.content, extension_for(response.headers.get("Content-Type", "")), request_key)
         
-        cache_path = Path(IMAGE_CACHE_DIR) / f"{prompt_hash}.png"
-        
-        with open(cache_path, 'wb') as f:
-            f.write(response.content)
-        
-        print(f"✅ 图片已缓存：{cache_path}")
-        return str(cache_path)
+        print(f"✅ 图片已缓存：{local_url}")
+        return local_url
     except Exception as e:
         print(f"❌ 图片缓存失败：{str(e)}")
         raise
 
 def generate_image_with_cache(scene_description: str, style: str, global_state: Dict) -> Dict:
-    """带缓存的图片生成"""
-    # 生成缓存键
-    prompt_hash = hashlib.md5(f"{scene_description}_{style}".encode()).hexdigest()
+    """带缓存的图片生成（与 generate_scene_image 使用同一个请求键）"""
+    request_key = _scene_image_request_key(scene_description, global_state, style)
     
     # 检查缓存
-    cached_path = get_cached_image(prompt_hash)
-    if cached_path:
-        print(f"✅ 使用缓存的图片：{prompt_hash}")
+    cached = image_store.lookup(request_key)
+    if cached:
+        print(f"✅ 使用缓存的图片：{cached['url']}")
         return {
-            "url": f"/image_cache/{prompt_hash}.png",
-            "prompt": scene_description,
+            "url": cached["url"],
+            "prompt": cached.get("prompt", scene_description),
             "style": style,
-            "width": 1024,
-            "height": 1024,
+            "width": cached.get("width", 1024),
+            "height": cached.get("height", 1024),
             "cached": True
         }
     
@@ -2236,26 +2470,12 @@ def generate_image_with_cache(scene_description: str, style: str, global_state:
     if image_url.startswith('/image_cache/') or image_url.startswith('image_cache/'):
         # 已经是本地缓存路径，直接返回，不需要再次缓存
         print(f"✅ 图片已在main2.py中缓存，使用现有路径：{image_url}")
-        return {
-            "url": image_url,
-            "prompt": scene_description,
-            "style": style,
-            "width": 1024,
-            "height": 1024,
-            "cached": True
-        }
+        return dict(image_data, style=style, cached=True)
     
     # 缓存图片（只有当image_url是完整的HTTP/HTTPS URL时才需要下载）
     try:
-        local_path = cache_image(prompt_hash, image_url)
-        return {
-            "url": f"/image_cache/{prompt_hash}.png",
-            "prompt": scene_description,
-            "style": style,
-            "width": 1024,
-            "height": 1024,
-            "cached": False
-        }
+        local_url = cache_image(request_key, image_url)
+        return dict(image_data, url=local_url, style=style, cached=False)
     except Exception as e:
         print(f"⚠️ 图片缓存失败，使用原始URL：{str(e)}")
         return image_data
@@ -2343,6 +2563,34 @@ def get_video_status_api(task_id):
         "message": "视频生成功能已禁用（性能优化）"
     }), 404
 
+def _send_image(path, content_hash=None):
+    """
+    按 Accept 头与 ?w=<宽度> 发送图片的 WebP/AVIF/缩略图变体（不可用时发送原图）。
+    均支持 If-None-Match / If-Modified-Since（304）与 Range；content_hash 为内容寻址 blob 的哈希时
+    以其作为强 ETag 并允许浏览器长期缓存，否则（同一路径可能被重新生成）每次向服务器确认。
+    """
+    try:
+        width = int(request.args.get('w', 0))
+    except ValueError:
+        width = 0
+    path = Path(path)
+    target, mimetype = image_variants.select(path, request.headers.get('Accept', ''), width)
+    if content_hash:
+        etag = image_variants.etag_for(content_hash, path, target)
+        response = send_file(target, mimetype=mimetype, conditional=True, etag=etag, max_age=IMMUTABLE_MAX_AGE)
+        response.cache_control.immutable = True
+    else:
+        response = send_file(target, mimetype=mimetype, conditional=True)
+        response.cache_control.no_cache = True
+    response.headers['Vary'] = 'Accept'
+    return response
+
+def _send_static(filename):
+    """发送前端静态文件：文件名不带内容哈希，带 ETag / Last-Modified，每次向服务器确认（未变化时 304）"""
+    response = send_from_directory('game-frontend', filename, conditional=True)
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/initial/main_character/<game_id>/<filename>')
 def serve_main_character_image(game_id, filename):
     """提供主角形象图片"""
@@ -2357,7 +2605,8 @@ def serve_main_character_image(game_id, filename):
         if not os.path.exists(image_path):
             return jsonify({"status": "error", "message": "Image not found"}), 404
         
-        return send_file(image_path)
+        storage_manager.touch_game(game_id)  # 记录访问时间（LRU 淘汰依据），并为当前会话续期固定
+        return _send_image(image_path)
     except Exception as e:
         print(f"❌ 提供主角形象图片错误：{str(e)}")
         return jsonify({"status": "error", "message": f"Failed to serve image: {str(e)}"}), 500
@@ -2366,19 +2615,83 @@ def serve_main_character_image(game_id, filename):
 def serve_cached_image(filename):
     """提供缓存的图片文件"""
     try:
-        cache_path = Path(IMAGE_CACHE_DIR) / filename
-        if cache_path.exists() and cache_path.suffix.lower() in ['.png', '.jpg', '.jpeg']:
-            return send_file(cache_path, mimetype='image/png')
+        # 只提供存储根目录下的图片文件（按扩展名给出正确的 MIME）
+        cache_path = image_store.resolve(filename)
+        if cache_path:
+            storage_manager.touch_blob(cache_path.name)  # 记录访问时间（LRU 淘汰依据）
+            return _send_image(cache_path, content_hash=image_store.content_hash(cache_path.name))
         return jsonify({"status": "error", "message": "图片不存在"}), 404
     except Exception as e:
         print(f"🔴 提供缓存图片错误：{str(e)}")
         return jsonify({"status": "error", "message": "无法提供图片"}), 500
 
+# 运行时统计（连接池等），便于排查性能问题
+@app.route('/runtime-stats', methods=['GET'])
+def runtime_stats():
+    """返回服务端运行时统计信息"""
+    try:
+        return jsonify({
+            "status": "success",
+            "http_pool": get_pool_stats(),
+            "progress_subscribers": progress_bus.subscriber_count(),
+            "pregeneration_cache": pregeneration_cache.get_stats(),
+            "cache_locks": pregeneration_cache.get_lock_stats(),
+            "scheduler": generation_scheduler.get_stats(),
+            "rate_limits": get_rate_limit_stats(),
+            "concurrency": get_concurrency_stats(),
+            "image_providers": get_provider_router_stats(),
+            "hedging": get_hedging_stats(),
+            "llm_cache": get_llm_cache_stats(),
+            "single_flight": get_single_flight_stats(),
+            "worldview_cache": get_worldview_cache_stats(),
+            "worldview_pool": get_worldview_pool_stats(),
+            "wiki_cache": get_wiki_cache_stats(),
+            "image_store": get_image_store_stats(),
+            "image_storage": get_storage_stats(),
+            "image_variants": get_image_variant_stats(),
+            "reference_payloads": get_reference_cache_stats()
+        })
+    except Exception as e:
+        print(f"🔴 获取运行时统计失败：{str(e)}")
+        return jsonify({"status": "error", "message": "无法获取运行时统计"}), 500
+
+@app.route('/admin/image-providers', methods=['GET', 'POST'])
+def admin_image_providers():
+    """
+    查看/操作图片 provider 路由的熔断状态与评分
+    GET：返回各 provider 的状态、成功率、p50/p95 延迟
+    POST：{"action": "reset" | "open", "provider": "yunwu"（reset 时可省略表示全部）, "seconds": 60}
+    需在请求头 X-Admin-Token 中携带 ADMIN_TOKEN；未配置 ADMIN_TOKEN 时接口禁用
+    """
+    admin_token = os.getenv("ADMIN_TOKEN", "")
+    if not admin_token:
+        return jsonify({"status": "error", "message": "管理接口未启用（未配置ADMIN_TOKEN）"}), 403
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode("utf-8"), admin_token.encode("utf-8")):
+        return jsonify({"status": "error", "message": "无权限"}), 403
+    try:
+        if request.method == 'POST':
+            data = request.json or {}
+            action = data.get("action", "")
+            provider = data.get("provider") or None
+            if action == "reset":
+                image_provider_router.reset(provider)
+            elif action == "open":
+                if not provider:
+                    return jsonify({"status": "error", "message": "缺少provider"}), 400
+                seconds = data.get("seconds")
+                image_provider_router.force_open(provider, float(seconds) if seconds is not None else None)
+            else:
+                return jsonify({"status": "error", "message": f"不支持的操作：{action}"}), 400
+        return jsonify({"status": "success", "image_providers": get_provider_router_stats()})
+    except Exception as e:
+        print(f"🔴 图片 provider 管理接口失败：{str(e)}")
+        return jsonify({"status": "error", "message": "图片 provider 管理操作失败"}), 500
+
 # 前端静态文件路由
 @app.route('/')
 def index():
     """返回前端首页"""
-    return send_from_directory('game-frontend', 'index.html')
+    return _send_static('index.html')
 
 @app.route('/<path:filename>')
 def frontend_files(filename):
@@ -2387,7 +2700,7 @@ def frontend_files(filename):
     if filename.startswith('api/') or filename.startswith('image_cache/'):
         return jsonify({"status": "error", "message": "路径不存在"}), 404
     try:
-        return send_from_directory('game-frontend', filename)
+        return _send_static(filename)
     except:
         return jsonify({"status": "error", "message": "文件不存在"}), 404
 
@@ -2398,6 +2711,8 @@ if __name__ == "__main__":
     print("API端点：")
     print("  POST /generate-worldview - 生成游戏世界观")
     print("  POST /generate-option - 生成单个选项对应的剧情（支持缓存）")
+    print("  POST /generate-option-stream - 流式生成选项剧情（SSE，场景正文边生成边推送）")
+    print("  GET /scene-progress/<scene_id> - 订阅场景预生成进度（SSE）")
     print("  POST /pregenerate-next-layers - 预生成两层内容")
     print("  POST /get-pregenerated-layer2 - 获取预生成的第二层内容")
     print("  POST /generate-ending - 生成游戏结局")
@@ -2409,5 +2724,13 @@ if __name__ == "__main__":
     # print("  POST /generate-scene-video - 生成场景视频（5-10秒）")  # 已禁用
     # print("  GET /video-status/<task_id> - 查询视频生成状态")  # 已禁用
     print("  GET /image_cache/<filename> - 获取缓存的图片")
+    print("  GET /runtime-stats - 运行时统计（连接池命中/未命中等）")
+    print("  GET/POST /admin/image-providers - 图片 provider 熔断状态与评分（重置/手动熔断）")
     print("===============================")
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    # reloader 父进程只负责监视文件变化，后台任务只在实际提供服务的进程中启动
+    # （WSGI 服务器下不经过这里：预热池与存储空间管理在首次使用时自动启动）
+    use_reloader = os.getenv("FLASK_USE_RELOADER", "true").lower() == "true"
+    if not use_reloader or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        worldview_pool.start()
+        storage_manager.start()
+    app.run(host='0.0.0.0', port=5001, debug=True, use_reloader=use_reloader)
\ No newline at end of file
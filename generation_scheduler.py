@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+统一的生成任务调度器：按上游（LLM / 图片服务）限制全局并发，按优先级出队。
+
+优先级（数值越小越优先）：
+  用户阻塞（玩家正在等待的选项） > 第一层文本 > 第一层图片 > 第二层推测生成
+
+- 每个上游一个优先级队列 + 固定数量的工作线程（即该上游的全局并发上限）；
+- 推测性任务最多占用 (上限 - 预留) 个工作线程，保证用户阻塞任务总能尽快拿到空位；
+- 排队中的推测任务可以按场景整体取消（抢占），已在执行的任务不会被打断；
+- 队列深度、运行数、等待时间等指标可通过 get_stats() 导出。
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+PRIORITY_USER_BLOCKING = 0
+PRIORITY_LAYER1_TEXT = 1
+PRIORITY_LAYER1_IMAGE = 2
+PRIORITY_LAYER2_SPECULATIVE = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_USER_BLOCKING: "user_blocking",
+    PRIORITY_LAYER1_TEXT: "layer1_text",
+    PRIORITY_LAYER1_IMAGE: "layer1_image",
+    PRIORITY_LAYER2_SPECULATIVE: "layer2_speculative",
+}
+
+# ------------------------------
+# 调度器配置（可通过环境变量调节）
+# ------------------------------
+GENERATION_SCHEDULER_CONFIG = {
+    # 各上游的全局并发上限（所有玩家共享）
+    "llm_concurrency": max(1, int(os.getenv("GEN_SCHED_LLM_CONCURRENCY", "8"))),
+    "image_concurrency": max(1, int(os.getenv("GEN_SCHED_IMAGE_CONCURRENCY", "4"))),
+    # 每个上游为非推测任务预留的工作线程数（推测任务不能占满）
+    "reserved_for_user": max(0, int(os.getenv("GEN_SCHED_RESERVED_FOR_USER", "1"))),
+}
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "fn", "args", "kwargs", "future", "tag", "submitted_at")
+
+    def __init__(self, priority, seq, fn, args, kwargs, tag):
+        self.priority = priority
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.tag = tag or {}
+        self.submitted_at = time.time()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _UpstreamQueue:
+    """单个上游的优先级队列与工作线程"""
+
+    def __init__(self, name: str, concurrency: int, reserved_for_user: int):
+        self.name = name
+        self.concurrency = concurrency
+        # 推测任务可同时运行的上限（至少 1，避免完全饿死）
+        self.speculative_limit = max(1, concurrency - reserved_for_user)
+        self._cond = threading.Condition()
+        self._heap = []
+        self._running = {p: 0 for p in PRIORITY_NAMES}
+        self._counters = {p: {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0,
+                              "total_wait_ms": 0.0, "max_wait_ms": 0.0} for p in PRIORITY_NAMES}
+        self._workers = []
+
+    def _ensure_workers(self):
+        # 调用方需持有 self._cond；工作线程按需启动
+        while len(self._workers) < self.concurrency:
+            worker = threading.Thread(
+                target=self._worker_loop,
+                name=f"gen-{self.name}-{len(self._workers)}",
+                daemon=True
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def submit(self, job: _Job):
+        with self._cond:
+            heapq.heappush(self._heap, job)
+            self._counters[job.priority]["submitted"] += 1
+            self._ensure_workers()
+            self._cond.notify()
+        return job.future
+
+    def _pick_locked(self) -> Optional[_Job]:
+        # 丢弃已取消的任务
+        while self._heap and self._heap[0].future.cancelled():
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        job = self._heap[0]
+        if job.priority >= PRIORITY_LAYER2_SPECULATIVE and self._running[PRIORITY_LAYER2_SPECULATIVE] >= self.speculative_limit:
+            # 堆顶是推测任务说明队列里只剩推测任务，且推测任务已占满可用名额
+            return None
+        return heapq.heappop(self._heap)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                job = self._pick_locked()
+                while job is None:
+                    self._cond.wait()
+                    job = self._pick_locked()
+                self._running[job.priority] += 1
+                wait_ms = (time.time() - job.submitted_at) * 1000
+                counters = self._counters[job.priority]
+                counters["total_wait_ms"] += wait_ms
+                if wait_ms > counters["max_wait_ms"]:
+                    counters["max_wait_ms"] = wait_ms
+
+            outcome = "completed"
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(job.fn(*job.args, **job.kwargs))
+                except BaseException as e:
+                    outcome = "failed"
+                    job.future.set_exception(e)
+            else:
+                outcome = "cancelled"
+
+            with self._cond:
+                self._running[job.priority] -= 1
+                self._counters[job.priority][outcome] += 1
+                # 释放了一个名额：可能有被推测上限挡住的任务可以运行了
+                self._cond.notify_all()
+
+    def cancel_queued(self, predicate: Callable[[_Job], bool]) -> int:
+        cancelled = 0
+        with self._cond:
+            for job in self._heap:
+                if not job.future.done() and predicate(job) and job.future.cancel():
+                    self._counters[job.priority]["cancelled"] += 1
+                    cancelled += 1
+        return cancelled
+
+    def stats(self) -> Dict:
+        with self._cond:
+            queued = {PRIORITY_NAMES[p]: 0 for p in PRIORITY_NAMES}
+            for job in self._heap:
+                if not job.future.cancelled():
+                    queued[PRIORITY_NAMES[job.priority]] += 1
+            by_priority = {}
+            for p, counters in self._counters.items():
+                item = dict(counters)
+                started = item["completed"] + item["failed"]
+                item["avg_wait_ms"] = round(item["total_wait_ms"] / started, 1) if started else 0.0
+                item["total_wait_ms"] = round(item["total_wait_ms"], 1)
+                item["max_wait_ms"] = round(item["max_wait_ms"], 1)
+                item["running"] = self._running[p]
+                by_priority[PRIORITY_NAMES[p]] = item
+            return {
+                "concurrency": self.concurrency,
+                "speculative_limit": self.speculative_limit,
+                "queue_depth": sum(queued.values()),
+                "queued": queued,
+                "running": sum(self._running.values()),
+                "by_priority": by_priority,
+            }
+
+
+class GenerationScheduler:
+    """按上游分组的优先级调度器"""
+
+    def __init__(self, config: Optional[Dict] = None):
+        cfg = dict(GENERATION_SCHEDULER_CONFIG, **(config or {}))
+        self._seq = itertools.count()
+        self._upstreams = {
+            "llm": _UpstreamQueue("llm", cfg["llm_concurrency"], cfg["reserved_for_user"]),
+            "image": _UpstreamQueue("image", cfg["image_concurrency"], cfg["reserved_for_user"]),
+        }
+
+    def submit(self, fn, *args, priority: int = PRIORITY_USER_BLOCKING, upstream: str = "llm",
+               tag: Optional[Dict] = None, **kwargs) -> Future:
+        """提交任务，返回 concurrent.futures.Future；tag 用于按场景取消（如 {"scene_id": ...}）"""
+        if priority not in PRIORITY_NAMES:
+            raise ValueError(f"未知的任务优先级：{priority}")
+        queue = self._upstreams.get(upstream)
+        if queue is None:
+            raise ValueError(f"未知的上游：{upstream}")
+        job = _Job(priority, next(self._seq), fn, args, kwargs, tag)
+        return queue.submit(job)
+
+    def submitter(self, priority: int, upstream: str = "llm", tag: Optional[Dict] = None):
+        """返回 submit(fn, *args) 形式的提交函数，供 generate_all_options 等接收执行器的函数使用"""
+        def _submit(fn, *args, **kwargs):
+            return self.submit(fn, *args, priority=priority, upstream=upstream, tag=tag, **kwargs)
+        return _submit
+
+    def cancel_queued(self, scene_id=None, min_priority: int = PRIORITY_LAYER2_SPECULATIVE) -> int:
+        """取消排队中（尚未开始）的任务：优先级不高于 min_priority，且（可选）属于 scene_id"""
+        def predicate(job):
+            if job.priority < min_priority:
+                return False
+            return scene_id is None or job.tag.get("scene_id") == scene_id
+
+        cancelled = sum(queue.cancel_queued(predicate) for queue in self._upstreams.values())
+        if cancelled:
+            print(f"⏹️ [调度器] 已取消 {cancelled} 个排队中的推测任务（scene_id={scene_id}）")
+        return cancelled
+
+    def get_stats(self) -> Dict:
+        return {name: queue.stats() for name, queue in self._upstreams.items()}
+
+
+generation_scheduler = GenerationScheduler()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+对冲请求（hedged requests）：压低玩家同步等待的生成调用的长尾延迟。
+
+- 主请求发出后，若超过"延迟分位数"（最近调用耗时的 p90 等，带上下限）仍未返回，
+  再向同一或备用模型端点发出一个副本；
+- 先返回有效结果的一方胜出，另一方通过取消令牌中止（http_transport 会关闭在途连接）；
+- 预算：每个符合条件的调用为预算累积 budget_ratio 个令牌（最多 budget_burst 个），
+  每发出一次对冲消耗 1 个，额外开销被限制在约 budget_ratio 倍以内；
+- 只用于显式开启的调用（玩家正在等待的选项生成），后台预生成不对冲。
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+from cancellation import CancelToken, OperationCancelled, cancel_scope, current_token
+
+# ------------------------------
+# 对冲请求配置（可通过环境变量调节，默认关闭）
+# ------------------------------
+HEDGING_CONFIG = {
+    "enabled": os.getenv("LLM_HEDGING_ENABLED", "false").lower() == "true",
+    # 等待主请求多久后发出对冲：最近调用耗时的该分位数
+    "percentile": float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9")),
+    # 对冲等待时间的上下限（秒）；样本不足时使用 default_delay
+    "min_delay": float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "5")),
+    "max_delay": float(os.getenv("LLM_HEDGE_MAX_DELAY_SECONDS", "90")),
+    "default_delay": float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_SECONDS", "30")),
+    "min_samples": int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")),
+    "window_size": int(os.getenv("LLM_HEDGE_WINDOW_SIZE", "200")),
+    # 预算：每个可对冲的调用累积多少个对冲名额，最多攒多少个
+    "budget_ratio": float(os.getenv("LLM_HEDGE_BUDGET_RATIO", "0.1")),
+    "budget_burst": float(os.getenv("LLM_HEDGE_BUDGET_BURST", "2")),
+}
+
+
+class HedgeBudget:
+    """对冲预算：按调用量累积名额，限制对冲带来的额外花费"""
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = max(0.0, ratio)
+        self.burst = max(1.0, burst)
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+
+    def on_request(self) -> None:
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            return self._tokens
+
+
+class Hedger:
+    """记录调用耗时分布，并按分位数截止时间为单次调用发出对冲副本"""
+
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.config = config
+        self.budget = HedgeBudget(config["budget_ratio"], config["budget_burst"])
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=max(1, config["window_size"]))
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0,
+                       "budget_denied": 0, "both_failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config["enabled"]
+
+    def record_latency(self, seconds: float) -> None:
+        """记录一次成功调用的耗时（用于计算对冲截止时间）"""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self) -> float:
+        cfg = self.config
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < cfg["min_samples"]:
+            delay = cfg["default_delay"]
+        else:
+            index = min(len(samples) - 1, int(cfg["percentile"] * len(samples)))
+            delay = samples[index]
+        return min(cfg["max_delay"], max(cfg["min_delay"], delay))
+
+    def _bump(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def run(self, primary: Callable, hedge: Callable, is_valid: Callable = None, label: str = ""):
+        """
+        执行 primary，超过对冲截止时间仍未返回时（预算允许）并发执行 hedge，返回先到的有效结果。
+        两个调用各自在当前令牌的子令牌下运行；胜出后取消另一方。
+        主请求在截止时间前失败则直接抛出（失败重试由调用方负责，对冲只解决"慢"）。
+        """
+        is_valid = is_valid or (lambda result: result is not None)
+        label = label or self.name
+        parent = current_token()
+        results = queue.Queue()
+        tokens: Dict[str, CancelToken] = {}
+
+        def launch(kind: str, fn: Callable) -> None:
+            token = parent.child() if parent is not None else CancelToken()
+            tokens[kind] = token
+
+            def worker():
+                with cancel_scope(token):
+                    try:
+                        results.put((kind, fn(), None))
+                    except BaseException as e:
+                        results.put((kind, None, e))
+
+            threading.Thread(target=worker, name=f"hedge-{self.name}-{kind}", daemon=True).start()
+
+        def cancel_all(reason: str) -> None:
+            for token in tokens.values():
+                token.cancel(reason)
+
+        self._bump("calls")
+        self.budget.on_request()
+        delay = self.hedge_delay()
+        start = time.time()
+        launch("primary", primary)
+        pending = {"primary"}
+        hedge_decided = False
+        fallback_result, first_error = None, None
+
+        try:
+            while pending:
+                timeout = None if hedge_decided else max(0.0, start + delay - time.time())
+                item = self._next_result(results, timeout, parent)
+                if item is None:
+                    # 主请求超过截止时间仍未返回
+                    hedge_decided = True
+                    if self.budget.try_spend():
+                        self._bump("hedged")
+                        print(f"🪁 {label} 请求 {delay:.1f}s 未返回，发出对冲请求")
+                        launch("hedge", hedge)
+                        pending.add("hedge")
+                    else:
+                        self._bump("budget_denied")
+                        print(f"⚠️ {label} 请求 {delay:.1f}s 未返回，但对冲预算已用完，继续等待主请求")
+                    continue
+                kind, result, error = item
+                pending.discard(kind)
+                if error is None and is_valid(result):
+                    if kind == "primary":
+                        self._bump("primary_wins")
+                    else:
+                        self._bump("hedge_wins")
+                        print(f"🏁 {label} 对冲请求先返回（耗时 {time.time() - start:.1f}s），取消主请求")
+                    return result
+                if error is None:
+                    fallback_result = result if fallback_result is None else fallback_result
+                elif first_error is None:
+                    first_error = error
+                if not hedge_decided:
+                    break  # 截止时间前主请求已结束：不再对冲
+            if len(tokens) > 1:
+                self._bump("both_failed")
+            if fallback_result is not None:
+                return fallback_result
+            raise first_error
+        finally:
+            cancel_all(f"{label} 对冲请求已结束")
+
+    @staticmethod
+    def _next_result(results: queue.Queue, timeout: Optional[float], parent: Optional[CancelToken]):
+        """等待下一个完成的调用；timeout 到期返回 None；外层令牌取消时抛出 OperationCancelled"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if parent is not None:
+                parent.raise_if_cancelled()
+            wait = 0.5 if deadline is None else min(0.5, deadline - time.time())
+            if wait <= 0:
+                return None
+            try:
+                return results.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            samples = len(self._latencies)
+        stats.update(
+            enabled=self.enabled,
+            samples=samples,
+            hedge_delay_seconds=round(self.hedge_delay(), 2),
+            budget_tokens=round(self.budget.tokens, 2),
+        )
+        return stats
+
+
+llm_hedger = Hedger("llm", HEDGING_CONFIG)
+
+
+def get_hedging_stats() -> Dict:
+    return {"llm": llm_hedger.stats()}
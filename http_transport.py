@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+共享 HTTP 传输层：按 base URL（scheme://host:port）复用带连接池的 requests.Session。
+
+LLM / 图片 / Wiki 等所有外部调用都走这里，避免每次请求重新建立 TCP+TLS 连接。
+"""
+import asyncio
+import os
+import socket
+import threading
+import time
+import weakref
+from typing import Callable, Dict, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from cancellation import OperationCancelled, current_token
+
+# ------------------------------
+# 连接池配置（可通过环境变量调节）
+# ------------------------------
+HTTP_POOL_CONFIG = {
+    # 每个 Session 缓存的 host 连接池数量
+    "pool_connections": max(1, int(os.getenv("HTTP_POOL_CONNECTIONS", "8"))),
+    # 每个 host 的最大保活连接数（即 per-host 连接上限）
+    "pool_maxsize": max(1, int(os.getenv("HTTP_POOL_MAXSIZE", "16"))),
+    # 连接数达到上限时是否阻塞等待（true=严格限制 per-host 并发连接数）
+    "pool_block": os.getenv("HTTP_POOL_BLOCK", "false").lower() == "true",
+    # 是否启用 keep-alive（false 时每次请求后关闭连接）
+    "keep_alive": os.getenv("HTTP_KEEP_ALIVE", "true").lower() == "true",
+    # Session 空闲（无在途请求且最后一次请求结束）超过该秒数后重建（避免复用已被服务端关闭的陈旧连接），0 表示不回收
+    "idle_timeout_seconds": float(os.getenv("HTTP_KEEP_ALIVE_IDLE_SECONDS", "90")),
+}
+
+_sessions: Dict[str, requests.Session] = {}
+_session_last_used: Dict[str, float] = {}  # 最近一次请求开始或结束的时间
+_session_in_flight: Dict[str, int] = {}  # 在途请求数（流式响应关闭前都算在途）
+_sessions_lock = threading.Lock()
+_pool_stats = {
+    "hits": 0,  # 复用已有 Session（连接池）
+    "misses": 0,  # 新建 Session
+    "recycled": 0,  # 因空闲超时重建的 Session
+    "requests": 0,
+    "errors": 0,
+    "cancelled": 0,  # 因取消令牌被放弃的请求
+}
+
+
+def _pool_key(url: str) -> str:
+    """按 scheme://netloc 归一化，作为连接池的 key"""
+    parts = urlsplit(url)
+    return f"{parts.scheme.lower()}://{parts.netloc.lower()}"
+
+
+# 绑定了取消令牌的请求：分块读取响应体时每块的大小
+_BODY_CHUNK_SIZE = 64 * 1024
+
+_request_local = threading.local()  # removers：当前请求用到的连接在取消令牌上的登记（注销函数列表）
+
+
+def _abort_connection(conn) -> None:
+    """取消回调：shutdown 连接的套接字，阻塞在发送 / 等待响应 / 读取中的线程立即出错返回"""
+    conn._abort_requested = True
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        return  # 尚未建连：connect() 完成后检查标记
+    try:
+        # 直接调用 socket.socket.shutdown：SSLSocket.shutdown 会在其他线程读取时清掉 SSL 对象
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except (OSError, TypeError):
+        pass
+
+
+def _watch_connection(conn) -> None:
+    """http_request 发起的请求用到连接时，把连接登记到当前线程的取消令牌上"""
+    removers = getattr(_request_local, "removers", None)
+    token = current_token()
+    conn._abort_requested = False
+    if removers is None or token is None:
+        return
+    removers.append(token.add_callback(lambda: _abort_connection(conn)))
+
+
+def _unwatch(removers) -> None:
+    for remove in removers:
+        remove()
+    del removers[:]
+
+
+class _AbortableConnectionMixin:
+    """可被取消令牌中止的连接：发送请求时登记到当前令牌（见 _watch_connection）"""
+
+    _abort_requested = False
+
+    def connect(self):
+        super().connect()
+        if self._abort_requested:
+            _abort_connection(self)
+
+    def request(self, *args, **kwargs):
+        _watch_connection(self)
+        return super().request(*args, **kwargs)
+
+
+class _AbortableHTTPConnection(_AbortableConnectionMixin, HTTPConnection):
+    pass
+
+
+class _AbortableHTTPSConnection(_AbortableConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _AbortableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _AbortableHTTPConnection
+
+
+class _AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _AbortableHTTPSConnection
+
+
+_ABORTABLE_POOL_CLASSES = {"http": _AbortableHTTPConnectionPool, "https": _AbortableHTTPSConnectionPool}
+
+
+class _AbortableAdapter(HTTPAdapter):
+    """连接池使用可中止的连接类（SOCKS 代理沿用默认连接类，只能在读取响应体的分块之间取消）"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _ABORTABLE_POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if not proxy.lower().startswith("socks"):
+            manager.pool_classes_by_scheme = _ABORTABLE_POOL_CLASSES
+        return manager
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    adapter = _AbortableAdapter(
+        pool_connections=HTTP_POOL_CONFIG["pool_connections"],
+        pool_maxsize=HTTP_POOL_CONFIG["pool_maxsize"],
+        pool_block=HTTP_POOL_CONFIG["pool_block"],
+        max_retries=0,  # 重试由调用方（tenacity / 手写重试循环）负责
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not HTTP_POOL_CONFIG["keep_alive"]:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def _checkout(url: str, hold: bool) -> Tuple[str, requests.Session]:
+    """
+    取得 url 所属 base URL 的共享 Session（不存在或空闲过久则新建）。
+    hold=True 时登记一个在途请求，请求结束后须调用 _release(key)；有在途请求的 Session 不会被回收。
+    """
+    key = _pool_key(url)
+    idle_timeout = HTTP_POOL_CONFIG["idle_timeout_seconds"]
+    now = time.time()
+    stale = None
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if (session is not None and idle_timeout > 0 and not _session_in_flight.get(key)
+                and now - _session_last_used.get(key, now) > idle_timeout):
+            stale = session
+            session = None
+            _pool_stats["recycled"] += 1
+        if session is None:
+            session = _new_session()
+            _sessions[key] = session
+            _pool_stats["misses"] += 1
+        else:
+            _pool_stats["hits"] += 1
+        _session_last_used[key] = now
+        if hold:
+            _session_in_flight[key] = _session_in_flight.get(key, 0) + 1
+        _pool_stats["requests"] += 1
+    if stale is not None:
+        try:
+            stale.close()
+        except Exception:
+            pass
+    return key, session
+
+
+def _release(key: str) -> None:
+    """请求结束：在途数减一，并以结束时间作为最近使用时间"""
+    with _sessions_lock:
+        remaining = _session_in_flight.get(key, 0) - 1
+        if remaining > 0:
+            _session_in_flight[key] = remaining
+        else:
+            _session_in_flight.pop(key, None)
+        _session_last_used[key] = time.time()
+
+
+def _on_close(response: requests.Response, callback: Callable[[], None]) -> None:
+    """
+    在响应第一次被关闭时执行 callback（流式响应读取结束后由调用方关闭）；
+    未显式关闭的响应在被垃圾回收时兜底执行，callback 只会执行一次。
+    """
+    finalizer = weakref.finalize(response, callback)
+    original_close = response.close
+
+    def close():
+        # 先执行 callback 再关闭：关闭后连接可能立即被其他请求复用，此时不应再挂在本请求的令牌上
+        try:
+            finalizer()
+        finally:
+            original_close()
+
+    response.close = close
+
+
+def get_session(url: str) -> requests.Session:
+    """获取 url 所属 base URL 的共享 Session（不存在或空闲过久则新建）"""
+    return _checkout(url, hold=False)[1]
+
+
+def _count_cancelled() -> None:
+    with _sessions_lock:
+        _pool_stats["cancelled"] += 1
+
+
+def _cancellable_request(session: requests.Session, method: str, url: str, token, kwargs) -> requests.Response:
+    """
+    在调用线程中发送请求，期间用到的连接登记在取消令牌上（见 _AbortableConnectionMixin）：
+    - 取消时直接 shutdown 套接字：阻塞在建连、发送、等待响应头或读取响应体中的调用立即出错返回，
+      上游随之看到连接断开（流式响应的服务端停止输出），调用方收到 OperationCancelled；
+    - 非流式请求内部同样以 stream=True 发出，响应体分块读取，块与块之间检查令牌，读完后连接归还连接池；
+    - stream=True 的响应在关闭前一直保持登记，读取期间被取消同样断开连接，读取方随即报错退出。
+    """
+    removers = _request_local.removers = []
+    response = None
+    try:
+        response = session.request(method, url, **dict(kwargs, stream=True))
+        if not kwargs.get("stream"):
+            chunks = []
+            for chunk in response.iter_content(_BODY_CHUNK_SIZE):
+                token.raise_if_cancelled()
+                chunks.append(chunk)
+            # 与 requests 非流式请求读取后的状态一致（Response.content 直接返回已读内容）
+            response._content = b"".join(chunks)
+    except BaseException as e:
+        _unwatch(removers)
+        if response is not None:
+            response.close()
+        if token.cancelled:
+            _count_cancelled()
+            if isinstance(e, OperationCancelled):
+                raise
+            raise OperationCancelled(token.reason) from e
+        raise
+    finally:
+        _request_local.removers = None
+
+    if kwargs.get("stream"):
+        _on_close(response, lambda: _unwatch(removers))
+    else:
+        _unwatch(removers)
+        response.close()  # 响应体已读完：归还连接
+    return response
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    通过共享连接池发送请求，参数与 requests.request 一致。
+    当前线程绑定了取消令牌（cancellation.cancel_scope）时，令牌取消会中止该请求并抛出 OperationCancelled。
+    """
+    key, session = _checkout(url, hold=True)
+    token = current_token()
+    response = None
+    try:
+        if token is None:
+            response = session.request(method, url, **kwargs)
+            return response
+        if token.cancelled:
+            _count_cancelled()
+            raise OperationCancelled(token.reason)
+        response = _cancellable_request(session, method, url, token, kwargs)
+        return response
+    except OperationCancelled:
+        raise
+    except Exception:
+        with _sessions_lock:
+            _pool_stats["errors"] += 1
+        raise
+    finally:
+        if response is not None and kwargs.get("stream"):
+            # 流式响应：连接在读取完并关闭响应之前仍在使用
+            _on_close(response, lambda: _release(key))
+        else:
+            _release(key)
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    return http_request("GET", url, **kwargs)
+
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    return http_request("POST", url, **kwargs)
+
+
+def _connection_stats(session: requests.Session) -> Dict[str, int]:
+    """汇总 urllib3 连接池中新建连接数/请求数，用于计算连接复用率"""
+    opened = 0
+    sent = 0
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        try:
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                opened += getattr(pool, "num_connections", 0)
+                sent += getattr(pool, "num_requests", 0)
+        except Exception:
+            continue
+    return {"connections_opened": opened, "requests_sent": sent}
+
+
+def get_pool_stats() -> Dict:
+    """返回连接池命中/未命中计数及各 host 的连接复用情况"""
+    with _sessions_lock:
+        stats = dict(_pool_stats)
+        stats["in_flight"] = sum(_session_in_flight.values())
+        sessions = dict(_sessions)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+    hosts = {}
+    for key, session in sessions.items():
+        conn = _connection_stats(session)
+        conn["connections_reused"] = max(0, conn["requests_sent"] - conn["connections_opened"])
+        hosts[key] = conn
+    stats["hosts"] = hosts
+    stats["config"] = dict(HTTP_POOL_CONFIG)
+    with _sessions_lock:
+        stats["async"] = dict(_async_stats, event_loops=len(_async_clients))
+    return stats
+
+
+def close_all_sessions() -> None:
+    """关闭所有共享 Session（进程退出或配置变更时调用）"""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+        _session_last_used.clear()
+        _session_in_flight.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except Exception:
+            pass
+
+
+
+# ------------------------------
+# 异步客户端（asyncio + httpx，可选依赖）
+# ------------------------------
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# httpx.AsyncClient 绑定创建它的事件循环，因此按事件循环各维护一个；
+# 与 requests 版本不同，httpx 的连接上限是整个客户端共享的
+HTTP_ASYNC_POOL_CONFIG = {
+    # 单个事件循环内的最大并发连接数
+    "max_connections": max(1, int(os.getenv("HTTP_ASYNC_MAX_CONNECTIONS", "200"))),
+    # 保活连接数上限
+    "max_keepalive_connections": max(1, int(os.getenv("HTTP_ASYNC_MAX_KEEPALIVE", str(HTTP_POOL_CONFIG["pool_maxsize"])))),
+}
+
+# 与 requests.exceptions.ConnectionError / Timeout 对应、可以自动重试的异步网络错误（未安装 httpx 时为空）
+ASYNC_RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError) if httpx is not None else ()
+
+_async_clients = weakref.WeakKeyDictionary()
+_async_stats = {"hits": 0, "misses": 0, "requests": 0, "errors": 0}
+
+
+def async_http_available() -> bool:
+    return httpx is not None
+
+
+def get_async_client():
+    """获取当前事件循环的共享 httpx.AsyncClient（需安装 httpx）"""
+    if httpx is None:
+        raise ImportError("异步HTTP客户端需要安装 httpx：pip install httpx")
+
+    loop = asyncio.get_running_loop()
+    with _sessions_lock:
+        client = _async_clients.get(loop)
+        if client is not None and not client.is_closed:
+            _async_stats["hits"] += 1
+            return client
+        keepalive_expiry = HTTP_POOL_CONFIG["idle_timeout_seconds"] if HTTP_POOL_CONFIG["keep_alive"] else 0
+        limits = httpx.Limits(
+            max_connections=HTTP_ASYNC_POOL_CONFIG["max_connections"],
+            max_keepalive_connections=HTTP_ASYNC_POOL_CONFIG["max_keepalive_connections"] if HTTP_POOL_CONFIG["keep_alive"] else 0,
+            keepalive_expiry=keepalive_expiry or None,
+        )
+        client = httpx.AsyncClient(limits=limits, timeout=None)
+        _async_clients[loop] = client
+        _async_stats["misses"] += 1
+        return client
+
+
+async def async_http_request(method: str, url: str, **kwargs):
+    """
+    通过当前事件循环的共享 httpx.AsyncClient 发送请求，参数与 httpx.AsyncClient.request 一致。
+    取消由任务取消完成（见 cancellation.run_cancellable），httpx 会随之关闭在途连接。
+    """
+    client = get_async_client()
+    with _sessions_lock:
+        _async_stats["requests"] += 1
+    try:
+        return await client.request(method, url, **kwargs)
+    except asyncio.CancelledError:
+        _count_cancelled()
+        raise
+    except Exception:
+        with _sessions_lock:
+            _async_stats["errors"] += 1
+        raise
+
+
+async def async_http_get(url: str, **kwargs):
+    return await async_http_request("GET", url, **kwargs)
+
+
+async def async_http_post(url: str, **kwargs):
+    return await async_http_request("POST", url, **kwargs)
+
+
+async def aclose_async_client() -> None:
+    """关闭当前事件循环的共享 AsyncClient（事件循环结束前调用）"""
+    loop = asyncio.get_running_loop()
+    with _sessions_lock:
+        client = _async_clients.pop(loop, None)
+    if client is not None and not client.is_closed:
+        await client.aclose()
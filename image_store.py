@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+内容寻址的图片存储：所有图片代码路径共用一套存储与缓存键。
+
+- blob：image_cache/<图片字节的 SHA-256>.<扩展名>，相同字节只存一份（写入前先查重）；
+- 请求键索引：image_cache/index/<键前两位>/<键>.json -> {"blob", "prompt", "width", "height", "created"}，
+  请求键由 scene_image_key() 统一计算（场景图各调用路径使用同一个键）；
+- 写入先写临时文件再 os.replace，读到一半的文件不会被当作有效图片；
+- 去重写入、索引命中与 link 都会刷新 blob 的 mtime：URL 刚交给玩家的旧图片不会被 LRU 淘汰；
+- 兼容旧文件：索引未命中时回退查找 image_cache/<请求键>.png（旧版本直接以请求键命名），
+  旧的 URL（存档中保存的 /image_cache/<md5>.png）继续可用；
+- /image_cache/<文件名> 通过 resolve() 取得文件路径（只允许存储根目录下的图片文件）。
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+IMAGE_STORE_DIR = "image_cache"
+URL_PREFIX = "/image_cache/"
+
+# 可直接提供的图片扩展名 -> MIME
+IMAGE_MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+}
+
+_SAFE_NAME = re.compile(r"^[A-Za-z0-9_\-]+\.[A-Za-z0-9]+$")
+_CONTENT_ADDRESSED_NAME = re.compile(r"^([0-9a-f]{64})\.[A-Za-z0-9]+$")
+
+
+def scene_image_key(scene_description: str, style: str, provider: str, width: int, height: int, reference_sig: str = "") -> str:
+    """场景图请求键：provider + 风格 + 剧情 + 参考图签名 + 尺寸（与旧版本的缓存文件名一致）"""
+    reference_sig = (reference_sig or "").strip()
+    if reference_sig:
+        ref_hash = hashlib.md5(reference_sig.encode("utf-8")).hexdigest()[:10]
+        seed = f"{provider}_{style}_{scene_description}_{ref_hash}_{width}x{height}"
+    else:
+        seed = f"{provider}_{style}_{scene_description}_{width}x{height}"
+    return hashlib.md5(seed.encode()).hexdigest()
+
+
+def extension_for(content_type: str, default: str = "png") -> str:
+    """Content-Type / data URI 中的子类型 -> 扩展名"""
+    subtype = (content_type or "").split(";")[0].strip().lower()
+    subtype = subtype.split("/", 1)[1] if "/" in subtype else subtype
+    if subtype == "jpeg":
+        return "jpg"
+    return subtype if subtype in IMAGE_MIME_TYPES else default
+
+
+class ImageStore:
+    """按内容哈希存储图片，并维护请求键 -> blob 的索引"""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.index_dir = self.root / "index"
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "legacy_hits": 0, "misses": 0, "writes": 0, "dedup_writes": 0, "bytes_written": 0}
+        self._write_listeners = []  # 新写入 blob 后回调 listener(路径, 字节数)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def _bump(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += amount
+
+    @staticmethod
+    def url_for(filename: str) -> str:
+        return f"{URL_PREFIX}{filename}"
+
+    @staticmethod
+    def filename_from_url(url: str) -> Optional[str]:
+        """/image_cache/<文件名> 或 image_cache/<文件名> -> 文件名；其他 URL 返回 None"""
+        url = (url or "").strip()
+        for prefix in (URL_PREFIX, URL_PREFIX[1:]):
+            if url.startswith(prefix):
+                return url[len(prefix):].split("?", 1)[0] or None
+        return None
+
+    def resolve(self, filename: str) -> Optional[Path]:
+        """文件名 -> 存储中的图片路径（不存在或不是合法图片文件名时返回 None）"""
+        if not filename or not _SAFE_NAME.match(filename):
+            return None
+        if filename.rsplit(".", 1)[1].lower() not in IMAGE_MIME_TYPES:
+            return None
+        path = self.root / filename
+        return path if path.is_file() else None
+
+    @staticmethod
+    def content_hash(filename: str) -> Optional[str]:
+        """内容寻址 blob 的文件名 -> SHA-256；旧版本以请求键命名的文件返回 None（内容可能不唯一）"""
+        match = _CONTENT_ADDRESSED_NAME.match(filename or "")
+        return match.group(1) if match else None
+
+    @staticmethod
+    def _touch(path: Path) -> None:
+        """刷新 mtime（storage_manager 按 atime / mtime 判断最近使用）"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def path_for_url(self, url: str) -> Optional[Path]:
+        filename = self.filename_from_url(url)
+        return self.resolve(filename) if filename else None
+
+    # ---------- 请求键索引 ----------
+
+    def _index_path(self, request_key: str) -> Path:
+        return self.index_dir / request_key[:2] / f"{request_key}.json"
+
+    def read_index(self, request_key: str) -> Optional[Dict]:
+        """读取请求键的索引记录（不检查 blob 是否存在）"""
+        try:
+            with open(self._index_path(request_key), "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return record if isinstance(record, dict) else None
+
+    def lookup(self, request_key: str) -> Optional[Dict]:
+        """请求键 -> {"url", "prompt", "width", "height"}；未命中（或 blob 已被删除）返回 None"""
+        record = self.read_index(request_key)
+        path = self.resolve(record.get("blob", "")) if record is not None else None
+        if path is not None:
+            self._touch(path)
+            self._bump("hits")
+            return dict(record, url=self.url_for(record["blob"]))
+        legacy = f"{request_key}.png"
+        path = self.resolve(legacy)
+        if path is not None:
+            self._touch(path)
+            self._bump("legacy_hits")
+            return {"url": self.url_for(legacy), "blob": legacy}
+        self._bump("misses")
+        return None
+
+    def link(self, request_key: str, url: str, **meta) -> Optional[str]:
+        """把请求键指向已在存储中的图片（不复制文件）；url 不是存储中的图片时返回 None"""
+        filename = self.filename_from_url(url)
+        path = self.resolve(filename) if filename else None
+        if path is None:
+            return None
+        self._touch(path)
+        self._write_index(request_key, filename, meta)
+        return self.url_for(filename)
+
+    def _write_index(self, request_key: str, filename: str, meta: Dict) -> None:
+        record = {"blob": filename, "created": time.time()}
+        record.update({k: v for k, v in meta.items() if v is not None})
+        path = self._index_path(request_key)
+        try:
+            os.makedirs(path.parent, exist_ok=True)
+            self._atomic_write(path, json.dumps(record, ensure_ascii=False).encode("utf-8"))
+        except Exception as e:
+            print(f"⚠️ 图片索引写入失败：{str(e)[:100]}")
+
+    # ---------- blob 写入 ----------
+
+    @staticmethod
+    def _atomic_write(path: Path, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def put_bytes(self, data: bytes, ext: str = "png", request_key: str = None, **meta) -> str:
+        """写入图片字节（相同内容只存一份），返回 /image_cache/<文件名>；可同时登记请求键"""
+        return self.put_stream([data], ext, request_key, **meta)
+
+    def put_stream(self, chunks: Iterable[bytes], ext: str = "png", request_key: str = None,
+                   max_bytes: int = 0, **meta) -> str:
+        """边写临时文件边计算哈希（适合下载），超过 max_bytes 抛出 ValueError；返回 /image_cache/<文件名>"""
+        ext = (ext or "png").lower().lstrip(".")
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.root), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise ValueError(f"图片过大，已终止写入（>{max_bytes // (1024 * 1024)}MB）")
+                    digest.update(chunk)
+                    f.write(chunk)
+            filename = f"{digest.hexdigest()}.{ext}"
+            path = self.root / filename
+            wrote = not path.exists()
+            if not wrote:
+                os.remove(tmp_path)  # 相同内容已存在：去重
+                self._touch(path)
+                self._bump("dedup_writes")
+            else:
+                os.replace(tmp_path, path)
+                self._bump("writes")
+                self._bump("bytes_written", size)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if request_key:
+            self._write_index(request_key, filename, meta)
+        if wrote:
+            for listener in list(self._write_listeners):
+                try:
+                    listener(path, size)
+                except Exception as e:
+                    print(f"⚠️ 图片写入回调失败：{str(e)[:100]}")
+        return self.url_for(filename)
+
+    def add_write_listener(self, listener) -> None:
+        """注册新 blob 写入后的回调 listener(路径, 字节数)（存储空间管理、变体预生成等）"""
+        self._write_listeners.append(listener)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+image_store = ImageStore(IMAGE_STORE_DIR)
+
+
+def get_image_store_stats() -> Dict:
+    return image_store.stats()
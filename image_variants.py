@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+响应式图片变体：为存储的图片生成 WebP（可选 AVIF）与若干缩小宽度的版本，按请求协商返回。
+
+- 变体目录：与原图同级的 variants/<原图文件名去扩展名>/w<宽度>.<格式>（orig 表示原始宽度）；
+  image_cache 中的变体随原图一起被 storage_manager 淘汰，主角形象的变体在游戏目录内；
+- 生成时机：首次请求时按需生成（之后直接复用）；图片写入图片存储后可在后台预先生成（eager）；
+- 协商：Accept 含 image/avif（已开启且 Pillow 支持）优先 AVIF，其次 image/webp，否则保持原格式；
+  ?w=<宽度> 选择不小于该宽度的最小预设宽度，不超过原图宽度；
+- 以 SHA-256 命名的内容寻址原图内容不会变（mtime 只用于记录最近使用），变体缺失时才生成；
+  其他原图（如主角形象）更新（mtime 更新）后变体自动重新生成；Pillow 不可用或转换失败时回退原图。
+"""
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from image_store import image_store
+
+# ------------------------------
+# 图片变体配置（可通过环境变量调节）
+# ------------------------------
+VARIANT_CONFIG = {
+    "enabled": os.getenv("IMAGE_VARIANTS_ENABLED", "true").lower() == "true",
+    # 预设的缩小宽度（像素）
+    "widths": sorted({int(x) for x in os.getenv("IMAGE_VARIANT_WIDTHS", "480,960").split(",") if x.strip().isdigit()}),
+    "webp_quality": int(os.getenv("IMAGE_VARIANT_WEBP_QUALITY", "80")),
+    # AVIF 编码较慢，默认关闭（需要 Pillow 支持 AVIF）
+    "avif": os.getenv("IMAGE_VARIANT_AVIF", "false").lower() == "true",
+    "avif_quality": int(os.getenv("IMAGE_VARIANT_AVIF_QUALITY", "60")),
+    # 图片写入图片存储后在后台预先生成 WebP 变体
+    "eager": os.getenv("IMAGE_VARIANT_EAGER", "true").lower() == "true",
+    "eager_workers": int(os.getenv("IMAGE_VARIANT_EAGER_WORKERS", "1")),
+}
+
+VARIANTS_DIRNAME = "variants"
+
+# 格式 -> (Pillow 格式名, MIME, 扩展名)
+_FORMATS = {
+    "avif": ("AVIF", "image/avif", "avif"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "png": ("PNG", "image/png", "png"),
+    "jpg": ("JPEG", "image/jpeg", "jpg"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "gif": ("GIF", "image/gif", "gif"),
+}
+
+_support_cache: Dict[str, bool] = {}
+
+
+def _supports(fmt: str) -> bool:
+    """Pillow 是否可用且支持该格式的编码"""
+    if fmt not in _support_cache:
+        try:
+            from PIL import features
+            _support_cache[fmt] = bool(features.check(fmt))
+        except Exception:
+            _support_cache[fmt] = False
+    return _support_cache[fmt]
+
+
+def _pillow_available() -> bool:
+    if "pillow" not in _support_cache:
+        try:
+            import PIL  # noqa: F401
+            _support_cache["pillow"] = True
+        except ImportError:
+            _support_cache["pillow"] = False
+    return _support_cache["pillow"]
+
+
+def negotiate_format(accept: str, source_ext: str) -> str:
+    """根据 Accept 头选择输出格式"""
+    accept = (accept or "").lower()
+    if VARIANT_CONFIG["avif"] and "image/avif" in accept and _supports("avif"):
+        return "avif"
+    if "image/webp" in accept and _supports("webp"):
+        return "webp"
+    return source_ext
+
+
+def pick_width(requested: Optional[int], widths: List[int]) -> Optional[int]:
+    """选择不小于请求宽度的最小预设宽度；未请求或超过所有预设时返回 None（原始宽度）"""
+    if not requested or requested <= 0:
+        return None
+    for width in widths:
+        if width >= requested:
+            return width
+    return None
+
+
+class ImageVariants:
+    """按需生成并缓存图片变体"""
+
+    def __init__(self, config: Dict):
+        self.config = config
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = {"served_variants": 0, "served_original": 0, "generated": 0, "errors": 0, "eager_queued": 0}
+
+    def _bump(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    @staticmethod
+    def variant_dir(source: Path) -> Path:
+        return source.parent / VARIANTS_DIRNAME / source.stem
+
+    def variant_path(self, source: Path, fmt: str, width: Optional[int]) -> Path:
+        return self.variant_dir(source) / f"{'w%d' % width if width else 'orig'}.{_FORMATS[fmt][2]}"
+
+    def select(self, source: Path, accept: str, requested_width: Optional[int]) -> Tuple[Path, str]:
+        """返回 (要发送的文件, MIME)；不需要变体或生成失败时返回原图（非图片文件的 MIME 为 None）"""
+        source_ext = source.suffix.lower().lstrip(".")
+        source_mime = _FORMATS.get(source_ext, (None, None))[1]
+        if not self.config["enabled"] or source_ext not in _FORMATS or not _pillow_available():
+            self._bump("served_original")
+            return source, source_mime
+        fmt = negotiate_format(accept, source_ext)
+        width = pick_width(requested_width, self.config["widths"])
+        if fmt == source_ext and width is None:
+            self._bump("served_original")
+            return source, source_mime
+        target = self._ensure(source, fmt, width)
+        if target is None:
+            self._bump("served_original")
+            return source, source_mime
+        self._bump("served_variants")
+        return target, _FORMATS[fmt][1]
+
+    def etag_for(self, source_tag: str, source: Path, target: Path) -> str:
+        """由原图的内容哈希派生 select() 结果的 ETag（变体附加变体名与编码质量）"""
+        if target == source:
+            return source_tag
+        fmt = target.suffix.lstrip(".")
+        quality = {"webp": self.config["webp_quality"], "avif": self.config["avif_quality"]}.get(fmt)
+        return f"{source_tag}-{target.stem}" + (f"-q{quality}" if quality else "") + f".{fmt}"
+
+    def _ensure(self, source: Path, fmt: str, width: Optional[int]) -> Optional[Path]:
+        """变体存在且不旧于原图时直接返回，否则生成（内容寻址的原图不比较 mtime）"""
+        target = self.variant_path(source, fmt, width)
+        try:
+            source_mtime = source.stat().st_mtime
+            if target.exists() and (image_store.content_hash(source.name)
+                                    or target.stat().st_mtime >= source_mtime):
+                return target
+        except OSError:
+            return None
+        try:
+            self._render(source, target, fmt, width)
+        except Exception as e:
+            self._bump("errors")
+            print(f"⚠️ 生成图片变体失败 {source.name} -> {target.name}：{str(e)[:100]}")
+            return None
+        self._bump("generated")
+        return target
+
+    def _render(self, source: Path, target: Path, fmt: str, width: Optional[int]) -> None:
+        from PIL import Image
+
+        with Image.open(source) as im:
+            im.load()
+            if width and im.width > width:
+                height = max(1, round(im.height * width / im.width))
+                im = im.resize((width, height), Image.Resampling.LANCZOS)
+            pil_format = _FORMATS[fmt][0]
+            if pil_format == "JPEG" and im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            options = {}
+            if pil_format == "WEBP":
+                options = {"quality": self.config["webp_quality"], "method": 4}
+            elif pil_format == "AVIF":
+                options = {"quality": self.config["avif_quality"]}
+            elif pil_format in ("JPEG", "PNG"):
+                options = {"optimize": True}
+            buf = io.BytesIO()
+            im.save(buf, pil_format, **options)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(target.parent), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(buf.getvalue())
+            os.replace(tmp_path, target)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def warm(self, source: Path) -> None:
+        """后台为原图预先生成 WebP 变体（原始宽度 + 各预设宽度）"""
+        if not (self.config["enabled"] and self.config["eager"]) or not _pillow_available() or not _supports("webp"):
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.config["eager_workers"]),
+                                                    thread_name_prefix="image-variants")
+            self._stats["eager_queued"] += 1
+        self._executor.submit(self._warm, Path(source))
+
+    def _warm(self, source: Path) -> None:
+        for width in [None] + list(self.config["widths"]):
+            if not source.exists():
+                return
+            self._ensure(source, "webp", width)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(enabled=self.config["enabled"], pillow=_pillow_available(),
+                     webp=_supports("webp"), avif=self.config["avif"] and _supports("avif"),
+                     widths=self.config["widths"])
+        return stats
+
+
+image_variants = ImageVariants(VARIANT_CONFIG)
+image_store.add_write_listener(lambda path, nbytes: image_variants.warm(path))
+
+
+def get_image_variant_stats() -> Dict:
+    return image_variants.stats()
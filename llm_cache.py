@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+LLM 响应缓存：相同的 prompt + 采样参数直接返回上次的结果，不再消耗 token。
+
+- 键：model + 规范化后的 messages + 采样参数（temperature / max_tokens / top_p / penalties 等）
+  的 SHA-256；stream、timeout 等传输参数不参与；
+- 规范化：去掉每行首尾空白与空行差异（prompt 多为带缩进的 f-string，排版变化不影响结果）；
+- 存储：磁盘上每条一个 JSON 文件（按键前两位分目录），写入先写临时文件再原子替换；
+- 淘汰：总大小超过 max_bytes 时按最近访问时间（文件 mtime，命中时刷新）淘汰到 90%；
+- 按调用点开启：call_ai_api(..., cache=True)，只有内容稳定、可复用的调用才应开启。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+# ------------------------------
+# LLM 响应缓存配置（可通过环境变量调节）
+# ------------------------------
+LLM_CACHE_CONFIG = {
+    "enabled": os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true",
+    "dir": os.getenv("LLM_CACHE_DIR", "llm_cache"),
+    # 磁盘占用上限（MB），超过后按最近访问时间淘汰
+    "max_bytes": int(float(os.getenv("LLM_CACHE_MAX_MB", "200")) * 1024 * 1024),
+    # 条目有效期（秒），0 表示不过期
+    "ttl_seconds": float(os.getenv("LLM_CACHE_TTL_SECONDS", "0")),
+}
+
+# 影响生成结果、需要纳入缓存键的请求参数
+_KEY_PARAMS = ("model", "temperature", "max_tokens", "top_p", "top_k",
+               "frequency_penalty", "presence_penalty", "stop", "seed", "response_format")
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        lines = (line.strip() for line in content.strip().splitlines())
+        return "\n".join(line for line in lines if line)
+    if isinstance(content, list):
+        # 多模态消息：只规范化其中的文本片段
+        return [dict(part, text=_normalize_content(part.get("text", ""))) if isinstance(part, dict) and part.get("type") == "text" else part
+                for part in content]
+    return content
+
+
+def cache_key(request_body: Dict) -> str:
+    """根据 model + 规范化 messages + 采样参数计算缓存键"""
+    material = {name: request_body.get(name) for name in _KEY_PARAMS if request_body.get(name) is not None}
+    material["messages"] = [
+        {"role": message.get("role"), "content": _normalize_content(message.get("content"))}
+        for message in request_body.get("messages", [])
+    ]
+    raw = json.dumps(material, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """按内容寻址的磁盘缓存，总大小超限时按 LRU 淘汰"""
+
+    def __init__(self, cache_dir: str, max_bytes: int, ttl_seconds: float = 0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._index = None  # key -> [size, last_access]，首次使用时扫描目录建立
+        self._total_bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "errors": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _load_index(self) -> None:
+        # 调用方需持有 self._lock
+        if self._index is not None:
+            return
+        self._index, self._total_bytes = {}, 0
+        if not os.path.isdir(self.cache_dir):
+            return
+        try:
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if not entry.name.endswith(".json"):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    self._index[entry.name[:-5]] = [st.st_size, st.st_mtime]
+                    self._total_bytes += st.st_size
+        except OSError as e:
+            print(f"⚠️ 扫描LLM响应缓存目录失败：{str(e)[:100]}")
+
+    def _forget(self, key: str) -> None:
+        # 调用方需持有 self._lock
+        meta = self._index.pop(key, None)
+        if meta:
+            self._total_bytes -= meta[0]
+
+    def get(self, request_body: Dict) -> Optional[Dict]:
+        """命中时返回缓存的响应（与 call_ai_api 返回结构相同），未命中返回 None"""
+        key = cache_key(request_body)
+        path = self._path(key)
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                self._stats["misses"] += 1
+                return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            # 文件被其他进程淘汰或已损坏
+            with self._lock:
+                self._forget(key)
+                self._stats["misses"] += 1
+            return None
+        now = time.time()
+        if self.ttl_seconds and now - record.get("created", 0) > self.ttl_seconds:
+            self._remove(key)
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        try:
+            os.utime(path, (now, now))  # 刷新访问时间，重启后仍按 LRU 淘汰
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._index:
+                self._index[key][1] = now
+            self._stats["hits"] += 1
+        return record.get("response")
+
+    def put(self, request_body: Dict, response_data: Dict) -> None:
+        key = cache_key(request_body)
+        path = self._path(key)
+        record = {
+            "created": time.time(),
+            "model": request_body.get("model"),
+            "response": response_data,
+        }
+        try:
+            data = json.dumps(record, ensure_ascii=False).encode("utf-8")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            print(f"⚠️ LLM响应缓存写入失败：{str(e)[:100]}")
+            return
+        with self._lock:
+            self._load_index()
+            self._forget(key)
+            self._index[key] = [len(data), time.time()]
+            self._total_bytes += len(data)
+            self._stats["writes"] += 1
+            victims = self._pick_victims()
+        for victim in victims:
+            self._remove(victim, evicted=True)
+
+    def _pick_victims(self):
+        # 调用方需持有 self._lock；超过上限时淘汰最久未访问的条目直到降到 90%
+        if self._total_bytes <= self.max_bytes:
+            return []
+        target = self.max_bytes * 0.9
+        victims, remaining = [], self._total_bytes
+        for key, (size, _) in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if remaining <= target:
+                break
+            victims.append(key)
+            remaining -= size
+        return victims
+
+    def _remove(self, key: str, evicted: bool = False) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+        with self._lock:
+            self._forget(key)
+            if evicted:
+                self._stats["evictions"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._load_index()
+            stats = dict(self._stats)
+            stats.update(entries=len(self._index), total_bytes=self._total_bytes, max_bytes=self.max_bytes)
+        return stats
+
+
+llm_response_cache = LLMResponseCache(
+    LLM_CACHE_CONFIG["dir"], LLM_CACHE_CONFIG["max_bytes"], LLM_CACHE_CONFIG["ttl_seconds"]
+)
+
+
+def get_llm_cache_stats() -> Dict:
+    stats = llm_response_cache.stats()
+    stats["enabled"] = LLM_CACHE_CONFIG["enabled"]
+    return stats
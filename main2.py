@@ -1,19 +1,52 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import json
 import os
+import queue
 import sys
 import re
 import hashlib
 import requests
 import threading
 from functools import lru_cache
+from contextlib import nullcontext
 from urllib.parse import quote
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from typing import Dict, List
 from dotenv import load_dotenv
 # 新增：导入重试相关模块
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, retry_if_result
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, retry_if_exception, retry_if_result, AsyncRetrying
+# 加载环境变量（需在导入下面这些模块之前：它们在导入时读取 os.getenv 配置）
+load_dotenv()
+# 共享连接池（keep-alive），所有外部 HTTP 调用统一走这里
+from http_transport import http_get, http_post, ASYNC_RETRYABLE_ERRORS, async_http_available, async_http_post
+# 协作式取消：被放弃的生成任务中止在途请求
+from cancellation import CancelToken, OperationCancelled, cancel_scope, cancellable_sleep, check_cancelled, current_token, run_cancellable
+# 图片等上游的令牌桶限速（按 provider + API Key，本机多进程共享）
+from rate_limiter import get_rate_limiter, parse_retry_after
+# LLM / 图片调用的自适应并发上限（AIMD + 延迟梯度）
+from adaptive_concurrency import llm_concurrency, image_concurrency
+# 图片 provider 路由：健康度统计、熔断与按延迟择优
+from provider_router import image_provider_router
+# 玩家同步等待的 LLM 调用：超过延迟分位数后发出对冲副本
+from hedging import llm_hedger
+# 按内容寻址的 LLM 响应磁盘缓存（按调用点开启）
+from llm_cache import LLM_CACHE_CONFIG, cache_key as llm_cache_key, llm_response_cache
+# 进行中的重复 LLM / 图片请求合并为一次
+from single_flight import llm_flights, image_flights
+# 世界观缓存（内存 LRU + 磁盘，TTL / 条数上限）
+from worldview_store import WORLDVIEW_CACHE_CONFIG, worldview_store
+# 世界观模板的相似度索引（字符 n-gram TF-IDF）
+from template_index import TEMPLATE_INDEX_CONFIG, TemplateIndex
+# Wikipedia 请求的磁盘缓存（含否定结果）与离线模式
+from wiki_cache import wiki_cache
+# 内容寻址的图片存储（所有图片代码路径共用同一套缓存键）
+from image_store import image_store, scene_image_key, extension_for
+# image_cache / 主角形象目录的容量预算与 LRU 淘汰（当前会话的游戏固定不淘汰）
+from storage_manager import storage_manager
+# 图生图参考图（主角三视图等）的编码结果缓存（按文件 mtime / 大小失效）
+from reference_cache import reference_payload_cache
 
 # 设置环境变量以使用 UTF-8 编码（解决 Windows GBK 编码问题）
 if sys.platform == 'win32':
@@ -46,8 +79,6 @@ def safe_input(prompt: str, default: str = "", retries: int = 3) -> str:
     print("⚠️ 多次无效输入，已使用默认值。")
     return default
 
-# 加载环境变量
-load_dotenv()
 
 # ------------------------------
 # 全局常量定义（替换为yunwu.ai配置）
@@ -58,6 +89,13 @@ AI_API_CONFIG = {
     "model": os.getenv("Camera_Analyst_MODEL")
 }
 
+# 对冲请求使用的端点（未配置时与主端点相同，可指向备用模型/供应商）
+AI_API_HEDGE_CONFIG = {
+    "api_key": os.getenv("LLM_HEDGE_API_KEY") or AI_API_CONFIG["api_key"],
+    "base_url": os.getenv("LLM_HEDGE_BASE_URL") or AI_API_CONFIG["base_url"],
+    "model": os.getenv("LLM_HEDGE_MODEL") or AI_API_CONFIG["model"]
+}
+
 # ------------------------------
 # 视觉内容生成API配置
 # ------------------------------
@@ -101,28 +139,36 @@ def _clip_text(s: str, max_chars: int) -> str:
     return s if len(s) <= max_chars else (s[:max_chars] + "…")
 
 
-def _wiki_api_get(lang: str, params: Dict) -> Dict:
-    """Wikipedia action API GET。失败返回 {}"""
-    try:
-        url = f"https://{lang}.wikipedia.org/w/api.php"
-        resp = requests.get(
-            url,
-            params={"format": "json", "formatversion": 2, **(params or {})},
-            timeout=WIKI_TIMEOUT_SECONDS,
-            headers={"User-Agent": "DN-main/1.0 (character-lookup; https://example.invalid)"}
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
+def _wiki_api_get(lang: str, params: Dict, is_empty=None) -> Dict:
+    """Wikipedia action API GET（经磁盘缓存）。失败返回 {}；is_empty(data) 为 True 时按否定结果缓存"""
+    url = f"https://{lang}.wikipedia.org/w/api.php"
+    full_params = {"format": "json", "formatversion": 2, **(params or {})}
+
+    def fetch():
+        try:
+            resp = http_get(
+                url,
+                params=full_params,
+                timeout=WIKI_TIMEOUT_SECONDS,
+                headers={"User-Agent": "DN-main/1.0 (character-lookup; https://example.invalid)"}
+            )
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception:
+            return None, False
+        if not isinstance(data, dict):
+            return None, False
+        return data, bool(is_empty and is_empty(data))
+
+    return wiki_cache.fetch(url, full_params, fetch)
 
 
 def _wiki_search(lang: str, query: str, limit: int = 5) -> List[Dict]:
     query = _safe_str(query).strip()
     if not query:
         return []
-    data = _wiki_api_get(lang, {"action": "query", "list": "search", "srsearch": query, "srlimit": max(1, int(limit))})
+    data = _wiki_api_get(lang, {"action": "query", "list": "search", "srsearch": query, "srlimit": max(1, int(limit))},
+                         is_empty=lambda d: not (d.get("query", {}) or {}).get("search"))
     items = (data.get("query", {}) or {}).get("search", []) if isinstance(data, dict) else []
     return items if isinstance(items, list) else []
 
@@ -144,6 +190,7 @@ def _wiki_langlink_title(source_lang: str, source_title: str, target_lang: str)
             "lllang": target_lang,
             "lllimit": 1,
         },
+        is_empty=lambda d: not any(isinstance(p, dict) and p.get("langlinks") for p in ((d.get("query", {}) or {}).get("pages") or [])),
     )
     try:
         pages = (data.get("query", {}) or {}).get("pages", [])
@@ -160,23 +207,29 @@ def _wiki_langlink_title(source_lang: str, source_title: str, target_lang: str)
 
 
 def _wiki_summary(lang: str, title: str) -> Dict:
-    """Wikipedia REST summary。失败返回 {}"""
+    """Wikipedia REST summary（经磁盘缓存）。失败返回 {}；条目不存在（404）按否定结果缓存"""
     title = _safe_str(title).strip()
     if not title:
         return {}
-    try:
-        # https://en.wikipedia.org/api/rest_v1/page/summary/Albert_Einstein
-        url = f"https://{lang}.wikipedia.org/api/rest_v1/page/summary/{quote(title)}"
-        resp = requests.get(
-            url,
-            timeout=WIKI_TIMEOUT_SECONDS,
-            headers={"User-Agent": "DN-main/1.0 (character-lookup; https://example.invalid)"}
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
+    # https://en.wikipedia.org/api/rest_v1/page/summary/Albert_Einstein
+    url = f"https://{lang}.wikipedia.org/api/rest_v1/page/summary/{quote(title)}"
+
+    def fetch():
+        try:
+            resp = http_get(
+                url,
+                timeout=WIKI_TIMEOUT_SECONDS,
+                headers={"User-Agent": "DN-main/1.0 (character-lookup; https://example.invalid)"}
+            )
+            if resp.status_code == 404:
+                return {}, True
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception:
+            return None, False
+        return (data, False) if isinstance(data, dict) else (None, False)
+
+    return wiki_cache.fetch(url, None, fetch)
 
 
 def _summary_is_disambiguation(summary: Dict) -> bool:
@@ -278,6 +331,22 @@ def _looks_like_real_ip_or_person(text: str) -> bool:
     return False
 
 
+def _wiki_map(fn, langs: List[str]) -> Dict[str, Dict]:
+    """对每种语言并发执行 fn(lang)，返回 {lang: 结果}（丢弃空结果，保持 langs 顺序）"""
+    if len(langs) <= 1:
+        results = {lang: fn(lang) for lang in langs}
+    else:
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(langs), thread_name_prefix="wiki") as executor:
+            futures = {lang: executor.submit(fn, lang) for lang in langs}
+            for lang, future in futures.items():
+                try:
+                    results[lang] = future.result()
+                except Exception:
+                    results[lang] = None
+    return {lang: result for lang, result in results.items() if result}
+
+
 @lru_cache(maxsize=256)
 def wiki_lookup_theme_and_character(theme: str) -> Dict:
     """
@@ -294,26 +363,27 @@ def wiki_lookup_theme_and_character(theme: str) -> Dict:
     if not theme or not WIKI_LOOKUP_ENABLED:
         return {"is_real_world": False, "theme": {}, "character": {}, "evidence_text": ""}
 
-    # 先用主题本身做检索（中/英都试），收集尽量多的语言标题（用于“中英文名+作品名”）
-    theme_hits_by_lang: Dict[str, Dict] = {}
-    for lang in WIKI_LANGS or ["zh", "en"]:
+    # 先用主题本身做检索（中/英并发），收集尽量多的语言标题（用于“中英文名+作品名”）
+    def _theme_hit(lang: str) -> Dict:
         results = _wiki_search(lang, theme, limit=5)
         if not results:
-            continue
+            return {}
         top = results[0] if isinstance(results[0], dict) else {}
         title = _safe_str(top.get("title")).strip()
         if not title:
-            continue
+            return {}
         summary = _wiki_summary(lang, title)
         if not summary or _summary_is_disambiguation(summary):
-            continue
-        theme_hits_by_lang[lang] = {
+            return {}
+        return {
             "lang": lang,
             "title": title,
             "summary": summary,
             "image_url": _extract_image_url_from_summary(summary),
         }
 
+    theme_hits_by_lang: Dict[str, Dict] = _wiki_map(_theme_hit, WIKI_LANGS or ["zh", "en"])
+
     # 用 langlinks 尝试补齐另一种语言标题（提高“中英文名+作品名”命中率）
     try:
         langs = (WIKI_LANGS or ["zh", "en"])
@@ -375,9 +445,8 @@ def wiki_lookup_theme_and_character(theme: str) -> Dict:
         f"{theme} main character",
     ]
 
-    # 尽量为每种语言找一个“人物/主角”条目
-    character_hits_by_lang: Dict[str, Dict] = {}
-    for lang in (WIKI_LANGS or ["zh", "en"]):
+    # 尽量为每种语言找一个“人物/主角”条目（各语言并发，同一语言内按检索词顺序）
+    def _character_hit(lang: str) -> Dict:
         theme_title_same_lang = _safe_str((theme_hits_by_lang.get(lang, {}) or {}).get("title")).strip()
         for q in second_queries:
             results = _wiki_search(lang, q, limit=5)
@@ -399,14 +468,16 @@ def wiki_lookup_theme_and_character(theme: str) -> Dict:
             summary = _wiki_summary(lang, cand_title)
             if not summary or _summary_is_disambiguation(summary):
                 continue
-            character_hits_by_lang[lang] = {
+            return {
                 "lang": lang,
                 "title": cand_title,
                 "summary": summary,
                 "query": q,
                 "image_url": _extract_image_url_from_summary(summary),
             }
-            break
+        return {}
+
+    character_hits_by_lang: Dict[str, Dict] = _wiki_map(_character_hit, WIKI_LANGS or ["zh", "en"])
 
     # 同样尝试用 langlinks 补齐人物条目的另一种语言标题
     try:
@@ -505,9 +576,10 @@ def wiki_lookup_theme_and_character(theme: str) -> Dict:
 # 图片生成：全局限速（避免 429 / 请求过于频繁）
 # ------------------------------
 # yunwu.ai 图片生成接口通常有更严格的速率限制；项目内又有多线程并行路径（预生成/批量图片），
-# 因此需要跨线程的“最小间隔”控制，降低 429 概率与重试等待时间。
-_YUNWU_RATE_LOCK = threading.Lock()
-_YUNWU_LAST_CALL_TS = 0.0
+# 因此按 API Key 使用令牌桶限速（YUNWU_MIN_INTERVAL_SECONDS / YUNWU_RATE_BURST，见 rate_limiter.py），
+# 排队等待时不持有任何锁，并根据 429 / Retry-After 自动放慢。
+def _yunwu_image_limiter():
+    return get_rate_limiter("yunwu_image", IMAGE_GENERATION_CONFIG.get("yunwu_api_key", ""))
 
 
 DIFFICULTY_SETTINGS = {
@@ -625,6 +697,8 @@ PERFORMANCE_OPTIMIZATION = {
     # 方案5：异步预生成优化
     "async_pregeneration": os.getenv("PERF_ASYNC_PREGEN", "true").lower() == "true",
     "stream_first_option": os.getenv("PERF_STREAM_FIRST", "true").lower() == "true",  # 流式返回第一个完成的选项
+    # 选项文本改由 asyncio + httpx 并发生成（需安装 httpx；使用外部调度器的第二层预生成仍走线程池）
+    "async_text_pipeline": os.getenv("PERF_ASYNC_TEXT_PIPELINE", "false").lower() == "true",
     
     # 方案6：重试优化
     "optimize_retry": os.getenv("PERF_OPT_RETRY", "true").lower() == "true",
@@ -643,10 +717,13 @@ WORLDVIEW_TEMPLATE_DIR = "worldview_templates"
 if not os.path.exists(WORLDVIEW_TEMPLATE_DIR):
     os.makedirs(WORLDVIEW_TEMPLATE_DIR)
 
-# 世界观缓存目录
-WORLDVIEW_CACHE_DIR = "worldview_cache"
-if not os.path.exists(WORLDVIEW_CACHE_DIR):
-    os.makedirs(WORLDVIEW_CACHE_DIR)
+# 模板相似度索引：启用模板时启动即加载，之后按文件变化自动刷新
+worldview_template_index = TemplateIndex(WORLDVIEW_TEMPLATE_DIR, TEMPLATE_INDEX_CONFIG)
+if PERFORMANCE_OPTIMIZATION["use_templates"]:
+    worldview_template_index.refresh(force=True)
+
+# 世界观缓存目录（由 worldview_store 管理：TTL、条数上限、原子写入）
+WORLDVIEW_CACHE_DIR = WORLDVIEW_CACHE_CONFIG["dir"]
 
 # ------------------------------
 # 世界观模板与缓存辅助函数
@@ -657,46 +734,35 @@ def _make_worldview_cache_key(user_idea: str, protagonist_attr: Dict, difficulty
 
 
 def _load_worldview_cache(cache_key: str) -> Dict:
-    cache_path = os.path.join(WORLDVIEW_CACHE_DIR, f"{cache_key}.json")
-    if os.path.exists(cache_path):
-        try:
-            with open(cache_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"⚠️ 读取世界观缓存失败：{e}")
-    return {}
+    """读取世界观缓存（未开启、未命中或已过期返回空字典）"""
+    if not WORLDVIEW_CACHE_CONFIG["enabled"]:
+        return {}
+    return worldview_store.get(cache_key) or {}
 
 
 def _save_worldview_cache(cache_key: str, data: Dict):
-    try:
-        cache_path = os.path.join(WORLDVIEW_CACHE_DIR, f"{cache_key}.json")
-        with open(cache_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"⚠️ 保存世界观缓存失败：{e}")
+    if not WORLDVIEW_CACHE_CONFIG["enabled"] or not data:
+        return
+    worldview_store.put(cache_key, data)
 
 
 def _load_template_worldview(user_idea: str) -> Dict:
-    """从模板库中选择匹配的世界观"""
+    """从模板库中选择最相似的世界观（相似度低于 template_similarity_threshold 视为未命中）"""
     if not PERFORMANCE_OPTIMIZATION["use_templates"]:
         return {}
-    idea_lower = user_idea.lower()
-    for root, _, files in os.walk(WORLDVIEW_TEMPLATE_DIR):
-        for file in files:
-            if not file.endswith(".json"):
-                continue
-            path = os.path.join(root, file)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    tpl = json.load(f)
-                keywords = tpl.get("keywords", [])
-                # 简单相似度：任一关键词出现即视为命中
-                if any(k.lower() in idea_lower for k in keywords):
-                    print(f"✅ 命中世界观模板：{file}")
-                    return tpl.get("worldview", tpl)
-            except Exception as e:
-                print(f"⚠️ 读取模板失败 {path}：{e}")
-    return {}
+    try:
+        match = worldview_template_index.best_match(user_idea)
+    except Exception as e:
+        print(f"⚠️ 查询世界观模板索引失败：{e}")
+        return {}
+    if not match:
+        return {}
+    template_view, score, file = match
+    if score < PERFORMANCE_OPTIMIZATION["template_similarity_threshold"]:
+        print(f"💡 最相似的世界观模板 {file} 相似度 {score:.2f}，低于阈值，不使用模板")
+        return {}
+    print(f"✅ 命中世界观模板：{file}（相似度 {score:.2f}）")
+    return template_view
 
 
 def _merge_template_with_input(template_view: Dict, protagonist_attr: Dict, difficulty: str, tone_key: str) -> Dict:
@@ -712,15 +778,14 @@ def _merge_template_with_input(template_view: Dict, protagonist_attr: Dict, diff
     return merged
 
 
-def _background_fill_worldview_details(cache_key: str, user_idea: str, protagonist_attr: Dict, difficulty: str, tone_key: str):
-    """后台补全世界观细节"""
+def _background_fill_worldview_details(cache_key: str, user_idea: str, protagonist_attr: Dict, difficulty: str, tone_key: str,
+                                       fresh: bool = False):
+    """后台生成完整版世界观并写入缓存（llm_generate_global 成功后自动保存）；fresh=True 时生成新的变体"""
     try:
-        print("🧵 正在后台补全世界观细节...")
-        detailed_state = llm_generate_global(user_idea, protagonist_attr, difficulty, tone_key, force_full=True)
+        print("🧵 正在后台补全世界观细节..." if not fresh else "🧵 正在后台重新生成世界观变体...")
+        detailed_state = llm_generate_global(user_idea, protagonist_attr, difficulty, tone_key, force_full=True, fresh=fresh)
         if detailed_state:
-            # 🔑 缓存机制已删除：不再保存缓存
-            # _save_worldview_cache(cache_key, detailed_state)
-            print("✅ 世界观细节补全完成")
+            print(f"✅ 世界观细节补全完成，已写入缓存：{cache_key}")
     except Exception as e:
         print(f"⚠️ 后台补全世界观失败：{e}")
 
@@ -833,24 +898,11 @@ def _regex_fill_worldview(raw_text: str, core_worldview: Dict, chapters: Dict):
 # ------------------------------
 # 新增：通用API请求函数（带自动重试）
 # ------------------------------
-@retry(
-    stop=stop_after_attempt(15),  # 重试上限保持不变，保证兼容
-    wait=wait_exponential(multiplier=1, min=5, max=30),  # 等待时间：5s → 10s → 20s → 30s → 30s...
-    retry=(
-        retry_if_exception_type(requests.exceptions.ConnectionError) |  # 网络连接错误重试
-        retry_if_exception_type(requests.exceptions.Timeout)            # 超时错误重试
-        # 注意：HTTPError不在这里重试，我们在函数内部处理
-    ),
-    reraise=True  # 最终失败后抛出原异常，方便上层处理
-)
-def call_ai_api(request_body: Dict) -> Dict:
-    """
-    调用AI API的通用函数，带自动重试（401/403错误不重试）
-    变更：移除全局共享的重试计数，改用固定超时以避免多线程下状态污染。
-    """
-    # 安全获取API配置
-    api_key = AI_API_CONFIG.get('api_key', '')
-    base_url = AI_API_CONFIG.get('base_url', '')
+def _ai_api_target(api_config: Dict = None) -> tuple:
+    """安全获取并验证API配置，返回 (api_key, base_url, headers)；api_config 默认为 AI_API_CONFIG"""
+    api_config = api_config or AI_API_CONFIG
+    api_key = api_config.get('api_key', '')
+    base_url = api_config.get('base_url', '')
     
     # 验证API配置
     if not api_key:
@@ -862,26 +914,70 @@ def call_ai_api(request_body: Dict) -> Dict:
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json; charset=utf-8"
     }
+    return api_key, base_url, headers
+
+
+# 同步与异步请求共用的重试策略
+_AI_API_RETRY_POLICY = dict(
+    stop=stop_after_attempt(15),  # 重试上限保持不变，保证兼容
+    wait=wait_exponential(multiplier=1, min=5, max=30),  # 等待时间：5s → 10s → 20s → 30s → 30s...
+    retry=(
+        retry_if_exception_type(requests.exceptions.ConnectionError) |  # 网络连接错误重试
+        retry_if_exception_type(requests.exceptions.Timeout) |          # 超时错误重试
+        retry_if_exception_type(ASYNC_RETRYABLE_ERRORS)                 # httpx 的对应错误（异步管线）
+        # 注意：HTTPError不在这里重试，我们在函数内部处理
+    ),
+    reraise=True  # 最终失败后抛出原异常，方便上层处理
+)
+
+
+def _ai_api_auth_error(status_code: int, base_url: str, api_key: str) -> ValueError:
+    """401/403 认证错误：打印配置诊断信息，返回不应重试的 ValueError（由调用方抛出）"""
+    print(f"❌ API认证失败（HTTP {status_code}），请检查API密钥和权限配置")
+    print(f"   当前API配置：")
+    print(f"   - API基础URL: {base_url}")
+    print(f"   - API密钥: {'已配置' if api_key else '未配置'} (长度: {len(api_key) if api_key else 0})")
+    print(f"   - 请求URL: {base_url}/chat/completions")
+    print(f"   提示：请确认.env文件中的Camera_Analyst_API_KEY是否正确")
+    print(f"   提示：请确认API密钥是否有访问该端点的权限")
+    print(f"   提示：请确认API基础URL（Camera_Analyst_BASE_URL）是否正确，应该是完整的URL，如：https://api.example.com/v1")
+    print(f"   提示：如果使用yunwu.ai，请确认API密钥格式和权限是否正确")
+    
+    # 检查URL格式
+    if base_url and not base_url.startswith(('http://', 'https://')):
+        print(f"   ⚠️ 警告：API基础URL格式可能不正确，应该以http://或https://开头")
+    
+    # 创建一个自定义异常，包含更多信息
+    error_msg = f"API认证失败（HTTP {status_code}）。请检查：1) .env文件中的Camera_Analyst_API_KEY是否正确 2) API密钥是否有权限 3) Camera_Analyst_BASE_URL格式是否正确（应该是完整URL）"
+    return ValueError(error_msg)
+
+
+@retry(
+    sleep=cancellable_sleep,  # 重试间隔可被取消令牌打断
+    **_AI_API_RETRY_POLICY
+)
+def _call_ai_api_with_retry(request_body: Dict, on_delta=None, api_config: Dict = None) -> Dict:
+    check_cancelled()
+    api_key, base_url, headers = _ai_api_target(api_config)
     
     try:
         # 固定超时，避免跨线程共享计数导致超时失控
         timeout = 180
         
-        # 处理流式开关：当前API若不支持流式，则退化为普通请求
-        stream_flag = False
         if request_body.get("stream"):
-            stream_flag = True
-            request_body = dict(request_body)
-            request_body.pop("stream", None)
-            print("ℹ️ Stream模式暂不直接支持，已自动降级为普通请求")
+            print(f"📡 发送流式API请求... (超时时间: {timeout}秒)")
+            with llm_concurrency.slot():
+                return _collect_chat_completion_stream(request_body, on_delta=on_delta, timeout=timeout)
         
         print(f"📡 发送API请求... (超时时间: {timeout}秒)")
-        response = requests.post(
-            url=f"{base_url}/chat/completions",
-            headers=headers,
-            json=request_body,
-            timeout=timeout
-        )
+        with llm_concurrency.slot() as slot:
+            response = http_post(
+                url=f"{base_url}/chat/completions",
+                headers=headers,
+                json=request_body,
+                timeout=timeout
+            )
+            slot.observe_response(response)
         response.raise_for_status()  # 抛出HTTP错误
         print("✅ API请求成功")
         return response.json()
@@ -890,23 +986,7 @@ def call_ai_api(request_body: Dict) -> Dict:
         
         # 401/403是认证错误，不应该重试
         if status_code in [401, 403]:
-            print(f"❌ API认证失败（HTTP {status_code}），请检查API密钥和权限配置")
-            print(f"   当前API配置：")
-            print(f"   - API基础URL: {base_url}")
-            print(f"   - API密钥: {'已配置' if api_key else '未配置'} (长度: {len(api_key) if api_key else 0})")
-            print(f"   - 请求URL: {base_url}/chat/completions")
-            print(f"   提示：请确认.env文件中的Camera_Analyst_API_KEY是否正确")
-            print(f"   提示：请确认API密钥是否有访问该端点的权限")
-            print(f"   提示：请确认API基础URL（Camera_Analyst_BASE_URL）是否正确，应该是完整的URL，如：https://api.example.com/v1")
-            print(f"   提示：如果使用yunwu.ai，请确认API密钥格式和权限是否正确")
-            
-            # 检查URL格式
-            if base_url and not base_url.startswith(('http://', 'https://')):
-                print(f"   ⚠️ 警告：API基础URL格式可能不正确，应该以http://或https://开头")
-            
-            # 创建一个自定义异常，包含更多信息
-            error_msg = f"API认证失败（HTTP {status_code}）。请检查：1) .env文件中的Camera_Analyst_API_KEY是否正确 2) API密钥是否有权限 3) Camera_Analyst_BASE_URL格式是否正确（应该是完整URL）"
-            raise ValueError(error_msg) from e
+            raise _ai_api_auth_error(status_code, base_url, api_key) from e
         
         # 其他HTTP错误（如500、502、503等）可以重试，但不在装饰器中重试
         # 这里直接抛出，让上层处理
@@ -916,10 +996,289 @@ def call_ai_api(request_body: Dict) -> Dict:
         # 这些错误会被装饰器自动重试
         print(f"⚠️ API请求失败（网络/超时），将自动重试：{str(e)[:100]}")
         raise
+    except OperationCancelled:
+        print("⏹️ API请求已取消")
+        raise
     except Exception as e:
         print(f"⚠️ API请求失败（未知错误）：{str(e)[:100]}")
         raise
 
+
+def _has_completion_content(response_data) -> bool:
+    """响应中是否有非空的 choices[0].message.content（对冲时用于判定有效结果）"""
+    try:
+        return bool((response_data.get("choices") or [{}])[0].get("message", {}).get("content", "").strip())
+    except Exception:
+        return False
+
+
+def _call_ai_api_timed(request_body: Dict, on_delta=None, api_config: Dict = None) -> Dict:
+    """执行请求并把非流式成功调用的耗时计入对冲截止时间的统计"""
+    start = time.time()
+    response_data = _call_ai_api_with_retry(request_body, on_delta=on_delta, api_config=api_config)
+    if not request_body.get("stream"):
+        llm_hedger.record_latency(time.time() - start)
+    return response_data
+
+
+def call_ai_api(request_body: Dict, on_delta=None, cancel_token: CancelToken = None, hedge: bool = False,
+                cache: bool = False, refresh_cache: bool = False, coalesce: bool = False) -> Dict:
+    """
+    调用AI API的通用函数，带自动重试（401/403错误不重试）
+    变更：移除全局共享的重试计数，改用固定超时以避免多线程下状态污染。
+    request_body 含 "stream": True 时走SSE流式请求，每收到一段增量文本调用 on_delta(text)，
+    最终仍返回与普通请求相同结构的 {"choices": [{"message": {"content": ...}}]}。
+    cancel_token：取消后中止在途请求与重试等待，抛出 OperationCancelled（不传则沿用当前线程的令牌）。
+    hedge：玩家同步等待的调用可开启对冲（需 LLM_HEDGING_ENABLED=true，流式请求不对冲），
+    主请求超过延迟分位数未返回时向 AI_API_HEDGE_CONFIG 端点发出副本，先返回的有效结果胜出。
+    cache：相同 model + prompt + 采样参数的请求直接返回磁盘缓存中的结果（见 llm_cache），
+    只应在结果可复用的调用点开启；refresh_cache=True 时跳过读取、用新结果覆盖
+    （例如上一次缓存的内容解析失败后的重试）。
+    coalesce：与进行中的相同请求（同一缓存键）合并，共享一次调用的结果（见 single_flight，流式请求不合并）；
+    返回的响应可能被多个调用方共享，调用方不应修改它。
+    """
+    use_cache = cache and LLM_CACHE_CONFIG["enabled"]
+    if use_cache and not refresh_cache:
+        cached = _cached_ai_response(request_body, on_delta)
+        if cached is not None:
+            return cached
+
+    def fetch():
+        response_data = _call_ai_api_uncached(request_body, on_delta, hedge)
+        _remember_ai_response(request_body, response_data, use_cache)
+        return response_data
+
+    with cancel_scope(cancel_token):
+        if coalesce and not request_body.get("stream"):
+            return llm_flights.do(llm_cache_key(request_body), fetch, label="LLM请求")
+        return fetch()
+
+
+def _cached_ai_response(request_body: Dict, on_delta=None):
+    """读取LLM响应缓存（无有效内容时视为未命中）；流式请求命中时把整段内容作为一次增量回调"""
+    cached = llm_response_cache.get(request_body)
+    if cached is None or not _has_completion_content(cached):
+        return None
+    print("⚡ 命中LLM响应缓存")
+    if request_body.get("stream") and on_delta:
+        on_delta(cached["choices"][0]["message"]["content"])
+    return cached
+
+
+def _remember_ai_response(request_body: Dict, response_data: Dict, use_cache: bool) -> None:
+    if use_cache and _has_completion_content(response_data):
+        llm_response_cache.put(request_body, response_data)
+
+
+def _call_ai_api_uncached(request_body: Dict, on_delta, hedge: bool) -> Dict:
+    """在调用方的取消作用域内执行请求（可选对冲）"""
+    if hedge and llm_hedger.enabled and not request_body.get("stream"):
+        hedge_body = dict(request_body)
+        if AI_API_HEDGE_CONFIG.get("model"):
+            hedge_body["model"] = AI_API_HEDGE_CONFIG["model"]
+        return llm_hedger.run(
+            lambda: _call_ai_api_timed(request_body),
+            lambda: _call_ai_api_timed(hedge_body, api_config=AI_API_HEDGE_CONFIG),
+            is_valid=_has_completion_content,
+            label="LLM",
+        )
+    return _call_ai_api_timed(request_body, on_delta=on_delta)
+
+
+# ------------------------------
+# 异步版本（asyncio + httpx）：缓存、请求合并、并发名额、重试策略与认证错误处理均与同步路径共用
+# ------------------------------
+async def _call_ai_api_once_async(request_body: Dict, api_config: Dict = None) -> Dict:
+    api_key, base_url, headers = _ai_api_target(api_config)
+    timeout = 180
+    print(f"📡 发送异步API请求... (超时时间: {timeout}秒)")
+    try:
+        async with llm_concurrency.async_slot() as slot:
+            response = await async_http_post(
+                f"{base_url}/chat/completions",
+                headers=headers,
+                json=request_body,
+                timeout=timeout
+            )
+            slot.observe_response(response)
+    except ASYNC_RETRYABLE_ERRORS as e:
+        print(f"⚠️ API请求失败（网络/超时），将自动重试：{str(e)[:100]}")
+        raise
+    
+    # 401/403是认证错误，不应该重试
+    if response.status_code in [401, 403]:
+        raise _ai_api_auth_error(response.status_code, base_url, api_key)
+    if response.status_code >= 400:
+        print(f"⚠️ API请求失败（HTTP错误 {response.status_code}），错误信息：{response.text[:100]}")
+    response.raise_for_status()
+    print("✅ API请求成功")
+    return response.json()
+
+
+async def _call_ai_api_timed_async(request_body: Dict) -> Dict:
+    """带重试的异步请求（重试间隔随任务取消而中止），成功耗时同样计入对冲截止时间的统计"""
+    start = time.time()
+    async for attempt in AsyncRetrying(**_AI_API_RETRY_POLICY):
+        with attempt:
+            response_data = await _call_ai_api_once_async(request_body)
+    llm_hedger.record_latency(time.time() - start)
+    return response_data
+
+
+async def call_ai_api_async(request_body: Dict, on_delta=None, cancel_token: CancelToken = None, hedge: bool = False,
+                            cache: bool = False, refresh_cache: bool = False, coalesce: bool = False) -> Dict:
+    """
+    call_ai_api 的异步版本，参数与返回值语义相同（需安装 httpx）。
+    与同步调用共用 LLM 响应缓存、请求合并表（同步与异步的相同请求也会合并）和 llm_concurrency 并发上限；
+    asyncio 中没有线程绑定的当前令牌，取消令牌需显式传入。
+    流式与对冲请求没有异步实现，在线程中走同步路径（取消令牌同样生效）。
+    """
+    if request_body.get("stream") or (hedge and llm_hedger.enabled):
+        return await _call_sync_in_thread(call_ai_api, cancel_token, request_body, on_delta, hedge=hedge,
+                                          cache=cache, refresh_cache=refresh_cache, coalesce=coalesce)
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+    use_cache = cache and LLM_CACHE_CONFIG["enabled"]
+    if use_cache and not refresh_cache:
+        cached = _cached_ai_response(request_body)
+        if cached is not None:
+            return cached
+
+    async def fetch():
+        response_data = await _call_ai_api_timed_async(request_body)
+        _remember_ai_response(request_body, response_data, use_cache)
+        return response_data
+
+    if coalesce:
+        return await llm_flights.do_async(llm_cache_key(request_body), fetch, label="LLM请求", cancel_token=cancel_token)
+    return await run_cancellable(fetch(), cancel_token)
+
+
+async def _call_sync_in_thread(fn, cancel_token: CancelToken, *args, **kwargs):
+    """在线程中执行 fn(*args, cancel_token=子令牌, **kwargs)；协程被取消时取消子令牌，让线程中的请求一并中止"""
+    token = cancel_token.child() if cancel_token is not None else CancelToken()
+    try:
+        return await asyncio.to_thread(fn, *args, cancel_token=token, **kwargs)
+    except asyncio.CancelledError:
+        token.cancel("异步调用方已取消")
+        raise
+    finally:
+        token.detach()
+
+
+class StreamInterruptedError(RuntimeError):
+    """流式响应在已输出部分内容后中断（不自动重试，避免重复输出增量文本）"""
+
+
+def _iter_chat_completion_stream(request_body: Dict, timeout: int = 180):
+    """
+    以SSE方式请求 chat/completions，逐段产出增量文本（choices[0].delta.content）
+    上游不支持流式、直接返回JSON时，整段内容作为一次增量产出。
+    """
+    api_key, base_url, headers = _ai_api_target()
+    request_body = dict(request_body)
+    request_body["stream"] = True
+    stream_headers = dict(headers, Accept="text/event-stream")
+    
+    with http_post(
+        f"{base_url}/chat/completions",
+        headers=stream_headers,
+        json=request_body,
+        timeout=timeout,
+        stream=True
+    ) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "")
+        if "application/json" in content_type:
+            data = response.json()
+            choices = data.get("choices") or [{}]
+            content = (choices[0].get("message") or {}).get("content") or ""
+            if content:
+                yield content
+            return
+        
+        response.encoding = "utf-8"
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                check_cancelled()
+                if not line or not line.startswith("data:"):
+                    continue  # 空行/注释/keep-alive
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(payload)
+                except json.JSONDecodeError:
+                    continue
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                delta = choices[0].get("delta") or choices[0].get("message") or {}
+                text = delta.get("content")
+                if text:
+                    yield text
+        except OperationCancelled:
+            raise
+        except Exception:
+            # 连接被取消回调关闭导致的读取错误按取消处理
+            check_cancelled()
+            raise
+
+
+def _collect_chat_completion_stream(request_body: Dict, on_delta=None, timeout: int = 180) -> Dict:
+    """消费SSE流并拼装为普通（非流式）响应结构"""
+    parts = []
+    try:
+        for text in _iter_chat_completion_stream(request_body, timeout=timeout):
+            parts.append(text)
+            if on_delta:
+                on_delta(text)
+    except requests.exceptions.RequestException as e:
+        if parts and not isinstance(e, requests.exceptions.HTTPError):
+            raise StreamInterruptedError(f"流式响应中断（已接收{len(''.join(parts))}字）：{str(e)[:100]}") from e
+        raise
+    content = "".join(parts)
+    print(f"✅ 流式API请求完成，共接收 {len(content)} 字")
+    return {
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }]
+    }
+
+
+def stream_ai_api(request_body: Dict):
+    """
+    逐段产出 call_ai_api 流式请求的增量文本（生成器），重试、并发槽与取消与同步调用共用同一套逻辑。
+    请求在后台线程中执行（当前令牌的子令牌下）；调用方提前停止迭代时取消该请求。
+    """
+    parent = current_token()
+    token = parent.child() if parent is not None else CancelToken()
+    events = queue.Queue()
+
+    def worker():
+        try:
+            call_ai_api(dict(request_body, stream=True), on_delta=lambda text: events.put(("delta", text)),
+                        cancel_token=token)
+            events.put(("done", None))
+        except BaseException as e:
+            events.put(("error", e))
+
+    threading.Thread(target=worker, name="llm-stream", daemon=True).start()
+    try:
+        while True:
+            kind, value = events.get()
+            if kind == "delta":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+    finally:
+        token.cancel("流式读取已结束")
+
+
 # ------------------------------
 # 新增JSON容错提取函数（核心修复）
 # ------------------------------
@@ -1236,16 +1595,26 @@ def optimize_image_prompt_with_llm(
             "max_tokens": 2000
         }
         
-        print("🔄 正在使用LLM优化图片生成提示词...")
-        response = requests.post(
-            f"{base_url}/chat/completions",
-            headers=headers,
-            json=request_body,
-            timeout=120
-        )
-        response.raise_for_status()
-        
-        result = response.json()
+        # 相同剧情文本与上下文的提示词优化结果直接复用缓存
+        use_cache = LLM_CACHE_CONFIG["enabled"]
+        result = llm_response_cache.get(request_body) if use_cache else None
+        if result is not None and _has_completion_content(result):
+            print("⚡ 命中LLM响应缓存（图片提示词）")
+        else:
+            print("🔄 正在使用LLM优化图片生成提示词...")
+            with llm_concurrency.slot() as slot:
+                response = http_post(
+                    f"{base_url}/chat/completions",
+                    headers=headers,
+                    json=request_body,
+                    timeout=120
+                )
+                slot.observe_response(response)
+            response.raise_for_status()
+
+            result = response.json()
+            if use_cache and _has_completion_content(result):
+                llm_response_cache.put(request_body, result)
         choices = result.get("choices", [])
         if choices and len(choices) > 0:
             optimized_prompt = choices[0].get("message", {}).get("content", "").strip()
@@ -1318,6 +1687,8 @@ def ensure_main_character_dir(game_id: str) -> Path:
     """
     main_character_dir = Path("initial") / "main_character" / game_id
     main_character_dir.mkdir(parents=True, exist_ok=True)
+    # 当前会话的主角形象不参与淘汰
+    storage_manager.pin(game_id)
     return main_character_dir
 
 def optimize_main_character_prompt_with_llm(
@@ -1569,12 +1940,14 @@ def optimize_main_character_prompt_with_llm(
         }
         
         print("🔄 正在使用LLM生成主角形象提示词...")
-        response = requests.post(
-            f"{base_url}/chat/completions",
-            headers=headers,
-            json=request_body,
-            timeout=120
-        )
+        with llm_concurrency.slot() as slot:
+            response = http_post(
+                f"{base_url}/chat/completions",
+                headers=headers,
+                json=request_body,
+                timeout=120
+            )
+            slot.observe_response(response)
         response.raise_for_status()
         
         result = response.json()
@@ -1791,38 +2164,39 @@ def _ref_image_to_input(ref: str, max_data_uri_bytes: int = 600000) -> str:
         return ref
     if ref.startswith(("http://", "https://")):
         return ref
-    if os.path.exists(ref):
+    if not os.path.exists(ref):
+        return ""
+
+    def _encode(raw: bytes) -> str:
+        # Replicate 建议 data URI 仅用于 <1MB；过大易导致 400
+        if len(raw) * 4 // 3 <= max_data_uri_bytes:
+            b64 = base64.b64encode(raw).decode("utf-8")
+            return f"data:image/png;base64,{b64}"
         try:
-            with open(ref, "rb") as f:
-                raw = f.read()
-            # Replicate 建议 data URI 仅用于 <1MB；过大易导致 400
-            if len(raw) * 4 // 3 <= max_data_uri_bytes:
-                b64 = base64.b64encode(raw).decode("utf-8")
-                return f"data:image/png;base64,{b64}"
-            try:
-                from PIL import Image
-                import io
-                im = Image.open(io.BytesIO(raw)).convert("RGB")
-                w, h = im.size
-                # 缩小长边至 640，使压缩后约 <500KB，避免代理/API 拒大 body
-                max_side = 640
-                if max(w, h) > max_side:
-                    if w >= h:
-                        im = im.resize((max_side, int(h * max_side / w)), Image.Resampling.LANCZOS)
-                    else:
-                        im = im.resize((int(w * max_side / h), max_side), Image.Resampling.LANCZOS)
-                buf = io.BytesIO()
-                im.save(buf, "JPEG", quality=88, optimize=True)
-                buf.seek(0)
-                raw = buf.read()
-                b64 = base64.b64encode(raw).decode("utf-8")
-                return f"data:image/jpeg;base64,{b64}"
-            except Exception:
-                b64 = base64.b64encode(raw).decode("utf-8")
-                return f"data:image/png;base64,{b64}"
+            from PIL import Image
+            import io
+            im = Image.open(io.BytesIO(raw)).convert("RGB")
+            w, h = im.size
+            # 缩小长边至 640，使压缩后约 <500KB，避免代理/API 拒大 body
+            max_side = 640
+            if max(w, h) > max_side:
+                if w >= h:
+                    im = im.resize((max_side, int(h * max_side / w)), Image.Resampling.LANCZOS)
+                else:
+                    im = im.resize((int(w * max_side / h), max_side), Image.Resampling.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, "JPEG", quality=88, optimize=True)
+            b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+            return f"data:image/jpeg;base64,{b64}"
         except Exception:
-            return ""
-    return ""
+            b64 = base64.b64encode(raw).decode("utf-8")
+            return f"data:image/png;base64,{b64}"
+
+    try:
+        # 同一局游戏的参考图不变：缓存编码结果，文件重新生成后自动失效
+        return reference_payload_cache.get(ref, f"data_uri:{max_data_uri_bytes}", _encode)
+    except Exception:
+        return ""
 
 
 # Replicate 官方 stability-ai/stable-diffusion-img2img 最新版 version hash（无 width/height 输入）
@@ -1867,7 +2241,9 @@ def call_img2img_via_replicate_direct(
         },
     }
     try:
-        resp = requests.post(create_url, headers=headers, json=payload, timeout=60)
+        with image_concurrency.slot() as slot:
+            resp = http_post(create_url, headers=headers, json=payload, timeout=60)
+            slot.observe_response(resp)
         if resp.status_code >= 400:
             try:
                 err_body = resp.json()
@@ -1884,7 +2260,7 @@ def call_img2img_via_replicate_direct(
         interval = float(os.getenv("IMG2IMG_POLL_INTERVAL_SECONDS", "2"))
         deadline = time.time() + max_wait
         while time.time() < deadline:
-            r2 = requests.get(get_url, headers=headers, timeout=30)
+            r2 = http_get(get_url, headers=headers, timeout=30)
             r2.raise_for_status()
             p = r2.json()
             status = (p.get("status") or "").lower()
@@ -1906,7 +2282,7 @@ def call_img2img_via_replicate_direct(
             if status in ("failed", "canceled"):
                 err = p.get("error") or status
                 raise RuntimeError(f"图生图任务结束：{err}")
-            time.sleep(interval)
+            cancellable_sleep(interval)
         raise RuntimeError(f"图生图轮询超时（{max_wait}s）")
     except requests.exceptions.HTTPError as e:
         print(f"❌ Replicate 图生图 API HTTP 错误：{e.response.status_code if e.response else ''} {str(e)}")
@@ -2041,7 +2417,9 @@ def call_img2img_via_yunwu(
         if "input" in payload:
             print(f"🔍 input keys: {list(payload['input'].keys())}")
         
-        resp = requests.post(create_url, headers=headers, json=payload, timeout=60)
+        with image_concurrency.slot() as slot:
+            resp = http_post(create_url, headers=headers, json=payload, timeout=60)
+            slot.observe_response(resp)
         if resp.status_code >= 400:
             try:
                 err_body = resp.json()
@@ -2106,7 +2484,7 @@ def call_img2img_via_yunwu(
             interval = float(os.getenv("IMG2IMG_POLL_INTERVAL_SECONDS", "2"))
             deadline = time.time() + max_wait
             while time.time() < deadline:
-                r2 = requests.get(get_url, headers=headers, timeout=30)
+                r2 = http_get(get_url, headers=headers, timeout=30)
                 r2.raise_for_status()
                 p = r2.json()
                 status = (p.get("status") or "").lower()
@@ -2128,7 +2506,7 @@ def call_img2img_via_yunwu(
                 if status in ("failed", "canceled"):
                     err = p.get("error") or status
                     raise RuntimeError(f"图生图任务结束：{err}")
-                time.sleep(interval)
+                cancellable_sleep(interval)
             raise RuntimeError(f"图生图轮询超时（{max_wait}s）")
         # 无法解析响应格式
         raise RuntimeError(f"云雾图生图返回格式无法解析：{data}")
@@ -2181,9 +2559,9 @@ def call_stable_diffusion_api_with_size(
             # HTTP/HTTPS URL
             if ref.startswith(("http://", "https://")):
                 try:
-                    resp = requests.get(ref, timeout=30, stream=True)
-                    resp.raise_for_status()
-                    img_bytes = resp.content
+                    with http_get(ref, timeout=30, stream=True) as resp:
+                        resp.raise_for_status()
+                        img_bytes = resp.content
                     return base64.b64encode(img_bytes).decode("utf-8")
                 except Exception:
                     return ""
@@ -2191,9 +2569,7 @@ def call_stable_diffusion_api_with_size(
             # 本地路径
             if os.path.exists(ref):
                 try:
-                    with open(ref, "rb") as f:
-                        img_bytes = f.read()
-                    return base64.b64encode(img_bytes).decode("utf-8")
+                    return reference_payload_cache.get(ref, "base64", lambda raw: base64.b64encode(raw).decode("utf-8"))
                 except Exception:
                     return ""
 
@@ -2245,12 +2621,14 @@ def call_stable_diffusion_api_with_size(
             }
             api_endpoint = f"{base_url}/sdapi/v1/txt2img"
 
-        response = requests.post(
-            api_endpoint,
-            headers=headers,
-            json=request_payload,
-            timeout=120
-        )
+        with image_concurrency.slot() as slot:
+            response = http_post(
+                api_endpoint,
+                headers=headers,
+                json=request_payload,
+                timeout=120
+            )
+            slot.observe_response(response)
         response.raise_for_status()
         
         result = response.json()
@@ -2323,11 +2701,11 @@ def generate_main_character_image(
                     return out_path.exists()
 
                 if image_url_str_local.startswith(("http://", "https://")):
-                    resp = requests.get(image_url_str_local, timeout=60, stream=True)
-                    resp.raise_for_status()
-                    with open(out_path, "wb") as f:
-                        for chunk in resp.iter_content(chunk_size=8192):
-                            f.write(chunk)
+                    with http_get(image_url_str_local, timeout=60, stream=True) as resp:
+                        resp.raise_for_status()
+                        with open(out_path, "wb") as f:
+                            for chunk in resp.iter_content(chunk_size=8192):
+                                f.write(chunk)
                     return out_path.exists()
 
                 if image_url_str_local.startswith("/image_cache/") or image_url_str_local.startswith("image_cache/"):
@@ -2648,7 +3026,8 @@ def generate_scene_image(
     style: str = "default",
     use_cache: bool = True,
     viewport_width: int = None,
-    viewport_height: int = None
+    viewport_height: int = None,
+    cancel_token: CancelToken = None
 ) -> Dict:
     """
     生成场景图片（支持本地缓存）
@@ -2658,8 +3037,150 @@ def generate_scene_image(
     :param use_cache: 是否使用本地缓存（默认True，下载图片到本地避免OSS URL失效）
     :param viewport_width: 视口宽度（可选，用于按视口宽高比生成图片）
     :param viewport_height: 视口高度（可选，用于按视口宽高比生成图片）
+    :param cancel_token: 取消令牌：提示词优化、各 provider 请求/轮询与图片下载都会随之中止，抛出 OperationCancelled
     :return: 包含图片URL和元数据的字典
     """
+    with cancel_scope(cancel_token):
+        # 同一剧情文本的图片（例如玩家点选时的同步生成与第一层预生成的图片任务）只生成一次
+        result = image_flights.do(
+            _scene_image_flight_key(scene_description, global_state, style, use_cache, viewport_width, viewport_height),
+            lambda: _generate_scene_image(scene_description, global_state, style, use_cache, viewport_width, viewport_height),
+            label="场景图片",
+        )
+    # 结果由合并的调用方共享，返回副本（调用方会改写 url 等字段）
+    return dict(result) if isinstance(result, dict) else result
+
+
+def _scene_image_flight_key(
+    scene_description: str,
+    global_state: Dict,
+    style: str,
+    use_cache: bool,
+    viewport_width: int,
+    viewport_height: int
+) -> str:
+    """场景图片的合并键：剧情文本 + 影响提示词/参考图/尺寸的参数"""
+    state = global_state if isinstance(global_state, dict) else {}
+    material = {
+        "scene": scene_description,
+        "style": style,
+        "use_cache": use_cache,
+        "viewport": [viewport_width, viewport_height],
+        "game_id": state.get("game_id"),
+        "image_style": state.get("image_style"),
+        "tone": state.get("tone"),
+        "visual_context": state.get("_visual_context"),
+    }
+    raw = json.dumps(material, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _scene_image_references(global_state: Dict) -> tuple:
+    """从视觉连续性上下文中取上一剧情的参考图 (url, prompt)，没有时为空串"""
+    visual_context = global_state.get('_visual_context') if isinstance(global_state, dict) else None
+    if not isinstance(visual_context, dict):
+        visual_context = {}
+    prev_img_obj = visual_context.get('previousSceneImage') or visual_context.get('currentSceneImage') or {}
+    if not isinstance(prev_img_obj, dict):
+        prev_img_obj = {}
+    reference_image_url = (
+        visual_context.get('previous_image_url')
+        or prev_img_obj.get('url')
+        or prev_img_obj.get('image_url')
+        or ""
+    )
+    reference_image_prompt = (
+        visual_context.get('previous_image_prompt')
+        or prev_img_obj.get('prompt')
+        or prev_img_obj.get('optimized_prompt')
+        or ""
+    )
+    return reference_image_url, reference_image_prompt
+
+
+def _scene_image_request_key(scene_description: str, global_state: Dict, style: str,
+                             provider: str = None, image_width: int = 1024, image_height: int = 1024) -> str:
+    """场景图在图片存储中的请求键（生成路径与预先查缓存的路径必须一致）"""
+    # 当存在“参考上一剧情图片/提示词”时，参考信息纳入缓存键，避免误用旧缓存
+    reference_image_url, reference_image_prompt = _scene_image_references(global_state)
+    return scene_image_key(scene_description, style, provider or IMAGE_GENERATION_CONFIG.get("provider", "yunwu"),
+                           image_width, image_height, reference_image_prompt or reference_image_url)
+
+
+# 各图片 provider 是否已配置（路由只在已配置的 provider 之间切换）
+_IMAGE_PROVIDER_READY = {
+    "yunwu": lambda: bool(IMAGE_GENERATION_CONFIG.get("yunwu_api_key")),
+    "replicate": lambda: bool(IMAGE_GENERATION_CONFIG.get("replicate_api_token")),
+    "openai": lambda: bool(IMAGE_GENERATION_CONFIG.get("openai_api_key")),
+    "stable_diffusion": lambda: bool(IMAGE_GENERATION_CONFIG.get("stable_diffusion_base_url")),
+    "comfyui": lambda: bool(IMAGE_GENERATION_CONFIG.get("comfyui_host")),
+}
+
+
+def _call_image_provider(
+    provider: str,
+    prompt: str,
+    style: str,
+    image_width: int,
+    image_height: int,
+    viewport_width: int,
+    viewport_height: int,
+    protagonist_reference_images: List[str],
+    reference_image_url: str,
+    as_fallback: bool = False
+) -> str:
+    """调用单个图片 provider，返回图片URL（失败抛异常或返回 None，由路由记录健康度）"""
+    if provider == "yunwu":
+        # yunwu.ai可能不支持自定义尺寸，在提示词中添加尺寸要求
+        size_prompt = f"{prompt}, aspect ratio {image_width}:{image_height}"
+
+        # 只要有主角参考图（1张正面 / 2张 / 3张），就用 gemini 图生图（第一次场景图时可能只有正面）
+        model = IMAGE_GENERATION_CONFIG.get("yunwu_model", "gemini-2.5-flash-image")
+        if protagonist_reference_images and len(protagonist_reference_images) >= 1:
+            if "gemini" in model.lower() and "image" in model.lower():
+                print(f"🎨 使用 gemini-2.5-flash-image 图生图，传递{len(protagonist_reference_images)}张主角参考图")
+                # 按实际张数构建参考图说明（1张=正面，2张=正+侧，3张=正+侧+背）
+                prefix_lines = ["Image 0: Front view portrait of the protagonist"]
+                if len(protagonist_reference_images) >= 2:
+                    prefix_lines.append("Image 1: Side view portrait of the protagonist")
+                if len(protagonist_reference_images) >= 3:
+                    prefix_lines.append("Image 2: Back view portrait of the protagonist")
+                prefix_prompt = "\n".join(prefix_lines) + "\n\n"
+                full_prompt = prefix_prompt + prompt + f", aspect ratio {image_width}:{image_height}"
+                return call_gemini_img2img(full_prompt, protagonist_reference_images)
+            print(f"⚠️ 当前模型 {model} 不支持多张参考图，使用文生图")
+            return call_yunwu_image_api(size_prompt, style)
+        # 没有主角参考图，使用普通文生图
+        return call_yunwu_image_api(size_prompt, style)
+    elif provider == "replicate":
+        return call_replicate_api(prompt, style)
+    elif provider == "openai":
+        # DALL-E 只支持固定尺寸：作为兜底时按 openai 的规则重新计算
+        if as_fallback:
+            dalle_width, dalle_height = calculate_image_size_for_viewport(viewport_width, viewport_height, "openai")
+        else:
+            dalle_width, dalle_height = image_width, image_height
+        return call_dalle_api_with_size(prompt, f"{dalle_width}x{dalle_height}")
+    elif provider == "stable_diffusion":
+        # SD 兜底时，如果有主角参考图，使用第一张（正面）作为参考
+        sd_ref = reference_image_url
+        if as_fallback and protagonist_reference_images:
+            sd_ref = protagonist_reference_images[0]
+        return call_stable_diffusion_api_with_size(prompt, image_width, image_height, style, reference_image_url=sd_ref)
+    elif provider == "comfyui":
+        return call_comfyui_api(prompt, style)
+    raise ValueError(f"不支持的图片生成服务：{provider}")
+
+
+def _generate_scene_image(
+    scene_description: str,
+    global_state: Dict,
+    style: str,
+    use_cache: bool,
+    viewport_width: int,
+    viewport_height: int
+) -> Dict:
+    """generate_scene_image 的实现（在调用方的取消作用域内执行）"""
     # 检查是否配置了图片生成API
     provider = IMAGE_GENERATION_CONFIG.get("provider", "yunwu")
     
@@ -2686,24 +3207,22 @@ def generate_scene_image(
     image_style = global_state.get('image_style', None)
 
     # 1.5 视觉连续性上下文（用于同场景统一风格/物件 & 参考上一剧情）
-    visual_context = global_state.get('_visual_context') if isinstance(global_state, dict) else None
-    if not isinstance(visual_context, dict):
-        visual_context = {}
-    prev_img_obj = visual_context.get('previousSceneImage') or visual_context.get('currentSceneImage') or {}
-    if not isinstance(prev_img_obj, dict):
-        prev_img_obj = {}
-    reference_image_url = (
-        visual_context.get('previous_image_url')
-        or prev_img_obj.get('url')
-        or prev_img_obj.get('image_url')
-        or ""
-    )
-    reference_image_prompt = (
-        visual_context.get('previous_image_prompt')
-        or prev_img_obj.get('prompt')
-        or prev_img_obj.get('optimized_prompt')
-        or ""
-    )
+    reference_image_url, reference_image_prompt = _scene_image_references(global_state)
+
+    # 1.55 先查图片存储：命中则跳过提示词优化与生图
+    request_key = _scene_image_request_key(scene_description, global_state, style, provider, image_width, image_height)
+    if use_cache:
+        cached = image_store.lookup(request_key)
+        if cached:
+            print(f"✅ 使用本地缓存的图片：{cached['url']}")
+            return {
+                "url": cached["url"],
+                "prompt": cached.get("prompt", scene_description[:100]),
+                "style": style,
+                "width": cached.get("width", image_width),
+                "height": cached.get("height", image_height),
+                "cached": True
+            }
     
     # 1.6 获取主角参考图路径（用于保持主角形象一致性）
     # 放宽条件：只要有正面图就使用（第一次场景图与主角生成并行，侧/背可能尚未就绪）
@@ -2737,94 +3256,67 @@ def generate_scene_image(
         image_style,
         protagonist_reference_images=protagonist_reference_images if protagonist_reference_images else None
     )
+    # 提示词优化失败会回退原始描述，这里再确认一次任务仍然需要，避免被取消后继续花费图片额度
+    check_cancelled()
     
     # 3. 调用AI图片生成API（传递尺寸参数和主角参考图）
     try:
-        if provider == "yunwu":
-            # yunwu.ai 易受 429 / 返回格式波动影响：失败时可选用本地 SD 兜底
-            image_url = None
+        if provider not in _IMAGE_PROVIDER_READY:
+            print(f"⚠️ 不支持的图片生成服务：{provider}")
+            return None
+
+        # 按健康度/延迟排序候选 provider：主 provider 熔断或失败时依次尝试其余已配置的 provider
+        available = [name for name, ready in _IMAGE_PROVIDER_READY.items() if ready()]
+        candidates = image_provider_router.candidates(provider, available)
+        if not candidates:
+            print(f"⚠️ 没有可用的图片生成服务（{provider} 熔断中且无其他可用 provider）")
+            return None
+
+        image_url = None
+        for candidate in candidates:
+            if not image_provider_router.allow(candidate):
+                continue
+            if candidate != provider:
+                print(f"🛟 使用 {candidate} 生图（主 provider {provider} 不可用或较慢）")
+            start_ts = time.time()
             try:
-                # yunwu.ai可能不支持自定义尺寸，在提示词中添加尺寸要求
-                size_prompt = f"{prompt}, aspect ratio {image_width}:{image_height}"
-                
-                # 只要有主角参考图（1张正面 / 2张 / 3张），就用 gemini 图生图（第一次场景图时可能只有正面）
-                model = IMAGE_GENERATION_CONFIG.get("yunwu_model", "gemini-2.5-flash-image")
-                if protagonist_reference_images and len(protagonist_reference_images) >= 1:
-                    if "gemini" in model.lower() and "image" in model.lower():
-                        print(f"🎨 使用 gemini-2.5-flash-image 图生图，传递{len(protagonist_reference_images)}张主角参考图")
-                        # 按实际张数构建参考图说明（1张=正面，2张=正+侧，3张=正+侧+背）
-                        prefix_lines = ["Image 0: Front view portrait of the protagonist"]
-                        if len(protagonist_reference_images) >= 2:
-                            prefix_lines.append("Image 1: Side view portrait of the protagonist")
-                        if len(protagonist_reference_images) >= 3:
-                            prefix_lines.append("Image 2: Back view portrait of the protagonist")
-                        prefix_prompt = "\n".join(prefix_lines) + "\n\n"
-                        full_prompt = prefix_prompt + prompt + f", aspect ratio {image_width}:{image_height}"
-                        image_url = call_gemini_img2img(full_prompt, protagonist_reference_images)
-                    else:
-                        print(f"⚠️ 当前模型 {model} 不支持多张参考图，使用文生图")
-                        image_url = call_yunwu_image_api(size_prompt, style)
-                else:
-                    # 没有主角参考图，使用普通文生图
-                    image_url = call_yunwu_image_api(size_prompt, style)
+                image_url = _call_image_provider(
+                    candidate, prompt, style, image_width, image_height,
+                    viewport_width, viewport_height,
+                    protagonist_reference_images, reference_image_url,
+                    as_fallback=candidate != provider,
+                )
+            except OperationCancelled:
+                image_provider_router.release(candidate)
+                raise  # 已取消：不计入健康度，也不再兜底
             except Exception as e:
-                print(f"⚠️ yunwu.ai 生图失败，将尝试兜底（如已配置）：{str(e)}")
-                image_url = None
+                image_provider_router.record_failure(candidate, time.time() - start_ts, str(e))
+                print(f"⚠️ {candidate} 生图失败，将尝试下一个 provider（如有）：{str(e)}")
+                continue
+            if image_url:
+                image_provider_router.record_success(candidate, time.time() - start_ts)
+                break
+            image_provider_router.record_failure(candidate, time.time() - start_ts, "无返回")
+            print(f"⚠️ {candidate} 未返回图片，将尝试下一个 provider（如有）")
 
-            if not image_url:
-                sd_base = IMAGE_GENERATION_CONFIG.get("stable_diffusion_base_url", "")
-                if sd_base:
-                    try:
-                        print("🛟 使用 Stable Diffusion 作为兜底生图（yunwu 失败/无返回）")
-                        # SD 兜底时，如果有主角参考图，使用第一张（正面）作为参考
-                        sd_ref = protagonist_reference_images[0] if protagonist_reference_images else reference_image_url
-                        image_url = call_stable_diffusion_api_with_size(prompt, image_width, image_height, style, reference_image_url=sd_ref)
-                    except Exception as e:
-                        print(f"⚠️ Stable Diffusion 兜底失败：{str(e)}")
-        elif provider == "replicate":
-            image_url = call_replicate_api(prompt, style)
-        elif provider == "openai":
-            image_url = call_dalle_api_with_size(prompt, f"{image_width}x{image_height}")
-        elif provider == "stable_diffusion":
-            image_url = call_stable_diffusion_api_with_size(prompt, image_width, image_height, style, reference_image_url=reference_image_url)
-        elif provider == "comfyui":
-            image_url = call_comfyui_api(prompt, style)
-        else:
-            print(f"⚠️ 不支持的图片生成服务：{provider}")
-            return None
-        
         if not image_url:
             return None
         
         # 如果启用缓存，下载图片到本地
         if use_cache and image_url:
             try:
-                import hashlib
-                from pathlib import Path
-                
                 MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024  # 10MB 防止超大文件拖垮内存/磁盘
                 VALID_IMAGE_PREFIX = "image/"
+                index_meta = {"prompt": prompt, "width": image_width, "height": image_height}
 
-                # 创建缓存目录
-                IMAGE_CACHE_DIR = "image_cache"
-                os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
-                
-                # 生成缓存键（包含尺寸信息，避免不同尺寸的图片互相覆盖）
-                # 新增：当存在“参考上一剧情图片/提示词”时，把参考信息纳入缓存键，避免误用旧缓存。
-                ref_sig = (reference_image_prompt or reference_image_url or "").strip()
-                if ref_sig:
-                    ref_hash = hashlib.md5(ref_sig.encode("utf-8")).hexdigest()[:10]
-                    cache_key_seed = f"{provider}_{style}_{scene_description}_{ref_hash}_{image_width}x{image_height}"
-                else:
-                    cache_key_seed = f"{provider}_{style}_{scene_description}_{image_width}x{image_height}"
-                prompt_hash = hashlib.md5(cache_key_seed.encode()).hexdigest()
-                cache_path = Path(IMAGE_CACHE_DIR) / f"{prompt_hash}.png"
-                
-                # 检查是否已缓存
-                if cache_path.exists():
-                    print(f"✅ 使用本地缓存的图片：{cache_path}")
+                # provider 已把图片存入本地（如 base64 结果）：只登记请求键，不再复制一份
+                if image_url.startswith('/image_cache/') or image_url.startswith('image_cache/'):
+                    linked_url = image_store.link(request_key, image_url, **index_meta)
+                    if not linked_url:
+                        raise ValueError(f"本地缓存路径对应的文件不存在：{image_url}")
+                    print(f"✅ 使用现有的本地缓存图片：{linked_url}")
                     return {
-                        "url": f"/image_cache/{prompt_hash}.png",
+                        "url": linked_url,
                         "prompt": prompt,
                         "style": style,
                         "width": image_width,
@@ -2832,66 +3324,6 @@ def generate_scene_image(
                         "cached": True
                     }
                 
-                # 检查image_url是否是相对路径（本地缓存路径）
-                if image_url.startswith('/image_cache/') or image_url.startswith('image_cache/'):
-                    # 如果image_url已经是相对路径，说明可能是从其他地方传入的缓存路径
-                    # 检查对应的文件是否存在
-                    import re
-                    hash_match = re.search(r'([a-f0-9]{32})\.png', image_url)
-                    if hash_match:
-                        existing_hash = hash_match.group(1)
-                        existing_path = Path(IMAGE_CACHE_DIR) / f"{existing_hash}.png"
-                        if existing_path.exists():
-                            # 如果文件存在，使用现有的hash，或者复制到新的hash
-                            if existing_hash == prompt_hash:
-                                print(f"✅ 使用现有的本地缓存图片：{existing_path}")
-                                return {
-                                    "url": f"/image_cache/{prompt_hash}.png",
-                                    "prompt": prompt,
-                                    "style": style,
-                                    "width": image_width,
-                                    "height": image_height,
-                                    "cached": True
-                                }
-                            else:
-                                # 复制到新的hash名称
-                                import shutil
-                                try:
-                                    print(f"🔄 开始复制图片：{existing_path} -> {cache_path}")
-                                    shutil.copy2(existing_path, cache_path)
-                                    print(f"✅ 从现有缓存复制图片到新hash：{cache_path}")
-                                    
-                                    # 验证文件是否成功复制
-                                    if not cache_path.exists():
-                                        raise FileNotFoundError(f"复制后的文件不存在：{cache_path}")
-                                    
-                                    print(f"✅ 图片复制完成，文件大小：{cache_path.stat().st_size} 字节")
-                                    
-                                    return {
-                                        "url": f"/image_cache/{prompt_hash}.png",
-                                        "prompt": prompt,
-                                        "style": style,
-                                        "width": image_width,
-                                        "height": image_height,
-                                        "cached": True
-                                    }
-                                except Exception as copy_err:
-                                    print(f"❌ 复制图片时发生错误：{copy_err}")
-                                    import traceback
-                                    traceback.print_exc()
-                                    # 如果复制失败，尝试使用原始路径
-                                    print(f"⚠️ 复制失败，尝试使用原始缓存路径")
-                                    return {
-                                        "url": f"/image_cache/{existing_hash}.png",
-                                        "prompt": prompt,
-                                        "style": style,
-                                        "width": image_width,
-                                        "height": image_height,
-                                        "cached": True
-                                    }
-                    # 如果相对路径对应的文件不存在，抛出错误
-                    raise ValueError(f"本地缓存路径对应的文件不存在：{image_url}")
-                
                 # 检查是否是完整的URL
                 if not (image_url.startswith('http://') or image_url.startswith('https://')):
                     raise ValueError(f"无效的图片URL格式：{image_url}（需要完整的HTTP/HTTPS URL或本地缓存路径）")
@@ -2913,7 +3345,6 @@ def generate_scene_image(
                 
                 # 下载图片到本地（带重试 + 流式写入，降低 image.pollinations.ai 等站点超时概率）
                 print(f"📥 正在下载图片到本地缓存：{image_url[:80]}...")
-                import time
                 download_retries = int(os.getenv("IMAGE_DOWNLOAD_MAX_RETRIES", "3"))
                 connect_timeout = float(os.getenv("IMAGE_DOWNLOAD_CONNECT_TIMEOUT", "10"))
                 read_timeout = float(os.getenv("IMAGE_DOWNLOAD_READ_TIMEOUT", "60"))
@@ -2923,7 +3354,7 @@ def generate_scene_image(
                 last_err = None
                 for dl_attempt in range(download_retries):
                     try:
-                        response = requests.get(
+                        response = http_get(
                             image_url,
                             timeout=(connect_timeout, read_timeout),
                             stream=True,
@@ -2950,7 +3381,7 @@ def generate_scene_image(
                         if dl_attempt < download_retries - 1:
                             backoff = (1.5 * (2 ** dl_attempt)) + random.random()
                             print(f"⚠️ 图片下载超时/连接失败，{backoff:.1f}s 后重试（{dl_attempt+1}/{download_retries}）: {e}")
-                            time.sleep(backoff)
+                            cancellable_sleep(backoff)
                             continue
                         raise
 
@@ -2959,19 +3390,20 @@ def generate_scene_image(
                 if VALID_IMAGE_PREFIX not in content_type:
                     raise ValueError(f"响应类型异常：{content_type}")
 
-                downloaded = 0
-                with open(cache_path, 'wb') as f:
+                def _chunks():
                     for chunk in response.iter_content(chunk_size=8192):
-                        if not chunk:
-                            continue
-                        downloaded += len(chunk)
-                        if downloaded > MAX_DOWNLOAD_BYTES:
-                            raise ValueError("图片过大，已终止下载（>10MB）")
-                        f.write(chunk)
-                
-                print(f"✅ 图片已缓存到本地：{cache_path}")
+                        check_cancelled()
+                        yield chunk
+
+                # 按内容哈希落盘（相同图片只存一份），并登记请求键
+                with response:
+                    local_url = image_store.put_stream(
+                        _chunks(), extension_for(content_type), request_key,
+                        max_bytes=MAX_DOWNLOAD_BYTES, **index_meta
+                    )
+                print(f"✅ 图片已缓存到本地：{local_url}")
                 return {
-                    "url": f"/image_cache/{prompt_hash}.png",
+                    "url": local_url,
                     "prompt": prompt,
                     "style": style,
                     "width": image_width,
@@ -2979,12 +3411,14 @@ def generate_scene_image(
                     "cached": True
                 }
             except Exception as cache_error:
-                # 如果缓存过程中写入失败，确保不留空文件
+                # 流式响应未读完时归还连接，避免占用共享连接池
                 try:
-                    if 'cache_path' in locals() and cache_path.exists():
-                        cache_path.unlink()
+                    if 'response' in locals() and response is not None:
+                        response.close()
                 except Exception:
                     pass
+                # 下载被取消（或读取时连接被取消回调关闭）：不返回结果
+                check_cancelled()
                 print(f"⚠️ 图片缓存失败，使用原始URL：{str(cache_error)}")
                 # 缓存失败时返回原始URL
                 return {
@@ -3004,12 +3438,16 @@ def generate_scene_image(
             "width": image_width,
             "height": image_height
         }
+    except OperationCancelled:
+        print("⏹️ 图片生成已取消")
+        raise
     except Exception as e:
         print(f"❌ 图片生成失败：{str(e)}")
         import traceback
         traceback.print_exc()
         return None
 
+
 def validate_image_url(url: str) -> bool:
     """
     验证图片URL是否完整有效
@@ -3125,12 +3563,11 @@ def save_base64_image(data_uri: str, prompt: str, cache_key_suffix: str = None)
     将base64 data URI保存为图片文件
     :param data_uri: base64 data URI，格式如 data:image/png;base64,iVBORw0KGgo...
     :param prompt: 提示词，用于生成文件名
-    :param cache_key_suffix: 可选，参与缓存 key（如 reference 路径），避免不同游戏复用同一缓存
+    :param cache_key_suffix: 兼容旧调用保留（按内容寻址后不同游戏的图片不会互相覆盖，无需再区分）
     :return: 保存的文件路径（相对路径），失败返回None
     """
     try:
         import base64
-        from pathlib import Path
         
         # 清理可能的空白/引号包装
         data_uri = (data_uri or "").strip()
@@ -3147,9 +3584,7 @@ def save_base64_image(data_uri: str, prompt: str, cache_key_suffix: str = None)
         if not mime_match:
             return None
         
-        image_format = mime_match.group(1)  # png, jpeg, webp等
-        if image_format == 'jpeg':
-            image_format = 'jpg'
+        image_format = extension_for(mime_match.group(1))  # png, jpg, webp等
         
         # 兼容多行/带空白的base64（模型输出可能自动换行）
         encoded = re.sub(r'\s+', '', encoded)
@@ -3185,28 +3620,10 @@ def save_base64_image(data_uri: str, prompt: str, cache_key_suffix: str = None)
             print("⚠️ 检测到 1x1/2x2 PNG 占位 base64，已丢弃该图片数据")
             return None
         
-        # 创建缓存目录
-        IMAGE_CACHE_DIR = "image_cache"
-        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
-        
-        # 生成文件名（基于提示词+可选后缀的 hash，suffix 用于主角侧/背图按游戏区分缓存）
-        key_str = f"{prompt}_{data_uri[:100]}"
-        if cache_key_suffix:
-            key_str += f"_{cache_key_suffix}"
-        prompt_hash = hashlib.md5(key_str.encode()).hexdigest()
-        cache_path = Path(IMAGE_CACHE_DIR) / f"{prompt_hash}.{image_format}"
-        
-        # 检查是否已存在
-        if cache_path.exists():
-            print(f"✅ 使用已存在的base64图片缓存：{cache_path}")
-            return f"/image_cache/{prompt_hash}.{image_format}"
-        
-        # 保存图片
-        with open(cache_path, 'wb') as f:
-            f.write(image_data)
-        
-        print(f"✅ base64图片已保存到：{cache_path}")
-        return f"/image_cache/{prompt_hash}.{image_format}"
+        # 按内容哈希保存（相同图片只存一份）
+        local_url = image_store.put_bytes(image_data, image_format)
+        print(f"✅ base64图片已保存到：{local_url}")
+        return local_url
         
     except Exception as e:
         print(f"❌ 保存base64图片失败：{str(e)}")
@@ -3311,31 +3728,25 @@ def call_gemini_img2img(prompt: str, reference_image_path, additional_reference_
     }
     
     request_timeout = int(os.getenv("YUNWU_IMAGE_TIMEOUT_SECONDS", "180"))
-    min_interval = float(os.getenv("YUNWU_MIN_INTERVAL_SECONDS", "12"))
+    limiter = _yunwu_image_limiter()
     
     try:
-        # 跨线程限速
-        global _YUNWU_LAST_CALL_TS
-        with _YUNWU_RATE_LOCK:
-            now = time.time()
-            delta = now - _YUNWU_LAST_CALL_TS
-            if delta < min_interval:
-                sleep_s = (min_interval - delta) + random.random() * 0.5
-                print(f"⏳ gemini 图生图限速：等待 {sleep_s:.1f}s")
-                time.sleep(sleep_s)
-            _YUNWU_LAST_CALL_TS = time.time()
+        # 跨线程/跨进程限速（与 call_yunwu_image_api 共用同一个令牌桶）
+        limiter.acquire("gemini 图生图")
         
         print(f"🔄 调用 gemini-2.5-flash-image 图生图 API（{len(image_data_uris)}张参考图）...")
         print(f"   提示词: {prompt[:100]}...")
         ref_paths_str = ", ".join([ref[:50] + "..." if len(ref) > 50 else ref for ref in reference_paths])
         print(f"   参考图: {ref_paths_str}")
         
-        response = requests.post(
-            f"{base_url}/chat/completions",
-            headers=headers,
-            json=request_body,
-            timeout=request_timeout
-        )
+        with image_concurrency.slot() as slot:
+            response = http_post(
+                f"{base_url}/chat/completions",
+                headers=headers,
+                json=request_body,
+                timeout=request_timeout
+            )
+            slot.observe_response(response)
         
         if response.status_code != 200:
             error_msg = ""
@@ -3353,7 +3764,11 @@ def call_gemini_img2img(prompt: str, reference_image_path, additional_reference_
                 error_msg = response.text[:200]
             
             print(f"❌ gemini-2.5-flash-image 图生图 API 错误 {response.status_code}: {error_msg}")
+            if response.status_code == 429:
+                limiter.on_rate_limited(parse_retry_after(response.headers.get('Retry-After')))
             return None
+        limiter.on_success()
+        limiter.observe_headers(response.headers)
         
         # 解析响应（复用 call_yunwu_image_api 的解析逻辑）
         result = response.json()
@@ -3400,6 +3815,8 @@ def call_gemini_img2img(prompt: str, reference_image_path, additional_reference_
         print(f"⚠️ gemini-2.5-flash-image 图生图响应中未找到图片数据")
         return None
         
+    except OperationCancelled:
+        raise
     except Exception as e:
         print(f"❌ gemini-2.5-flash-image 图生图调用异常: {str(e)}")
         import traceback
@@ -3488,20 +3905,12 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
     # 可配置：超时/最小间隔/重试次数（避免长时间卡住 + 降低 429 概率）
     # 🔧 修复：增加默认超时时间到180秒，因为图片生成通常需要较长时间
     request_timeout = int(os.getenv("YUNWU_IMAGE_TIMEOUT_SECONDS", "180"))  # 从90秒增加到180秒
-    min_interval = float(os.getenv("YUNWU_MIN_INTERVAL_SECONDS", "12"))
     max_retries = int(os.getenv("YUNWU_IMAGE_MAX_RETRIES", "3"))
+    limiter = _yunwu_image_limiter()
     for attempt in range(max_retries):
         try:
-            # 跨线程限速：保证相邻请求之间至少间隔 min_interval 秒
-            global _YUNWU_LAST_CALL_TS
-            with _YUNWU_RATE_LOCK:
-                now = time.time()
-                delta = now - _YUNWU_LAST_CALL_TS
-                if delta < min_interval:
-                    sleep_s = (min_interval - delta) + random.random() * 0.5
-                    print(f"⏳ yunwu.ai 限速：等待 {sleep_s:.1f}s（最小间隔 {min_interval}s）")
-                    time.sleep(sleep_s)
-                _YUNWU_LAST_CALL_TS = time.time()
+            # 跨线程/跨进程限速：令牌桶排队（429 后的 Retry-After 暂停也在这里等待）
+            limiter.acquire("yunwu.ai")
 
             # 🔍 调试：打印实际发送的请求内容
             print(f"🔍 ========== 发送给API的请求内容 ==========")
@@ -3525,12 +3934,14 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
             # 🔧 修复：添加超时日志，方便调试
             print(f"⏱️ 发送图片生成请求（超时时间：{request_timeout}秒）...")
             start_request_time = time.time()
-            response = requests.post(
-                f"{base_url}/chat/completions",
-                headers=headers,
-                json=request_body,
-                timeout=request_timeout
-            )
+            with image_concurrency.slot() as slot:
+                response = http_post(
+                    f"{base_url}/chat/completions",
+                    headers=headers,
+                    json=request_body,
+                    timeout=request_timeout
+                )
+                slot.observe_response(response)
             elapsed_time = time.time() - start_request_time
             print(f"✅ API请求完成，耗时：{elapsed_time:.2f}秒")
             
@@ -3560,7 +3971,7 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
                             if "response_format" in request_body:
                                 request_body.pop("response_format")
                                 print(f"   移除 response_format 参数后重试（尝试 {attempt + 2}/{max_retries}）...")
-                                time.sleep(2)  # 等待2秒后重试
+                                cancellable_sleep(2)  # 等待2秒后重试
                                 continue
                     
                     # 检查是否是API格式错误（messages字段不存在）
@@ -3607,30 +4018,9 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
                     print(f"🔍 速率限制响应头：{json.dumps({k: v for k, v in rate_limit_headers.items() if v}, ensure_ascii=False)}")
                 
                 # Retry-After 可能是秒数（整数）或 HTTP-date（如 RFC 7231 指定）
-                wait_time = None
-                if retry_after:
-                    retry_after_raw = str(retry_after).strip()
-                    # 先尝试按“秒数”解析
-                    try:
-                        wait_time = int(retry_after_raw)
-                        if wait_time < 0:
-                            wait_time = 0
-                        print(f"⚠️ 遇到速率限制（429），API建议等待 {wait_time} 秒后重试（尝试 {attempt + 1}/{max_retries}）")
-                    except (TypeError, ValueError):
-                        # 再尝试按 HTTP-date 解析
-                        try:
-                            from email.utils import parsedate_to_datetime
-                            from datetime import datetime, timezone
-                            dt = parsedate_to_datetime(retry_after_raw)
-                            if dt is not None:
-                                if dt.tzinfo is None:
-                                    dt = dt.replace(tzinfo=timezone.utc)
-                                now = datetime.now(timezone.utc)
-                                wait_seconds = int((dt.astimezone(timezone.utc) - now).total_seconds())
-                                wait_time = max(0, wait_seconds)
-                                print(f"⚠️ 遇到速率限制（429），API建议等待 {wait_time} 秒后重试（尝试 {attempt + 1}/{max_retries}）")
-                        except Exception:
-                            wait_time = None
+                wait_time = parse_retry_after(retry_after)
+                if wait_time is not None:
+                    print(f"⚠️ 遇到速率限制（429），API建议等待 {wait_time:.0f} 秒后重试（尝试 {attempt + 1}/{max_retries}）")
                 
                 if wait_time is None:
                     # 如果 Retry-After 不存在或无法解析，使用指数退避：10s, 20s, 40s
@@ -3651,9 +4041,9 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
                 print(f"   - 考虑切换到其他图片生成服务（ComfyUI、Replicate等）")
                 print(f"   - 增加请求间隔时间")
                 
-                # 如果还有重试机会，等待后继续
+                # 通知令牌桶暂停放行（本进程及其他 worker 的排队请求一起顺延），下一次 acquire 时等待
+                limiter.on_rate_limited(wait_time)
                 if attempt < max_retries - 1:
-                    time.sleep(wait_time)
                     continue
                 else:
                     # 最后一次尝试也失败，抛出异常
@@ -3661,6 +4051,8 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
             
             # 其他HTTP错误直接抛出
             response.raise_for_status()
+            limiter.on_success()
+            limiter.observe_headers(response.headers)
             
             # 如果成功，解析响应（兼容：返回体不是 JSON / 结构变化）
             try:
@@ -4220,7 +4612,7 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
                 # 超时后等待更长时间再重试
                 wait_time = 10 * (attempt + 1)  # 10s, 20s, 30s
                 print(f"   等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
+                cancellable_sleep(wait_time)
                 continue
             else:
                 # 最后一次尝试也超时，抛出异常
@@ -4245,7 +4637,7 @@ def call_yunwu_image_api(prompt: str, style: str) -> str:
                 if attempt < max_retries - 1:
                     wait_time = 10 * (attempt + 1)
                     print(f"   等待 {wait_time} 秒后重试...")
-                    time.sleep(wait_time)
+                    cancellable_sleep(wait_time)
                     continue
             # 其他错误直接抛出
             print(f"❌ yunwu.ai图片生成API调用失败：{error_msg}")
@@ -4352,14 +4744,14 @@ def call_stable_diffusion_api(prompt: str, style: str, reference_image_url: str
                 base_dir = Path(__file__).resolve().parent
                 local_path = (base_dir / rel).resolve()
                 if local_path.exists():
-                    data = local_path.read_bytes()
-                    return base64.b64encode(data).decode("utf-8")
+                    return reference_payload_cache.get(str(local_path), "base64",
+                                                       lambda raw: base64.b64encode(raw).decode("utf-8"))
                 return ""
 
             # HTTP/HTTPS
             if ref.startswith("http://") or ref.startswith("https://"):
                 try:
-                    r = requests.get(ref, timeout=30)
+                    r = http_get(ref, timeout=30)
                     r.raise_for_status()
                     return base64.b64encode(r.content).decode("utf-8")
                 except Exception:
@@ -4375,7 +4767,7 @@ def call_stable_diffusion_api(prompt: str, style: str, reference_image_url: str
         ref_b64 = _load_ref_image_b64(reference_image_url)
         if ref_b64:
             # img2img：参考上一剧情图片，保持人物/物件一致性更强
-            response = requests.post(
+            response = http_post(
                 f"{base_url}/sdapi/v1/img2img",
                 headers=headers,
                 json={
@@ -4391,7 +4783,7 @@ def call_stable_diffusion_api(prompt: str, style: str, reference_image_url: str
             )
         else:
             # txt2img
-            response = requests.post(
+            response = http_post(
                 f"{base_url}/sdapi/v1/txt2img",
                 headers=headers,
                 json={
@@ -4714,7 +5106,8 @@ def generate_ending_prediction(global_state: Dict) -> Dict:
                 "timeout": 100
             }
             
-            response_data = call_ai_api(request_body)
+            # 同一世界观的结局预测可直接复用（重玩/重新进入存档时不再消耗 token）
+            response_data = call_ai_api(request_body, cache=True)
             choices = response_data.get("choices", [])
             if choices and len(choices) > 0:
                 message = choices[0].get("message", {})
@@ -4742,10 +5135,12 @@ def generate_ending_prediction(global_state: Dict) -> Dict:
 # ------------------------------
 # LLM生成函数（修复JSON解析+强制贴合用户选择+自动重试）
 # ------------------------------
-def llm_generate_global(user_idea: str, protagonist_attr: Dict, difficulty: str, tone_key: str = "normal_ending", force_full: bool = False) -> Dict:
+def llm_generate_global(user_idea: str, protagonist_attr: Dict, difficulty: str, tone_key: str = "normal_ending", force_full: bool = False,
+                        fresh: bool = False) -> Dict:
     """调用yunwu.ai生成包含章节矛盾、适配主角属性/难度的Global世界观
     
-    force_full: True 时跳过分阶段/模板/缓存，加速生成完整版本（用于后台补全）
+    force_full: True 时跳过分阶段/模板/缓存读取，加速生成完整版本（用于后台补全）
+    fresh: True 时不读取任何缓存（世界观缓存与 LLM 响应缓存），为想要新世界的玩家重新生成；结果仍写入缓存
     """
     if not user_idea.strip():
         raise ValueError("游戏主题idea不能为空")
@@ -4773,22 +5168,37 @@ def llm_generate_global(user_idea: str, protagonist_attr: Dict, difficulty: str,
         # 抛出异常，让后端能够返回错误信息给前端
         raise ValueError(f"缺少必要的API配置：{', '.join(missing_env_names)}。请在.env文件中配置这些环境变量以启用AI生成功能。")
     
-    # 模板加速：若开启且命中模板，直接返回，并可后台补全（已禁用，强制使用AI生成）
-    # 注释掉模板机制，确保每次都通过AI生成
-    # if perf_enabled and perf.get("use_templates", True) and not force_full:
-    #     template_view = _load_template_worldview(user_idea)
-    #     if template_view:
-    #         merged = _merge_template_with_input(template_view, protagonist_attr, difficulty, tone_key)
-    #         _save_worldview_cache(cache_key, merged)
-    #         print("✅ 使用模板世界观返回")
-    #         if staged_mode:
-    #             threading.Thread(
-    #                 target=_background_fill_worldview_details,
-    #                 args=(cache_key, user_idea, protagonist_attr, difficulty, tone_key),
-    #                 daemon=True
-    #             ).start()
-    #             merged.setdefault("meta", {})["detail_async"] = True
-    #         return merged
+    # 世界观缓存：相同输入直接返回（可选在后台重新生成一个变体替换缓存）
+    cache_key = _make_worldview_cache_key(user_idea, protagonist_attr, difficulty, tone_key)
+    cache_enabled = WORLDVIEW_CACHE_CONFIG["enabled"]
+    if cache_enabled and not force_full and not fresh:
+        cached_state = _load_worldview_cache(cache_key)
+        if cached_state:
+            print(f"⚡ 命中世界观缓存：{cache_key}")
+            if WORLDVIEW_CACHE_CONFIG["refresh_on_hit"]:
+                threading.Thread(
+                    target=_background_fill_worldview_details,
+                    args=(cache_key, user_idea, protagonist_attr, difficulty, tone_key, True),
+                    daemon=True
+                ).start()
+            return cached_state
+
+    # 模板加速：开启模板（PERF_USE_TEMPLATES，默认关闭）且相似度达到阈值时直接返回模板，并可后台补全
+    if perf_enabled and perf.get("use_templates", False) and not force_full and not fresh:
+        template_view = _load_template_worldview(user_idea)
+        if template_view:
+            merged = _merge_template_with_input(template_view, protagonist_attr, difficulty, tone_key)
+            merged["tone"] = tone_key
+            _save_worldview_cache(cache_key, merged)
+            print("✅ 使用模板世界观返回")
+            if staged_mode:
+                threading.Thread(
+                    target=_background_fill_worldview_details,
+                    args=(cache_key, user_idea, protagonist_attr, difficulty, tone_key),
+                    daemon=True
+                ).start()
+                merged.setdefault("meta", {})["detail_async"] = True
+            return merged
     
     # 获取基调配置
     tone = TONE_CONFIGS.get(tone_key, TONE_CONFIGS["normal_ending"])
@@ -4902,8 +5312,8 @@ def llm_generate_global(user_idea: str, protagonist_attr: Dict, difficulty: str,
     for attempt in range(max_retries):
         try:
             print(f"📝 尝试生成世界观（第{attempt+1}/{max_retries}次）...")
-            # 调用带重试的API函数
-            response_data = call_ai_api(request_body)
+            # 调用带重试的API函数；相同主题/属性/难度/基调直接复用缓存，重试时（缓存内容解析失败）重新生成并覆盖
+            response_data = call_ai_api(request_body, cache=True, refresh_cache=fresh or attempt > 0)
             # 安全访问嵌套键
             choices = response_data.get("choices", [])
             if not choices or len(choices) == 0:
@@ -5431,14 +5841,12 @@ def llm_generate_global(user_idea: str, protagonist_attr: Dict, difficulty: str,
             
             # 验证基本完整性
             if core_wv.get('game_style') and core_wv.get('world_basic_setting') and core_wv.get('chapters'):
-                # 🔑 缓存机制已删除：不再保存缓存
-                # if perf_enabled and not force_full:
-                #     _save_worldview_cache(cache_key, global_state)
-                if staged_mode:
-                    # cache_key 不再生成，传入空字符串（后台补全函数不再使用它）
+                _save_worldview_cache(cache_key, global_state)
+                if staged_mode and cache_enabled:
+                    # 后台补全的完整版只用于写入缓存（下一次相同输入直接命中完整版），未开启缓存时不再白白生成
                     threading.Thread(
                         target=_background_fill_worldview_details,
-                        args=("", user_idea, protagonist_attr, difficulty, tone_key),
+                        args=(cache_key, user_idea, protagonist_attr, difficulty, tone_key),
                         daemon=True
                     ).start()
                     global_state.setdefault("meta", {})["detail_async"] = True
@@ -5455,7 +5863,9 @@ def llm_generate_global(user_idea: str, protagonist_attr: Dict, difficulty: str,
     
     # 所有尝试都失败后，才返回默认世界观
     print("💡 提示：所有尝试均失败，将使用默认世界观继续游戏")
-    return _get_default_worldview(user_idea, protagonist_attr, difficulty)
+    default_state = _get_default_worldview(user_idea, protagonist_attr, difficulty)
+    default_state.setdefault("meta", {})["is_default"] = True  # 标记兜底世界观：预热池不收录
+    return default_state
 
 def _get_default_worldview(user_idea: str, protagonist_attr: Dict, difficulty: str, tone_key: str = "normal_ending") -> Dict:
     """
@@ -5640,12 +6050,13 @@ def prune_options(options: List[str]) -> List[str]:
     return pruned[:2]  # 最多保留2个选项
 
 # 重构：生成单个选项剧情的独立函数
-def _generate_single_option(i: int, option: str, global_state: Dict) -> Dict:
+def _generate_single_option(i: int, option: str, global_state: Dict, hedge: bool = False) -> Dict:
     """
     生成单个选项对应的剧情+下一层选项
     :param i: 选项索引
     :param option: 选项内容
     :param global_state: 全局状态
+    :param hedge: 玩家正在同步等待时传 True，慢请求会发出对冲副本（见 call_ai_api）
     :return: 包含选项索引和剧情数据的字典
     """
     perf = PERFORMANCE_OPTIMIZATION
@@ -5822,7 +6233,8 @@ def _generate_single_option(i: int, option: str, global_state: Dict) -> Dict:
         try:
             # 调用带重试的API函数
             try:
-                response_data = call_ai_api(request_body)
+                # 与第一层/第二层预生成中相同选项的在途请求合并（两条路径的请求体相同）
+                response_data = call_ai_api(request_body, hedge=hedge, coalesce=True)
             except ValueError as e:
                 # 如果是403/401认证错误，立即停止重试，使用默认剧情
                 error_str = str(e)
@@ -6157,16 +6569,14 @@ def _generate_single_option(i: int, option: str, global_state: Dict) -> Dict:
     return {"index": i, "data": option_data}
 
 # 优化：只生成文本内容的版本（用于并行优化）
-def _generate_single_option_text_only(i: int, option: str, global_state: Dict) -> Dict:
+# 以下拆分为「构建请求 / 解析返回 / 默认剧情」三部分
+def _build_option_text_request(option: str, global_state: Dict) -> Dict:
     """
-    生成单个选项对应的剧情+下一层选项（仅文本，不含图片）
-    这是优化版本，用于并行生成文本后再批量生成图片
-    :param i: 选项索引
+    构建"仅文本"选项剧情的请求体
     :param option: 选项内容
     :param global_state: 全局状态
-    :return: 包含选项索引、剧情数据和场景描述的字典
+    :return: chat/completions 请求体
     """
-    print(f"📝 正在生成选项 {i+1} 的剧情（文本模式）...")
     perf = PERFORMANCE_OPTIMIZATION
     perf_enabled = perf.get("enabled", True)
     
@@ -6317,228 +6727,461 @@ def _generate_single_option_text_only(i: int, option: str, global_state: Dict) -
         "presence_penalty": 0.1,
         "timeout": 200
     }
+    # 方案8：流式响应（需要API支持），call_ai_api 会按SSE逐段接收后拼装
+    if perf_enabled and perf.get("stream_response", False):
+        request_body["stream"] = True
+    return request_body
+
+
+def _option_text_max_retries() -> int:
+    """选项剧情生成的内部重试次数"""
+    perf = PERFORMANCE_OPTIMIZATION
+    if perf.get("enabled", True) and perf.get("optimize_retry", True):
+        return perf.get("plot_max_retries", 2)
+    return 3
+
+
+def _is_auth_error(e: Exception) -> bool:
+    """判断是否为401/403认证错误（认证错误不应重试）"""
+    error_str = str(e)
+    return (
+        "API认证失败" in error_str
+        or "403" in error_str
+        or "401" in error_str
+        or "Forbidden" in error_str
+    )
+
+
+def _extract_message_content(i: int, response_data: Dict) -> str:
+    """安全访问 choices[0].message.content，格式异常时返回空串"""
+    choices = response_data.get("choices", [])
+    if not choices or len(choices) == 0:
+        print(f"❌ 错误：选项 {i+1} 的AI返回内容格式异常，缺少choices字段，将重试...")
+        return ""
+    message = choices[0].get("message", {})
+    if not message:
+        print(f"❌ 错误：选项 {i+1} 的AI返回内容格式异常，缺少message字段，将重试...")
+        return ""
+    raw_content = (message.get("content") or "").strip()
+    if not raw_content:
+        print(f"❌ 错误：选项 {i+1} 的AI返回内容为空，将重试...")
+    return raw_content
+
+
+def _parse_option_lines(options_text: str) -> List[str]:
+    """把【选项】段落按行拆分，去掉序号"""
+    next_options = []
+    for line in options_text.split('\n'):
+        stripped_line = line.strip()
+        if stripped_line:
+            next_option = re.sub(r'^\s*\d+\.?\s*', '', stripped_line)
+            if next_option:
+                next_options.append(next_option)
+    return next_options
+
+
+def _parse_option_text_content(i: int, raw_content: str) -> tuple:
+    """
+    从AI返回的原始文本中解析场景、选项、世界线更新和深层背景关联
+    :return: (option_data, scene)
+    """
+    scene = None
+    # 直接从文本中提取信息，不依赖JSON解析
+    next_options = []
+    flow_update = {
+        "characters": {},
+        "environment": {},
+        "quest_progress": "",
+        "chapter_conflict_solved": False
+    }
+    deep_background_links = {}
+
+    # 清理AI返回的内容
+    cleaned_content = raw_content
+    error_patterns = [
+        r'(请求.*?失败|申请.*?失败|请.*?重试|侧向请求|生化或者失败联盟|出让角1|遣代表试)',
+    ]
+    for pattern in error_patterns:
+        cleaned_content = re.sub(pattern, '', cleaned_content, flags=re.IGNORECASE)
+
+    # 提取场景描述
+    scene_match1 = re.search(r'【场景】：([\s\S]*?)【选项】：', cleaned_content, re.DOTALL)
+    scene_match2 = re.search(r'【场景】：([\s\S]*?)$', cleaned_content, re.DOTALL)
+    scene_match3 = re.search(r'【场景】：([^\n]*)', cleaned_content)
+
+    if scene_match1:
+        scene = scene_match1.group(1).strip()
+    elif scene_match2:
+        scene = scene_match2.group(1).strip()
+    elif scene_match3:
+        scene = scene_match3.group(1).strip()
+
+    # 清理场景描述
+    if scene:
+        error_patterns = [
+            r'请求.*?失败|申请.*?失败|请.*?重试|侧向请求|生化或者失败联盟|出让角1|遣代表试',
+            # 保留：中文/英文/数字（含全角）+ 常用中文标点（含省略号）+ 引号
+            r"[^一-龥a-zA-Z0-9０-９\s，。！？、：；“”‘’（）《》【】…\"']+",
+        ]
+        for pattern in error_patterns:
+            scene = re.sub(pattern, '', scene, flags=re.IGNORECASE)
+        scene = scene.strip()
+
+        first_valid_char = re.search(r'[\u4e00-\u9fa5a-zA-Z"""''「【(]', scene)
+        if first_valid_char:
+            scene = scene[first_valid_char.start():]
+
+        if len(scene) < 10:
+            scene = "你仔细观察周围的环境，准备采取行动。"
+
+    # 提取选项
+    options_match1 = re.search(r'【选项】：([\s\S]*?)【世界线更新】：', cleaned_content, re.DOTALL)
+    options_match2 = re.search(r'【选项】：([\s\S]*?)【深层背景关联】：', cleaned_content, re.DOTALL)
+    options_match3 = re.search(r'【选项】：([\s\S]*?)$', cleaned_content, re.DOTALL)
+
+    if options_match1:
+        options_text = options_match1.group(1).strip()
+    elif options_match2:
+        options_text = options_match2.group(1).strip()
+    elif options_match3:
+        options_text = options_match3.group(1).strip()
+    else:
+        options_text = ""
+
+    if options_text:
+        next_options.extend(_parse_option_lines(options_text))
+
+    # 提取世界线更新
+    worldline_match = re.search(r'【世界线更新】：([\s\S]*?)(?:【深层背景关联】：|$)', raw_content, re.DOTALL)
+    if worldline_match:
+        worldline_text = worldline_match.group(1).strip()
+
+        quest_progress_match = re.search(r'主线进度：([^\n]*)', worldline_text)
+        if quest_progress_match:
+            flow_update["quest_progress"] = quest_progress_match.group(1).strip()
+
+        chapter_conflict_match = re.search(r'章节矛盾：([^\n]*)', worldline_text)
+        if chapter_conflict_match:
+            chapter_status = chapter_conflict_match.group(1).strip()
+            flow_update["chapter_conflict_solved"] = chapter_status == "已解决"
+
+    # 提取深层背景关联信息
+    deep_bg_match = re.search(r'【深层背景关联】：([\s\S]*?)$', raw_content, re.DOTALL)
+    if deep_bg_match:
+        deep_bg_text = deep_bg_match.group(1).strip()
+        deep_bg_lines = deep_bg_text.split('\n')
+
+        for line in deep_bg_lines:
+            stripped_line = line.strip()
+            if stripped_line and "：" in stripped_line:
+                parts = stripped_line.split("：")
+                if len(parts) >= 2:
+                    option_part = parts[0].strip()
+                    char_name = parts[1].strip()
+                    option_num_match = re.search(r'选项(\d+)', option_part)
+                    if option_num_match:
+                        option_idx = int(option_num_match.group(1)) - 1
+                        deep_background_links[option_idx] = char_name
+
+    # 选项剪枝
+    original_options_count = len(next_options)
+    original_options = next_options.copy()
+    next_options = prune_options(next_options)
+    pruned_count = len(next_options)
+
+    # 限制选项数量为2个（确保只保留2个选项）
+    if len(next_options) > 2:
+        print(f"📊 选项 {i+1} 数量超过2个，限制为前2个")
+        next_options = next_options[:2]
+    elif len(next_options) < 2:
+        # 如果选项少于2个，尝试从原始选项补充
+        if original_options_count >= 2:
+            print(f"⚠️ 选项 {i+1} 剪枝后选项过少（{len(next_options)}个），使用原始选项的前2个")
+            next_options = original_options[:2] if len(original_options) >= 2 else original_options
+
+    # 构建选项数据（不包含图片）
+    option_data = {
+        "scene": scene,
+        "next_options": next_options,
+        "flow_update": flow_update,
+        "deep_background_links": deep_background_links
+    }
+    return option_data, scene
+
+
+def _is_valid_option_text(option_data: Dict) -> bool:
+    """场景描述和选项都有内容（至少2个选项）才算有效"""
+    if not option_data:
+        return False
+    next_options = option_data.get("next_options") or []
+    return bool(option_data.get("scene")) and len(next_options) >= 2
+
+
+def _default_option_text_data(option: str) -> Dict:
+    """所有生成尝试均失败时使用的默认剧情"""
+    return {
+        "scene": f"你选择了：{option}。在你的努力下，你取得了一些进展。",
+        "next_options": ["继续前进", "查看当前状态", "返回上一步"],
+        "flow_update": {
+            "characters": {},
+            "environment": {},
+            "quest_progress": f"你正在执行任务：{option}",
+            "chapter_conflict_solved": False
+        },
+        "deep_background_links": {}
+    }
+
+
+def _finish_option_text_result(i: int, option: str, option_data: Dict, scene: str) -> Dict:
+    """组装返回结果；失败时回退到默认剧情"""
+    if not option_data or not option_data.get("scene") or not option_data.get("next_options"):
+        print(f"💡 提示：选项 {i+1} 的所有生成尝试均失败，将使用默认剧情")
+        option_data = _default_option_text_data(option)
+        scene = option_data["scene"]
+    
+    # 返回包含场景描述的字典，用于后续图片生成
+    return {
+        "index": i,
+        "data": option_data,
+        "scene_for_image": scene  # 保存场景描述，用于后续并行生成图片
+    }
+
+
+def _option_text_steps(i: int, option: str, global_state: Dict):
+    """
+    单个选项剧情生成的请求、解析与重试流程，与调用方式无关（同步 / 异步版本共用）：
+    每次产出一个请求体，驱动方发出请求后把响应 send 回来、失败时把异常 throw 回来，
+    流程结束时以 _finish_option_text_result 的结果作为返回值（StopIteration.value）。
+    """
+    print(f"📝 正在生成选项 {i+1} 的剧情（文本模式）...")
+    request_body = _build_option_text_request(option, global_state)
     
     option_data = None
     scene = None
     
     # 内部重试机制
-    max_retries = 3
-    if perf_enabled and perf.get("optimize_retry", True):
-        max_retries = perf.get("plot_max_retries", 2)
+    max_retries = _option_text_max_retries()
     for attempt in range(max_retries):
         try:
             # 调用带重试的API函数
             try:
-                response_data = call_ai_api(request_body)
-            except ValueError as e:
-                error_str = str(e)
-                if "API认证失败" in error_str or "HTTP 403" in error_str or "HTTP 401" in error_str:
-                    print(f"❌ 选项 {i+1} API认证失败，停止重试，使用默认剧情")
-                    option_data = None
-                    break
-                else:
-                    raise
+                response_data = yield request_body
             except Exception as api_error:
-                error_str = str(api_error)
-                if "403" in error_str or "401" in error_str or "Forbidden" in error_str:
+                # 如果是403/401认证错误，立即停止重试，使用默认剧情
+                if _is_auth_error(api_error):
                     print(f"❌ 选项 {i+1} API认证失败，停止重试，使用默认剧情")
                     option_data = None
                     break
                 raise
             
-            # 安全访问嵌套键
-            choices = response_data.get("choices", [])
-            if not choices or len(choices) == 0:
-                print(f"❌ 错误：选项 {i+1} 的AI返回内容格式异常，缺少choices字段，将重试...")
-                continue
-            
-            message = choices[0].get("message", {})
-            if not message:
-                print(f"❌ 错误：选项 {i+1} 的AI返回内容格式异常，缺少message字段，将重试...")
-                continue
-            
-            raw_content = message.get("content", "").strip()
+            raw_content = _extract_message_content(i, response_data)
             if not raw_content:
-                print(f"❌ 错误：选项 {i+1} 的AI返回内容为空，将重试...")
                 continue
             
-            # 直接从文本中提取信息，不依赖JSON解析
-            next_options = []
-            flow_update = {
-                "characters": {},
-                "environment": {},
-                "quest_progress": "",
-                "chapter_conflict_solved": False
-            }
-            deep_background_links = {}
-            
-            # 清理AI返回的内容
-            cleaned_content = raw_content
-            error_patterns = [
-                r'(请求.*?失败|申请.*?失败|请.*?重试|侧向请求|生化或者失败联盟|出让角1|遣代表试)',
-            ]
-            for pattern in error_patterns:
-                cleaned_content = re.sub(pattern, '', cleaned_content, flags=re.IGNORECASE)
-            
-            # 提取场景描述
-            scene_match1 = re.search(r'【场景】：([\s\S]*?)【选项】：', cleaned_content, re.DOTALL)
-            scene_match2 = re.search(r'【场景】：([\s\S]*?)$', cleaned_content, re.DOTALL)
-            scene_match3 = re.search(r'【场景】：([^\n]*)', cleaned_content)
-            
-            if scene_match1:
-                scene = scene_match1.group(1).strip()
-            elif scene_match2:
-                scene = scene_match2.group(1).strip()
-            elif scene_match3:
-                scene = scene_match3.group(1).strip()
-            
-            # 清理场景描述
-            if scene:
-                error_patterns = [
-                    r'请求.*?失败|申请.*?失败|请.*?重试|侧向请求|生化或者失败联盟|出让角1|遣代表试',
-                    # 保留：中文/英文/数字（含全角）+ 常用中文标点（含省略号）+ 引号
-                    r"[^一-龥a-zA-Z0-9０-９\s，。！？、：；“”‘’（）《》【】…\"']+",
-                ]
-                for pattern in error_patterns:
-                    scene = re.sub(pattern, '', scene, flags=re.IGNORECASE)
-                scene = scene.strip()
-                
-                first_valid_char = re.search(r'[\u4e00-\u9fa5a-zA-Z"""''「【(]', scene)
-                if first_valid_char:
-                    scene = scene[first_valid_char.start():]
-                
-                if len(scene) < 10:
-                    scene = "你仔细观察周围的环境，准备采取行动。"
-            
-            # 提取选项
-            options_match1 = re.search(r'【选项】：([\s\S]*?)【世界线更新】：', cleaned_content, re.DOTALL)
-            options_match2 = re.search(r'【选项】：([\s\S]*?)【深层背景关联】：', cleaned_content, re.DOTALL)
-            options_match3 = re.search(r'【选项】：([\s\S]*?)$', cleaned_content, re.DOTALL)
-            
-            if options_match1:
-                options_text = options_match1.group(1).strip()
-            elif options_match2:
-                options_text = options_match2.group(1).strip()
-            elif options_match3:
-                options_text = options_match3.group(1).strip()
-            else:
-                options_text = ""
-            
-            if options_text:
-                option_lines = options_text.split('\n')
-                for line in option_lines:
-                    stripped_line = line.strip()
-                    if stripped_line:
-                        next_option = re.sub(r'^\s*\d+\.?\s*', '', stripped_line)
-                        if next_option:
-                            next_options.append(next_option)
-            
-            # 提取世界线更新
-            worldline_match = re.search(r'【世界线更新】：([\s\S]*?)(?:【深层背景关联】：|$)', raw_content, re.DOTALL)
-            if worldline_match:
-                worldline_text = worldline_match.group(1).strip()
-                
-                quest_progress_match = re.search(r'主线进度：([^\n]*)', worldline_text)
-                if quest_progress_match:
-                    flow_update["quest_progress"] = quest_progress_match.group(1).strip()
-                
-                chapter_conflict_match = re.search(r'章节矛盾：([^\n]*)', worldline_text)
-                if chapter_conflict_match:
-                    chapter_status = chapter_conflict_match.group(1).strip()
-                    flow_update["chapter_conflict_solved"] = chapter_status == "已解决"
-            
-            # 提取深层背景关联信息
-            deep_bg_match = re.search(r'【深层背景关联】：([\s\S]*?)$', raw_content, re.DOTALL)
-            if deep_bg_match:
-                deep_bg_text = deep_bg_match.group(1).strip()
-                deep_bg_lines = deep_bg_text.split('\n')
-                
-                for line in deep_bg_lines:
-                    stripped_line = line.strip()
-                    if stripped_line and "：" in stripped_line:
-                        parts = stripped_line.split("：")
-                        if len(parts) >= 2:
-                            option_part = parts[0].strip()
-                            char_name = parts[1].strip()
-                            option_num_match = re.search(r'选项(\d+)', option_part)
-                            if option_num_match:
-                                option_idx = int(option_num_match.group(1)) - 1
-                                deep_background_links[option_idx] = char_name
-            
-            # 选项剪枝
-            original_options_count = len(next_options)
-            original_options = next_options.copy()
-            next_options = prune_options(next_options)
-            pruned_count = len(next_options)
-            
-            # 限制选项数量为2个（确保只保留2个选项）
-            if len(next_options) > 2:
-                print(f"📊 选项 {i+1} 数量超过2个，限制为前2个")
-                next_options = next_options[:2]
-            elif len(next_options) < 2:
-                # 如果选项少于2个，尝试从原始选项补充
-                if original_options_count >= 2:
-                    print(f"⚠️ 选项 {i+1} 剪枝后选项过少（{len(next_options)}个），使用原始选项的前2个")
-                    next_options = original_options[:2] if len(original_options) >= 2 else original_options
-            
-            # 构建选项数据（不包含图片）
-            option_data = {
-                "scene": scene,
-                "next_options": next_options,
-                "flow_update": flow_update,
-                "deep_background_links": deep_background_links
-            }
+            option_data, scene = _parse_option_text_content(i, raw_content)
             
             # 只有当场景描述和选项都有内容时，才返回结果（至少2个选项）
-            if scene and next_options and len(next_options) >= 2:
-                print(f"✅ 选项 {i+1} 剧情生成成功，共{len(next_options)}个选项：{next_options}")
+            if _is_valid_option_text(option_data):
+                print(f"✅ 选项 {i+1} 剧情生成成功，共{len(option_data['next_options'])}个选项：{option_data['next_options']}")
                 break
             else:
                 print(f"❌ 错误：无法从选项 {i+1} 的AI返回内容中提取有效剧情信息，将重试...")
                 if attempt < max_retries - 1:
                     continue
         
+        except OperationCancelled:
+            print(f"⏹️ 选项 {i+1} 的剧情生成已取消")
+            raise
         except Exception as e:
-            error_str = str(e)
-            if "403" in error_str or "401" in error_str or "Forbidden" in error_str or "API认证失败" in error_str:
+            if _is_auth_error(e):
                 print(f"❌ 选项 {i+1} API认证失败，停止重试，使用默认剧情")
                 option_data = None
                 break
             else:
-                print(f"❌ 选项 {i+1} 剧情生成失败（第{attempt+1}/{max_retries}次）：{error_str}")
+                print(f"❌ 选项 {i+1} 剧情生成失败（第{attempt+1}/{max_retries}次）：{str(e)}")
                 if attempt < max_retries - 1:
                     print(f"🔄 将重试生成选项 {i+1} 的剧情...")
                     continue
     
-    # 如果所有尝试都失败，返回默认剧情
-    if not option_data or not option_data.get("scene") or not option_data.get("next_options"):
-        print(f"💡 提示：选项 {i+1} 的所有生成尝试均失败，将使用默认剧情")
-        option_data = {
-            "scene": f"你选择了：{option}。在你的努力下，你取得了一些进展。",
-            "next_options": ["继续前进", "查看当前状态", "返回上一步"],
-            "flow_update": {
-                "characters": {},
-                "environment": {},
-                "quest_progress": f"你正在执行任务：{option}",
-                "chapter_conflict_solved": False
-            },
-            "deep_background_links": {}
-        }
-        scene = option_data["scene"]
+    return _finish_option_text_result(i, option, option_data, scene)
+
+
+def _generate_single_option_text_only(i: int, option: str, global_state: Dict, cancel_token: CancelToken = None) -> Dict:
+    """
+    生成单个选项对应的剧情+下一层选项（仅文本，不含图片）
+    这是优化版本，用于并行生成文本后再批量生成图片
+    :param i: 选项索引
+    :param option: 选项内容
+    :param global_state: 全局状态
+    :param cancel_token: 取消令牌，取消后中止在途的 LLM 请求并抛出 OperationCancelled（不回退默认剧情）
+    :return: 包含选项索引、剧情数据和场景描述的字典
+    """
+    steps = _option_text_steps(i, option, global_state)
+    try:
+        request_body = next(steps)
+        while True:
+            try:
+                # 同一场景状态 + 选项文本的请求体相同：/generate-option、第一层、第二层的重复生成合并为一次
+                response_data = call_ai_api(request_body, cancel_token=cancel_token, coalesce=True)
+            except Exception as e:
+                request_body = steps.throw(e)
+            else:
+                request_body = steps.send(response_data)
+    except StopIteration as done:
+        return done.value
+
+
+async def _generate_single_option_text_only_async(i: int, option: str, global_state: Dict,
+                                                  cancel_token: CancelToken = None) -> Dict:
+    """_generate_single_option_text_only 的异步版本（流程见 _option_text_steps）"""
+    steps = _option_text_steps(i, option, global_state)
+    try:
+        request_body = next(steps)
+        while True:
+            try:
+                response_data = await call_ai_api_async(request_body, cancel_token=cancel_token, coalesce=True)
+            except Exception as e:
+                request_body = steps.throw(e)
+            else:
+                request_body = steps.send(response_data)
+    except StopIteration as done:
+        return done.value
+
+
+# ------------------------------
+# 流式剧情生成：增量解析分段输出
+# ------------------------------
+_OPTION_STREAM_MARKERS = {
+    "【场景】：": "scene",
+    "【选项】：": "options",
+    "【世界线更新】：": "worldline_update",
+    "【深层背景关联】：": "deep_background_links",
+}
+_OPTION_STREAM_MARKER_MAX_LEN = max(len(m) for m in _OPTION_STREAM_MARKERS)
+
+
+class OptionStreamParser:
+    """
+    选项剧情的增量解析器：逐段喂入LLM输出的增量文本
+    - 【场景】正文随到随发（scene_delta 事件），并保留可能是分隔符前缀的尾部，避免把半个分隔符发给前端
+    - 【选项】/【世界线更新】/【深层背景关联】在下一个分隔符出现（或 finish）时整段发出
+    最终的完整解析（清洗、剪枝、兜底）仍由 _parse_option_text_content 负责。
+    """
     
-    # 返回包含场景描述的字典，用于后续图片生成
-    return {
-        "index": i,
-        "data": option_data,
-        "scene_for_image": scene  # 保存场景描述，用于后续并行生成图片
-    }
+    def __init__(self):
+        self.text = ""
+        self._section = None
+        self._section_start = 0
+        self._scene_emitted = 0
+        self._scan_pos = 0
+    
+    def _find_next_marker(self):
+        found = None
+        for marker, name in _OPTION_STREAM_MARKERS.items():
+            idx = self.text.find(marker, self._scan_pos)
+            if idx != -1 and (found is None or idx < found[0]):
+                found = (idx, marker, name)
+        return found
+    
+    def _close_section(self, end: int) -> List[Dict]:
+        events = []
+        body = self.text[self._section_start:end]
+        if self._section == "scene":
+            if end > self._scene_emitted:
+                events.append({"event": "scene_delta", "text": self.text[self._scene_emitted:end]})
+                self._scene_emitted = end
+        elif self._section == "options":
+            options = _parse_option_lines(body.strip())
+            events.append({"event": "options", "options": prune_options(options) or options[:2]})
+        elif self._section:
+            events.append({"event": self._section, "text": body.strip()})
+        return events
+    
+    def feed(self, delta: str) -> List[Dict]:
+        """喂入增量文本，返回本次可以发出的事件列表"""
+        if not delta:
+            return []
+        self.text += delta
+        events = []
+        while True:
+            found = self._find_next_marker()
+            if not found:
+                break
+            idx, marker, name = found
+            events.extend(self._close_section(idx))
+            self._section = name
+            self._section_start = idx + len(marker)
+            self._scan_pos = self._section_start
+            if name == "scene":
+                self._scene_emitted = self._section_start
+        
+        if self._section == "scene":
+            # 尾部若出现“【”，可能是下一个分隔符的前半截，先不发
+            tail_from = max(self._scene_emitted, len(self.text) - _OPTION_STREAM_MARKER_MAX_LEN + 1)
+            held = self.text.rfind("【", tail_from)
+            safe_end = held if held != -1 else len(self.text)
+            if safe_end > self._scene_emitted:
+                events.append({"event": "scene_delta", "text": self.text[self._scene_emitted:safe_end]})
+                self._scene_emitted = safe_end
+        
+        self._scan_pos = max(self._scan_pos, len(self.text) - _OPTION_STREAM_MARKER_MAX_LEN + 1)
+        return events
+    
+    def finish(self) -> List[Dict]:
+        """输出结束：发出最后一个分段"""
+        events = self._close_section(len(self.text))
+        self._section = None
+        return events
+
+
+def _generate_single_option_text_stream(i: int, option: str, global_state: Dict):
+    """
+    _generate_single_option_text_only 的流式版本（生成器）
+    依次产出 scene_delta / options / worldline_update / deep_background_links 事件，
+    最后一个事件为 {"event": "done", "result": ...}，result 与 _generate_single_option_text_only 的返回值结构一致。
+    流式失败或结果无法解析时回退为普通请求；若此前已输出过增量，先产出 {"event": "reset"}。
+    """
+    print(f"📝 正在生成选项 {i+1} 的剧情（流式）...")
+    request_body = _build_option_text_request(option, global_state)
+    parser = OptionStreamParser()
+    emitted = False
+    try:
+        for delta in stream_ai_api(request_body):
+            for event in parser.feed(delta):
+                emitted = True
+                yield event
+        for event in parser.finish():
+            emitted = True
+            yield event
+        
+        option_data, scene = _parse_option_text_content(i, parser.text)
+        if _is_valid_option_text(option_data):
+            print(f"✅ 选项 {i+1} 流式剧情生成成功，共{len(option_data['next_options'])}个选项：{option_data['next_options']}")
+            yield {"event": "done", "result": _finish_option_text_result(i, option, option_data, scene)}
+            return
+        print(f"❌ 错误：无法从选项 {i+1} 的流式返回内容中提取有效剧情信息，回退为普通请求...")
+    except OperationCancelled:
+        raise
+    except Exception as e:
+        if _is_auth_error(e):
+            print(f"❌ 选项 {i+1} API认证失败，停止重试，使用默认剧情")
+            if emitted:
+                yield {"event": "reset"}
+            yield {"event": "done", "result": _finish_option_text_result(i, option, None, None)}
+            return
+        print(f"⚠️ 选项 {i+1} 流式生成失败，回退为普通请求：{str(e)}")
+    
+    if emitted:
+        yield {"event": "reset"}
+    yield {"event": "done", "result": _generate_single_option_text_only(i, option, global_state)}
 
 # 优化：并行生成多个场景的图片
-def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -> Dict[int, Dict]:
+def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict, cancel_token: CancelToken = None) -> Dict[int, Dict]:
     """
     并行生成多个场景的图片
     :param scenes_dict: 场景描述字典 {option_index: scene_description}
     :param global_state: 全局状态
+    :param cancel_token: 取消令牌（每张图派生子令牌，单张超时只中止该图片的请求）
     :return: 图片结果字典 {option_index: image_data}
     """
     if not scenes_dict:
@@ -6548,13 +7191,7 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
     
     image_results = {}
     
-    # 先检查缓存，避免重复生成
-    import hashlib
-    from pathlib import Path
-    
-    IMAGE_CACHE_DIR = "image_cache"
-    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
-    
+    # 先检查图片存储，避免重复生成（与 generate_scene_image 使用同一请求键：默认风格、默认尺寸）
     # 过滤需要生成的场景（检查缓存）
     scenes_to_generate = {}
     cached_images = {}
@@ -6563,19 +7200,16 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
         if not scene:
             continue
         
-        # 生成缓存键
-        prompt_hash = hashlib.md5(f"{scene}_default".encode()).hexdigest()
-        cache_path = Path(IMAGE_CACHE_DIR) / f"{prompt_hash}.png"
-        
         # 检查缓存
-        if cache_path.exists():
-            print(f"✅ 选项 {option_index+1} 使用缓存的图片：{cache_path}")
+        cached = image_store.lookup(_scene_image_request_key(scene, global_state, "default"))
+        if cached:
+            print(f"✅ 选项 {option_index+1} 使用缓存的图片：{cached['url']}")
             cached_images[option_index] = {
-                "url": f"/image_cache/{prompt_hash}.png",
-                "prompt": scene[:100],
+                "url": cached["url"],
+                "prompt": cached.get("prompt", scene[:100]),
                 "style": "default",
-                "width": 1024,
-                "height": 1024,
+                "width": cached.get("width", 1024),
+                "height": cached.get("height", 1024),
                 "cached": True
             }
         else:
@@ -6586,21 +7220,23 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
         print(f"✅ 所有图片都已缓存，跳过生成")
         return cached_images
     
-    # 并行生成图片（限制并发数，避免API限流）
-    # - yunwu.ai 速率限制更严格：默认只开 1 并发（再配合全局最小间隔）
-    # - 其它 provider 可适当并发
+    # 并行生成图片：真正发往上游的并发由 image_concurrency 自适应控制（yunwu 另有令牌桶限速），
+    # 这里每张图一个线程，超出当前并发上限的请求在控制器里排队
     provider = IMAGE_GENERATION_CONFIG.get("provider", "yunwu")
-    default_workers = 1 if provider == "yunwu" else 2
-    max_workers_env = int(os.getenv("IMAGE_PARALLEL_MAX_WORKERS", str(default_workers)))
-    max_workers = max(1, min(len(scenes_to_generate), max_workers_env))
-    print(f"📊 需要生成 {len(scenes_to_generate)} 张图片，使用 {max_workers} 个并发线程（provider={provider}）")
+    max_workers = len(scenes_to_generate)
+    print(f"📊 需要生成 {len(scenes_to_generate)} 张图片，当前图片并发上限 {image_concurrency.limit}（provider={provider}）")
+    
+    task_tokens = {
+        option_index: cancel_token.child() if cancel_token is not None else CancelToken()
+        for option_index in scenes_to_generate
+    }
     
     def generate_single_image(option_index: int, scene: str) -> tuple:
         """生成单个图片的包装函数，返回 (option_index, image_data, error)"""
         try:
             print(f"🎨 正在为选项 {option_index+1} 生成场景图片...")
             # 使用带缓存的图片生成，会自动下载到本地
-            image_data = generate_scene_image(scene, global_state, "default", use_cache=True)
+            image_data = generate_scene_image(scene, global_state, "default", use_cache=True, cancel_token=task_tokens[option_index])
             
             if image_data and image_data.get('url'):
                 # 验证图片URL
@@ -6636,6 +7272,8 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
                 print(f"💡 前端可能会使用缓存的图片或其他选项的图片作为替代")
                 return (option_index, None, "无返回数据")
         
+        except OperationCancelled:
+            return (option_index, None, "已取消")
         except Exception as e:
             error_msg = str(e)
             print(f"⚠️ 选项 {option_index+1} 图片生成异常：{error_msg}")
@@ -6643,22 +7281,14 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
             traceback.print_exc()
             return (option_index, None, error_msg)
     
-    # 使用线程池并行生成（添加延迟避免速率限制）
-    import time
+    # 使用线程池并行生成（速率与并发由限速器/自适应并发控制，不再在提交之间固定 sleep）
     per_task_timeout = int(os.getenv("IMAGE_TASK_TIMEOUT_SECONDS", "120"))
-    submit_delay = float(os.getenv("IMAGE_SUBMIT_DELAY_SECONDS", "2.0"))
     total_images = len(scenes_to_generate)
     completed_images = 0
     failed_images = 0
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # 提交所有任务（添加延迟避免同时发送过多请求）
         futures = {}
-        for idx, (option_index, scene) in enumerate(scenes_to_generate.items()):
-            # 如果不是第一个任务，添加延迟（避免同时发送过多请求触发速率限制）
-            if idx > 0:
-                if submit_delay > 0:
-                    print(f"⏳ 等待 {submit_delay:.1f} 秒后提交下一个图片生成任务（避免API速率限制）...")
-                    time.sleep(submit_delay)
+        for option_index, scene in scenes_to_generate.items():
             future = executor.submit(generate_single_image, option_index, scene)
             futures[option_index] = future
         
@@ -6684,7 +7314,8 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
                 failed_images += 1
                 print(f"⚠️ 选项 {option_index+1} 图片生成超时（{per_task_timeout}s），将跳过该图片")
                 print(f"💡 提示：图片生成任务可能因为API响应慢或网络问题而超时")
-                # 尝试取消该任务，释放资源（但任务可能已经在执行，无法取消）
+                # 尝试取消该任务；已在执行的任务通过取消令牌中止在途请求，释放线程与图片额度
+                task_tokens[option_index].cancel("图片任务超时")
                 try:
                     future.cancel()
                 except:
@@ -6696,7 +7327,8 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
                 if isinstance(e, (TimeoutError, type(None))) or "timeout" in error_msg.lower() or "超时" in error_msg or "TimeoutError" in str(type(e)):
                     print(f"⚠️ 选项 {option_index+1} 图片生成超时（{per_task_timeout}s），将跳过该图片")
                     print(f"💡 提示：图片生成任务可能因为API响应慢或网络问题而超时")
-                    # 尝试取消任务
+                    # 尝试取消任务（已在执行的任务通过取消令牌中止在途请求）
+                    task_tokens[option_index].cancel("图片任务超时")
                     try:
                         future.cancel()
                     except:
@@ -6707,6 +7339,10 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
                 import traceback
                 traceback.print_exc()
     
+    # 所有任务已结束：子令牌从调用方令牌上注销
+    for token in task_tokens.values():
+        token.detach()
+    
     # 合并缓存的结果和生成的结果
     image_results.update(cached_images)
     
@@ -6715,23 +7351,50 @@ def _generate_images_parallel(scenes_dict: Dict[int, str], global_state: Dict) -
     print(f"✅ 图片生成完成，成功生成 {len(image_results)} 张图片（包含缓存）")
     return image_results
 
+def _merge_scene_image(all_options_data: Dict, option_index: int, image_data: Dict) -> None:
+    """把图片结果合并到对应选项数据中（含 scene_text_hash，确保图片与文本一一对应）"""
+    if option_index in all_options_data and image_data:
+        # 验证图片数据格式
+        if image_data.get('url'):
+            scene_text = all_options_data[option_index].get("scene", "") or ""
+            scene_text_hash = hashlib.md5(scene_text.encode("utf-8")).hexdigest() if scene_text.strip() else None
+            all_options_data[option_index]["scene_image"] = {
+                "url": image_data.get("url"),
+                "prompt": image_data.get("prompt", ""),
+                "style": image_data.get("style", "default"),
+                "width": image_data.get("width", 1024),
+                "height": image_data.get("height", 1024),
+                "cached": image_data.get("cached", True),
+                "scene_text_hash": scene_text_hash,
+            }
+            print(f"✅ 选项 {option_index+1} 图片已合并到选项数据")
+        else:
+            print(f"⚠️ 选项 {option_index+1} 图片数据无效，跳过")
+    else:
+        print(f"⚠️ 选项 {option_index+1} 图片数据为空，跳过")
+
 # 重构：实现并行批量预生成（优化版）
-def generate_all_options(global_state: Dict, current_options: List[str], skip_images: bool = False) -> Dict:
+def generate_all_options(global_state: Dict, current_options: List[str], skip_images: bool = False, submit=None,
+                         cancel_token: CancelToken = None) -> Dict:
     """
     生成当前场景下所有可选选项对应的剧情+下一层选项，并返回完整的剧情数据
     优化版：使用两阶段并行处理，提高生成效率
     阶段1：并行生成所有选项的文本内容（场景描述、选项等）
     阶段2：并行生成所有场景的图片并缓存
+    submit：可选的任务提交函数 submit(fn, *args) -> Future（如全局调度器），不传则使用本地线程池
+    cancel_token：取消令牌，取消后中止各选项在途的 LLM/图片请求并抛出 OperationCancelled
+    开启 PERF_ASYNC_TEXT_PIPELINE 且已安装 httpx 时，未指定 submit 的调用改走 generate_all_options_async
     """
     if not global_state or not current_options:
         return {}
     if not AI_API_CONFIG["api_key"]:
         print("❌ 错误：未配置Camera_Analyst_API_KEY，请在.env文件中设置")
         return {}
+    if submit is None and PERFORMANCE_OPTIMIZATION.get("async_text_pipeline") and async_http_available():
+        # asyncio 中没有线程绑定的当前令牌，显式传入
+        return _run_on_async_loop(generate_all_options_async(global_state, current_options, skip_images,
+                                                             cancel_token or current_token()))
     
-    perf = PERFORMANCE_OPTIMIZATION
-    perf_enabled = perf.get("enabled", True)
-    stream_first = perf_enabled and perf.get("stream_first_option", True)
     print(f"📝 开始并行生成 {len(current_options)} 个选项的剧情（优化版：两阶段并行）...")
     
     # ========== 阶段1：并行生成所有选项的文本内容 ==========
@@ -6739,42 +7402,63 @@ def generate_all_options(global_state: Dict, current_options: List[str], skip_im
     all_options_data = {}
     scenes_for_images = {}  # 用于收集需要生成图片的场景描述 {option_index: scene_description}
     
-    # 使用线程池并行生成文本内容
-    text_workers = min(len(current_options), 4)
-    with ThreadPoolExecutor(max_workers=text_workers) as executor:
+    # 使用线程池（或调用方提供的调度器）并行生成文本内容；LLM 实际并发由 llm_concurrency 自适应控制
+    text_workers = len(current_options)
+    with ThreadPoolExecutor(max_workers=text_workers) if submit is None else nullcontext() as executor:
+        submit_task = submit or executor.submit
         # 提交所有选项的文本生成任务
         futures = []
         for i, option in enumerate(current_options):
-            future = executor.submit(_generate_single_option_text_only, i, option, global_state)
+            future = submit_task(_generate_single_option_text_only, i, option, global_state, cancel_token)
             futures.append(future)
         
-        first_ready = None
         completed = 0
         total = len(futures)
         # 收集所有任务结果（支持流式先返回第一个完成的选项）
         for future in as_completed(futures):
             completed += 1
+            if future.cancelled():
+                # 调度器抢占了排队中的推测任务
+                print(f"⏹️ 文本生成任务已被取消：{completed}/{total}")
+                continue
             print(f"📝 文本生成进度：{completed}/{total}")
             try:
-                result = future.result()
-                option_index = result["index"]
-                option_data = result["data"]
-                all_options_data[option_index] = option_data
-                
-                if stream_first and first_ready is None:
-                    first_ready = {option_index: option_data}
-                    global_state.setdefault("stream_first_option", {}).update(first_ready)
-                    print(f"🚀 第一条选项文本已完成并缓存（流式）：{option_index+1}")
-                
-                # 收集需要生成图片的场景描述
-                scene_for_image = result.get("scene_for_image")
-                if scene_for_image:
-                    scenes_for_images[option_index] = scene_for_image
+                _collect_option_text_result(future.result(), global_state, all_options_data, scenes_for_images)
+            except OperationCancelled:
+                continue
             except Exception as e:
                 print(f"❌ 选项文本生成异常：{str(e)}")
                 import traceback
                 traceback.print_exc()
     
+    return _finish_all_options(global_state, all_options_data, scenes_for_images, skip_images, cancel_token)
+
+
+def _collect_option_text_result(result: Dict, global_state: Dict, all_options_data: Dict, scenes_for_images: Dict) -> None:
+    """阶段1：登记一个选项的文本结果（第一个完成的选项按流式配置提前缓存），并收集需要生成图片的场景描述"""
+    perf = PERFORMANCE_OPTIMIZATION
+    stream_first = perf.get("enabled", True) and perf.get("stream_first_option", True)
+    option_index = result["index"]
+    option_data = result["data"]
+    is_first = not all_options_data
+    all_options_data[option_index] = option_data
+    
+    if stream_first and is_first:
+        global_state.setdefault("stream_first_option", {}).update({option_index: option_data})
+        print(f"🚀 第一条选项文本已完成并缓存（流式）：{option_index+1}")
+    
+    # 收集需要生成图片的场景描述
+    scene_for_image = result.get("scene_for_image")
+    if scene_for_image:
+        scenes_for_images[option_index] = scene_for_image
+
+
+def _finish_all_options(global_state: Dict, all_options_data: Dict, scenes_for_images: Dict, skip_images: bool,
+                        cancel_token: CancelToken = None) -> Dict:
+    """阶段1收尾（检查取消）+ 阶段2：并行生成所有场景的图片并合并回选项数据"""
+    if cancel_token is not None and cancel_token.cancelled:
+        print(f"⏹️ 选项生成已取消（已完成 {len(all_options_data)} 个选项的文本）")
+        cancel_token.raise_if_cancelled()
     print(f"✅ 阶段1完成：所有选项文本内容生成完成，共 {len(all_options_data)} 个选项")
     
     # ========== 阶段2：并行生成所有场景的图片 ==========
@@ -6784,29 +7468,11 @@ def generate_all_options(global_state: Dict, current_options: List[str], skip_im
         print(f"🎨 阶段2：并行生成 {len(scenes_for_images)} 个场景的图片...")
         try:
             # 并行生成所有图片（包含缓存检查和错误处理）
-            image_results = _generate_images_parallel(scenes_for_images, global_state)
+            image_results = _generate_images_parallel(scenes_for_images, global_state, cancel_token=cancel_token)
             
             # 将图片结果合并回选项数据（含 scene_text_hash，确保图片与文本一一对应）
             for option_index, image_data in image_results.items():
-                if option_index in all_options_data and image_data:
-                    # 验证图片数据格式
-                    if image_data.get('url'):
-                        scene_text = all_options_data[option_index].get("scene", "") or ""
-                        scene_text_hash = hashlib.md5(scene_text.encode("utf-8")).hexdigest() if scene_text.strip() else None
-                        all_options_data[option_index]["scene_image"] = {
-                            "url": image_data.get("url"),
-                            "prompt": image_data.get("prompt", ""),
-                            "style": image_data.get("style", "default"),
-                            "width": image_data.get("width", 1024),
-                            "height": image_data.get("height", 1024),
-                            "cached": image_data.get("cached", True),
-                            "scene_text_hash": scene_text_hash,
-                        }
-                        print(f"✅ 选项 {option_index+1} 图片已合并到选项数据")
-                    else:
-                        print(f"⚠️ 选项 {option_index+1} 图片数据无效，跳过")
-                else:
-                    print(f"⚠️ 选项 {option_index+1} 图片数据为空，跳过")
+                _merge_scene_image(all_options_data, option_index, image_data)
             
             print(f"✅ 阶段2完成：图片生成完成，成功合并 {len(image_results)} 张图片")
         except Exception as e:
@@ -6820,6 +7486,66 @@ def generate_all_options(global_state: Dict, current_options: List[str], skip_im
     print(f"✅ 所有选项生成完成，共生成 {len(all_options_data)} 个选项的剧情（包含文本和图片）")
     return all_options_data
 
+
+async def generate_all_options_async(global_state: Dict, current_options: List[str], skip_images: bool = False,
+                                     cancel_token: CancelToken = None) -> Dict:
+    """
+    generate_all_options 的 asyncio 版本（需安装 httpx）：
+    阶段1：各选项文本作为协程并发生成，不占用线程（实际并发由 llm_concurrency 自适应控制）
+    阶段2：图片 provider 都是同步实现，整体复用 _generate_images_parallel（在线程中执行）
+    """
+    if not global_state or not current_options:
+        return {}
+    if not AI_API_CONFIG["api_key"]:
+        print("❌ 错误：未配置Camera_Analyst_API_KEY，请在.env文件中设置")
+        return {}
+    
+    print(f"📝 开始并发生成 {len(current_options)} 个选项的剧情（异步管线：两阶段）...")
+    all_options_data = {}
+    scenes_for_images = {}
+    tasks = [
+        asyncio.ensure_future(_generate_single_option_text_only_async(i, option, global_state, cancel_token))
+        for i, option in enumerate(current_options)
+    ]
+    try:
+        completed = 0
+        for next_done in asyncio.as_completed(tasks):
+            completed += 1
+            print(f"📝 文本生成进度：{completed}/{len(tasks)}")
+            try:
+                _collect_option_text_result(await next_done, global_state, all_options_data, scenes_for_images)
+            except OperationCancelled:
+                continue
+            except Exception as e:
+                print(f"❌ 选项文本生成异常：{str(e)}")
+                import traceback
+                traceback.print_exc()
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    return await _call_sync_in_thread(
+        lambda cancel_token: _finish_all_options(global_state, all_options_data, scenes_for_images, skip_images, cancel_token),
+        cancel_token,
+    )
+
+
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+
+def _run_on_async_loop(coro):
+    """
+    在常驻的后台事件循环中执行协程并同步等待结果：
+    各次调用共用同一个事件循环，从而复用同一个 httpx.AsyncClient 的连接池。
+    """
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(target=_async_loop.run_forever, name="async-pipeline", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _async_loop).result()
+
 # 重构：适配新的批量预生成机制
 def llm_generate_local(global_state: Dict, user_interaction: str, last_options: List[str]) -> List[Dict]:
     """生成1层递进剧情，适配章节矛盾、难度、主角属性（强制贴合用户选择+自动重试）"""
@@ -7116,6 +7842,7 @@ class TextAdventureGame:
         self.current_scene_id: str = "initial"  # 当前场景ID
         self.generating_task = None  # 异步生成任务
         self.generation_cancelled = False  # 生成取消标志
+        self.generation_cancel_token = None  # 当前预生成的取消令牌（取消时中止在途请求）
         self.skip_images: bool = False  # 是否跳过图片生成以加速
         self.max_autosaves: int = 5  # 自动存档最多保留数量
         
@@ -8389,16 +9116,20 @@ class TextAdventureGame:
             print(f"❌ 查看存档详情失败：{str(e)}")
             safe_input("\n请按回车键返回存档管理...", default="")
     
-    def _async_pregenerate(self, scene_id: str, options: List[str]):
+    def _async_pregenerate(self, scene_id: str, options: List[str], cancel_token: CancelToken):
         """异步预生成指定场景下所有选项的剧情"""
         print(f"🔄 启动异步预生成线程，场景ID：{scene_id}")
         self.generation_cancelled = False
         
         # 生成所有选项的剧情
-        all_options_data = generate_all_options(self.global_state, options, skip_images=self.skip_images)
+        try:
+            all_options_data = generate_all_options(self.global_state, options, skip_images=self.skip_images, cancel_token=cancel_token)
+        except OperationCancelled:
+            print(f"⏹️ 异步预生成已取消，场景ID：{scene_id}")
+            return
         
         # 如果生成未被取消，将结果缓存
-        if not self.generation_cancelled:
+        if not self.generation_cancelled and not cancel_token.cancelled:
             print(f"✅ 异步预生成完成，场景ID：{scene_id}")
             self.scene_cache[scene_id] = all_options_data
         else:
@@ -8406,8 +9137,11 @@ class TextAdventureGame:
     
     def start_pregeneration(self, options: List[str]):
         """启动预生成线程"""
-        # 取消当前正在进行的生成任务
+        # 取消当前正在进行的生成任务（中止其在途请求）
         self.generation_cancelled = True
+        if self.generation_cancel_token is not None:
+            self.generation_cancel_token.cancel("开始新的预生成")
+        self.generation_cancel_token = CancelToken()
         
         # 生成新的场景ID
         next_scene_id = f"scene_{len(self.scene_cache) + 1}"
@@ -8415,7 +9149,7 @@ class TextAdventureGame:
         # 启动新的预生成线程
         self.generating_task = threading.Thread(
             target=self._async_pregenerate,
-            args=(next_scene_id, options),
+            args=(next_scene_id, options, self.generation_cancel_token),
             daemon=True
         )
         self.generating_task.start()
@@ -8425,6 +9159,9 @@ class TextAdventureGame:
     def cancel_pregeneration(self):
         """取消当前正在进行的预生成任务"""
         self.generation_cancelled = True
+        if self.generation_cancel_token is not None:
+            # 令牌取消会立即中止在途的 LLM/图片请求，下面的 join 通常很快返回
+            self.generation_cancel_token.cancel("玩家已做出选择")
         if self.generating_task and self.generating_task.is_alive():
             self.generating_task.join(timeout=1.0)  # 等待最多1秒
         print("⏹️ 已取消正在进行的预生成任务")
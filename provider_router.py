@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+图片生成 provider 路由：健康度统计 + 熔断 + 按延迟择优。
+
+- 每个 provider 维护一个滚动窗口（最近 window_size 次 / window_seconds 秒内的调用），
+  统计成功率与 p50/p95 延迟；
+- 熔断器：连续失败达到 failure_threshold 次，或窗口内失败率超过 failure_rate_threshold，
+  熔断打开（open），冷却 open_seconds 后进入半开（half_open）只放行一个探测请求，
+  探测成功则恢复（closed），失败则冷却时间翻倍（不超过 max_open_seconds）；
+- 路由：在已配置且未熔断的 provider 中按"期望耗时"（p50 / 成功率）排序，
+  配置的主 provider 享有 primary_bias 倍的偏好，样本不足时主 provider 优先、其余按配置顺序兜底；
+- 熔断状态与评分通过 get_stats() 导出（/admin/image-providers）。
+"""
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+# ------------------------------
+# 路由与熔断配置（可通过环境变量调节）
+# ------------------------------
+PROVIDER_ROUTER_CONFIG = {
+    # 关闭后只使用配置的主 provider（与原行为一致，不做跨 provider 兜底）
+    "enabled": os.getenv("IMAGE_PROVIDER_ROUTING_ENABLED", "true").lower() == "true",
+    # 参与路由的 provider（逗号分隔，留空表示全部已配置的 provider）
+    "candidates": [x.strip() for x in os.getenv("IMAGE_PROVIDER_CANDIDATES", "").split(",") if x.strip()],
+    # 滚动窗口：最多保留多少次调用、多长时间内的调用
+    "window_size": int(os.getenv("IMAGE_PROVIDER_WINDOW_SIZE", "50")),
+    "window_seconds": float(os.getenv("IMAGE_PROVIDER_WINDOW_SECONDS", "900")),
+    # 样本数达到该值才参与按延迟排序 / 按失败率熔断
+    "min_samples": int(os.getenv("IMAGE_PROVIDER_MIN_SAMPLES", "5")),
+    # 连续失败多少次熔断
+    "failure_threshold": int(os.getenv("IMAGE_PROVIDER_FAILURE_THRESHOLD", "3")),
+    # 窗口内失败率超过该值熔断
+    "failure_rate_threshold": float(os.getenv("IMAGE_PROVIDER_FAILURE_RATE", "0.5")),
+    # 熔断冷却时间（秒），半开探测失败后翻倍
+    "open_seconds": float(os.getenv("IMAGE_PROVIDER_OPEN_SECONDS", "60")),
+    "max_open_seconds": float(os.getenv("IMAGE_PROVIDER_MAX_OPEN_SECONDS", "600")),
+    # 主 provider 的偏好系数：其他 provider 的期望耗时要快这么多倍才会被优先选用
+    "primary_bias": float(os.getenv("IMAGE_PROVIDER_PRIMARY_BIAS", "1.5")),
+}
+
+# 支持路由的图片 provider（也是样本不足时的兜底顺序）
+IMAGE_PROVIDERS = ["yunwu", "replicate", "openai", "stable_diffusion", "comfyui"]
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+def _percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class _ProviderHealth:
+    """单个 provider 的滚动窗口与熔断状态（由 ProviderRouter 的锁保护）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.samples = deque()  # (ts, ok, latency_seconds)
+        self.state = STATE_CLOSED
+        self.open_until = 0.0
+        self.open_seconds = 0.0
+        self.probe_inflight = False
+        self.consecutive_failures = 0
+        self.last_error = ""
+        self.counters = {"calls": 0, "successes": 0, "failures": 0, "trips": 0, "skipped": 0}
+
+    def prune(self, now: float, cfg: Dict) -> None:
+        while self.samples and (len(self.samples) > cfg["window_size"]
+                                or now - self.samples[0][0] > cfg["window_seconds"]):
+            self.samples.popleft()
+
+    def success_rate(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        return sum(1 for _, ok, _ in self.samples if ok) / len(self.samples)
+
+    def latencies(self) -> List[float]:
+        # 只统计成功调用的延迟：失败往往是快速报错，会把延迟拉低误导路由
+        return sorted(latency for _, ok, latency in self.samples if ok)
+
+    def score(self, cfg: Dict) -> Optional[float]:
+        """期望耗时（秒）= p50 / 成功率；样本不足返回 None"""
+        if len(self.samples) < cfg["min_samples"]:
+            return None
+        rate = self.success_rate() or 0.0
+        p50 = _percentile(self.latencies(), 0.5)
+        if rate <= 0 or p50 is None:
+            return float("inf")
+        return p50 / rate
+
+
+class ProviderRouter:
+    """按健康度与延迟为每次生图请求挑选 provider 顺序"""
+
+    def __init__(self, providers: List[str], config: Dict):
+        self.config = config
+        self._lock = threading.Lock()
+        self._health = {name: _ProviderHealth(name) for name in providers}
+
+    def _get(self, provider: str) -> _ProviderHealth:
+        health = self._health.get(provider)
+        if health is None:
+            health = self._health[provider] = _ProviderHealth(provider)
+        return health
+
+    def _refresh_state(self, health: _ProviderHealth, now: float) -> None:
+        # 调用方需持有 self._lock
+        if health.state == STATE_OPEN and now >= health.open_until:
+            health.state = STATE_HALF_OPEN
+            health.probe_inflight = False
+            print(f"🩺 图片 provider {health.name} 熔断冷却结束，进入半开状态（放行一次探测）")
+
+    def candidates(self, primary: str, available: List[str]) -> List[str]:
+        """返回本次请求依次尝试的 provider 列表（已排除熔断中的 provider）"""
+        cfg = self.config
+        if not cfg["enabled"]:
+            return [primary] if primary in available else []
+        allowed = cfg["candidates"]
+        pool = [p for p in available if p == primary or not allowed or p in allowed]
+        now = time.time()
+        known, unknown = [], []
+        with self._lock:
+            for provider in pool:
+                health = self._get(provider)
+                health.prune(now, cfg)
+                self._refresh_state(health, now)
+                if health.state == STATE_OPEN or (health.state == STATE_HALF_OPEN and health.probe_inflight):
+                    continue
+                score = health.score(cfg)
+                if score is None:
+                    unknown.append(provider)
+                else:
+                    if provider == primary:
+                        score /= max(cfg["primary_bias"], 1e-6)
+                    known.append((score, provider))
+        known.sort(key=lambda item: item[0])
+        ordered = [provider for _, provider in known]
+        # 样本不足时：主 provider 最先尝试，其余排在有数据的 provider 之后
+        if primary in unknown:
+            ordered.insert(0, primary)
+        ordered.extend(p for p in unknown if p != primary)
+        return ordered
+
+    def allow(self, provider: str) -> bool:
+        """真正发起调用前确认：熔断中拒绝，半开状态只允许一个探测请求"""
+        now = time.time()
+        with self._lock:
+            health = self._get(provider)
+            self._refresh_state(health, now)
+            if health.state == STATE_OPEN:
+                health.counters["skipped"] += 1
+                return False
+            if health.state == STATE_HALF_OPEN:
+                if health.probe_inflight:
+                    health.counters["skipped"] += 1
+                    return False
+                health.probe_inflight = True
+            return True
+
+    def release(self, provider: str) -> None:
+        """调用被取消（不计入成功/失败）：归还半开探测名额"""
+        with self._lock:
+            self._get(provider).probe_inflight = False
+
+    def record_success(self, provider: str, latency: float) -> None:
+        now = time.time()
+        with self._lock:
+            health = self._get(provider)
+            if health.state != STATE_CLOSED:
+                # 熔断前的失败样本不再代表当前状态，恢复后重新统计
+                health.samples.clear()
+            health.samples.append((now, True, latency))
+            health.prune(now, self.config)
+            health.counters["calls"] += 1
+            health.counters["successes"] += 1
+            health.consecutive_failures = 0
+            health.probe_inflight = False
+            if health.state != STATE_CLOSED:
+                health.state = STATE_CLOSED
+                health.open_seconds = 0.0
+                print(f"✅ 图片 provider {provider} 探测成功，熔断恢复")
+
+    def record_failure(self, provider: str, latency: float, error: str = "") -> None:
+        cfg = self.config
+        now = time.time()
+        with self._lock:
+            health = self._get(provider)
+            health.samples.append((now, False, latency))
+            health.prune(now, cfg)
+            health.counters["calls"] += 1
+            health.counters["failures"] += 1
+            health.consecutive_failures += 1
+            health.last_error = (error or "")[:200]
+            health.probe_inflight = False
+            if health.state == STATE_HALF_OPEN:
+                # 探测失败：冷却时间翻倍
+                self._trip(health, now, min(cfg["max_open_seconds"], max(health.open_seconds, cfg["open_seconds"]) * 2))
+            elif health.state == STATE_CLOSED:
+                rate = health.success_rate()
+                too_many = health.consecutive_failures >= cfg["failure_threshold"]
+                too_often = (len(health.samples) >= cfg["min_samples"] and rate is not None
+                             and 1.0 - rate > cfg["failure_rate_threshold"])
+                if too_many or too_often:
+                    self._trip(health, now, cfg["open_seconds"])
+
+    def _trip(self, health: _ProviderHealth, now: float, open_seconds: float) -> None:
+        # 调用方需持有 self._lock
+        health.state = STATE_OPEN
+        health.open_seconds = open_seconds
+        health.open_until = now + open_seconds
+        health.counters["trips"] += 1
+        print(f"🔌 图片 provider {health.name} 熔断 {open_seconds:.0f}s（连续失败 {health.consecutive_failures} 次：{health.last_error[:80]}）")
+
+    def force_open(self, provider: str, seconds: Optional[float] = None) -> None:
+        """手动熔断（运维用），默认使用 open_seconds"""
+        with self._lock:
+            health = self._get(provider)
+            self._trip(health, time.time(), seconds if seconds is not None else self.config["open_seconds"])
+
+    def reset(self, provider: Optional[str] = None) -> None:
+        """清空统计并关闭熔断；provider 为 None 时重置全部"""
+        with self._lock:
+            names = [provider] if provider else list(self._health.keys())
+            for name in names:
+                self._health[name] = _ProviderHealth(name)
+        print(f"🔄 已重置图片 provider 路由状态：{provider or '全部'}")
+
+    def get_stats(self) -> Dict:
+        cfg = self.config
+        now = time.time()
+        providers = {}
+        with self._lock:
+            for name, health in self._health.items():
+                health.prune(now, cfg)
+                self._refresh_state(health, now)
+                latencies = health.latencies()
+                rate = health.success_rate()
+                score = health.score(cfg)
+                p50 = _percentile(latencies, 0.5)
+                p95 = _percentile(latencies, 0.95)
+                providers[name] = dict(
+                    health.counters,
+                    state=health.state,
+                    samples=len(health.samples),
+                    success_rate=round(rate, 3) if rate is not None else None,
+                    p50_ms=round(p50 * 1000, 1) if p50 is not None else None,
+                    p95_ms=round(p95 * 1000, 1) if p95 is not None else None,
+                    # 成功率为 0 时期望耗时为无穷大，JSON 中以 None 表示
+                    score_ms=round(score * 1000, 1) if score is not None and score != float("inf") else None,
+                    consecutive_failures=health.consecutive_failures,
+                    open_remaining_seconds=round(max(0.0, health.open_until - now), 1) if health.state == STATE_OPEN else 0.0,
+                    last_error=health.last_error,
+                )
+        return {
+            "enabled": cfg["enabled"],
+            "candidates": cfg["candidates"] or "all",
+            "providers": providers,
+        }
+
+
+image_provider_router = ProviderRouter(IMAGE_PROVIDERS, PROVIDER_ROUTER_CONFIG)
+
+
+def get_provider_router_stats() -> Dict:
+    return image_provider_router.get_stats()
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+按 provider + API Key 的令牌桶限速器（图片生成等有严格速率限制的上游）。
+
+- 令牌桶：按 rate 匀速补充令牌，最多积攒 burst 个（允许短时突发）；
+- 预约制：acquire 在短暂的临界区内"预约"下一个令牌并算出需要等待的时间，
+  然后在不持有任何锁的情况下 sleep，排队中的请求互不阻塞、按预约先后放行；
+- 自适应：遇到 429 / Retry-After / X-RateLimit-Remaining=0 时暂停放行到指定时间，
+  并把实际速率减半（不低于 min_rate_factor），之后每次成功逐步恢复；
+  暂停前已拿到预约、正在 sleep 的请求醒来后会重新读取暂停状态，预约时间整体顺延暂停时长；
+- 跨进程：coordinator=file 时桶状态保存在本地文件中（flock 保护读改写），
+  同一台机器上的多个 worker 进程共享同一个桶；不支持 flock 的平台退回进程内共享。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from cancellation import OperationCancelled, cancellable_sleep
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ------------------------------
+# 限速配置（可通过环境变量调节）
+# ------------------------------
+RATE_LIMIT_CONFIG = {
+    # 桶状态的协调方式：file=本机多进程共享（默认），local=仅进程内
+    "coordinator": os.getenv("RATE_LIMIT_COORDINATOR", "file").lower(),
+    # coordinator=file 时桶状态文件所在目录
+    "state_dir": os.getenv("RATE_LIMIT_STATE_DIR", os.path.join(tempfile.gettempdir(), "dn_rate_limits")),
+    # 触发 429 后速率最多降到配置值的多少倍
+    "min_rate_factor": float(os.getenv("RATE_LIMIT_MIN_FACTOR", "0.25")),
+    # 每次成功后速率恢复的步长（倍数）
+    "recover_step": float(os.getenv("RATE_LIMIT_RECOVER_STEP", "0.1")),
+}
+
+# 各 provider 的速率：interval_seconds=平均每个请求的间隔，burst=最多可连续放行的请求数
+PROVIDER_RATE_LIMITS = {
+    "yunwu_image": {
+        "interval_seconds": float(os.getenv("YUNWU_MIN_INTERVAL_SECONDS", "12")),
+        "burst": max(1, int(os.getenv("YUNWU_RATE_BURST", "1"))),
+    },
+}
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """解析 Retry-After（秒数或 HTTP-date），无法解析返回 None"""
+    if value is None:
+        return None
+    raw = str(value).strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except (TypeError, ValueError):
+        pass
+    try:
+        dt = parsedate_to_datetime(raw)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if dt is None:
+        return None
+    return max(0.0, dt.timestamp() - time.time())
+
+
+class _LocalBucketStore:
+    """进程内的桶状态"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states: Dict[str, Dict] = {}
+
+    def update(self, key: str, mutate):
+        with self._lock:
+            state = self._states.setdefault(key, {})
+            return mutate(state)
+
+
+class _FileBucketStore:
+    """本机多进程共享的桶状态：每个桶一个 JSON 文件，读改写期间持有 flock（不在锁内 sleep）"""
+
+    def __init__(self, state_dir: str):
+        self._state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        # 同一进程内的线程先在这里串行，再去竞争文件锁
+        self._lock = threading.Lock()
+
+    def update(self, key: str, mutate):
+        path = os.path.join(self._state_dir, f"{key}.json")
+        with self._lock:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                raw = b""
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    raw += chunk
+                try:
+                    state = json.loads(raw.decode("utf-8")) if raw else {}
+                except ValueError:
+                    state = {}  # 文件损坏：从空状态重新开始
+                result = mutate(state)
+                data = json.dumps(state).encode("utf-8")
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+                return result
+            finally:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                finally:
+                    os.close(fd)
+
+
+class TokenBucketLimiter:
+    """单个 provider + API Key 的令牌桶（状态存放在 store 中，可跨进程共享）"""
+
+    def __init__(self, key: str, provider: str, interval_seconds: float, burst: int, store):
+        self.key = key
+        self.provider = provider
+        self.rate = 1.0 / interval_seconds if interval_seconds > 0 else 0.0  # 0 表示不限速
+        self.burst = max(1, burst)
+        self._store = store
+        self._stats_lock = threading.Lock()
+        self._stats = {"acquired": 0, "waited": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0,
+                       "cancelled": 0, "rate_limited": 0}
+
+    def _init_state(self, state: Dict, now: float) -> None:
+        if "ts" not in state:
+            state.update(tokens=float(self.burst), ts=now, factor=1.0)
+
+    def _refill(self, state: Dict, until: float) -> None:
+        """把令牌补充到 until 时刻（ts 在未来表示暂停中，不补充）；tokens 为负表示已有预约在排队"""
+        if until > state["ts"]:
+            state["tokens"] = min(float(self.burst), state["tokens"] + (until - state["ts"]) * self.rate * state["factor"])
+            state["ts"] = until
+
+    def _reserve(self, state: Dict):
+        """预约一个令牌，返回 (需要等待的秒数, 预约时已生效的暂停开始时间)（调用方在 store 临界区内执行）"""
+        now = time.time()
+        self._init_state(state, now)
+        self._refill(state, now)
+        base = state["ts"]  # 暂停中则从暂停结束时刻开始计算
+        state["tokens"] -= 1.0
+        ready_at = base + max(0.0, -state["tokens"]) / (self.rate * state["factor"])
+        return max(0.0, ready_at - now), state.get("pause_from")
+
+    @staticmethod
+    def _read_pause(state: Dict):
+        return state.get("pause_from"), state.get("pause_until")
+
+    def acquire(self, label: str = "") -> float:
+        """等待直到可以发出一个请求，返回实际等待的秒数；被取消时归还预约并抛出 OperationCancelled"""
+        if self.rate <= 0:
+            return 0.0
+        start = time.time()
+        wait, handled_pause = self._store.update(self.key, self._reserve)
+        if wait > 0:
+            print(f"⏳ {label or self.provider} 限速：排队等待 {wait:.1f}s")
+            ready_at = start + wait
+            try:
+                while True:
+                    cancellable_sleep(ready_at - time.time())
+                    # 等待期间出现了新的暂停（429）：预约时间整体顺延暂停时长，继续等待
+                    pause_from, pause_until = self._store.update(self.key, self._read_pause)
+                    if pause_from is None or pause_from == handled_pause or ready_at < pause_from:
+                        break
+                    handled_pause = pause_from
+                    ready_at += pause_until - pause_from
+                    print(f"⏳ {label or self.provider} 限速：上游要求暂停，再等待 {ready_at - time.time():.1f}s")
+            except OperationCancelled:
+                self._store.update(self.key, self._refund)
+                with self._stats_lock:
+                    self._stats["cancelled"] += 1
+                raise
+            wait = time.time() - start
+        with self._stats_lock:
+            wait_ms = wait * 1000
+            self._stats["acquired"] += 1
+            if wait > 0:
+                self._stats["waited"] += 1
+            self._stats["total_wait_ms"] += wait_ms
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+        return wait
+
+    def _refund(self, state: Dict) -> None:
+        now = time.time()
+        self._init_state(state, now)
+        self._refill(state, now)
+        state["tokens"] = min(float(self.burst), state["tokens"] + 1.0)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """上游返回 429：暂停放行 retry_after 秒（未知时按当前间隔的 2 倍），并把速率减半"""
+        min_factor = RATE_LIMIT_CONFIG["min_rate_factor"]
+
+        def mutate(state):
+            now = time.time()
+            self._init_state(state, now)
+            self._refill(state, now)
+            pause = retry_after if retry_after is not None else 2.0 / max(self.rate * state["factor"], 1e-6)
+            # 暂停期间不补充令牌，新的预约排在暂停结束之后；已拿到预约的请求醒来后按 pause_from/pause_until 顺延
+            state["ts"] = max(state["ts"], now + pause)
+            state["pause_from"], state["pause_until"] = now, now + pause
+            state["tokens"] = min(state["tokens"], 0.0)
+            state["factor"] = max(min_factor, state["factor"] * 0.5)
+            return state["factor"]
+
+        factor = self._store.update(self.key, mutate)
+        with self._stats_lock:
+            self._stats["rate_limited"] += 1
+        print(f"🚦 {self.provider} 触发速率限制：暂停放行，速率降至配置值的 {factor:.2f} 倍")
+
+    def on_success(self) -> None:
+        """请求成功：逐步恢复被 429 压低的速率"""
+        step = RATE_LIMIT_CONFIG["recover_step"]
+
+        def mutate(state):
+            now = time.time()
+            self._init_state(state, now)
+            self._refill(state, now)  # 先按旧速率结算，再调整速率
+            if state["factor"] < 1.0:
+                state["factor"] = min(1.0, state["factor"] + step)
+
+        self._store.update(self.key, mutate)
+
+    def observe_headers(self, headers) -> None:
+        """根据 X-RateLimit-Remaining/Reset 提前暂停：配额已用完时等到重置时间"""
+        try:
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset = headers.get("X-RateLimit-Reset")
+        except Exception:
+            return
+        if remaining is None or reset is None:
+            return
+        try:
+            if int(float(remaining)) > 0:
+                return
+            reset_value = float(reset)
+        except (TypeError, ValueError):
+            return
+        # Reset 既可能是剩余秒数，也可能是 Unix 时间戳
+        pause = reset_value - time.time() if reset_value > 1e9 else reset_value
+        if pause > 0:
+            self.on_rate_limited(pause)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["total_wait_ms"] = round(stats["total_wait_ms"], 1)
+        stats["max_wait_ms"] = round(stats["max_wait_ms"], 1)
+        stats["rate_per_second"] = round(self.rate, 4)
+        stats["burst"] = self.burst
+        return stats
+
+
+_limiters: Dict[str, TokenBucketLimiter] = {}
+_limiters_lock = threading.Lock()
+_store = None
+
+
+def _get_store():
+    global _store
+    if _store is None:
+        if RATE_LIMIT_CONFIG["coordinator"] == "file" and fcntl is not None:
+            try:
+                _store = _FileBucketStore(RATE_LIMIT_CONFIG["state_dir"])
+            except OSError as e:
+                print(f"⚠️ 限速状态目录不可用，改为进程内限速：{e}")
+                _store = _LocalBucketStore()
+        else:
+            _store = _LocalBucketStore()
+    return _store
+
+
+def get_rate_limiter(provider: str, api_key: str = "") -> TokenBucketLimiter:
+    """获取 provider + API Key 对应的限速器（Key 只以摘要形式出现在桶名/状态文件名中）"""
+    key_digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+    key = f"{provider}-{key_digest}"
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limits = PROVIDER_RATE_LIMITS.get(provider, {"interval_seconds": 0, "burst": 1})
+            limiter = TokenBucketLimiter(key, provider, limits["interval_seconds"], limits["burst"], _get_store())
+            _limiters[key] = limiter
+        return limiter
+
+
+def get_rate_limit_stats() -> Dict:
+    """各限速器的放行/等待/429 计数（本进程视角）"""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {
+        "coordinator": "file" if isinstance(_store, _FileBucketStore) else "local",
+        "limiters": {key: limiter.stats() for key, limiter in limiters.items()},
+    }
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+图生图参考图的编码结果缓存：同一局游戏的每张场景图都会带上同样的主角三视图，
+缓存缩放 / 压缩 / base64 编码后的结果，避免每次请求都重新读盘、缩放、编码几 MB 的图片。
+
+- 键：参考图绝对路径 + 编码方式（如 data URI 大小上限）；条目记录文件的 mtime_ns 与大小，
+  文件被重新生成（mtime / 大小变化）时视为失效并重新编码；
+- 容量：按编码结果的字节数计算，超过 max_bytes 时按 LRU 淘汰；单个结果超过上限时不缓存；
+- 编码失败（返回空串）不缓存。
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+
+# ------------------------------
+# 参考图编码缓存配置（可通过环境变量调节）
+# ------------------------------
+REFERENCE_CACHE_CONFIG = {
+    "enabled": os.getenv("REFERENCE_PAYLOAD_CACHE_ENABLED", "true").lower() == "true",
+    # 编码结果（data URI / base64 字符串）的总字节上限
+    "max_bytes": max(0, int(os.getenv("REFERENCE_PAYLOAD_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))),
+}
+
+
+class ReferencePayloadCache:
+    """本地参考图 -> 编码结果的内存 LRU 缓存（按文件 mtime / 大小失效）"""
+
+    def __init__(self, config: Dict):
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Tuple[int, int], str]]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, path: str, variant: str, build: Callable[[bytes], str]) -> str:
+        """
+        返回 build(文件内容) 的结果；文件未变化时直接返回缓存。
+        variant 区分同一文件的不同编码方式；读文件失败时抛出 OSError（由调用方处理）。
+        """
+        path = os.path.abspath(path)
+        key = (path, variant)
+        if self.config["enabled"]:
+            st = os.stat(path)
+            signature = (st.st_mtime_ns, st.st_size)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == signature:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                if entry is not None:
+                    self._stats["invalidations"] += 1
+                self._stats["misses"] += 1
+        with open(path, "rb") as f:
+            # 以实际读到的文件状态作为签名：读取期间文件被替换时，下次请求会重新编码
+            st = os.fstat(f.fileno())
+            raw = f.read()
+        payload = build(raw)
+        if payload and self.config["enabled"]:
+            self._put(key, (st.st_mtime_ns, st.st_size), payload)
+        return payload
+
+    def _put(self, key: Tuple[str, str], signature: Tuple[int, int], payload: str) -> None:
+        size = len(payload)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            if size > self.config["max_bytes"]:
+                return
+            self._entries[key] = (signature, payload)
+            self._bytes += size
+            while self._bytes > self.config["max_bytes"] and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats["evictions"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(entries=len(self._entries), bytes=self._bytes)
+        stats.update(enabled=self.config["enabled"], max_bytes=self.config["max_bytes"])
+        return stats
+
+
+reference_payload_cache = ReferencePayloadCache(REFERENCE_CACHE_CONFIG)
+
+
+def get_reference_cache_stats() -> Dict:
+    return reference_payload_cache.stats()
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""
+预生成缓存的并发结构：按 scene_id 分片加锁。
+
+- 顶层索引锁只在插入/删除/遍历场景时短暂持有；
+- 每个场景有独立的条目锁（TrackedLock），同一场景内的读写互斥，不同场景互不阻塞；
+- 每个选项有一个绑定在场景锁上的条件变量，状态变化时唤醒等待者，替代 sleep 轮询；
+- 所有锁的等待时间/持有时间按类别（index/scene）汇总，可通过 get_lock_stats() 导出；
+- 淘汰按 LRU 进行，受总字节预算、每个玩家的配额与 TTL 约束，并统计命中/未命中/淘汰次数；
+- 条目按 owner（玩家 game_id）归属到会话，会话整体空闲超时后一并清理。
+
+锁顺序：允许“持有场景锁 → 获取索引锁”，禁止反向（持有索引锁时不得获取场景锁）。
+"""
+import json
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+# ------------------------------
+# 缓存容量配置（可通过环境变量调节）
+# ------------------------------
+SCENE_CACHE_CONFIG = {
+    # 所有场景数据的总字节预算（按 JSON 序列化后的大小估算）
+    "max_bytes": max(0, int(os.getenv("PREGEN_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))),
+    # 场景条目数量上限（兜底，0 表示不限）
+    "max_scenes": max(0, int(os.getenv("PREGEN_CACHE_MAX_SCENES", "512"))),
+    # 单个玩家（game_id）的字节配额，0 表示不限
+    "player_max_bytes": max(0, int(os.getenv("PREGEN_CACHE_PLAYER_MAX_BYTES", str(8 * 1024 * 1024)))),
+    # 单个玩家（game_id）的场景数配额，0 表示不限
+    "player_max_scenes": max(0, int(os.getenv("PREGEN_CACHE_PLAYER_MAX_SCENES", "12"))),
+    # 场景超过该秒数未被访问/写入即过期，0 表示不过期
+    "ttl_seconds": float(os.getenv("PREGEN_CACHE_TTL_SECONDS", "1800")),
+    # 玩家会话（game_id）所有场景都超过该秒数无活动时，整体清理该会话，0 表示不清理
+    "session_idle_seconds": float(os.getenv("PREGEN_SESSION_IDLE_SECONDS", "900")),
+}
+
+# 不计入字节估算的字段（线程/事件等运行时对象）
+_UNSIZED_KEYS = ('generation_events', 'layer2_thread', 'cancel_token', 'option_cancel_tokens', 'layer2_cancel_token')
+
+
+def estimate_entry_bytes(entry: Dict) -> int:
+    """估算条目占用的字节数（各数据字段 JSON 序列化后的长度之和）"""
+    total = 0
+    for key, value in list(entry.items()):
+        if key in _UNSIZED_KEYS:
+            continue
+        try:
+            total += len(json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'))
+        except (TypeError, ValueError, RuntimeError):
+            # 序列化期间被其他线程修改等情况：跳过该字段，下次记账时再修正
+            continue
+    return total
+
+
+class LockWaitStats:
+    """按类别汇总锁的获取次数、竞争次数、等待时间与持有时间"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict] = {}
+
+    def _bucket(self, category: str) -> Dict:
+        bucket = self._stats.get(category)
+        if bucket is None:
+            bucket = {
+                "acquisitions": 0,
+                "contended": 0,  # 首次尝试未能立即拿到锁的次数
+                "timeouts": 0,
+                "total_wait_ms": 0.0,
+                "max_wait_ms": 0.0,
+                "total_hold_ms": 0.0,
+                "max_hold_ms": 0.0,
+            }
+            self._stats[category] = bucket
+        return bucket
+
+    def record_acquire(self, category: str, wait_seconds: float, contended: bool, acquired: bool):
+        wait_ms = wait_seconds * 1000
+        with self._lock:
+            bucket = self._bucket(category)
+            if acquired:
+                bucket["acquisitions"] += 1
+            else:
+                bucket["timeouts"] += 1
+            if contended:
+                bucket["contended"] += 1
+            bucket["total_wait_ms"] += wait_ms
+            if wait_ms > bucket["max_wait_ms"]:
+                bucket["max_wait_ms"] = wait_ms
+
+    def record_hold(self, category: str, hold_seconds: float):
+        hold_ms = hold_seconds * 1000
+        with self._lock:
+            bucket = self._bucket(category)
+            bucket["total_hold_ms"] += hold_ms
+            if hold_ms > bucket["max_hold_ms"]:
+                bucket["max_hold_ms"] = hold_ms
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            result = {}
+            for category, bucket in self._stats.items():
+                item = dict(bucket)
+                count = item["acquisitions"] or 1
+                item["avg_wait_ms"] = round(item["total_wait_ms"] / count, 3)
+                item["avg_hold_ms"] = round(item["total_hold_ms"] / count, 3)
+                item["contention_rate"] = round(item["contended"] / count, 4)
+                for key in ("total_wait_ms", "max_wait_ms", "total_hold_ms", "max_hold_ms"):
+                    item[key] = round(item[key], 3)
+                result[category] = item
+            return result
+
+
+lock_wait_stats = LockWaitStats()
+
+
+class TrackedLock:
+    """
+    为 threading.Lock 增加“谁持有锁/持有多久/当前堆栈”的追踪能力，并记录等待时间。
+    目的：定位缓存锁被长时间持有导致的“图片生成后无法写入缓存”问题。
+    """
+
+    def __init__(self, name: str = "cache_lock", category: str = "scene"):
+        self._lock = threading.Lock()
+        self.name = name
+        self.category = category
+        self.holder_ident = None
+        self.holder_name = None
+        self.holder_since = None
+        self._last_stack_dump_ts = 0.0
+        # 绑定在本锁上的条件变量（option_index -> Condition，None 表示场景级），由 SceneCache 管理
+        self.conditions: Dict[Optional[int], threading.Condition] = {}
+
+    def acquire(self, blocking: bool = True, timeout: float = -1):
+        # 先无阻塞尝试：拿到即视为无竞争，避免为每次加锁计时
+        got = self._lock.acquire(False)
+        contended = not got
+        wait_seconds = 0.0
+        if not got and blocking:
+            start = time.perf_counter()
+            # 兼容 threading.Lock.acquire(blocking=True, timeout=-1)
+            if timeout is None or timeout == -1:
+                got = self._lock.acquire()
+            else:
+                got = self._lock.acquire(True, timeout)
+            wait_seconds = time.perf_counter() - start
+        lock_wait_stats.record_acquire(self.category, wait_seconds, contended, got)
+
+        if got:
+            self.holder_ident = threading.get_ident()
+            self.holder_name = threading.current_thread().name
+            self.holder_since = time.time()
+
+        return got
+
+    def release(self):
+        if self.holder_since is not None:
+            lock_wait_stats.record_hold(self.category, time.time() - self.holder_since)
+        self.holder_ident = None
+        self.holder_name = None
+        self.holder_since = None
+        return self._lock.release()
+
+    def _is_owned(self):
+        # threading.Condition 用于判断调用方是否持有锁
+        return self.holder_ident == threading.get_ident()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
+
+    def dump_holder_stack(self, limit: int = 40, min_interval_seconds: float = 2.0):
+        """
+        返回当前持锁线程的“实时堆栈”（不是获取锁时的堆栈）。
+        为避免刷屏，默认 2 秒最多输出一次（由调用方 print）。
+        """
+        import sys
+        import traceback
+
+        if not self.holder_ident:
+            return None
+
+        now = time.time()
+        if now - self._last_stack_dump_ts < min_interval_seconds:
+            return None
+
+        frames = sys._current_frames()
+        frame = frames.get(self.holder_ident)
+        if frame is None:
+            self._last_stack_dump_ts = now
+            return f"[{self.name}] 无法获取持锁线程堆栈（holder_ident={self.holder_ident})"
+
+        stack = "".join(traceback.format_stack(frame, limit=limit))
+        self._last_stack_dump_ts = now
+        return stack
+
+
+class SceneCache:
+    """
+    scene_id -> 缓存条目 的并发映射（用法与 dict 基本一致）。
+    读操作（get / in / keys）不加锁；插入、删除、淘汰走短暂持有的索引锁；
+    修改某个条目的内容前需持有该场景的锁：with cache.scene_lock(scene_id): ...
+    条目按 LRU 顺序保存：lookup()/touch() 刷新访问时间，account() 在写入后更新字节数。
+    """
+
+    def __init__(self, config: Optional[Dict] = None):
+        self.config = dict(SCENE_CACHE_CONFIG, **(config or {}))
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        # scene_id -> {"bytes", "owner", "last_active"}
+        self._meta: Dict[str, Dict] = {}
+        # owner(game_id) -> 最近活跃时间
+        self._sessions: Dict[str, float] = {}
+        self._total_bytes = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "inserts": 0,
+            "evictions": {"session_idle": 0, "ttl": 0, "player_quota": 0, "budget": 0, "explicit": 0},
+        }
+        self._index_lock = TrackedLock("cache_index", category="index")
+        # 场景锁按需创建：弱引用表保证同一时刻同一 scene_id 只有一把锁，
+        # _entry_locks 在条目存在期间持有强引用，条目删除且无人持锁后自动回收
+        self._locks_guard = threading.Lock()
+        self._scene_locks = weakref.WeakValueDictionary()
+        self._entry_locks: Dict[str, TrackedLock] = {}
+
+    # ---------- 锁 ----------
+    def scene_lock(self, scene_id) -> TrackedLock:
+        """获取 scene_id 的条目锁（同一 scene_id 始终返回同一把锁）"""
+        with self._locks_guard:
+            lock = self._scene_locks.get(scene_id)
+            if lock is None:
+                lock = TrackedLock(f"scene:{scene_id}", category="scene")
+                self._scene_locks[scene_id] = lock
+            return lock
+
+    def _condition(self, lock: TrackedLock, option_index=None) -> threading.Condition:
+        # 调用方需持有 lock
+        cond = lock.conditions.get(option_index)
+        if cond is None:
+            cond = threading.Condition(lock)
+            lock.conditions[option_index] = cond
+        return cond
+
+    def notify_option(self, scene_id, option_index=None):
+        """唤醒等待该选项（以及整个场景）的线程（调用方需持有场景锁）"""
+        lock = self.scene_lock(scene_id)
+        if option_index is not None:
+            self._condition(lock, option_index).notify_all()
+        self._condition(lock, None).notify_all()
+
+    def _notify_all_conditions(self, scene_id):
+        lock = self.scene_lock(scene_id)
+        if lock._is_owned():
+            for cond in list(lock.conditions.values()):
+                cond.notify_all()
+            return
+        with lock:
+            for cond in list(lock.conditions.values()):
+                cond.notify_all()
+
+    def wait_until(self, scene_id, predicate: Callable[[Optional[Dict]], object], timeout: float, option_index=None):
+        """
+        在场景锁内等待 predicate(entry) 为真，返回最后一次 predicate 的结果（超时则为假值）。
+        option_index 为 None 时等待该场景任意选项的状态变化。
+        predicate 在持锁状态下调用，entry 可能为 None（场景已被清理）。
+        """
+        lock = self.scene_lock(scene_id)
+        deadline = time.monotonic() + max(0.0, timeout)
+        with lock:
+            cond = self._condition(lock, option_index)
+            while True:
+                result = predicate(self._entries.get(scene_id))
+                if result:
+                    return result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return result
+                cond.wait(remaining)
+
+    # ---------- 记账 ----------
+    def _mark_active(self, scene_id, now):
+        # 调用方需持有索引锁
+        meta = self._meta[scene_id]
+        meta["last_active"] = now
+        if meta["owner"] is not None:
+            self._sessions[meta["owner"]] = now
+
+    def _insert_locked(self, scene_id, entry, lock):
+        # 调用方需持有索引锁
+        old = self._meta.pop(scene_id, None)
+        if old:
+            self._total_bytes -= old["bytes"]
+        size = estimate_entry_bytes(entry)
+        self._entries[scene_id] = entry
+        self._entries.move_to_end(scene_id)
+        self._meta[scene_id] = {"bytes": size, "owner": entry.get('owner'), "last_active": 0.0}
+        self._mark_active(scene_id, time.time())
+        self._total_bytes += size
+        self._entry_locks[scene_id] = lock
+        self._counters["inserts"] += 1
+
+    def _remove_locked(self, scene_id):
+        # 调用方需持有索引锁
+        entry = self._entries.pop(scene_id, None)
+        meta = self._meta.pop(scene_id, None)
+        if meta:
+            self._total_bytes -= meta["bytes"]
+        self._entry_locks.pop(scene_id, None)
+        return entry
+
+    def account(self, scene_id, entry=None):
+        """条目内容写入后重新估算字节数并刷新活跃时间（建议在持有场景锁时调用）"""
+        entry = entry if entry is not None else self._entries.get(scene_id)
+        if entry is None:
+            return
+        size = estimate_entry_bytes(entry)
+        with self._index_lock:
+            meta = self._meta.get(scene_id)
+            if meta is None or self._entries.get(scene_id) is not entry:
+                return
+            self._total_bytes += size - meta["bytes"]
+            meta["bytes"] = size
+            meta["owner"] = entry.get('owner', meta["owner"])
+            self._mark_active(scene_id, time.time())
+
+    def touch(self, scene_id):
+        """刷新 LRU 顺序与活跃时间"""
+        with self._index_lock:
+            if scene_id in self._entries:
+                self._entries.move_to_end(scene_id)
+                self._mark_active(scene_id, time.time())
+
+    def lookup(self, scene_id):
+        """对外请求的缓存查找：统计命中/未命中并刷新 LRU 顺序"""
+        with self._index_lock:
+            entry = self._entries.get(scene_id)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["hits"] += 1
+            self._entries.move_to_end(scene_id)
+            self._mark_active(scene_id, time.time())
+            return entry
+
+    # ---------- 索引 ----------
+    def __setitem__(self, scene_id, entry):
+        lock = self.scene_lock(scene_id)
+        with self._index_lock:
+            self._insert_locked(scene_id, entry, lock)
+
+    def setdefault(self, scene_id, entry):
+        lock = self.scene_lock(scene_id)
+        with self._index_lock:
+            existing = self._entries.get(scene_id)
+            if existing is not None:
+                return existing
+            self._insert_locked(scene_id, entry, lock)
+            return entry
+
+    def pop(self, scene_id, default=None):
+        with self._index_lock:
+            entry = self._remove_locked(scene_id)
+            if entry is not None:
+                self._counters["evictions"]["explicit"] += 1
+        # 唤醒等待者，让它们看到条目已被清理（在索引锁外进行，遵守锁顺序）
+        self._notify_all_conditions(scene_id)
+        return entry if entry is not None else default
+
+    def __delitem__(self, scene_id):
+        if scene_id not in self._entries:
+            raise KeyError(scene_id)
+        self.pop(scene_id)
+
+    def evict(self, keep=()) -> list:
+        """
+        按 会话空闲 → TTL → 玩家配额 → 总预算 的顺序淘汰条目（同一规则内按 LRU，keep 中的 scene_id 不淘汰）。
+        只在索引锁内摘除条目，返回 [(scene_id, entry, reason)]；取消后台任务由调用方在锁外完成。
+        不要在持有任何场景锁时调用。
+        """
+        cfg = self.config
+        removed = []
+        now = time.time()
+        with self._index_lock:
+            def drop(scene_id, reason):
+                removed.append((scene_id, self._remove_locked(scene_id), reason))
+                self._counters["evictions"][reason] += 1
+
+            # 0) 会话空闲：玩家长时间没有任何活动，清理其全部场景（包括 initial）
+            if cfg["session_idle_seconds"] > 0:
+                idle_owners = {
+                    owner for owner, last_active in self._sessions.items()
+                    if now - last_active > cfg["session_idle_seconds"]
+                }
+                if idle_owners:
+                    for scene_id in list(self._entries.keys()):
+                        if scene_id not in keep and self._meta[scene_id]["owner"] in idle_owners:
+                            drop(scene_id, "session_idle")
+
+            # 1) TTL：长时间无访问/写入的条目
+            if cfg["ttl_seconds"] > 0:
+                for scene_id in list(self._entries.keys()):
+                    if scene_id not in keep and now - self._meta[scene_id]["last_active"] > cfg["ttl_seconds"]:
+                        drop(scene_id, "ttl")
+
+            # 2) 玩家配额：同一 owner 超出场景数/字节配额时淘汰其最久未用的条目
+            if cfg["player_max_scenes"] or cfg["player_max_bytes"]:
+                usage = {}
+                for scene_id in self._entries:
+                    meta = self._meta[scene_id]
+                    if meta["owner"] is None:
+                        continue
+                    count, size = usage.get(meta["owner"], (0, 0))
+                    usage[meta["owner"]] = (count + 1, size + meta["bytes"])
+                for scene_id in list(self._entries.keys()):
+                    meta = self._meta[scene_id]
+                    owner = meta["owner"]
+                    if owner is None or scene_id in keep:
+                        continue
+                    count, size = usage[owner]
+                    over_count = cfg["player_max_scenes"] and count > cfg["player_max_scenes"]
+                    over_bytes = cfg["player_max_bytes"] and size > cfg["player_max_bytes"]
+                    if over_count or over_bytes:
+                        usage[owner] = (count - 1, size - meta["bytes"])
+                        drop(scene_id, "player_quota")
+
+            # 3) 总预算：字节数 / 条目数超限时从最久未用的开始淘汰
+            def over_budget():
+                if cfg["max_bytes"] and self._total_bytes > cfg["max_bytes"]:
+                    return True
+                return bool(cfg["max_scenes"]) and len(self._entries) > cfg["max_scenes"]
+
+            if over_budget():
+                for scene_id in list(self._entries.keys()):
+                    if not over_budget():
+                        break
+                    if scene_id not in keep:
+                        drop(scene_id, "budget")
+
+            # 已没有任何条目的会话不再跟踪
+            live_owners = {meta["owner"] for meta in self._meta.values()}
+            for owner in list(self._sessions.keys()):
+                if owner not in live_owners:
+                    del self._sessions[owner]
+        for scene_id, _, _ in removed:
+            self._notify_all_conditions(scene_id)
+        return removed
+
+    def __getitem__(self, scene_id):
+        return self._entries[scene_id]
+
+    def get(self, scene_id, default=None):
+        return self._entries.get(scene_id, default)
+
+    def __contains__(self, scene_id):
+        return scene_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self._index_lock:
+            return list(self._entries.keys())
+
+    def get_stats(self) -> Dict:
+        """容量与命中/未命中/淘汰统计"""
+        with self._index_lock:
+            counters = dict(self._counters, evictions=dict(self._counters["evictions"]))
+            owners = {}
+            for meta in self._meta.values():
+                if meta["owner"] is not None:
+                    owners[meta["owner"]] = owners.get(meta["owner"], 0) + 1
+            stats = {
+                "scenes": len(self._entries),
+                "bytes": self._total_bytes,
+                "players": len(owners),
+                "scenes_per_player_max": max(owners.values()) if owners else 0,
+            }
+        lookups = counters["hits"] + counters["misses"]
+        stats.update(counters)
+        stats["hit_rate"] = round(counters["hits"] / lookups, 4) if lookups else 0.0
+        stats["config"] = dict(self.config)
+        return stats
+
+    def get_lock_stats(self) -> Dict:
+        """锁等待/持有统计 + 当前场景锁数量"""
+        with self._locks_guard:
+            live_locks = len(self._scene_locks)
+        return {
+            "by_category": lock_wait_stats.snapshot(),
+            "scenes": len(self._entries),
+            "live_scene_locks": live_locks,
+        }
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+单飞（single-flight）请求合并：同一键的重复请求在进行中时只执行一次，其余调用方共享结果。
+
+- 第一个调用方发起执行（在独立线程中运行，不占用调用方线程），后到的调用方挂到同一个 Future 上；
+- 执行使用独立的取消令牌：任一调用方被取消只会让它自己停止等待，
+  只有所有等待方都离开时才取消执行本身（例如第二层推测生成被取消时，玩家仍在等待的同一请求不受影响）；
+- 执行结束后立即移除，不缓存结果（结果复用由 llm_cache / 图片缓存负责）；
+- do() 供线程调用，do_async() 供 asyncio 调用（执行作为事件循环中的任务运行），
+  两者共用同一张进行中表，同步与异步调用方之间同样会合并；
+- 合并次数等指标通过 get_single_flight_stats() 导出。
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Hashable
+
+from cancellation import CancelToken, OperationCancelled, cancel_scope, current_token, run_cancellable
+
+
+class _Flight:
+    """一次进行中的执行"""
+
+    __slots__ = ("future", "token", "waiters", "abandoned", "task")
+
+    def __init__(self):
+        self.future = Future()
+        self.token = CancelToken()
+        self.waiters = 0
+        self.abandoned = False  # 所有等待方都已离开，执行即将被取消，新的调用方不应再加入
+        self.task = None  # do_async 发起的执行任务（事件循环只弱引用任务，需在此持有）
+
+
+class SingleFlight:
+    """按键合并进行中的重复调用"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._stats = {"executions": 0, "coalesced": 0, "abandoned": 0}
+
+    def do(self, key: Hashable, fn: Callable, label: str = ""):
+        """执行 fn（或加入进行中的同键执行）并返回其结果；当前令牌取消时抛出 OperationCancelled"""
+        caller_token = current_token()
+        flight, leader = self._join(key, label)
+        if leader:
+            threading.Thread(target=self._run, args=(key, flight, fn),
+                             name=f"single-flight-{self.name}", daemon=True).start()
+        try:
+            return self._wait(flight, caller_token)
+        finally:
+            self._leave(flight, label)
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable], label: str = "",
+                       cancel_token: CancelToken = None):
+        """do() 的 asyncio 版本：fn 返回协程；cancel_token 取消时抛出 OperationCancelled"""
+        flight, leader = self._join(key, label)
+        if leader:
+            flight.task = asyncio.ensure_future(self._run_async(key, flight, fn))
+        result = asyncio.wrap_future(flight.future)
+        # 提前离开时结果无人读取，避免事件循环告警 "exception was never retrieved"
+        result.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            # shield：调用方被取消只停止自己的等待，不取消共享的 Future
+            return await run_cancellable(asyncio.shield(result), cancel_token)
+        finally:
+            self._leave(flight, label)
+
+    def _join(self, key: Hashable, label: str):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None or flight.abandoned
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._stats["executions"] += 1
+            else:
+                self._stats["coalesced"] += 1
+            flight.waiters += 1
+        if not leader:
+            print(f"🔗 {label or self.name} 与进行中的相同请求合并，等待其结果")
+        return flight, leader
+
+    def _leave(self, flight: _Flight, label: str) -> None:
+        with self._lock:
+            flight.waiters -= 1
+            abandon = flight.waiters == 0 and not flight.future.done()
+            if abandon:
+                flight.abandoned = True
+                self._stats["abandoned"] += 1
+        if abandon:
+            flight.token.cancel(f"{label or self.name} 的所有等待方均已取消")
+
+    def _run(self, key: Hashable, flight: _Flight, fn: Callable) -> None:
+        try:
+            with cancel_scope(flight.token):
+                result = fn()
+            flight.future.set_result(result)
+        except BaseException as e:
+            flight.future.set_exception(e)
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    async def _run_async(self, key: Hashable, flight: _Flight, fn: Callable[[], Awaitable]) -> None:
+        try:
+            flight.future.set_result(await run_cancellable(fn(), flight.token))
+        except asyncio.CancelledError:
+            # 事件循环关闭等情况：同步等待方不应收到 CancelledError（BaseException）
+            flight.future.set_exception(OperationCancelled(f"{self.name} 的执行任务被取消"))
+            raise
+        except BaseException as e:
+            flight.future.set_exception(e)
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    @staticmethod
+    def _wait(flight: _Flight, caller_token: CancelToken):
+        # 执行完成或调用方自己的令牌被取消，哪个先发生就先返回
+        wake = threading.Event()
+        flight.future.add_done_callback(lambda _: wake.set())
+        remove = caller_token.add_callback(wake.set) if caller_token is not None else None
+        try:
+            wake.wait()
+            if flight.future.done():
+                return flight.future.result()
+            caller_token.raise_if_cancelled()
+        finally:
+            if remove is not None:
+                remove()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._flights)
+        return stats
+
+
+llm_flights = SingleFlight("llm")
+image_flights = SingleFlight("image")
+
+
+def get_single_flight_stats() -> Dict:
+    return {"llm": llm_flights.stats(), "image": image_flights.stats()}
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+图片存储空间管理：让 image_cache/ 与 initial/main_character/ 的磁盘占用在持续流量下保持平稳。
+
+- 容量预算：两个目录合计超过 max_bytes 时，按最近访问时间（LRU）淘汰到 max_bytes * target_ratio；
+- 过期：超过 max_age_seconds 未被访问的条目直接淘汰（0 表示不按时间淘汰）；
+- 淘汰单位：image_cache 下的单个图片文件（连同其 WebP/缩略图变体）；
+  主角形象按游戏整目录淘汰（三视图不会只剩一部分）；
+- 访问时间：/image_cache 与 /initial/main_character 每次命中都会记录（内存中），
+  压缩时写回文件 atime，重启后仍按 LRU 淘汰；
+- 固定（pin）：当前会话的游戏（生成主角形象时固定，访问时续期 pin_ttl_seconds）
+  以及存档中引用到的游戏 / 图片不会被淘汰；
+- 后台压缩：每 compact_interval_seconds 运行一次；写入量估计超出预算时提前唤醒；
+  同时清理残留的临时文件与指向已淘汰图片的请求键索引；
+  首次写入 / 访问时在当前进程中自动启动（gunicorn 等 WSGI 服务器、fork 出的 worker 同样生效）。
+"""
+import os
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from image_store import IMAGE_MIME_TYPES, image_store
+from image_variants import VARIANTS_DIRNAME
+
+# ------------------------------
+# 图片存储空间配置（可通过环境变量调节）
+# ------------------------------
+STORAGE_CONFIG = {
+    "enabled": os.getenv("IMAGE_STORAGE_ENABLED", "true").lower() == "true",
+    # image_cache + initial/main_character 合计占用上限（MB）
+    "max_bytes": int(float(os.getenv("IMAGE_STORAGE_MAX_MB", "2048")) * 1024 * 1024),
+    # 超限后淘汰到上限的多少比例
+    "target_ratio": float(os.getenv("IMAGE_STORAGE_TARGET_RATIO", "0.9")),
+    # 超过多少天未访问直接淘汰，0 表示不按时间淘汰
+    "max_age_seconds": float(os.getenv("IMAGE_STORAGE_MAX_AGE_DAYS", "30")) * 24 * 3600,
+    # 后台压缩间隔（秒）
+    "compact_interval_seconds": float(os.getenv("IMAGE_STORAGE_COMPACT_INTERVAL_SECONDS", "600")),
+    # 游戏固定的有效期（秒），期间每次访问该游戏的主角形象都会续期
+    "pin_ttl_seconds": float(os.getenv("IMAGE_STORAGE_PIN_TTL_SECONDS", str(6 * 3600))),
+    # 存档中引用的游戏 / 图片不淘汰
+    "protect_saves": os.getenv("IMAGE_STORAGE_PROTECT_SAVES", "true").lower() == "true",
+}
+
+MAIN_CHARACTER_ROOT = Path("initial") / "main_character"
+SAVE_DIR = "saves"
+
+# 残留临时文件超过该时间视为写入中断，可以删除
+_STALE_TMP_SECONDS = 3600
+
+_SAVE_IMAGE_REF = re.compile(r"/?image_cache/([A-Za-z0-9_\-]+\.[A-Za-z0-9]+)")
+_SAVE_GAME_REF = re.compile(r"main_character/([A-Za-z0-9_\-]+)/|\"game_id\"\s*:\s*\"([A-Za-z0-9_\-]+)\"")
+
+
+class StorageManager:
+    """按容量预算与访问时间淘汰图片文件"""
+
+    def __init__(self, config: Dict, cache_root: Path, main_character_root: Path, save_dir: str):
+        self.config = config
+        self.cache_root = Path(cache_root)
+        self.main_character_root = Path(main_character_root)
+        self.save_dir = save_dir
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started_pid = None  # 已启动后台线程的进程（fork 后的子进程需要重新启动）
+        self._access: Dict[tuple, float] = {}  # ("blob", 文件名) / ("game", game_id) -> 最近访问时间
+        self._pins: Dict[str, float] = {}  # game_id -> 固定到期时间
+        self._estimated_bytes = 0
+        self._stats = {"runs": 0, "evicted_files": 0, "evicted_games": 0, "evicted_bytes": 0,
+                       "expired": 0, "stale_index_entries": 0, "last_run": None, "last_duration_ms": None}
+
+    # ---------- 访问与固定 ----------
+
+    def touch_blob(self, filename: str) -> None:
+        self._ensure_started()
+        with self._lock:
+            self._access[("blob", filename)] = time.time()
+
+    def touch_game(self, game_id: str) -> None:
+        self._ensure_started()
+        now = time.time()
+        with self._lock:
+            self._access[("game", game_id)] = now
+            if game_id in self._pins:
+                self._pins[game_id] = now + self.config["pin_ttl_seconds"]
+
+    def pin(self, game_id: str) -> None:
+        """固定游戏的主角形象（当前会话），pin_ttl_seconds 内无访问后自动解除"""
+        if not game_id:
+            return
+        self._ensure_started()
+        now = time.time()
+        with self._lock:
+            self._pins[game_id] = now + self.config["pin_ttl_seconds"]
+            self._access[("game", game_id)] = now
+
+    def unpin(self, game_id: str) -> None:
+        with self._lock:
+            self._pins.pop(game_id, None)
+
+    def note_write(self, nbytes: int) -> None:
+        """新写入的字节数：估计占用超出预算时提前唤醒后台压缩"""
+        self._ensure_started()
+        with self._lock:
+            self._estimated_bytes += nbytes
+            over = self._estimated_bytes > self.config["max_bytes"]
+        if over:
+            self._wake.set()
+
+    # ---------- 后台压缩 ----------
+
+    def _ensure_started(self) -> None:
+        if self._started_pid != os.getpid():
+            self.start()
+
+    def start(self) -> None:
+        """在当前进程中启动后台压缩线程（每个进程只启动一次）"""
+        if not self.config["enabled"]:
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        threading.Thread(target=self._loop, name="image-storage-compactor", daemon=True).start()
+        print(f"🧹 图片存储空间管理已启动：上限 {self.config['max_bytes'] // (1024 * 1024)}MB")
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"⚠️ 图片存储压缩失败：{e}")
+            self._wake.wait(max(1.0, self.config["compact_interval_seconds"]))
+            self._wake.clear()
+
+    def _saved_refs(self) -> Tuple[Set[str], Set[str]]:
+        """存档中引用的图片文件名与游戏 ID"""
+        blobs, games = set(), set()
+        if not self.config["protect_saves"] or not os.path.isdir(self.save_dir):
+            return blobs, games
+        for entry in os.scandir(self.save_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    text = f.read()
+            except OSError:
+                continue
+            blobs.update(_SAVE_IMAGE_REF.findall(text))
+            for from_path, from_field in _SAVE_GAME_REF.findall(text):
+                games.add(from_path or from_field)
+        return blobs, games
+
+    @staticmethod
+    def _last_access(st: os.stat_result, recorded: Optional[float]) -> float:
+        return max(st.st_atime, st.st_mtime, recorded or 0.0)
+
+    def _collect(self, now: float) -> List[Dict]:
+        """扫描两个目录，返回淘汰候选单元 [{"kind", "name", "path", "bytes", "last_access"}]"""
+        with self._lock:
+            access = dict(self._access)
+        units = []
+        variant_sizes = self._variant_sizes()
+        if self.cache_root.is_dir():
+            for entry in os.scandir(self.cache_root):
+                if not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(".tmp"):
+                    if now - st.st_mtime > _STALE_TMP_SECONDS:
+                        self._remove_file(entry.path)
+                    continue
+                if entry.name.rsplit(".", 1)[-1].lower() not in IMAGE_MIME_TYPES:
+                    continue
+                recorded = access.get(("blob", entry.name))
+                if recorded and recorded > st.st_atime:
+                    try:
+                        os.utime(entry.path, (recorded, st.st_mtime))  # 访问时间写回 atime，重启后仍有效
+                    except OSError:
+                        pass
+                stem = entry.name.rsplit(".", 1)[0]
+                units.append({"kind": "blob", "name": entry.name, "path": entry.path,
+                              "bytes": st.st_size + variant_sizes.pop(stem, 0),
+                              "last_access": self._last_access(st, recorded)})
+        # 原图已不存在的变体目录
+        for stem in variant_sizes:
+            shutil.rmtree(self.cache_root / VARIANTS_DIRNAME / stem, ignore_errors=True)
+        if self.main_character_root.is_dir():
+            for game_dir in os.scandir(self.main_character_root):
+                if not game_dir.is_dir():
+                    continue
+                recorded = access.get(("game", game_dir.name))
+                size, last = 0, recorded or 0.0
+                for root, _, files in os.walk(game_dir.path):
+                    for file in files:
+                        path = os.path.join(root, file)
+                        try:
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        if recorded and recorded > st.st_atime:
+                            try:
+                                os.utime(path, (recorded, st.st_mtime))
+                            except OSError:
+                                pass
+                        size += st.st_size
+                        last = self._last_access(st, last)
+                units.append({"kind": "game", "name": game_dir.name, "path": game_dir.path,
+                              "bytes": size, "last_access": last})
+        # 已不存在的条目不再跟踪访问时间（防止记录无限增长）
+        present = {(unit["kind"], unit["name"]) for unit in units}
+        with self._lock:
+            for key in [key for key in self._access if key not in present]:
+                del self._access[key]
+        return units
+
+    def _variant_sizes(self) -> Dict[str, int]:
+        """image_cache/variants/<原图名> -> 变体总字节数"""
+        sizes = {}
+        variants_root = self.cache_root / VARIANTS_DIRNAME
+        if not variants_root.is_dir():
+            return sizes
+        for variant_dir in os.scandir(variants_root):
+            if not variant_dir.is_dir():
+                continue
+            total = 0
+            for entry in os.scandir(variant_dir.path):
+                try:
+                    total += entry.stat().st_size
+                except OSError:
+                    continue
+            sizes[variant_dir.name] = total
+        return sizes
+
+    def compact(self) -> Dict:
+        """执行一次压缩：淘汰过期条目，超出预算时按 LRU 淘汰，并清理失效索引"""
+        cfg = self.config
+        started = time.time()
+        now = started
+        with self._lock:
+            self._pins = {game_id: until for game_id, until in self._pins.items() if until > now}
+            pinned_games = set(self._pins)
+        saved_blobs, saved_games = self._saved_refs()
+        pinned_games |= saved_games
+
+        units = self._collect(now)
+        total = sum(unit["bytes"] for unit in units)
+        evictable = [unit for unit in units
+                     if not (unit["kind"] == "game" and unit["name"] in pinned_games)
+                     and not (unit["kind"] == "blob" and unit["name"] in saved_blobs)]
+        evictable.sort(key=lambda unit: unit["last_access"])
+
+        victims, expired = [], 0
+        if cfg["max_age_seconds"]:
+            for unit in evictable:
+                if now - unit["last_access"] > cfg["max_age_seconds"]:
+                    victims.append(unit)
+                    expired += 1
+        remaining = total - sum(unit["bytes"] for unit in victims)
+        if remaining > cfg["max_bytes"]:
+            target = cfg["max_bytes"] * cfg["target_ratio"]
+            chosen = {id(unit) for unit in victims}
+            for unit in evictable:
+                if remaining <= target:
+                    break
+                if id(unit) in chosen:
+                    continue
+                victims.append(unit)
+                remaining -= unit["bytes"]
+
+        freed = 0
+        for unit in victims:
+            if unit["kind"] == "game":
+                shutil.rmtree(unit["path"], ignore_errors=True)
+            else:
+                self._remove_file(unit["path"])
+                shutil.rmtree(self.cache_root / VARIANTS_DIRNAME / unit["name"].rsplit(".", 1)[0], ignore_errors=True)
+            freed += unit["bytes"]
+        with self._lock:
+            for unit in victims:
+                self._access.pop((unit["kind"], unit["name"]), None)
+            self._estimated_bytes = total - freed
+        stale = self._prune_index(now) if any(unit["kind"] == "blob" for unit in victims) else 0
+
+        duration_ms = round((time.time() - started) * 1000, 1)
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["evicted_files"] += sum(1 for unit in victims if unit["kind"] == "blob")
+            self._stats["evicted_games"] += sum(1 for unit in victims if unit["kind"] == "game")
+            self._stats["evicted_bytes"] += freed
+            self._stats["expired"] += expired
+            self._stats["stale_index_entries"] += stale
+            self._stats["last_run"] = started
+            self._stats["last_duration_ms"] = duration_ms
+        if victims:
+            print(f"🧹 图片存储压缩：淘汰 {len(victims)} 项，释放 {freed / (1024 * 1024):.1f}MB，"
+                  f"当前 {(total - freed) / (1024 * 1024):.1f}MB（{duration_ms}ms）")
+        return {"total_bytes": total - freed, "evicted": len(victims), "freed_bytes": freed}
+
+    def _prune_index(self, now: float) -> int:
+        """删除指向已不存在图片的请求键索引与残留临时文件"""
+        removed = 0
+        index_dir = image_store.index_dir
+        if not index_dir.is_dir():
+            return 0
+        for shard in os.scandir(index_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    try:
+                        if now - entry.stat().st_mtime > _STALE_TMP_SECONDS:
+                            self._remove_file(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                if not entry.name.endswith(".json"):
+                    continue
+                record = image_store.read_index(entry.name[:-5])
+                if record is None or not image_store.resolve(record.get("blob", "")):
+                    self._remove_file(entry.path)
+                    removed += 1
+        return removed
+
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(
+                enabled=self.config["enabled"],
+                max_bytes=self.config["max_bytes"],
+                estimated_bytes=self._estimated_bytes,
+                pinned_games=len(self._pins),
+                tracked_accesses=len(self._access),
+            )
+        return stats
+
+
+storage_manager = StorageManager(STORAGE_CONFIG, image_store.root, MAIN_CHARACTER_ROOT, SAVE_DIR)
+image_store.add_write_listener(lambda path, nbytes: storage_manager.note_write(nbytes))
+
+
+def get_storage_stats() -> Dict:
+    return storage_manager.stats()
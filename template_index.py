@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+世界观模板相似度索引：启动时加载一次模板库，之后按文件变化增量刷新，
+每次请求只做一次内存中的向量打分，不再逐个读取模板文件。
+
+- 每个模板拆成若干"文档"：每个关键词各一个，描述（description / name / 世界观风格与基础设定）一个；
+- 文档与查询都表示为字符 n-gram（默认 2~3 字）的 TF-IDF 向量（L2 归一化），相似度为余弦；
+- 关键词完整出现在玩家输入中时相似度记为 1.0（与原先的子串匹配行为一致）；
+- 模板得分取其所有文档得分的最大值，由调用方与 template_similarity_threshold 比较；
+- 刷新：距上次检查超过 refresh_seconds 时比对目录中文件的 mtime / size，有变化才重建索引。
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# ------------------------------
+# 模板索引配置（可通过环境变量调节）
+# ------------------------------
+TEMPLATE_INDEX_CONFIG = {
+    # 字符 n-gram 长度范围
+    "ngram_min": int(os.getenv("TEMPLATE_INDEX_NGRAM_MIN", "2")),
+    "ngram_max": int(os.getenv("TEMPLATE_INDEX_NGRAM_MAX", "3")),
+    # 多久检查一次模板目录是否有变化（秒）
+    "refresh_seconds": float(os.getenv("TEMPLATE_INDEX_REFRESH_SECONDS", "30")),
+}
+
+
+def _normalize(text: str) -> str:
+    return "".join(str(text).lower().split())
+
+
+def _ngrams(text: str, ngram_min: int, ngram_max: int) -> Counter:
+    text = _normalize(text)
+    grams = Counter()
+    if 0 < len(text) < ngram_min:
+        grams[text] += 1  # 单字输入也能参与匹配
+    for n in range(ngram_min, ngram_max + 1):
+        for i in range(len(text) - n + 1):
+            grams[text[i:i + n]] += 1
+    return grams
+
+
+def _describe(tpl: Dict) -> str:
+    """模板的描述文本：description / name + 世界观风格与基础设定"""
+    worldview = tpl.get("worldview", tpl)
+    core = worldview.get("core_worldview", {}) if isinstance(worldview, dict) else {}
+    parts = [tpl.get("description", ""), tpl.get("name", ""),
+             core.get("game_style", ""), core.get("world_basic_setting", "")]
+    return " ".join(str(part) for part in parts if part)
+
+
+class TemplateIndex:
+    """模板库的内存 TF-IDF 索引"""
+
+    def __init__(self, template_dir: str, config: Dict):
+        self.template_dir = template_dir
+        self.config = config
+        self._lock = threading.Lock()
+        self._signature: Optional[Dict[str, Tuple[float, int]]] = None
+        self._checked_at = 0.0
+        self._templates: List[Dict] = []  # [{"file", "worldview", "keywords"}]
+        self._postings: Dict[str, List[Tuple[int, float]]] = {}  # ngram -> [(doc_id, weight)]
+        self._doc_owner: List[int] = []  # doc_id -> 模板下标
+        self._idf: Dict[str, float] = {}
+        self._default_idf = 1.0
+        self._stats = {"builds": 0, "queries": 0}
+
+    def _scan(self) -> Dict[str, Tuple[float, int]]:
+        signature = {}
+        for root, _, files in os.walk(self.template_dir):
+            for file in files:
+                if not file.endswith(".json"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                signature[path] = (st.st_mtime, st.st_size)
+        return signature
+
+    def refresh(self, force: bool = False) -> None:
+        """模板目录有变化时重建索引（未到检查间隔且非强制时直接返回）"""
+        now = time.time()
+        if not force and self._signature is not None and now - self._checked_at < self.config["refresh_seconds"]:
+            return
+        with self._lock:
+            if not force and self._signature is not None and now - self._checked_at < self.config["refresh_seconds"]:
+                return
+            self._checked_at = now
+            signature = self._scan()
+            if signature == self._signature:
+                return
+            self._build(signature)
+
+    def _build(self, signature: Dict[str, Tuple[float, int]]) -> None:
+        # 调用方需持有 self._lock
+        cfg = self.config
+        templates, docs, owners = [], [], []
+        for path in sorted(signature):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    tpl = json.load(f)
+            except Exception as e:
+                print(f"⚠️ 读取模板失败 {path}：{e}")
+                continue
+            if not isinstance(tpl, dict):
+                continue
+            keywords = [str(k) for k in tpl.get("keywords", []) if str(k).strip()]
+            template_id = len(templates)
+            templates.append({"file": os.path.basename(path), "worldview": tpl.get("worldview", tpl),
+                              "keywords": [_normalize(k) for k in keywords]})
+            for text in keywords + [_describe(tpl)]:
+                grams = _ngrams(text, cfg["ngram_min"], cfg["ngram_max"])
+                if grams:
+                    docs.append(grams)
+                    owners.append(template_id)
+
+        doc_freq = Counter()
+        for grams in docs:
+            doc_freq.update(grams.keys())
+        total = len(docs)
+        idf = {gram: math.log((1 + total) / (1 + df)) + 1.0 for gram, df in doc_freq.items()}
+        postings = defaultdict(list)
+        for doc_id, grams in enumerate(docs):
+            weights = {gram: tf * idf[gram] for gram, tf in grams.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for gram, w in weights.items():
+                postings[gram].append((doc_id, w / norm))
+
+        self._templates = templates
+        self._postings = dict(postings)
+        self._doc_owner = owners
+        self._idf = idf
+        # 模板库中没出现过的 n-gram 按"只出现在 0 篇文档"计算 idf（只影响查询向量的归一化）
+        self._default_idf = math.log(1 + total) + 1.0
+        self._signature = signature
+        self._stats["builds"] += 1
+        print(f"📚 世界观模板索引已重建：{len(templates)} 个模板，{total} 个文档")
+
+    def best_match(self, user_idea: str) -> Optional[Tuple[Dict, float, str]]:
+        """返回 (模板世界观, 相似度, 文件名)；模板库为空或没有任何重合时返回 None"""
+        self.refresh()
+        cfg = self.config
+        with self._lock:
+            templates, postings, owners = self._templates, self._postings, self._doc_owner
+            idf, default_idf = self._idf, self._default_idf
+            self._stats["queries"] += 1
+        if not templates:
+            return None
+        idea = _normalize(user_idea)
+        scores = [0.0] * len(templates)
+        # 关键词完整出现在输入中：视为完全匹配
+        for template_id, tpl in enumerate(templates):
+            if any(keyword and keyword in idea for keyword in tpl["keywords"]):
+                scores[template_id] = 1.0
+        grams = _ngrams(user_idea, cfg["ngram_min"], cfg["ngram_max"])
+        weights = {gram: tf * idf.get(gram, default_idf) for gram, tf in grams.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        doc_scores = defaultdict(float)
+        for gram, w in weights.items():
+            for doc_id, doc_w in postings.get(gram, ()):
+                doc_scores[doc_id] += w / norm * doc_w
+        for doc_id, score in doc_scores.items():
+            template_id = owners[doc_id]
+            scores[template_id] = max(scores[template_id], min(1.0, score))
+        best = max(range(len(templates)), key=lambda i: scores[i])
+        if scores[best] <= 0:
+            return None
+        return templates[best]["worldview"], scores[best], templates[best]["file"]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(templates=len(self._templates), documents=len(self._doc_owner))
+        return stats
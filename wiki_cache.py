@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Wikipedia 请求的磁盘缓存与离线模式：世界观/主角形象生成不再每次串行等待 Wikipedia 往返。
+
+- 按 URL + 参数缓存成功的响应（每条一个 JSON 文件，按键前两位分目录，原子写入），重启后仍有效、多进程共享；
+- 否定结果也缓存：空的搜索结果、不存在的条目（404）使用较短的 negative_ttl_seconds；
+- 网络错误、超时、5xx 不缓存（下次仍会重试）；
+- 离线模式（WIKI_OFFLINE_MODE=true）：只读 fixture 目录与本地缓存（忽略过期时间），从不访问网络，
+  未命中按"无结果"处理；fixture 目录与缓存目录格式相同，联网运行一段时间后直接拷贝 wiki_cache 即可。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# ------------------------------
+# Wikipedia 缓存配置（可通过环境变量调节）
+# ------------------------------
+WIKI_CACHE_CONFIG = {
+    "enabled": os.getenv("WIKI_CACHE_ENABLED", "true").lower() == "true",
+    "dir": os.getenv("WIKI_CACHE_DIR", "wiki_cache"),
+    # 有结果的响应保留多久（秒），默认 7 天
+    "ttl_seconds": float(os.getenv("WIKI_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    # 否定结果（无搜索结果 / 条目不存在）保留多久（秒），默认 1 天
+    "negative_ttl_seconds": float(os.getenv("WIKI_CACHE_NEGATIVE_TTL_SECONDS", str(24 * 3600))),
+    # 离线模式：只读 fixture 与本地缓存，从不访问网络
+    "offline": os.getenv("WIKI_OFFLINE_MODE", "false").lower() == "true",
+    "fixture_dir": os.getenv("WIKI_FIXTURE_DIR", "wiki_fixtures"),
+}
+
+
+def request_key(url: str, params: Optional[Dict] = None) -> str:
+    raw = json.dumps({"url": url, "params": params or {}}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class WikiCache:
+    """Wikipedia 响应的磁盘缓存（含否定结果）"""
+
+    def __init__(self, config: Dict):
+        self.config = config
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "writes": 0, "fetch_errors": 0, "offline_misses": 0}
+
+    def _bump(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    @staticmethod
+    def _path(base_dir: str, key: str) -> str:
+        return os.path.join(base_dir, key[:2], f"{key}.json")
+
+    @staticmethod
+    def _read(path: str) -> Optional[Dict]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return record if isinstance(record, dict) and "data" in record else None
+
+    def _fresh(self, record: Dict, now: float) -> bool:
+        ttl = self.config["negative_ttl_seconds"] if record.get("negative") else self.config["ttl_seconds"]
+        return not ttl or now - record.get("created", 0) <= ttl
+
+    def _write(self, key: str, url: str, params: Optional[Dict], data: Dict, negative: bool) -> None:
+        path = self._path(self.config["dir"], key)
+        # 记录请求本身，方便人工查看 / 编写 fixture
+        record = {"created": time.time(), "url": url, "params": params or {}, "negative": negative, "data": data}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(record, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except Exception as e:
+            print(f"⚠️ Wikipedia 缓存写入失败：{str(e)[:100]}")
+            return
+        self._bump("writes")
+
+    def fetch(self, url: str, params: Optional[Dict], fetcher: Callable[[], Tuple[Optional[Dict], bool]]) -> Dict:
+        """
+        返回响应 JSON（失败 / 无结果返回 {}）。
+        fetcher() 负责真正的网络请求，返回 (data, negative)：data 为 None 表示请求失败（不缓存），
+        negative=True 表示请求成功但没有结果（按否定结果缓存）。
+        """
+        cfg = self.config
+        key = request_key(url, params)
+        now = time.time()
+        if cfg["offline"]:
+            for base_dir in (cfg["fixture_dir"], cfg["dir"]):
+                record = self._read(self._path(base_dir, key))
+                if record is not None:
+                    self._bump("negative_hits" if record.get("negative") else "hits")
+                    return record["data"] or {}
+            self._bump("offline_misses")
+            return {}
+        if cfg["enabled"]:
+            record = self._read(self._path(cfg["dir"], key))
+            if record is not None and self._fresh(record, now):
+                self._bump("negative_hits" if record.get("negative") else "hits")
+                return record["data"] or {}
+            self._bump("misses")
+        data, negative = fetcher()
+        if data is None:
+            self._bump("fetch_errors")
+            return {}
+        if cfg["enabled"]:
+            self._write(key, url, params, data, negative)
+        return data
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(enabled=self.config["enabled"], offline=self.config["offline"])
+        return stats
+
+
+wiki_cache = WikiCache(WIKI_CACHE_CONFIG)
+
+
+def get_wiki_cache_stats() -> Dict:
+    return wiki_cache.stats()
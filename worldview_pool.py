@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+世界观预热池：为配置的 / 热门的（主题, 基调, 难度, 主角属性）组合提前生成好世界观与初始场景文本，
+玩家开局时直接取用，省去开局阶段最慢的两次 LLM 调用。
+
+- 组合来源：WORLDVIEW_POOL_COMBOS 显式配置（主角属性使用 base_attr）+ 近期请求次数最多的 popular_top_n 个组合；
+- 主角属性与难度会写进世界观与初始场景文本，因此都属于组合的一部分，只把条目交给属性完全相同的玩家；
+- 每个组合保持 size 个就绪条目，被取走后自动补充；补充任务以最低优先级（第二层推测）
+  提交到 generation_scheduler，同时在途的补充任务不超过 refill_concurrency 个；
+- 兜底的默认世界观 / 默认剧情不入池，条目超过 max_age_seconds 后丢弃；
+- 命中率等指标通过 get_worldview_pool_stats() 导出（/runtime-stats）。
+"""
+import copy
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, List, Optional, Tuple
+
+from main2 import (
+    llm_generate_global,
+    _generate_single_option_text_only,
+    _default_option_text_data,
+)
+from generation_scheduler import generation_scheduler, PRIORITY_LAYER2_SPECULATIVE
+
+_DEFAULT_BASE_ATTR = {"颜值": "中", "智商": "中", "体力": "中", "魅力": "中"}
+
+
+def _parse_combos(raw: str) -> List[Tuple[str, str, str]]:
+    """解析 "主题|基调|难度;主题|基调|难度"，基调与难度可省略（主角属性由 base_attr 决定）"""
+    combos = []
+    for item in raw.split(";"):
+        parts = [part.strip() for part in item.split("|")]
+        if not parts or not parts[0]:
+            continue
+        theme = parts[0]
+        tone_key = parts[1] if len(parts) > 1 and parts[1] else "normal_ending"
+        difficulty = parts[2] if len(parts) > 2 and parts[2] else "中等"
+        combos.append((theme, tone_key, difficulty))
+    return combos
+
+
+def _attr_key(protagonist_attr: Dict) -> str:
+    """主角属性的规范化表示（键排序的 JSON），作为组合的一部分"""
+    return json.dumps(protagonist_attr or {}, ensure_ascii=False, sort_keys=True)
+
+
+def _parse_base_attr(raw: str) -> Dict:
+    if not raw:
+        return dict(_DEFAULT_BASE_ATTR)
+    try:
+        attr = json.loads(raw)
+        if isinstance(attr, dict):
+            return attr
+    except ValueError:
+        pass
+    print("⚠️ WORLDVIEW_POOL_BASE_ATTR 不是合法的 JSON 对象，使用默认中性属性")
+    return dict(_DEFAULT_BASE_ATTR)
+
+
+# ------------------------------
+# 世界观预热池配置（可通过环境变量调节，默认关闭：预热会持续消耗 token）
+# ------------------------------
+WORLDVIEW_POOL_CONFIG = {
+    "enabled": os.getenv("WORLDVIEW_POOL_ENABLED", "false").lower() == "true",
+    # 显式预热的组合，如 "修仙|normal_ending|中等;赛博朋克|bad_ending|困难"
+    "combos": _parse_combos(os.getenv("WORLDVIEW_POOL_COMBOS", "")),
+    # 每个组合保持多少个就绪条目
+    "size": int(os.getenv("WORLDVIEW_POOL_SIZE", "2")),
+    # 同时在途的补充任务上限
+    "refill_concurrency": int(os.getenv("WORLDVIEW_POOL_REFILL_CONCURRENCY", "1")),
+    # 额外预热请求次数最多的前 N 个组合（请求次数至少 popular_min_requests）
+    "popular_top_n": int(os.getenv("WORLDVIEW_POOL_POPULAR_TOP_N", "3")),
+    "popular_min_requests": int(os.getenv("WORLDVIEW_POOL_POPULAR_MIN_REQUESTS", "3")),
+    # 条目最长保留时间（秒），0 表示不过期
+    "max_age_seconds": float(os.getenv("WORLDVIEW_POOL_MAX_AGE_SECONDS", str(24 * 3600))),
+    # 后台巡检间隔（清理过期条目并补充）
+    "check_interval_seconds": float(os.getenv("WORLDVIEW_POOL_CHECK_INTERVAL_SECONDS", "60")),
+    # 显式配置的组合使用的主角属性（JSON）
+    "base_attr": _parse_base_attr(os.getenv("WORLDVIEW_POOL_BASE_ATTR", "")),
+}
+
+# 请求计数最多跟踪多少个组合（超过后只保留计数最高的一半）
+_MAX_TRACKED_COMBOS = 1000
+
+
+def _combo_key(theme: str, tone_key: str, difficulty: str, protagonist_attr: Dict) -> Tuple[str, str, str, str]:
+    return ((theme or "").strip(), tone_key or "normal_ending", difficulty or "中等", _attr_key(protagonist_attr))
+
+
+def _combo_label(combo: Tuple[str, ...]) -> str:
+    return "|".join(combo)
+
+
+class WorldviewPool:
+    """按（主题, 基调, 难度, 主角属性）组合维护的就绪世界观池"""
+
+    def __init__(self, config: Dict):
+        self.config = config
+        self._lock = threading.Lock()
+        self._pools: Dict[Tuple[str, str, str, str], deque] = {}  # combo -> deque[{"created", "worldview", "initial"}]
+        self._requests: Counter = Counter()
+        self._inflight: Counter = Counter()
+        self._started = False
+        self._stats = {"requests": 0, "hits": 0, "misses": 0, "generated": 0, "failed": 0, "expired": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config["enabled"]
+
+    def start(self) -> None:
+        """启动后台巡检线程（幂等）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._warm_loop, name="worldview-pool", daemon=True).start()
+        print(f"🔥 世界观预热池已启动：每个组合 {self.config['size']} 个，补充并发 {self.config['refill_concurrency']}")
+
+    def take(self, theme: str, tone_key: str, difficulty: str, protagonist_attr: Dict) -> Optional[Dict]:
+        """取出一个就绪条目（{"worldview", "initial"}，initial 可能为 None）；未命中返回 None"""
+        if not self.enabled:
+            return None
+        self.start()
+        combo = _combo_key(theme, tone_key, difficulty, protagonist_attr)
+        now = time.time()
+        entry = None
+        with self._lock:
+            self._stats["requests"] += 1
+            self._requests[combo] += 1
+            if len(self._requests) > _MAX_TRACKED_COMBOS:
+                self._requests = Counter(dict(self._requests.most_common(_MAX_TRACKED_COMBOS // 2)))
+            pool = self._pools.get(combo)
+            while pool:
+                candidate = pool.popleft()
+                if self._expired(candidate, now):
+                    self._stats["expired"] += 1
+                    continue
+                entry = candidate
+                break
+            self._stats["hits" if entry else "misses"] += 1
+        self._schedule_refill()
+        if entry is None:
+            return None
+        print(f"🔥 世界观预热池命中：{_combo_label(combo)}（已就绪 {time.time() - entry['created']:.0f}s）")
+        return {"worldview": copy.deepcopy(entry["worldview"]), "initial": copy.deepcopy(entry["initial"])}
+
+    def _expired(self, entry: Dict, now: float) -> bool:
+        max_age = self.config["max_age_seconds"]
+        return bool(max_age) and now - entry["created"] > max_age
+
+    def _targets(self) -> List[Tuple[str, str, str, str]]:
+        # 调用方需持有 self._lock
+        cfg = self.config
+        base_attr = _attr_key(cfg["base_attr"])
+        targets = [combo + (base_attr,) for combo in cfg["combos"]]
+        if cfg["popular_top_n"] > 0:
+            for combo, count in self._requests.most_common(cfg["popular_top_n"]):
+                if count >= cfg["popular_min_requests"] and combo not in targets:
+                    targets.append(combo)
+        return targets
+
+    def _purge_expired(self) -> None:
+        now = time.time()
+        with self._lock:
+            for pool in self._pools.values():
+                fresh = [entry for entry in pool if not self._expired(entry, now)]
+                self._stats["expired"] += len(pool) - len(fresh)
+                pool.clear()
+                pool.extend(fresh)
+
+    def _schedule_refill(self) -> None:
+        """为缺额的组合提交补充任务（总在途数不超过 refill_concurrency）"""
+        cfg = self.config
+        jobs = []
+        with self._lock:
+            budget = cfg["refill_concurrency"] - sum(self._inflight.values())
+            for combo in self._targets():
+                while budget > 0 and len(self._pools.get(combo, ())) + self._inflight[combo] < cfg["size"]:
+                    self._inflight[combo] += 1
+                    budget -= 1
+                    jobs.append(combo)
+        # 在锁外提交：future 若已完成，done 回调会在当前线程立即执行并再次获取锁
+        for combo in jobs:
+            try:
+                future = generation_scheduler.submit(
+                    self._fill, combo,
+                    priority=PRIORITY_LAYER2_SPECULATIVE, upstream="llm", tag={"pool": _combo_label(combo)}
+                )
+            except Exception as e:
+                print(f"⚠️ 提交世界观预热任务失败（{_combo_label(combo)}）：{e}")
+                self._on_done(combo, None)
+                continue
+            future.add_done_callback(lambda f, combo=combo: self._on_done(combo, f))
+
+    def _on_done(self, combo: Tuple[str, str, str, str], future) -> None:
+        failed = future is None or future.cancelled() or future.exception() is not None or not future.result()
+        with self._lock:
+            self._inflight[combo] -= 1
+            if self._inflight[combo] <= 0:
+                del self._inflight[combo]
+            if failed:
+                self._stats["failed"] += 1
+        if not failed:
+            # 失败时不立即重试，等下一次取用或巡检，避免上游故障时空转消耗 token
+            self._schedule_refill()
+
+    def _fill(self, combo: Tuple[str, str, str, str]) -> bool:
+        """生成一个世界观 + 初始场景文本并入池；生成失败（得到兜底内容）返回 False"""
+        theme, tone_key, difficulty, attr_key = combo
+        label = _combo_label(combo)
+        print(f"🔥 [世界观预热] 正在生成：{label}")
+        try:
+            # fresh=True：每个条目都是新的变体，不从世界观缓存里复制同一个
+            worldview = llm_generate_global(theme, json.loads(attr_key), difficulty, tone_key,
+                                            force_full=True, fresh=True)
+            if not worldview or worldview.get("meta", {}).get("is_default"):
+                print(f"⚠️ [世界观预热] {label} 世界观生成失败，不入池")
+                return False
+            worldview["user_theme"] = theme
+            initial = None
+            result = _generate_single_option_text_only(0, "开始游戏", worldview)
+            data = result.get("data") if isinstance(result, dict) else None
+            if data and data.get("scene") != _default_option_text_data("开始游戏")["scene"]:
+                initial = {"data": data, "scene_for_image": result.get("scene_for_image") or data.get("scene", "")}
+            else:
+                print(f"⚠️ [世界观预热] {label} 初始场景生成失败，仅缓存世界观")
+        except Exception as e:
+            print(f"⚠️ [世界观预热] {label} 生成出错：{e}")
+            return False
+        with self._lock:
+            self._pools.setdefault(combo, deque()).append({"created": time.time(), "worldview": worldview, "initial": initial})
+            self._stats["generated"] += 1
+            ready = len(self._pools[combo])
+        print(f"✅ [世界观预热] {label} 入池（就绪 {ready} 个）")
+        return True
+
+    def _warm_loop(self) -> None:
+        while True:
+            try:
+                self._purge_expired()
+                self._schedule_refill()
+            except Exception as e:
+                print(f"⚠️ 世界观预热池巡检失败：{e}")
+            time.sleep(max(1.0, self.config["check_interval_seconds"]))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            targets = self._targets()
+            stats["pools"] = {
+                _combo_label(combo): {
+                    "ready": len(self._pools.get(combo, ())),
+                    "refilling": self._inflight[combo],
+                    "requests": self._requests[combo],
+                }
+                for combo in set(targets) | set(self._pools.keys())
+            }
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        stats.update(enabled=self.enabled, size=self.config["size"], refill_concurrency=self.config["refill_concurrency"])
+        return stats
+
+
+worldview_pool = WorldviewPool(WORLDVIEW_POOL_CONFIG)
+
+
+def get_worldview_pool_stats() -> Dict:
+    return worldview_pool.stats()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+世界观缓存：相同 主题 + 主角属性 + 难度 + 基调 的世界观直接复用，省去一次完整的世界观 LLM 调用。
+
+- 两层：进程内 LRU（memory_entries 条）在前，磁盘 worldview_cache/<key>.json 在后；
+- 每条带创建时间，超过 ttl_seconds 视为过期（读取时删除）；
+- 磁盘条目数超过 max_entries 时按最近访问时间（文件 mtime，命中时刷新）淘汰；
+- 写入先写临时文件再 os.replace，读到一半的文件不会被当作有效缓存；
+- 兼容旧格式（直接保存的 global_state，无元数据），以文件 mtime 作为创建时间。
+"""
+import copy
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# ------------------------------
+# 世界观缓存配置（可通过环境变量调节）
+# ------------------------------
+WORLDVIEW_CACHE_CONFIG = {
+    "enabled": os.getenv("WORLDVIEW_CACHE_ENABLED", "true").lower() == "true",
+    "dir": os.getenv("WORLDVIEW_CACHE_DIR", "worldview_cache"),
+    # 条目有效期（秒），默认 7 天，0 表示不过期
+    "ttl_seconds": float(os.getenv("WORLDVIEW_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    # 磁盘最多保留多少条
+    "max_entries": int(os.getenv("WORLDVIEW_CACHE_MAX_ENTRIES", "200")),
+    # 进程内 LRU 前置层条数
+    "memory_entries": int(os.getenv("WORLDVIEW_CACHE_MEMORY_ENTRIES", "32")),
+    # 命中后是否在后台重新生成一个变体替换缓存（下一位玩家拿到不同的世界）
+    "refresh_on_hit": os.getenv("WORLDVIEW_CACHE_REFRESH_ON_HIT", "false").lower() == "true",
+}
+
+
+class WorldviewStore:
+    """内存 LRU + 磁盘的两层世界观缓存"""
+
+    def __init__(self, cache_dir: str, ttl_seconds: float, max_entries: int, memory_entries: int):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self.memory_entries = max(0, memory_entries)
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Dict]" = OrderedDict()  # key -> {"created", "worldview"}
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "writes": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _expired(self, record: Dict, now: float) -> bool:
+        return bool(self.ttl_seconds) and now - record.get("created", 0) > self.ttl_seconds
+
+    def _remember(self, key: str, record: Dict) -> None:
+        # 调用方需持有 self._lock
+        if not self.memory_entries:
+            return
+        self._memory[key] = record
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            created = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 读取世界观缓存失败：{e}")
+            return None
+        if isinstance(data, dict) and "worldview" in data and "created" in data:
+            return data
+        # 旧格式：文件内容就是世界观本身
+        return {"created": created, "worldview": data}
+
+    def get(self, key: str) -> Optional[Dict]:
+        """命中返回世界观的深拷贝（调用方可随意修改），未命中或已过期返回 None"""
+        now = time.time()
+        with self._lock:
+            record = self._memory.get(key)
+            if record is not None:
+                if self._expired(record, now):
+                    self._memory.pop(key, None)
+                    record = None
+                else:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return copy.deepcopy(record["worldview"])
+        record = self._read_disk(key)
+        if record is None:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        if self._expired(record, now):
+            self.delete(key)
+            with self._lock:
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+            return None
+        try:
+            os.utime(self._path(key), None)  # 刷新访问时间（LRU 淘汰依据）
+        except OSError:
+            pass
+        with self._lock:
+            self._remember(key, record)
+            self._stats["disk_hits"] += 1
+        return copy.deepcopy(record["worldview"])
+
+    def put(self, key: str, worldview: Dict) -> None:
+        record = {"created": time.time(), "worldview": copy.deepcopy(worldview)}
+        path = self._path(key)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(record, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except Exception as e:
+            print(f"⚠️ 保存世界观缓存失败：{e}")
+            return
+        with self._lock:
+            self._remember(key, record)
+            self._stats["writes"] += 1
+        self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._memory.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """磁盘条目超过上限时删除最久未访问的条目"""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json")]
+        except OSError:
+            return
+        overflow = len(entries) - self.max_entries
+        if overflow <= 0:
+            return
+        def mtime(entry):
+            try:
+                return entry.stat().st_mtime
+            except OSError:
+                return 0.0
+        for entry in sorted(entries, key=mtime)[:overflow]:
+            self.delete(entry.name[:-5])
+            with self._lock:
+                self._stats["evictions"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        try:
+            stats["disk_entries"] = sum(1 for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json"))
+        except OSError:
+            stats["disk_entries"] = 0
+        return stats
+
+
+worldview_store = WorldviewStore(
+    WORLDVIEW_CACHE_CONFIG["dir"],
+    WORLDVIEW_CACHE_CONFIG["ttl_seconds"],
+    WORLDVIEW_CACHE_CONFIG["max_entries"],
+    WORLDVIEW_CACHE_CONFIG["memory_entries"],
+)
+
+
+def get_worldview_cache_stats() -> Dict:
+    stats = worldview_store.stats()
+    stats["enabled"] = WORLDVIEW_CACHE_CONFIG["enabled"]
+    return stats